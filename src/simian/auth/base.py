@@ -35,7 +35,9 @@ warnings.filterwarnings(
 
 import array  # (Mute warnings before cause) pylint: disable=g-bad-import-order,g-import-not-at-top
 import base64
+import copy
 import datetime
+import hashlib
 import logging
 import os
 import struct
@@ -61,6 +63,17 @@ LEVEL_APPLESUS = -5
 LEVEL_BASE = 0
 LEVEL_ADMIN = 5
 
+# Max number of entries in the per process caches of parsed certificates and
+# of verified CA signatures.
+CERT_CACHE_SIZE = 1000
+VERIFIED_CERT_CACHE_SIZE = 10000
+
+# Per process cache of parsed x509.X509Certificate objects keyed by the
+# digest of their PEM, and set of (cert fingerprint, CA PEM digest) for which
+# the cert was verified to be signed by the CA.
+_PARSED_CERTS = {}
+_VERIFIED_CERTS = set()
+
 
 class Error(Exception):
   """Base."""
@@ -626,6 +639,9 @@ class Auth1(AuthBase):
   def _LoadCert(self, certstr):
     """Load a certificate and return a cert object.
 
+    Certs are parsed once per process; each call returns a copy, so that
+    callers may set the required issuer on their cert.
+
     Args:
       certstr: str, cert in PEM format
     Returns:
@@ -633,11 +649,17 @@ class Auth1(AuthBase):
     Raises:
       ValueError: if the cert is malformed
     """
-    try:
-      cert = x509.LoadCertificateFromPEM(certstr)
-    except x509.Error, e:
-      raise ValueError(str(e))
-    return cert
+    digest = hashlib.sha256(certstr).digest()
+    cert = _PARSED_CERTS.get(digest)
+    if cert is None:
+      try:
+        cert = x509.LoadCertificateFromPEM(certstr)
+      except x509.Error, e:
+        raise ValueError(str(e))
+      if len(_PARSED_CERTS) >= CERT_CACHE_SIZE:
+        _PARSED_CERTS.clear()
+      _PARSED_CERTS[digest] = cert
+    return copy.copy(cert)
 
   def _LoadKey(self, keystr):
     """Load a key and return a key object.
@@ -710,19 +732,34 @@ class Auth1(AuthBase):
   def VerifyCertSignedByCA(self, cert):
     """Verify that a client cert was signed by the required CA cert.
 
+    Successful verifications are cached per process, so the signature of a
+    cert is only verified once per CA.
+
     Args:
       cert: certificate object, client cert to verify
     Returns:
       True or False
     """
+    verified_key = (
+        hashlib.sha256(cert.GetFieldsData() + cert.GetSignatureData()).digest(),
+        hashlib.sha256(self._ca_pem).digest())
+    if verified_key in _VERIFIED_CERTS:
+      return True
+
     ca_cert = self.LoadOtherCert(self._ca_pem)
     try:
-      return cert.IsSignedBy(ca_cert)
+      signed = cert.IsSignedBy(ca_cert)
     except (x509.Error, AssertionError), e:
       logging.exception(str(e))
       raise CryptoError(
           'VerifyCertSignedByCA: IsSignedBy: %s' % str(e))
 
+    if signed:
+      if len(_VERIFIED_CERTS) >= VERIFIED_CERT_CACHE_SIZE:
+        _VERIFIED_CERTS.clear()
+      _VERIFIED_CERTS.add(verified_key)
+    return signed
+
   def VerifyDataSignedWithCert(self, data, signature, cert=None):
     """Verify that this cert signed this data.
 
@@ -955,11 +992,10 @@ class Auth1(AuthBase):
         client_cert.SetRequiredIssuer(self._required_issuer)
         try:
           client_cert.CheckAll()
+          # obtain uuid from cert
+          uuid = client_cert.GetSubject()
         except x509.Error, e:
           raise _Error('X509 certificate error: %s' % str(e))
-
-        # obtain uuid from cert
-        uuid = client_cert.GetSubject()
         log_prefix = uuid
 
         # client_cert is loaded
@@ -27,10 +27,12 @@ Functions:
   DoMunkiAuth:                  Check Munki client auth credentials.
 """
 
+import collections
 import Cookie
 import datetime
 import logging
 import os
+import threading
 import time
 
 
@@ -61,6 +63,22 @@ ALL_LEVELS = [LEVEL_APPLESUS, LEVEL_BASE, LEVEL_ADMIN, LEVEL_UPLOADPKG]
 # Deadline in seconds for datastore RPC operations
 DATASTORE_RPC_DEADLINE = 5
 
+# Max number of sessions in the per instance session cache.
+SESSION_CACHE_SIZE = 10000
+# Seconds sessions, and unknown session ids, are kept in the session cache.
+SESSION_CACHE_SECS = 30
+SESSION_CACHE_NEGATIVE_SECS = 60
+# Seconds between checks for sessions deleted by other instances.
+SESSION_CACHE_GENERATION_SECS = 5
+# Max number of deleted sessions read per check; the cache is cleared instead
+# when more sessions were deleted.
+SESSION_CACHE_MAX_DELETES = 500
+# Seconds between logs of the session cache stats of each instance.
+SESSION_CACHE_STATS_LOG_SECS = 600
+# Memcache key of the counter incremented on every session delete, and of the
+# session id deleted by each increment.
+SESSION_GENERATION_MEMCACHE_KEY = 'a1sd_generation'
+SESSION_DELETED_MEMCACHE_KEY = 'a1sd_deleted_%d'
 
 
 class Error(Exception):
@@ -75,6 +93,124 @@ class CaParametersError(Error, base.NotAuthenticated):
   """Loading/finding (ca, server certs, keys) error."""
 
 
+class _SessionCache(object):
+  """Bounded per instance LRU cache of sessions, and of unknown session ids.
+
+  A delete on any instance increments a generation counter in memcache and
+  stores the deleted session id under the new generation. Every
+  SESSION_CACHE_GENERATION_SECS each instance reads the ids deleted since the
+  generation it last saw, and caches them as unknown.
+  """
+
+  def __init__(self, max_size=SESSION_CACHE_SIZE):
+    self._max_size = max_size
+    self._sessions = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._generation = None
+    self._generation_time = 0
+    self._stats_log_time = 0
+    self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0}
+
+  def _CheckGeneration(self, now):
+    """Evicts sessions deleted by other instances, at most every few secs."""
+    if now - self._generation_time < SESSION_CACHE_GENERATION_SECS:
+      return
+    self._generation_time = now
+    generation = memcache.get(SESSION_GENERATION_MEMCACHE_KEY) or 0
+    last_generation = self._generation
+    self._generation = generation
+    if last_generation is None or generation == last_generation:
+      return
+
+    generations = range(last_generation + 1, generation + 1)
+    deleted = {}
+    if 0 < len(generations) <= SESSION_CACHE_MAX_DELETES:
+      deleted = memcache.get_multi(
+          [SESSION_DELETED_MEMCACHE_KEY % g for g in generations])
+    with self._lock:
+      if not generations or len(deleted) < len(generations):
+        # the counter was reset or deleted ids were lost, so any may be stale.
+        self._sessions.clear()
+      else:
+        for key in deleted.itervalues():
+          self._Set(key, None, now)
+
+  def _Set(self, key, session, now):
+    """Caches a session, or None for an unknown session id; call with lock."""
+    if session is None:
+      expires = now + SESSION_CACHE_NEGATIVE_SECS
+    else:
+      expires = now + SESSION_CACHE_SECS
+    self._sessions.pop(key, None)
+    self._sessions[key] = (expires, session)
+    while len(self._sessions) > self._max_size:
+      self._sessions.popitem(last=False)
+      self.stats['evictions'] += 1
+
+  def Get(self, key):
+    """Get a session from the cache.
+
+    Args:
+      key: str, session memcache key.
+    Returns:
+      tuple (bool True if cached, session or None if cached as unknown)
+    """
+    now = time.time()
+    self._CheckGeneration(now)
+    if now - self._stats_log_time >= SESSION_CACHE_STATS_LOG_SECS:
+      self._stats_log_time = now
+      logging.info('Session cache stats: %s', GetSessionCacheStats())
+    with self._lock:
+      entry = self._sessions.pop(key, None)
+      if entry is None or entry[0] < now:
+        self.stats['misses'] += 1
+        return False, None
+      self._sessions[key] = entry  # now the most recently used.
+      if entry[1] is None:
+        self.stats['negative_hits'] += 1
+      else:
+        self.stats['hits'] += 1
+      return True, entry[1]
+
+  def Set(self, key, session):
+    """Cache a session.
+
+    Args:
+      key: str, session memcache key.
+      session: session instance, or None if the session id is unknown.
+    """
+    with self._lock:
+      self._Set(key, session, time.time())
+
+  def Delete(self, key):
+    """Cache a session as unknown on all instances.
+
+    Args:
+      key: str, session memcache key.
+    """
+    self.Set(key, None)
+    generation = memcache.incr(SESSION_GENERATION_MEMCACHE_KEY, initial_value=0)
+    if generation is not None:
+      memcache.set(
+          SESSION_DELETED_MEMCACHE_KEY % generation, key,
+          time=SESSION_CACHE_NEGATIVE_SECS * 2)
+
+  def Clear(self):
+    """Clear the cache."""
+    with self._lock:
+      self._sessions.clear()
+      self._generation = None
+      self._generation_time = 0
+
+
+_SESSION_CACHE = _SessionCache()
+
+
+def GetSessionCacheStats():
+  """Returns a dict of hits, negative_hits, misses and evictions counts."""
+  return dict(_SESSION_CACHE.stats)
+
+
 class Auth1ServerDatastoreSession(base.Auth1ServerSession):
   """AuthSession data container which can write to AppEngine datastore."""
 
@@ -175,7 +311,14 @@ class Auth1ServerDatastoreSession(base.Auth1ServerSession):
 
 
 class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
-  """AuthSession data container which uses memcache as a frontend."""
+  """AuthSession data container which uses memcache as a frontend.
+
+  Token sessions are also kept in a per instance cache, _SESSION_CACHE, as are
+  token ids found in neither memcache nor Datastore. Token ids are only
+  written once, before they are handed out, so an unknown token id is never
+  written later. cn sessions are single use, and are never cached per
+  instance, so one deleted on one instance is not accepted by another.
+  """
 
   def __init__(self):
     super(Auth1ServerDatastoreMemcacheSession, self).__init__()
@@ -205,6 +348,10 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     # logging.debug('Deferring %s %s %s', method_name, args, defer_id)
     deferred.defer(method, _name=deferred_name, *args, **kwargs)
 
+  def _IsCachedSession(self, sid):
+    """Returns True if the session id is kept in the per instance cache."""
+    return sid.startswith(self.SESSION_TYPE_PREFIX_TOKEN)
+
   def _Get(self, sid):
     """Get a session instance from storage given its session id.
 
@@ -213,10 +360,18 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     Returns:
       session instance
     """
-    mcv = memcache.get('%s%s' % (self.prefix, sid))
-    if mcv is not None:
-      return mcv
-    return super(Auth1ServerDatastoreMemcacheSession, self)._Get(sid)
+    key = '%s%s' % (self.prefix, sid)
+    cache = self._IsCachedSession(sid)
+    if cache:
+      cached, session = _SESSION_CACHE.Get(key)
+      if cached:
+        return session
+    session = memcache.get(key)
+    if session is None:
+      session = super(Auth1ServerDatastoreMemcacheSession, self)._Get(sid)
+    if cache:
+      _SESSION_CACHE.Set(key, session)
+    return session
 
   def _Put(self, session):
     """Put a session instance into storage.
@@ -224,9 +379,11 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     Args:
       session: db.Model, session instance
     """
-    memcache.set(
-        '%s%s' % (self.prefix, session.key().name()),
-        value=session, time=self.ttl)
+    sid = session.key().name()
+    key = '%s%s' % (self.prefix, sid)
+    memcache.set(key, value=session, time=self.ttl)
+    if self._IsCachedSession(sid):
+      _SESSION_CACHE.Set(key, session)
     self._CallSuperWithDefer('_Put', session)
 
   def DeleteById(self, sid):
@@ -235,7 +392,10 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     Args:
       sid: str, session id
     """
-    memcache.delete('%s%s' % (self.prefix, sid))
+    key = '%s%s' % (self.prefix, sid)
+    memcache.delete(key)
+    if self._IsCachedSession(sid):
+      _SESSION_CACHE.Delete(key)
     # slightly defer with countdown so that back to back _Put(cn, sn)
     # and DeleteById(cn) are more likely to run in the right order.    best
     # effort, the session cleaner cron will destroy anything leftover later
@@ -248,7 +408,11 @@ class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
     Args:
       session: db.Model, session instance
     """
-    memcache.delete('%s%s' % (self.prefix, session.key().name()))
+    sid = session.key().name()
+    key = '%s%s' % (self.prefix, sid)
+    memcache.delete(key)
+    if self._IsCachedSession(sid):
+      _SESSION_CACHE.Delete(key)
     self._CallSuperWithDefer('Delete', session)
 
 
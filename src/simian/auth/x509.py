@@ -36,7 +36,6 @@ import time
 
 
 from pyasn1.codec.der import decoder as der_decoder
-from pyasn1.codec.der import encoder as der_encoder
 import pyasn1.error
 from pyasn1.type import univ
 from pyasn1_modules import rfc2459
@@ -101,6 +100,17 @@ OID_X509V3_SUBJECT_ALT_NAME = (2, 5, 29, 17)
 # Certificate versions that X509Certificate can load
 X509_CERT_VERSION_3 = 0x2
 
+# DER tags of the certificate elements
+DER_TAG_BIT_STRING = 0x03
+DER_TAG_SEQUENCE = 0x30
+DER_TAG_VERSION = 0xa0      # [0] EXPLICIT Version
+DER_TAG_EXTENSIONS = 0xa3   # [3] EXPLICIT Extensions
+
+# Cert fields which are decoded on their first access, by loader groups
+LAZY_SUBJECT_FIELDS = ['subject']
+LAZY_V3_EXTENSION_FIELDS = ['may_act_as_ca', 'key_usage', 'subject_alt_name']
+LAZY_PUBLIC_KEY_FIELDS = ['public_key']
+
 
 # Regex for valid, standard base64 characters. (i.e. not websafe)
 BASE64_RE = re.compile(r'^[0-9A-Za-z/+=]+$')
@@ -164,6 +174,118 @@ class RSAPrivateKeyPEMFormatError(RSAKeyPEMFormatError):
   """RSA Private Key PEM Format Error."""
 
 
+class _LazyDict(dict):
+  """dict which loads the values of some keys on their first access."""
+
+  def __init__(self, *args, **kwargs):
+    super(_LazyDict, self).__init__(*args, **kwargs)
+    self._loaders = {}
+
+  def SetLoader(self, keys, loader):
+    """Set a loader of the values of keys, replacing their current values.
+
+    Args:
+      keys: list of str keys.
+      loader: function returning a dict with the values of some or all of
+        keys, missing keys get None. It is called again after it raises.
+    """
+    for key in keys:
+      self.pop(key, None)
+      self._loaders[key] = (keys, loader)
+
+  def LoadAll(self):
+    """Load the values of all keys which have a loader."""
+    for key in self._loaders.keys():
+      _ = self[key]
+
+  def __missing__(self, key):
+    keys, loader = self._loaders.get(key, (None, None))
+    if loader is None:
+      # another thread may have loaded the key since it was looked up.
+      if key in self:
+        return self.get(key)
+      raise KeyError(key)
+    values = loader()
+    for k in keys:
+      self[k] = values.get(k)
+    for k in keys:
+      self._loaders.pop(k, None)
+    return self.get(key)
+
+
+def _ReadDerElement(data, offset):
+  """Read the tag and length of a DER encoded element.
+
+  Args:
+    data: str, DER encoded data.
+    offset: int, offset of the element in data.
+  Returns:
+    tuple (int tag, int offset of the contents, int offset of the end)
+  Raises:
+    CertificateASN1FormatError: the element is not well formed DER.
+  """
+  if len(data) - offset < 2:
+    raise CertificateASN1FormatError('DER element truncated')
+  tag = ord(data[offset])
+  if tag & 0x1f == 0x1f:
+    raise CertificateASN1FormatError('DER high tag number unsupported')
+  length = ord(data[offset + 1])
+  start = offset + 2
+  if length & 0x80:
+    num_octets = length & 0x7f
+    # zero octets is the BER indefinite length, which DER does not allow.
+    if not num_octets or num_octets > 4:
+      raise CertificateASN1FormatError('DER length encoding')
+    if start + num_octets > len(data):
+      raise CertificateASN1FormatError('DER element truncated')
+    length = 0
+    for c in data[start:start + num_octets]:
+      length = (length << 8) | ord(c)
+    start += num_octets
+  end = start + length
+  if end > len(data):
+    raise CertificateASN1FormatError('DER element truncated')
+  return tag, start, end
+
+
+def _GetDerElements(data):
+  """Split DER encoded data into its consecutive elements, undecoded.
+
+  Args:
+    data: str, DER encoded elements, e.g. the contents of a SEQUENCE.
+  Returns:
+    list of tuples (int tag, str encoded element, str element contents)
+  Raises:
+    CertificateASN1FormatError: the data is not well formed DER.
+  """
+  elements = []
+  offset = 0
+  while offset < len(data):
+    tag, start, end = _ReadDerElement(data, offset)
+    elements.append((tag, data[offset:end], data[start:end]))
+    offset = end
+  return elements
+
+
+def _DecodeDer(bytes_str, asn1_spec=None):
+  """Decode a DER encoded element with pyasn1.
+
+  Args:
+    bytes_str: str, DER encoded element.
+    asn1_spec: pyasn1 type to decode as, optional, default a generic type.
+  Returns:
+    pyasn1 object
+  Raises:
+    CertificateASN1FormatError: the element cannot be decoded.
+  """
+  try:
+    if asn1_spec is None:
+      return der_decoder.decode(bytes_str)[0]
+    return der_decoder.decode(bytes_str, asn1Spec=asn1_spec)[0]
+  except pyasn1.error.PyAsn1Error, e:
+    raise CertificateASN1FormatError('DER decode: %s' % str(e))
+
+
 class BaseDataObject(object):
   """Object which can auto-generate its own Get* methods."""
 
@@ -198,7 +320,7 @@ class X509Certificate(BaseDataObject):
 
   def Reset(self):
     """Reset certificate contents."""
-    self._cert = {
+    self._cert = _LazyDict({
         'serial_num': None,
         'issuer': None,
         'subject': None,
@@ -212,7 +334,7 @@ class X509Certificate(BaseDataObject):
         'may_act_as_ca': None,
         'key_usage': None,
         'subject_alt_name': None,
-    }
+    })
 
   def _GetDataDict(self):
     return self._cert
@@ -258,7 +380,7 @@ class X509Certificate(BaseDataObject):
     Args:
       values: A list that should contain OctetString(s).
     Returns:
-      list of der_encoder.univ.OctetString
+      list of univ.OctetString
     """
     return [x for x in values if isinstance(x, univ.OctetString)]
 
@@ -266,7 +388,7 @@ class X509Certificate(BaseDataObject):
     """Get X509 V3 extension fields from a sequence.
 
     Args:
-      seq: pyasn1_modules.rfc2459.Extensions
+      seq: pyasn1.type.univ.Sequence, Extensions decoded without a spec
     Returns:
       dict containing these keys if present in input sequence = {
         'key_usage': tuple of X509V3_KEY_USAGE_BIT_FIELDS items,
@@ -278,8 +400,6 @@ class X509Certificate(BaseDataObject):
         as expected way and cannot be parsed
       CertificateValueError: error in a value in the certificate
     """
-    # convert to pyasn1.type.univ.Sequence
-    seq = der_decoder.decode(der_encoder.encode(seq))[0]
     output = {}
     cert_key_usage = []
 
@@ -392,6 +512,27 @@ class X509Certificate(BaseDataObject):
       output['key_usage'] = cert_key_usage
     return output
 
+  def _GetV3ExtensionFieldsFromByteString(self, bytes_str):
+    """Get X509 V3 extension fields from a byte string.
+
+    Args:
+      bytes_str: str, Extensions as ASN1 DER encoded, or None if none
+    Returns:
+      dict, like _GetV3ExtensionFieldsFromSequence() output
+    Raises:
+      CertificateASN1FormatError: the extensions cannot be decoded
+      CertificateParseError: the certificate isn't constructed
+        as expected way and cannot be parsed
+      CertificateValueError: error in a value in the certificate
+    """
+    if bytes_str is None:
+      return {}
+    seq = _DecodeDer(bytes_str)
+    try:
+      return self._GetV3ExtensionFieldsFromSequence(seq)
+    except (IndexError, TypeError, AttributeError, ValueError), e:
+      raise CertificateParseError(str(e))
+
   def _AttributeValueToString(self, value):
     """Transform an AttributeValue to a String, escaping if needed.
 
@@ -457,76 +598,88 @@ class X509Certificate(BaseDataObject):
       raise CertificateParseError('Unknown DN sequence structure', seq)
     return delimiter.join(output)
 
-  def _GetFieldsFromSequence(self, seq):
-    """Get cert fields from a sequence.
+  def _GetSubjectFromByteString(self, bytes_str):
+    """Get the subject from a byte string.
+
+    Args:
+      bytes_str: str, subject Name as ASN1 DER encoded
+    Returns:
+      dict {
+          'subject': unicode,
+      }
+    Raises:
+      CertificateASN1FormatError: the subject cannot be decoded
+      CertificateParseError: the sequence structured is unknown
+    """
+    seq = _DecodeDer(bytes_str, rfc2459.Name())
+    return {'subject': unicode(self._AssembleDNSequence(seq))}
+
+  def _GetFieldsFromElements(self, elements):
+    """Get cert fields from the elements of the tbsCertificate sequence.
+
+    Only the fields which CheckAll() needs are decoded. The subject and the
+    X509V3 extensions are returned still encoded, to decode on first access.
 
     Args:
-      seq: pyasn1_modules.rfc2459.Certificate
+      elements: list, _GetDerElements() output of the tbsCertificate contents
     Returns:
       dict {
           'serial_num': int,
           'issuer': unicode,
-          'subject': unicode,
           'valid_notbefore': datetime.datetime,
           'valid_notafter': datetime.datetime,
-          'fields_data': str, field data as ASN1 DER encoded,
-          'sig_data': str, sig data as ASN1 DER encoded,
-          'sig_algorithm': str, sig algorithm,
-          'may_act_as_ca': bool or None if unknown,
-          'key_usage': tuple, of items from X509V3_KEY_USAGE_BIT_FIELDS,
+          'subject_data': str, subject as ASN1 DER encoded,
+          'extensions_data': str, extensions as ASN1 DER encoded, or None,
       }
     Raises:
+      CertificateASN1FormatError: a field cannot be decoded
       CertificateParseError: the certificate isn't constructed
         as expected way and cannot be parsed
       CertificateValueError: error in a value in the certificate
     """
     try:
       # only support version 3 at this time because this code looks for
-      # the x509v3 extensions in sequence 7.
-      if seq['version'] != X509_CERT_VERSION_3:
-        raise CertificateParseError(
-            'X509 version %s not supported' % seq['version'])
+      # the x509v3 extensions.
+      if elements[0][0] == DER_TAG_VERSION:
+        version = _DecodeDer(elements[0][2])
+      else:
+        version = 0  # the default, v1
+      if version != X509_CERT_VERSION_3:
+        raise CertificateParseError('X509 version %s not supported' % version)
 
-      serial_num = int(seq['serialNumber'])
+      (serial_num, signature, issuer, validity, subject,
+       unused_public_key_info) = [e[1] for e in elements[1:7]]
 
-      cert_sig_algorithm = self._GetSignatureAlgorithmFromSequence(
-          seq['signature'])
+      serial_num = int(_DecodeDer(serial_num, rfc2459.CertificateSerialNumber()))
 
-      cert_issuer = self._AssembleDNSequence(seq['issuer'])
+      self._GetSignatureAlgorithmFromSequence(
+          _DecodeDer(signature, rfc2459.AlgorithmIdentifier()))
 
-      if (seq['validity']['notBefore'].isSameTypeWith(rfc2459.Time()) and
-          seq['validity']['notAfter'].isSameTypeWith(rfc2459.Time())):
+      cert_issuer = self._AssembleDNSequence(_DecodeDer(issuer, rfc2459.Name()))
+
+      validity = _DecodeDer(validity, rfc2459.Validity())
+      if (validity['notBefore'].isSameTypeWith(rfc2459.Time()) and
+          validity['notAfter'].isSameTypeWith(rfc2459.Time())):
         cert_valid_notbefore = self._CertTimestampToDatetime(
-            seq['validity']['notBefore'])
+            validity['notBefore'])
         cert_valid_notafter = self._CertTimestampToDatetime(
-            seq['validity']['notAfter'])
+            validity['notAfter'])
       else:
         raise CertificateParseError('Validity time structure')
 
-      cert_subject = self._AssembleDNSequence(seq['subject'])
-
-      # parse X509V3 extensions
-      if len(seq) > 7:
-        v3_output = self._GetV3ExtensionFieldsFromSequence(seq['extensions'])
-      else:
-        v3_output = {}
-
-      # produce binary version of the certificate fields
-      # for later use when verifying CA signature
-      fields_data = der_encoder.encode(seq)
+      extensions_data = None
+      for tag, unused_element, contents in elements[7:]:
+        if tag == DER_TAG_EXTENSIONS:
+          extensions_data = contents
 
-      # put all values together
       output = {
           'serial_num': serial_num,
           'issuer': unicode(cert_issuer),
-          'subject': unicode(cert_subject),
           'valid_notbefore': cert_valid_notbefore,
           'valid_notafter': cert_valid_notafter,
-          'fields_data': fields_data,
-          'sig_algorithm': cert_sig_algorithm,
+          'subject_data': subject,
+          'extensions_data': extensions_data,
       }
-      # add the v3 extended output
-      output.update(v3_output)
 
     except (IndexError, TypeError, AttributeError, ValueError), e:
       raise CertificateParseError(str(e))
@@ -558,11 +711,11 @@ class X509Certificate(BaseDataObject):
 
     return output
 
-  def _GetSignatureFromSequence(self, seq):
-    """Get signature from a sequence.
+  def _GetSignatureFromByteString(self, bytes_str):
+    """Get signature from a byte string.
 
     Args:
-      seq: pyasn1.type.univ.Sequence
+      bytes_str: str, contents of the signatureValue BIT STRING
     Returns:
       dict {
           'sig_data': str, signature data as ASN1 encoded
@@ -571,64 +724,12 @@ class X509Certificate(BaseDataObject):
       CertificateParseError: the certificate isn't constructed
         as expected way and cannot be parsed
     """
-    try:
-      if len(seq) >= 1024:
-        total = 0
-        # is it just a bit list?
-        for b in seq:
-          total |= seq[b]
-        if total not in [0, 1]:
-          raise CertificateParseError('Invalid signature format')
-      else:
-        raise CertificateParseError('Signature length must be >=1024')
-
-      # the signature data
-      sig_data = der_encoder.encode(seq)
-      # skip header bytes, which may vary in size due to the way BER/DER
-      # can encode one same thing in different ways.  use the original
-      # bit length to guide us to the correct length instead of trying
-      # to read the header.
-      sig_data = sig_data[-1 * (len(seq)/8):]
-
-      output = {'sig_data': sig_data}
-
-    except (IndexError, TypeError, AttributeError), e:
-      raise CertificateParseError(str(e))
-
-    return output
-
-  def _GetCertSequencesFromTopSequence(self, seq):
-    """Get RFC 3280 cert sequences from top sequence.
-
-    Args:
-      seq: pyasn1.type.univ.Sequence
-    Returns:
-      dict combining all _Get* output
-    Raises:
-      CertificateParseError: the certificate isn't constructed
-        as expected way and cannot be parsed
-      CertificateValueError: error in a value in the certificate
-    """
-    # The structure below is defined in:
-    # http://www.ietf.org/rfc/rfc3280.txt
-
-    if type(seq) is not tuple or len(seq) < 1:
-      raise CertificateParseError(
-          'Top of certificate should consist of 1+ sequences')
-
-    # the x509 cert starts out with one top level sequence.
-    certificate = seq[0]
-
-    fields = self._GetFieldsFromSequence(certificate['tbsCertificate'])
-    sigalg = self._GetSignatureAlgorithmFromSequence(
-        certificate['signatureAlgorithm'])
-    sig = self._GetSignatureFromSequence(certificate['signatureValue'])
-
-    cert = {}
-    cert.update(fields)
-    cert.update(sigalg)
-    cert.update(sig)
-    return cert
+    # the first octet is the number of unused bits in the last octet.
+    if not bytes_str or bytes_str[0] != '\x00':
+      raise CertificateParseError('Invalid signature format')
+    if len(bytes_str) - 1 < 1024 / 8:
+      raise CertificateParseError('Signature length must be >=1024')
+    return {'sig_data': bytes_str[1:]}
 
   def _GetPublicKeyFromByteString(self, bytes_str):
     """Get the public key from a byte string.
@@ -649,22 +750,63 @@ class X509Certificate(BaseDataObject):
   def LoadFromByteString(self, bytes_str):
     """Load certificate contents from a byte string.
 
+    Only the fields needed to check the certificate and its signature are
+    decoded here. The subject, X509V3 extensions and public key are decoded
+    on first access, so their Get* methods may raise CertificateError.
+
     Args:
       bytes_str: str, bytes
+    Raises:
+      CertificateASN1FormatError: the certificate is not well formed DER
+      CertificateParseError: the certificate isn't constructed
+        as expected way and cannot be parsed
+      CertificateValueError: error in a value in the certificate
     """
-    # break the client cert into pieces
-    try:
-      c = der_decoder.decode(bytes_str, asn1Spec=rfc2459.Certificate())
-    except pyasn1.error.PyAsn1Error, e:
-      raise CertificateASN1FormatError('DER decode: %s' % str(e))
-
+    # The structure below is defined in:
+    # http://www.ietf.org/rfc/rfc3280.txt
+    tag, start, end = _ReadDerElement(bytes_str, 0)
+    if tag != DER_TAG_SEQUENCE:
+      raise CertificateASN1FormatError('Certificate is not a SEQUENCE')
+    elements = _GetDerElements(bytes_str[start:end])
+    if [e[0] for e in elements] != [
+        DER_TAG_SEQUENCE, DER_TAG_SEQUENCE, DER_TAG_BIT_STRING]:
+      raise CertificateASN1FormatError(
+          'Certificate should consist of tbsCertificate, signatureAlgorithm '
+          'and signatureValue')
+    tbs, sig_alg, sig = elements
+
+    # keep the binary version of the certificate fields
+    # for later use when verifying CA signature
     cert = {
         'entire_byte_string': bytes_str,
+        'fields_data': tbs[1],
     }
-    cert.update(self._GetCertSequencesFromTopSequence(c))
-    cert.update(self._GetPublicKeyFromByteString(bytes_str))
+    cert.update(self._GetFieldsFromElements(_GetDerElements(tbs[2])))
+    cert.update(self._GetSignatureAlgorithmFromSequence(
+        _DecodeDer(sig_alg[1], rfc2459.AlgorithmIdentifier())))
+    cert.update(self._GetSignatureFromByteString(sig[2]))
+    subject_data = cert.pop('subject_data')
+    extensions_data = cert.pop('extensions_data')
+
     self.Reset()
     self._cert.update(cert)
+    self._cert.SetLoader(
+        LAZY_SUBJECT_FIELDS,
+        lambda: self._GetSubjectFromByteString(subject_data))
+    self._cert.SetLoader(
+        LAZY_V3_EXTENSION_FIELDS,
+        lambda: self._GetV3ExtensionFieldsFromByteString(extensions_data))
+    self._cert.SetLoader(
+        LAZY_PUBLIC_KEY_FIELDS,
+        lambda: self._GetPublicKeyFromByteString(bytes_str))
+
+  def DecodeAll(self):
+    """Decode all fields which are otherwise decoded on first access.
+
+    Raises:
+      CertificateError: a field cannot be decoded
+    """
+    self._cert.LoadAll()
 
   def CheckValidity(self, utcnow=None):
     """Check that the certificate is still valid, given its validity time.
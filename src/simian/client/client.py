@@ -17,6 +17,7 @@
 """Module containing classes to connect to Simian as a client."""
 
 import datetime
+import hashlib
 import httplib
 import logging
 import mimetools
@@ -68,6 +69,10 @@ URL_UPLOADPKG = '/uploadpkg'
 
 _SSL_VERSION = 'sslv23'
 _CIPHER_LIST = None
+# Seconds after which an idle keep-alive connection is not reused.
+CONNECTION_IDLE_TIMEOUT = 30
+# Suffix of the file storing the ETag of a partially downloaded file.
+PARTIAL_DOWNLOAD_ETAG_SUFFIX = '.etag'
 
 
 class Error(Exception):
@@ -173,6 +178,11 @@ class MultiBodyConnection:  # pylint: disable=g-old-style-class,no-init
       raise Error('SetProgressCallback argument fn must be callable')
     self._progress_callback = fn
 
+  def ClearProgressCallback(self):
+    """Clear any function set with SetProgressCallback()."""
+    if hasattr(self, '_progress_callback'):
+      del self._progress_callback
+
   def _ProgressCallback(self, bytes_sent, bytes_total):
     """Call the progress callback with current transfer data.
 
@@ -260,9 +270,13 @@ class MultiBodyConnection:  # pylint: disable=g-old-style-class,no-init
     # the connection is ready for it after this request() completes.
     # note python >=2.7 httplib now offers this functionality for us,
     # but we are continuing to do it ourselves.
-
+    #
+    # request_sent stays False if sending the headers fails, in which case
+    # the server cannot have acted on the request and it may be resent.
+    self.request_sent = False
     httplib.HTTPConnection.request(
         self, method, url, headers=headers)
+    self.request_sent = True
 
     bytes_sent = 0
     self._ProgressCallback(bytes_sent, content_length)
@@ -401,6 +415,62 @@ class HTTPSMultiBodyConnection(MultiBodyConnection, httplib.HTTPSConnection):
 
 
 
+class ConnectionPool(object):
+  """Pool of idle keep-alive connections.
+
+  Connections are pooled by a key identifying the host, port and proxy
+  they are connected to, and are not reused after being idle for longer
+  than idle_timeout seconds.
+  """
+
+  def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+    self.idle_timeout = idle_timeout
+    self._idle = {}
+    self.handshakes = 0
+    self.reused = 0
+
+  def Get(self, key):
+    """Returns an idle connection for key, or None if none is available.
+
+    Args:
+      key: tuple, connection key.
+    Returns:
+      HTTP{,S}Connection or None
+    """
+    idle = self._idle.get(key, [])
+    now = time.time()
+    while idle:
+      conn, last_used = idle.pop()
+      if now - last_used < self.idle_timeout:
+        self.reused += 1
+        return conn
+      conn.close()
+    return None
+
+  def Put(self, key, conn):
+    """Returns a connection to the pool for reuse.
+
+    Args:
+      key: tuple, connection key.
+      conn: HTTP{,S}Connection, with no outstanding response.
+    """
+    self._idle.setdefault(key, []).append((conn, time.time()))
+
+  def CloseAll(self):
+    """Closes all idle connections."""
+    for idle in self._idle.itervalues():
+      for conn, unused_last_used in idle:
+        conn.close()
+    self._idle = {}
+
+  def GetStats(self):
+    """Returns a dict of handshake and reused connection counters."""
+    return {'handshakes': self.handshakes, 'reused': self.reused}
+
+
+_CONNECTION_POOL = ConnectionPool()
+
+
 class HttpsClient(object):
   """Connect to a http or https service.
 
@@ -412,6 +482,7 @@ class HttpsClient(object):
     self._LoadHost(hostname, port, proxy)
     self._progress_callback = None
     self._ca_cert_chain = None
+    self._connection_pool = _CONNECTION_POOL
 
   def SetProgressCallback(self, fn):
     self._progress_callback = fn
@@ -544,12 +615,15 @@ class HttpsClient(object):
       raise SimianClientError('_Connect() httplib.socket.error: %s' % str(e))
     return conn
 
-  def _GetResponse(self, conn, output_file=None):
+  def _GetResponse(self, conn, output_file=None, output_file_fn=None):
     """Obtain a response from the connection and interpret it.
 
     Args:
       conn: HTTP{,S}Connection
       output_file: file, optional, file to write response body to
+      output_file_fn: func, optional, called with the httplib.HTTPResponse
+        before the body is read, returning a file to write the response body
+        to, or None to store the body in the Response instance.
     Returns:
       Response instance
     """
@@ -559,6 +633,9 @@ class HttpsClient(object):
     reason = response.reason
     body_len = 0
 
+    if output_file_fn is not None:
+      output_file = output_file_fn(response)
+
     read_len = 8192   # some arbitrary block size
 
     if output_file:
@@ -600,39 +677,130 @@ class HttpsClient(object):
     # sends properly.
     conn.request(method, str(url), body=body, headers=headers)
 
+  def _GetConnectionKey(self):
+    """Returns a tuple identifying connections which may be reused."""
+    return (
+        self.hostname, self.port, self.use_https, self.proxy_hostname,
+        self.proxy_port, self.proxy_use_https, self._ca_cert_chain)
+
   def _DoRequestResponse(
-      self, method, url, body=None, headers=None, output_file=None):
+      self, method, url, body=None, headers=None, output_file=None,
+      output_file_fn=None):
     """Connect to hostname, make a request, obtain response.
 
+    An idle keep-alive connection is reused if available.  If a reused
+    connection turns out to be stale, the request is retried once on a
+    new connection when it is safe to send again; see
+    _IsStaleConnectionError().
+
     Args:
       method: str, like 'GET' or 'POST'
       url: str, url like '/foo.html', not 'http://host/foo.html'
       body: str or dict or file, optional, body to send with request
       headers: dict, optional, headers to send with request
       output_file: file, optional, file to write response body to
+      output_file_fn: func, optional, see _GetResponse
     Returns:
       Response instance
     Raises:
       HTTPError: if a connection level error occured
     """
+    # if proxy is in use, request the full URL including host.
+    if self.proxy_hostname:
+      url = 'http%s://%s%s' % (self.use_https * 's', self.netloc, url)
+
+    key = self._GetConnectionKey()
+    conn = self._connection_pool.Get(key)
     try:
+      if conn is not None:
+        logging.debug('Reusing connection to %s', self.netloc)
+        if self._progress_callback is not None:
+          conn.SetProgressCallback(self._progress_callback)
+        else:
+          conn.ClearProgressCallback()
+        try:
+          return self._DoRequestResponseOnConnection(
+              key, conn, method, url, body, headers, output_file,
+              output_file_fn)
+        except (httplib.HTTPException, IOError, SSL.SSLError), e:
+          if not self._IsStaleConnectionError(conn, method, body, e):
+            raise
+          logging.debug('Stale connection to %s: %s', self.netloc, str(e))
+
       suffix = self.use_https * 's'
       logging.debug('Connecting to http%s://%s:%s',
                     suffix, self.hostname, self.port)
       conn = self._Connect()
-      # if proxy is in use, request the full URL including host.
-      if self.proxy_hostname:
-        url = 'http%s://%s%s' % (self.use_https * 's', self.netloc, url)
-      logging.debug('Requesting %s %s', method, url)
-      self._Request(method, conn, url, body=body, headers=headers)
-      logging.debug('Waiting for response')
-      response = self._GetResponse(conn, output_file=output_file)
-      logging.debug('Response status %d', response.status)
-      return response
+      self._connection_pool.handshakes += 1
+      return self._DoRequestResponseOnConnection(
+          key, conn, method, url, body, headers, output_file, output_file_fn)
     except httplib.HTTPException, e:
       raise HTTPError(str(e))
     except IOError as e:
       raise HTTPError(str(e))
+    except SSL.SSLError as e:
+      raise HTTPError(str(e))
+
+  def _IsStaleConnectionError(self, conn, method, body, e):
+    """Returns True if a request on a reused connection may be resent.
+
+    A reused connection may have been closed by the server while idle.  A
+    request of any method is resent if it failed before any byte was sent.
+    Once sent, a request other than POST is resent if the server answered
+    with an empty or malformed status line, which is how a closed keep-alive
+    socket shows up once the request has been written; a POST may have been
+    acted on, so it is not.
+
+    Args:
+      conn: HTTP{,S}Connection, the reused connection.
+      method: str, like 'GET' or 'POST'
+      body: str or dict or file, body sent with the request
+      e: Exception, raised while making the request
+    Returns:
+      bool
+    """
+    if not getattr(conn, 'request_sent', True):
+      return True
+    if method == 'POST':
+      return False
+    if body is not None and type(body) not in [str, unicode, dict]:
+      return False
+    return isinstance(e, httplib.BadStatusLine)
+
+  def _DoRequestResponseOnConnection(
+      self, key, conn, method, url, body, headers, output_file,
+      output_file_fn=None):
+    """Make a request on a connection and obtain the response.
+
+    The connection is returned to the pool if the server keeps it open,
+    and closed otherwise.
+
+    Args:
+      key: tuple, connection key from _GetConnectionKey().
+      conn: HTTP{,S}Connection
+      method: str, like 'GET' or 'POST'
+      url: str, url to request
+      body: str or dict or file, body to send with request
+      headers: dict, headers to send with request
+      output_file: file, file to write response body to
+      output_file_fn: func, optional, see _GetResponse
+    Returns:
+      Response instance
+    """
+    try:
+      logging.debug('Requesting %s %s', method, url)
+      self._Request(method, conn, url, body=body, headers=headers)
+      logging.debug('Waiting for response')
+      response = self._GetResponse(
+          conn, output_file=output_file, output_file_fn=output_file_fn)
+    except:
+      conn.close()
+      raise
+    logging.debug('Response status %d', response.status)
+    # httplib closes the socket if the server will close the connection.
+    if getattr(conn, 'sock', None) is not None:
+      self._connection_pool.Put(key, conn)
+    return response
 
   def Do(
       self, method, url,
@@ -693,6 +861,159 @@ class HttpsClient(object):
 
     return response
 
+  def _GetPartialDownload(self, output_filename):
+    """Returns the state of a partial download.
+
+    Args:
+      output_filename: str, filename being downloaded to.
+    Returns:
+      tuple of (int bytes already downloaded, str ETag of the download), or
+      (0, None) if there is no download to resume.
+    """
+    etag_filename = output_filename + PARTIAL_DOWNLOAD_ETAG_SUFFIX
+    if not os.path.isfile(output_filename) or not os.path.isfile(etag_filename):
+      return 0, None
+    f = open(etag_filename, 'r')
+    try:
+      etag = f.read().strip()
+    finally:
+      f.close()
+    offset = os.path.getsize(output_filename)
+    if not etag or not offset:
+      return 0, None
+    return offset, etag
+
+  def _RemovePartialDownload(self, output_filename):
+    """Removes a partial download and its ETag file."""
+    for filename in [
+        output_filename, output_filename + PARTIAL_DOWNLOAD_ETAG_SUFFIX]:
+      if os.path.isfile(filename):
+        os.unlink(filename)
+
+  def _IsValidDownload(self, output_filename, etag):
+    """Returns False if a sha256 ETag does not match the downloaded file."""
+    if not etag or len(etag) != 64:
+      return True  # not a sha256 hash, nothing to verify against.
+    sha256 = hashlib.sha256()
+    f = open(output_filename, 'rb')
+    try:
+      buf = f.read(8192)
+      while buf:
+        sha256.update(buf)
+        buf = f.read(8192)
+    finally:
+      f.close()
+    return sha256.hexdigest() == etag.lower()
+
+  def DoDownload(
+      self, url, output_filename, headers=None,
+      retry_on_status=DEFAULT_RETRY_HTTP_STATUS_CODES,
+      attempt_times=DEFAULT_HTTP_ATTEMPTS):
+    """Make a GET request, resumably downloading the response body to a file.
+
+    The ETag of the download is stored next to output_filename until the
+    download completes, so a download interrupted in this or an earlier call
+    is resumed with a Range request rather than started over.  If the ETag
+    is a sha256 hash, the completed file is verified against it.
+
+    Args:
+      url: str, url like '/foo.html', not 'http://host/foo.html'
+      output_filename: str, filename to write response body to
+      headers: dict, optional, headers to send with request
+      retry_on_status: list, default (500, 502, etc.), int status codes to
+          retry upon receiving.
+      attempt_times: int, default 4, how many times to attempt the request
+    Returns:
+      Response object, with a body only if the request was not successful.
+    Raises:
+      HTTPError: if a connection level error occured
+      SimianClientError: if the download does not match its sha256 ETag
+    """
+    etag_filename = output_filename + PARTIAL_DOWNLOAD_ETAG_SUFFIX
+    n = 0
+    while n < attempt_times:
+      time.sleep(n * 5)
+      n += 1
+      offset, etag = self._GetPartialDownload(output_filename)
+      request_headers = dict(headers or {})
+      if offset:
+        logging.debug('Resuming %s from byte %d', url, offset)
+        request_headers['Range'] = 'bytes=%d-' % offset
+        request_headers['If-Range'] = etag
+      output_files = []
+
+      def _OpenOutputFile(response):
+        """Opens output_filename to write the response body to.
+
+        This may be called again if the request is retried on a new
+        connection, in which case the earlier file is closed and the partial
+        download is truncated back to offset before being resumed.
+        """
+        while output_files:
+          output_files.pop().close()
+        if response.status == httplib.PARTIAL_CONTENT and offset:
+          f = open(output_filename, 'r+b')
+          f.truncate(offset)
+          f.seek(offset)
+          output_files.append(f)
+        elif response.status in [httplib.OK, httplib.PARTIAL_CONTENT]:
+          output_files.append(open(output_filename, 'wb'))
+          response_etag = response.getheader('etag')
+          if response_etag:
+            f = open(etag_filename, 'w')
+            f.write(response_etag)
+            f.close()
+          elif os.path.isfile(etag_filename):
+            os.unlink(etag_filename)
+        else:
+          return None  # do not overwrite a partial download with an error.
+        return output_files[0]
+
+      logging.debug('DoDownload(%s) try #%d', url, n)
+      try:
+        response = self._DoRequestResponse(
+            'GET', url, headers=request_headers,
+            output_file_fn=_OpenOutputFile)
+      except HTTPError:
+        logging.warning('HTTPError in DoDownload(%s)', url)
+        if n == attempt_times:
+          raise
+        response = None
+      finally:
+        for f in output_files:
+          f.close()
+
+      if response is None:
+        pass
+      elif response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+        logging.warning('Invalid partial download of %s', url)
+        self._RemovePartialDownload(output_filename)
+      elif response.status in [httplib.OK, httplib.PARTIAL_CONTENT]:
+        expected_size = int(response.headers.get('content-length', -1))
+        if expected_size >= 0 and response.status == httplib.PARTIAL_CONTENT:
+          expected_size += offset
+        if (expected_size >= 0 and
+            os.path.getsize(output_filename) < expected_size):
+          logging.warning('Incomplete download of %s', url)
+          if n == attempt_times:
+            raise HTTPError('Incomplete download of %s' % url)
+          continue
+        etag = response.headers.get('etag')
+        if self._IsValidDownload(output_filename, etag):
+          if os.path.isfile(etag_filename):
+            os.unlink(etag_filename)
+          return response
+        logging.warning('sha256 mismatch for download of %s', url)
+        self._RemovePartialDownload(output_filename)
+        if n == attempt_times:
+          raise SimianClientError('sha256 mismatch downloading %s' % url)
+      elif response.status not in retry_on_status:
+        return response
+      else:
+        logging.warning('Retry status hit for DoDownload(%s)', url)
+
+    return response
+
   def DoMultipart(
       self, url, params, filename, input_filename=None, input_file=None):
     """Make a form/multipart POST request and return the response.
@@ -1306,6 +1627,25 @@ class SimianClient(HttpsAuthClient):
     else:
       raise SimianServerError(response.status, response.reason, response.body)
 
+  def _SimianDownload(self, url, output_filename):
+    """Resumably download a url to a file.
+
+    Args:
+      url: str, url to connect to, like '/foo/1'
+      output_filename: str, filename to write response body to
+    Returns:
+      None
+    Raises
+      SimianServerError: if the Simian server returned an error (status != 200)
+    """
+    try:
+      response = self.DoDownload(url, output_filename)
+    except HTTPError, e:
+      raise SimianServerError(str(e))
+
+    if not response.IsSuccess():
+      raise SimianServerError(response.status, response.reason, response.body)
+
   def _GetLoggedOnUser(self):
     """Returns the username of the logged on user."""
     if sys.platform == 'win32':
@@ -1330,9 +1670,10 @@ class SimianClient(HttpsAuthClient):
     Returns:
       See _SimianRequest
     """
-    return self._SimianRequest(
-        'GET', '/pkgs/%s' % urllib.quote(name),
-        output_filename=output_filename)
+    if output_filename:
+      return self._SimianDownload(
+          '/pkgs/%s' % urllib.quote(name), output_filename)
+    return self._SimianRequest('GET', '/pkgs/%s' % urllib.quote(name))
 
   def GetPackageInfo(self, filename, get_hash=False):
     """Get package info.
@@ -1374,9 +1715,8 @@ class SimianClient(HttpsAuthClient):
     Raises:
       SimianServerError: if the Simian server returned an error (status != 200)
     """
-    return self._SimianRequest(
-        'GET', '/pkgs/%s' % urllib.quote(filename),
-        output_filename=filename)
+    return self._SimianDownload(
+        '/pkgs/%s' % urllib.quote(filename), filename)
 
   def GetPackageMetadata(
       self, install_types=None, catalogs=None, filename=None):
@@ -51,6 +51,8 @@ class AppleSUSAdmin(admin.AdminHandler):
       self._ChangeProduct(product_id)
     elif self.request.get('regenerate-catalogs'):
       self._RegenerateCatalogs()
+    elif self.request.get('restore-catalog-backup'):
+      self._RestoreCatalogBackup()
     else:
       self.response.set_status(httplib.NOT_FOUND)
 
@@ -63,6 +65,16 @@ class AppleSUSAdmin(admin.AdminHandler):
     else:
       self.redirect('/admin/applesus?msg=Select at least one catalog!')
 
+  def _RestoreCatalogBackup(self):
+    """Serves a specified Apple SUS catalog backup."""
+    backup = self.request.get('backup')
+    try:
+      applesus.RestoreAppleSUSCatalogBackup(backup)
+    except (ValueError, applesus.CatalogChunkMissingError):
+      self.redirect('/admin/applesus?msg=Catalog backup not found!')
+      return
+    self.redirect('/admin/applesus?msg=Catalog backup %s restored.' % backup)
+
   def _ChangeProduct(self, product_id):
     """Method to change properties of a given Apple SUS product."""
     user = users.get_current_user()
@@ -217,6 +229,7 @@ class AppleSUSAdmin(admin.AdminHandler):
     install_counts, counts_mtime = models.ReportsCache.GetInstallCounts()
     data = {
         'catalogs': catalogs,
+        'catalog_backups': applesus.GetAppleSUSCatalogBackupKeyNames(),
         'catalogs_pending': catalogs_pending,
         'products': products,
         'install_counts': install_counts,
@@ -22,7 +22,8 @@ from simian.mac import admin
 from simian.mac import models
 from simian.mac.common import util
 
-IP_REGEX = '^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(\/\d{1,2})?$'
+IP_REGEX = ('^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(\/\d{1,2})?|'
+            '[0-9a-fA-F:.]*:[0-9a-fA-F:.]*(\/\d{1,3})?)$')
 
 
 class IPBlacklist(admin.AdminHandler):
@@ -42,7 +43,8 @@ class IPBlacklist(admin.AdminHandler):
     d = {'report_type': 'ip_blacklist', 'title': 'IP Blacklist', 'columns': 2,
          'list': sorted(ips.items()), 'labels': ['IP', 'Comment'],
          'regex': ['/%s/' % IP_REGEX, '/^.{0,60}$/'],
-         'infopanel': 'Subnet format required (e.g. 192.168.1.0/24)'}
+         'infopanel': ('Subnet format required '
+                       '(e.g. 192.168.1.0/24 or 2001:db8::/32)')}
     self.Render('list_edit.html', d)
 
   @admin.AdminHandler.XsrfProtected('ip_blacklist')
@@ -58,11 +58,11 @@ def RebuildInstallCounts():
   lock = models.KeyValueCache.get_by_key_name('pkgs_list_cron_lock')
   if lock:
     lock.delete()
-  cursor_obj = models.KeyValueCache.get_by_key_name('pkgs_list_cursor')
-  if cursor_obj:
-    cursor_obj.delete()
+  # an empty cursor starts the rebuild from the first InstallLog.
+  models.KeyValueCache(
+      key_name=reports_cache.INSTALL_COUNTS_CURSOR_NAME, text_value=None).put()
   models.ReportsCache.SetInstallCounts({})
-  deferred.defer(reports_cache._GenerateInstallCounts)
+  deferred.defer(reports_cache._RebuildInstallCounts)
 
 
 def UpdateInstallLogSchema(cursor=None, num_updated=0):
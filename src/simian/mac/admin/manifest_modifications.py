@@ -151,7 +151,9 @@ class ManifestModifications(admin.AdminHandler):
   def _DeleteManifestModification(self):
     """Deletes a manifest modifications."""
     key_str = self.request.get('key')
-    db.delete(db.Key(key_str))
+    mod = db.get(db.Key(key_str))
+    if mod:
+      mod.delete()
     data = {'deleted': True, 'key': key_str}
     self.response.headers['Content-Type'] = 'application/json'
     self.response.out.write(json.dumps(data))
@@ -75,7 +75,9 @@ class Packages(admin.AdminHandler):
       pkg['count'] = installs.get(p.munki_name, {}).get('install_count', 'N/A')
       pkg['fail_count'] = installs.get(p.munki_name, {}).get(
           'install_fail_count', 'N/A')
-      pkg['pending_count'] = pending.get(p.munki_name, 'N/A')
+      # only installs pending on a computer are counted.
+      pkg['pending_count'] = pending.get(
+          p.munki_name, 0 if pending_mtime else 'N/A')
       pkg['duration_seconds_avg'] = installs.get(p.munki_name, {}).get(
           'duration_seconds_avg', None) or 'N/A'
       pkg['unattended'] = p.plist.get('unattended_install', False)
@@ -18,9 +18,11 @@
 
 import copy
 import datetime
+import logging
 import urllib
 
 from  distutils import version as distutils_version
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
 from simian import settings
@@ -28,10 +30,13 @@ from simian.mac import admin
 from simian.mac import common
 from simian.mac import models
 from simian.mac.common import auth
+from simian.mac.common import fleet_summary
 
 
 ACTIVE_DAY_COUNTS = [30, 14, 7, 1]
 DEFAULT_COMPUTER_FETCH_LIMIT = 500
+# URL of the cron which generates the fleet summary.
+FLEET_SUMMARY_URL = '/cron/reports_cache/summary'
 REPORT_TYPES = [
     'owner', 'hostname', 'serial', 'uuid', 'client_version', 'os_version']
 
@@ -64,7 +69,16 @@ class Summary(admin.AdminHandler):
 
   def _DisplayCachedSummary(self):
     """Displays stats summary from cached dict."""
-    summary, mtime = models.ReportsCache.GetStatsSummary()
+    fleet, mtime = models.ReportsCache.GetFleetSummary()
+    summary = None
+    if mtime is None:
+      # the fleet summary was never generated; generate it now, and show the
+      # stats summary cached before it existed in the meantime.
+      _ScheduleFleetSummary()
+      summary, mtime = models.ReportsCache.GetStatsSummary()
+    if not summary:
+      summary = PrepareComputerSummaryForTemplate(
+          GetComputerSummaryFromFleet(fleet))
 
     trend_hour, trend_hour_mtime = models.ReportsCache.GetTrendingInstalls(1)
     trend_day, trend_day_mtime = models.ReportsCache.GetTrendingInstalls(24)
@@ -254,6 +268,50 @@ def GetComputerSummary(computers, initial_summary=None):
   return summary
 
 
+def _ScheduleFleetSummary():
+  """Schedules generation of the fleet summary, at most once an hour."""
+  name = 'fleet-summary-%d' % fleet_summary.GetHour(datetime.datetime.utcnow())
+  try:
+    taskqueue.add(url=FLEET_SUMMARY_URL, method='GET', name=name)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass  # already scheduled this hour.
+  except taskqueue.Error as e:
+    logging.warning('Scheduling fleet summary failed: %s', str(e))
+
+
+def GetComputerSummaryFromFleet(fleet, now=None):
+  """Generates a GetComputerSummary() summary from a fleet summary.
+
+  Args:
+    fleet: dict fleet summary, see simian.mac.common.fleet_summary.
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time
+  Returns:
+    dict, stats summary data.
+  """
+  if now is None:
+    now = datetime.datetime.utcnow()
+  summary = GetComputerSummary([])
+  summary['conns_on_corp'] = fleet.get('conns_on_corp', 0)
+  summary['conns_off_corp'] = fleet.get('conns_off_corp', 0)
+  for key in ['os_versions', 'client_versions', 'sites_histogram']:
+    summary[key] = dict(fleet.get(key, {}))
+
+  now_hour = fleet_summary.GetHour(now)
+  for hour, counts in fleet.get('hours', {}).iteritems():
+    for days in ACTIVE_DAY_COUNTS:
+      if now_hour - hour >= days * 24:
+        continue
+      for key in ['active', 'all_pkgs_installed',
+                  'all_apple_updates_installed']:
+        summary[key][days] += counts.get(key, 0)
+      for track, count in counts.get('tracks', {}).iteritems():
+        track_counts = summary['tracks'].setdefault(track, {})
+        track_counts[days] = track_counts.get(days, 0) + count
+
+  return summary
+
+
 def GetPercentage(number, total):
   """Returns the float percentage that a number is of a total."""
   if not number:
@@ -48,6 +48,8 @@ LAST_RUN_FILE = '/Library/Managed Installs/lastrun'
 MAX_ATTEMPTS = 4
 MSULOGFILE = '/Users/Shared/.com.googlecode.munki.ManagedSoftwareUpdate.log'
 MSULOGDIR = '/Users/Shared/.com.googlecode.munki.ManagedSoftwareUpdate.logs'
+# Max number of MSU logs posted per msu_logs report.
+MSU_LOGS_BATCH_SIZE = 500
 
 # Prefix to prevent Cross Site Script Inclusion.
 JSON_PREFIX = ')]}\',\n'
@@ -312,9 +314,27 @@ def PostManagedSoftwareUpdateLogs(client, logs):
     client:  A SimianAuthClient object.
     logs: same format as output from GetManagedSoftwareUpdateLogs.
   """
-  for log in logs:
-    # TODO(user):  Combine all of these into a single HTTP request.
-    client.PostReport('msu_log', log)
+  start = time.time()
+  requests = 0
+  for i in xrange(0, len(logs), MSU_LOGS_BATCH_SIZE):
+    batch = logs[i:i + MSU_LOGS_BATCH_SIZE]
+    response = None
+    try:
+      body = json.dumps(batch)
+    except (TypeError, ValueError) as e:
+      logging.warning('Could not serialize MSU logs: %s', e)
+    else:
+      response = client.PostReport('msu_logs', {'logs': body})
+      requests += 1
+    # servers predating msu_logs reports do not return the number of logs.
+    if (response or '').strip() != str(len(batch)):
+      for log in batch:
+        client.PostReport('msu_log', log)
+      requests += len(batch)
+  if logs:
+    logging.debug(
+        'Posted %d MSU logs in %d requests in %.2fs.',
+        len(logs), requests, time.time() - start)
 
 
 def NoteLastRun(open_=open):
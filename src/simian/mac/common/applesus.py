@@ -17,12 +17,15 @@
 """Apple SUS shared functions."""
 
 import datetime
+import hashlib
 import logging
 import re
 import xml
 from xml.dom import minidom
+import zlib
 
 from google.appengine.api import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import deferred
 
 from simian.mac.common import datastore_locks
@@ -37,6 +40,21 @@ OS_VERSIONS = frozenset(['10.9', '10.10', '10.11', '10.12', '10.13', '10.14'])
 
 _CATALOG_REGENERATION_LOCK_NAME = 'applesus_catalog_regeneration_%s_%s'
 
+BACKUP_KEY_PREFIX = 'backup_'
+# backups are kept for this many days, and at least this many per catalog.
+BACKUP_RETENTION_DAYS = 30
+BACKUP_MIN_KEPT = 10
+
+# catalogs are split into chunks after lines which end a chunk of at least
+# CHUNK_MIN_SIZE bytes and whose crc32 matches CHUNK_BOUNDARY_MASK, or which
+# end a chunk of CHUNK_MAX_SIZE bytes. As boundaries depend on content, not
+# offsets, a changed product only changes the chunks around it.
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+CHUNK_BOUNDARY_MASK = 0xff
+# unreferenced chunks are kept this long, for catalogs being generated.
+CHUNK_GC_GRACE = datetime.timedelta(hours=6)
+
 MON, TUE, WED, THU, FRI, SAT, SUN = range(0, 7)
 
 
@@ -53,6 +71,10 @@ class DocumentFormatError(Error):
   """Error in document format."""
 
 
+class CatalogChunkMissingError(Error):
+  """A chunk of a catalog backup does not exist."""
+
+
 class DistFileDocument(object):
   """Class to hold a Apple SUS distfile document."""
 
@@ -176,27 +198,34 @@ def GenerateAppleSUSCatalogs(track=None, tracks=None, delay=0):
   elif track:
     tracks = [track]
 
-  for track in tracks:
-    for os_version in OS_VERSIONS:
+  for os_version in OS_VERSIONS:
+    locked_tracks = []
+    locks = []
+    for track in tracks:
       lock_name = CatalogRegenerationLockName(track, os_version)
       lock = datastore_locks.DatastoreLock(lock_name)
       try:
         lock.Acquire(timeout=600 + delay, max_acquire_attempts=1)
       except datastore_locks.AcquireLockError:
         continue
-      if delay:
-        now_str = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
-        deferred_name = 'gen-applesus-catalog-%s-%s-%s' % (
-            os_version, track, now_str)
-        deferred_name = re.sub(r'[^\w-]', '', deferred_name)
-        try:
-          deferred.defer(
-              GenerateAppleSUSCatalog, os_version, track, catalog_lock=lock,
-              _countdown=delay, _name=deferred_name)
-        except taskqueue.TaskAlreadyExistsError:
-          logging.info('Skipping duplicate Apple SUS Catalog generation task.')
-      else:
-        GenerateAppleSUSCatalog(os_version, track, catalog_lock=lock)
+      locked_tracks.append(track)
+      locks.append(lock)
+    if not locked_tracks:
+      continue
+    if delay:
+      now_str = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
+      deferred_name = 'gen-applesus-catalogs-%s-%s-%s' % (
+          os_version, '-'.join(locked_tracks), now_str)
+      deferred_name = re.sub(r'[^\w-]', '', deferred_name)
+      try:
+        deferred.defer(
+            GenerateAppleSUSTrackCatalogs, os_version, locked_tracks,
+            catalog_locks=locks, _countdown=delay, _name=deferred_name)
+      except taskqueue.TaskAlreadyExistsError:
+        logging.info('Skipping duplicate Apple SUS Catalog generation task.')
+    else:
+      GenerateAppleSUSTrackCatalogs(
+          os_version, locked_tracks, catalog_locks=locks)
 
   if delay:
     now_str = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
@@ -215,10 +244,6 @@ def GenerateAppleSUSCatalog(
     os_version, track, datetime_=datetime.datetime, catalog_lock=None):
   """Generates an Apple SUS catalog for a given os_version and track.
 
-  This function loads the untouched/raw Apple SUS catalog, removes any
-  products/updates that are not approved for the given track, then saves
-  a new catalog (plist/xml) to Datastore for client consumption.
-
   Args:
     os_version: str OS version to generate the catalog for.
     track: str track name to generate the catalog for.
@@ -226,51 +251,346 @@ def GenerateAppleSUSCatalog(
     catalog_lock: datastore_lock.DatastoreLock; If provided, the lock to release
                   upon completion of the operation.
   Returns:
-    tuple, new models.AppleSUSCatalog object and plist.ApplePlist object. Or,
-    if there is no "untouched" catalog for the os_version, then (None, None) is
-    returned.
+    models.AppleSUSCatalog object, or None if there is no "untouched" catalog
+    for the os_version.
+  """
+  catalog_locks = None
+  if catalog_lock:
+    catalog_locks = [catalog_lock]
+  catalogs = GenerateAppleSUSTrackCatalogs(
+      os_version, [track], datetime_=datetime_, catalog_locks=catalog_locks)
+  return catalogs.get(track)
+
+
+def _GetApprovedProductIds(tracks):
+  """Returns a dict of track to set of str ids of products approved for it."""
+  approved_product_ids = dict((track, set()) for track in tracks)
+  for product in models.AppleSUSProduct.AllActive():
+    for track in product.tracks:
+      if track in approved_product_ids:
+        approved_product_ids[track].add(product.product_id)
+  return approved_product_ids
+
+
+def _GetProductXml(product_id, product):
+  """Returns the XML of a product of a catalog, keyed by its product id."""
+  indent = plist.INDENT_CHAR * 3
+  return '%s<key>%s</key>\n%s' % (
+      indent, plist.EscapeString(product_id),
+      plist.GetXmlStr(product, indent_num=3))
+
+
+def _GetCatalogXml(catalog, products_xml, product_ids):
+  """Returns the XML document of a catalog with some of its products.
+
+  The output is identical to ApplePlist.GetXml() of the catalog with only the
+  given products.
+
+  Args:
+    catalog: dict catalog without its Products.
+    products_xml: dict of str product id to _GetProductXml() output, or None
+      if the catalog has no Products.
+    product_ids: list of str ids of products in products_xml to include.
+  Returns:
+    str XML document.
+  """
+  indent = plist.INDENT_CHAR
+  keys = set(catalog)
+  if products_xml is not None:
+    keys.add('Products')
+  lines = [indent + '<dict>']
+  for key in sorted(keys):
+    lines.append('%s<key>%s</key>' % (indent * 2, plist.EscapeString(key)))
+    if key == 'Products' and products_xml is not None:
+      lines.append(indent * 2 + '<dict>')
+      lines.extend(products_xml[product_id] for product_id in product_ids)
+      lines.append(indent * 2 + '</dict>')
+    else:
+      lines.append(plist.GetXmlStr(catalog[key], indent_num=2))
+  lines.append(indent + '</dict>')
+  return ''.join([plist.PLIST_HEAD, '\n'.join(lines), plist.PLIST_FOOT])
+
+
+def _SplitCatalogChunks(catalog_xml):
+  """Splits a catalog into content-defined chunks.
+
+  Args:
+    catalog_xml: str catalog XML.
+  Returns:
+    list of str chunks, which join to catalog_xml.
+  """
+  chunks = []
+  start = 0
+  pos = 0
+  length = len(catalog_xml)
+  while pos < length:
+    end = catalog_xml.find('\n', pos) + 1 or length
+    size = end - start
+    if size >= CHUNK_MAX_SIZE or (
+        size >= CHUNK_MIN_SIZE and
+        not zlib.crc32(catalog_xml[pos:end]) & CHUNK_BOUNDARY_MASK):
+      chunks.append(catalog_xml[start:end])
+      start = end
+    pos = end
+  if start < length:
+    chunks.append(catalog_xml[start:])
+  return chunks
+
+
+def _PutCatalogChunks(catalog_xml, stored_digests):
+  """Stores the chunks of a catalog which are not stored yet.
+
+  Args:
+    catalog_xml: str catalog XML.
+    stored_digests: set of str digests of stored chunks, updated in place.
+  Returns:
+    list of str sha256 digests of the catalog chunks, in order.
+  """
+  if isinstance(catalog_xml, unicode):
+    catalog_xml = catalog_xml.encode('utf-8')
+  digests = []
+  new_chunks = []
+  for chunk in _SplitCatalogChunks(catalog_xml):
+    digest = hashlib.sha256(chunk).hexdigest()
+    digests.append(digest)
+    if digest not in stored_digests:
+      stored_digests.add(digest)
+      new_chunks.append(models.AppleSUSCatalogChunk(
+          key_name=digest, data=db.Blob(zlib.compress(chunk))))
+  db.put(new_chunks)
+  return digests
+
+
+def GetAppleSUSCatalogBackupXml(backup):
+  """Returns the catalog XML of a backup.
+
+  Args:
+    backup: models.AppleSUSCatalog backup entity.
+  Returns:
+    str catalog XML.
+  Raises:
+    CatalogChunkMissingError: a chunk of the backup does not exist.
+  """
+  if not backup.chunk_digests:
+    return backup.plist  # backups used to hold the plist.
+  chunks = models.AppleSUSCatalogChunk.get_by_key_name(backup.chunk_digests)
+  if None in chunks:
+    raise CatalogChunkMissingError(backup.key().name())
+  return ''.join(zlib.decompress(chunk.data) for chunk in chunks)
+
+
+def _GetBackupQuery():
+  """Returns a keys only query of all catalog backups.
+
+  Backup key names sort by catalog, then timestamp.
+  """
+  query = models.AppleSUSCatalog.all(keys_only=True)
+  query.filter('__key__ >', db.Key.from_path(
+      models.AppleSUSCatalog.kind(), BACKUP_KEY_PREFIX))
+  query.filter('__key__ <', db.Key.from_path(
+      models.AppleSUSCatalog.kind(), BACKUP_KEY_PREFIX[:-1] + '`'))
+  return query
+
+
+def GetAppleSUSCatalogBackupKeyNames():
+  """Returns a list of str backup key names, newest first per catalog."""
+  return [key.name() for key in _GetBackupQuery()][::-1]
+
+
+def RestoreAppleSUSCatalogBackup(backup_key_name):
+  """Serves a backup as the catalog of its os_version and track.
+
+  The catalog is overwritten again the next time it is generated.
+
+  Args:
+    backup_key_name: str key name of a models.AppleSUSCatalog backup, like
+      backup_<os_version>_<track>_<timestamp>.
+  Returns:
+    models.AppleSUSCatalog object being served.
+  Raises:
+    ValueError: the backup does not exist.
+    CatalogChunkMissingError: a chunk of the backup does not exist.
+  """
+  backup = models.AppleSUSCatalog.get_by_key_name(backup_key_name)
+  if not backup or not backup_key_name.startswith(BACKUP_KEY_PREFIX):
+    raise ValueError('Backup does not exist: %s' % backup_key_name)
+  key_name = backup_key_name[len(BACKUP_KEY_PREFIX):].rsplit('_', 1)[0]
+  c = models.AppleSUSCatalog(key_name=key_name)
+  c.plist = GetAppleSUSCatalogBackupXml(backup)
+  c.chunk_digests = backup.chunk_digests
+  c.put()
+  models.AppleSUSCatalog.DeleteMemcacheWrap(key_name)
+  logging.info('Restored catalog %s from %s', key_name, backup_key_name)
+  return c
+
+
+def CleanupAppleSUSCatalogBackups(now=None):
+  """Deletes expired catalog backups, and chunks no catalog references.
+
+  Backups older than BACKUP_RETENTION_DAYS are deleted, except the newest
+  BACKUP_MIN_KEPT of each catalog.
+
+  Args:
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time.
+  Returns:
+    tuple of int number of deleted backups and chunks.
+  """
+  now = now or datetime.datetime.utcnow()
+  # chunks stored from now on may belong to catalogs being generated, which
+  # are not referenced yet.
+  chunk_cutoff = now - CHUNK_GC_GRACE
+  backup_cutoff = (now - datetime.timedelta(days=BACKUP_RETENTION_DAYS)
+                  ).strftime('%Y-%m-%d-%H-%M-%S')
+
+  backups = {}
+  for key in _GetBackupQuery():
+    key_name, timestamp = key.name().rsplit('_', 1)
+    backups.setdefault(key_name, []).append((timestamp, key))
+  expired = []
+  kept = []
+  for catalog_backups in backups.itervalues():
+    catalog_backups.sort(reverse=True)
+    for i, (timestamp, key) in enumerate(catalog_backups):
+      if i >= BACKUP_MIN_KEPT and timestamp < backup_cutoff:
+        expired.append(key)
+      else:
+        kept.append(key)
+  db.delete(expired)
+
+  # queries are eventually consistent, so only keys are queried and the
+  # current catalogs are read by key.
+  served_query = models.AppleSUSCatalog.all(keys_only=True).filter(
+      '__key__ <', db.Key.from_path(
+          models.AppleSUSCatalog.kind(), BACKUP_KEY_PREFIX))
+  referenced = set()
+  for c in db.get(list(served_query) + kept):
+    if c:
+      referenced.update(c.chunk_digests)
+
+  deleted = 0
+  chunk_query = models.AppleSUSCatalogChunk.all(keys_only=True).filter(
+      'mtime <', chunk_cutoff)
+  for key in chunk_query:
+    if key.name() not in referenced:
+      deleted += db.run_in_transaction(_DeleteChunk, key, chunk_cutoff)
+
+  logging.info(
+      'Deleted %d Apple SUS catalog backups, %d chunks', len(expired), deleted)
+  return len(expired), deleted
+
+
+def _DeleteChunk(key, chunk_cutoff):
+  """Deletes a chunk unless it was stored again since chunk_cutoff.
+
+  Catalogs only reference chunks which were referenced before, or which they
+  stored, so a chunk which is stored again for a new catalog is kept.
+
+  Args:
+    key: db.Key of a models.AppleSUSCatalogChunk.
+    chunk_cutoff: datetime.datetime, only chunks stored before are deleted.
+  Returns:
+    int number of deleted chunks.
   """
-  logging.info('Generating catalog: %s_%s', os_version, track)
+  chunk = db.get(key)
+  if not chunk or chunk.mtime >= chunk_cutoff:
+    return 0
+  chunk.delete()
+  return 1
+
+
+def GenerateAppleSUSTrackCatalogs(
+    os_version, tracks, datetime_=datetime.datetime, catalog_locks=None):
+  """Generates Apple SUS catalogs for a given os_version and tracks.
+
+  This function loads and parses the untouched/raw Apple SUS catalog once,
+  serializes each product approved for any of the tracks once, then saves a
+  new catalog (plist/xml) per track to Datastore for client consumption,
+  assembled from the product XML. A track's catalog is not saved again if it
+  would be generated from the same untouched catalog and approved products.
+
+  Args:
+    os_version: str OS version to generate the catalogs for.
+    tracks: list of str track names to generate the catalogs for.
+    datetime_: datetime module; only used for stub during testing.
+    catalog_locks: list of datastore_lock.DatastoreLock; If provided, the
+                   locks to release upon completion of the operation.
+  Returns:
+    dict of str track name to models.AppleSUSCatalog object. Empty if there
+    is no "untouched" catalog for the os_version.
+  """
+  try:
+    return _GenerateAppleSUSTrackCatalogs(os_version, tracks, datetime_)
+  finally:
+    for catalog_lock in catalog_locks or []:
+      catalog_lock.Release()
+
+
+def _GenerateAppleSUSTrackCatalogs(os_version, tracks, datetime_):
+  """Generates Apple SUS catalogs; see GenerateAppleSUSTrackCatalogs()."""
+  logging.info('Generating catalogs: %s_%s', os_version, ','.join(tracks))
 
   catalog_key = '%s_untouched' % os_version
   untouched_catalog_obj = models.AppleSUSCatalog.get_by_key_name(catalog_key)
   if not untouched_catalog_obj:
     logging.warning('Apple Update catalog does not exist: %s', catalog_key)
-    if catalog_lock:
-      catalog_lock.Release()
-    return None, None
-  untouched_catalog_plist = plist.ApplePlist(untouched_catalog_obj.plist)
+    return {}
+  # the plist property is decompressed on every access.
+  untouched_catalog_xml = untouched_catalog_obj.plist
+  untouched_digest = hashlib.sha256(
+      untouched_catalog_xml.encode('utf-8')).hexdigest()
+  untouched_catalog_plist = plist.ApplePlist(untouched_catalog_xml)
   untouched_catalog_plist.Parse()
+  catalog = untouched_catalog_plist.GetContents()
+  products = catalog.pop('Products', None)
+
+  approved_product_ids = _GetApprovedProductIds(tracks)
+  products_xml = None
+  if products is not None:
+    products_xml = {}
+    for product_id in set().union(*approved_product_ids.values()):
+      if product_id in products:
+        products_xml[product_id] = _GetProductXml(
+            product_id, products[product_id])
 
-  approved_product_ids = set()
-  products_query = models.AppleSUSProduct.AllActive().filter('tracks =', track)
-  for product in products_query:
-    approved_product_ids.add(product.product_id)
-
-  product_ids = untouched_catalog_plist.get('Products', {}).keys()
-  new_plist = untouched_catalog_plist
-  for product_id in product_ids:
-    if product_id not in approved_product_ids:
-      del new_plist['Products'][product_id]
-
-  catalog_plist_xml = new_plist.GetXml()
-
-  # Save the catalog using a time-specific key for rollback purposes.
   now = datetime_.utcnow()
   now_str = now.strftime('%Y-%m-%d-%H-%M-%S')
-  backup = models.AppleSUSCatalog(
-      key_name='backup_%s_%s_%s' % (os_version, track, now_str))
-  backup.plist = catalog_plist_xml
-  backup.put()
-  # Overwrite the catalog being served for this os_version/track pair.
-  c = models.AppleSUSCatalog(key_name='%s_%s' % (os_version, track))
-  c.plist = catalog_plist_xml
-  c.put()
-
-  if catalog_lock:
-    catalog_lock.Release()
-
-  return c, new_plist
+  key_names = ['%s_%s' % (os_version, track) for track in tracks]
+  catalogs = {}
+  stored_digests = set()
+  for track, key_name, c in zip(
+      tracks, key_names, models.AppleSUSCatalog.get_by_key_name(key_names)):
+    product_ids = sorted(approved_product_ids[track].intersection(
+        products_xml or []))
+    source_digest = hashlib.sha256(
+        '\0'.join([untouched_digest] + product_ids).encode('utf-8')).hexdigest()
+    if c and c.source_digest == source_digest:
+      logging.info('Catalog unchanged: %s', key_name)
+      catalogs[track] = c
+      continue
+
+    catalog_plist_xml = _GetCatalogXml(catalog, products_xml, product_ids)
+    # chunks of the catalog being replaced exist, as it references them.
+    if c:
+      stored_digests.update(c.chunk_digests)
+    chunk_digests = _PutCatalogChunks(catalog_plist_xml, stored_digests)
+
+    # Save a reference to the catalog chunks, using a time-specific key for
+    # rollback purposes.
+    backup = models.AppleSUSCatalog(
+        key_name='%s%s_%s_%s' % (BACKUP_KEY_PREFIX, os_version, track, now_str))
+    backup.chunk_digests = chunk_digests
+    backup.put()
+    # Overwrite the catalog being served for this os_version/track pair.
+    c = models.AppleSUSCatalog(key_name=key_name)
+    c.plist = catalog_plist_xml
+    c.source_digest = source_digest
+    c.chunk_digests = chunk_digests
+    c.put()
+    models.AppleSUSCatalog.DeleteMemcacheWrap(key_name)
+    catalogs[track] = c
+
+  return catalogs
 
 
 def GenerateAppleSUSMetadataCatalog():
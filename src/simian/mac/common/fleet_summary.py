@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Incrementally maintained summary of all active computers.
+
+A fleet summary is a dict of nested dicts of int counts:
+
+  hours: dict of int hour since the epoch of the last preflight, to dict with
+      active, all_pkgs_installed and all_apple_updates_installed counts, and
+      tracks, a dict of str track to count.
+  os_versions, client_versions, sites_histogram: dict of str value to count.
+  conns_on_corp, conns_off_corp: int total connection counts.
+
+As each computer adds its own counts, a change to a computer is applied by
+merging a delta which removes its old counts and adds its new ones. Counts
+which reach zero are removed.
+"""
+
+import calendar
+import datetime
+
+from simian.mac import models
+
+
+def GetHour(dt):
+  """Returns the int hour since the epoch of a UTC datetime."""
+  return calendar.timegm(dt.utctimetuple()) / 3600
+
+
+def Merge(summary, delta):
+  """Adds the counts of a delta to a summary, in place.
+
+  Args:
+    summary: dict fleet summary to update.
+    delta: dict fleet summary of count changes.
+  """
+  for k, v in delta.iteritems():
+    if isinstance(v, dict):
+      sub_summary = summary.setdefault(k, {})
+      Merge(sub_summary, v)
+      if not sub_summary:
+        del summary[k]
+    else:
+      count = summary.get(k, 0) + v
+      if count:
+        summary[k] = count
+      else:
+        summary.pop(k, None)
+
+
+def AddComputer(summary, c, count=1):
+  """Adds the counts of a Computer to a fleet summary, in place.
+
+  Args:
+    summary: dict fleet summary to update.
+    c: models.Computer entity; inactive computers are not counted.
+    count: int, 1 to add the computer, or -1 to remove it.
+  """
+  if not c.active:
+    return
+
+  delta = {
+      'os_versions': {str(c.os_version): count},
+      'client_versions': {str(c.client_version): count},
+      'sites_histogram': {str(c.site): count},
+      'conns_on_corp': (c.connections_on_corp or 0) * count,
+      'conns_off_corp': (c.connections_off_corp or 0) * count,
+  }
+  if c.preflight_datetime:
+    delta['hours'] = {GetHour(c.preflight_datetime): {
+        'active': count,
+        'all_pkgs_installed': c.all_pkgs_installed and count or 0,
+        'all_apple_updates_installed': (
+            getattr(c, 'all_apple_updates_installed', False) and count or 0),
+        'tracks': {c.track: count},
+    }}
+  Merge(summary, delta)
+
+
+def Prune(summary, now=None):
+  """Removes hours older than COMPUTER_ACTIVE_DAYS from a fleet summary.
+
+  Args:
+    summary: dict fleet summary to update.
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time
+  """
+  if now is None:
+    now = datetime.datetime.utcnow()
+  oldest_hour = GetHour(now) - models.COMPUTER_ACTIVE_DAYS * 24
+  hours = summary.get('hours', {})
+  for hour in [h for h in hours if h < oldest_hour]:
+    del hours[hour]
+
+
+def Update(delta):
+  """Applies a delta to the fleet summary in Datastore.
+
+  Nothing is applied until the reports_cache summary cron has stored a full
+  fleet summary to apply deltas to.
+
+  Args:
+    delta: dict fleet summary of count changes.
+  """
+  summary, mtime = models.ReportsCache.GetFleetSummary()
+  if mtime is None:
+    return
+  Merge(summary, delta)
+  Prune(summary)
+  models.ReportsCache.SetFleetSummary(summary)
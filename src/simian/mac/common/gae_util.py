@@ -36,6 +36,37 @@ def BatchDatastoreOp(op, entities_or_keys, batch_size=25):
     op(entities_or_keys[i:i + batch_size])
 
 
+def BatchDatastoreOpAsync(op_async, entities_or_keys, batch_size=25):
+  """Performs overlapping async Datastore operations on a sequence.
+
+  Every batch RPC is issued before waiting on any of them, so the batches
+  run concurrently rather than one after another.
+
+  Args:
+    op_async: func, async Datastore operation, i.e. db.put_async.
+    entities_or_keys: sequence, db.Key or db.Model instances.
+    batch_size: int, number of keys or entities to batch per operation.
+  Returns:
+    list of the results of each batch, in order.
+  Raises:
+    db.Error, or any other exception raised by a batch RPC, once all batches
+    have completed.
+  """
+  rpcs = [op_async(entities_or_keys[i:i + batch_size])
+          for i in xrange(0, len(entities_or_keys), batch_size)]
+  results = []
+  error = None
+  for rpc in rpcs:
+    try:
+      results.append(rpc.get_result())
+    except Exception as e:  # pylint: disable=broad-except
+      results.append(None)
+      error = error or e
+  if error is not None:
+    raise error
+  return results
+
+
 def SafeBlobDel(blobstore_key):
   """Helper method to delete a blob by its key.
 
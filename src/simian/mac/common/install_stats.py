@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Per-package install statistics, pre-aggregated into time buckets.
+
+Install stats are a dict of str package name to dict with install_count,
+install_fail_count, duration_count and duration_total_seconds int counts, and
+the applesus bool of the package; the same format as install counts.
+
+Stats of ingested InstallLog entities are buffered in a pull queue by
+LogInstalls(), then Flush() adds them to hour and day buckets, keyed by the
+install mtime, and to the install counts of all time. Stats of any recent
+window are then a sum of a few dozen buckets.
+
+Buffered stats are counted at most once: Flush() deletes leased tasks before
+adding their stats, so stats of tasks deleted by a Flush() which then fails
+are lost rather than added again by the next Flush().
+"""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.runtime import apiproxy_errors
+
+from simian.mac import models
+from simian.mac.common import datastore_locks
+from simian.mac.common import fleet_summary
+from simian.mac.common import util
+
+
+QUEUE = 'install-stats'
+FLUSH_LOCK_NAME = 'install_stats_flush_lock'
+FLUSH_MAX = 1000
+FLUSH_LEASES = 10
+LEASE_SECS = 300
+
+# int number of hour and day buckets kept, besides the current ones.
+HOURS_KEPT = 48
+DAYS_KEPT = 30
+
+HOURS = 'hours'
+DAYS = 'days'
+
+
+def _GetInstallStats(install):
+  """Returns install stats of a single InstallLog entity."""
+  stats = {
+      'install_count': 0,
+      'install_fail_count': 0,
+      'applesus': install.applesus,
+      'duration_count': 0,
+      'duration_total_seconds': 0,
+  }
+  if install.IsSuccess():
+    stats['install_count'] = 1
+    # only proceed if entity has "duration_seconds" property != None.
+    if getattr(install, 'duration_seconds', None) is not None:
+      stats['duration_count'] = 1
+      stats['duration_total_seconds'] = install.duration_seconds
+  else:
+    stats['install_fail_count'] = 1
+  return {install.package: stats}
+
+
+def Merge(stats, delta):
+  """Adds install stats to other install stats, in place.
+
+  Args:
+    stats: dict install stats to update.
+    delta: dict install stats to add.
+  """
+  for pkg, counts in delta.iteritems():
+    pkg_stats = stats.setdefault(pkg, {'applesus': counts.get('applesus')})
+    for key in ['install_count', 'install_fail_count', 'duration_count',
+                'duration_total_seconds']:
+      pkg_stats[key] = pkg_stats.get(key, 0) + counts.get(key, 0)
+
+
+def LogInstalls(installs, name=None):
+  """Buffers the install stats of InstallLog entities, for Flush().
+
+  Args:
+    installs: list of models.InstallLog entities which have been written.
+    name: str, optional, task name identifying the installs; stats are only
+        buffered once per name.
+  """
+  hours = {}
+  for install in installs:
+    Merge(hours.setdefault(fleet_summary.GetHour(install.mtime), {}),
+          _GetInstallStats(install))
+  if not hours:
+    return
+  try:
+    taskqueue.Queue(QUEUE).add(taskqueue.Task(
+        payload=util.Serialize(hours), method='PULL', name=name))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('LogInstalls: %s already buffered.', name)
+  except (taskqueue.Error, apiproxy_errors.Error) as e:
+    logging.warning(
+        'LogInstalls error %s: %s', e.__class__.__name__, str(e))
+
+
+def Flush(install_counts=True, now=None, on_drained=None):
+  """Adds buffered install stats to buckets and install counts.
+
+  Flushes are chained by deferred tasks until the queue is drained.
+
+  Args:
+    install_counts: bool, True to also add the stats to install counts.
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time
+    on_drained: callable, optional, called while the flush lock is still
+      held once all buffered stats are flushed; not called if stats remain.
+  """
+  lock = datastore_locks.DatastoreLock(FLUSH_LOCK_NAME)
+  try:
+    lock.Acquire(timeout=600, max_acquire_attempts=1)
+  except datastore_locks.AcquireLockError:
+    logging.warning('install_stats.Flush: lock found; exiting.')
+    return
+
+  remaining = False
+  try:
+    queue = taskqueue.Queue(QUEUE)
+    for _ in xrange(FLUSH_LEASES):
+      tasks = queue.lease_tasks(LEASE_SECS, FLUSH_MAX)
+      if not tasks:
+        break
+      hours = {}
+      for task in tasks:
+        # serialized int hour keys are deserialized as str.
+        for hour, stats in util.Deserialize(task.payload).iteritems():
+          Merge(hours.setdefault(int(hour), {}), stats)
+      # delete before writing, so a failed write never leaves tasks to be
+      # counted again.
+      queue.delete_tasks(tasks)
+      _WriteInstallStats(hours, install_counts, now)
+      remaining = len(tasks) == FLUSH_MAX
+      if not remaining:
+        break
+    if not remaining and on_drained is not None:
+      on_drained()
+  finally:
+    lock.Release()
+
+  if remaining:
+    deferred.defer(Flush, install_counts=install_counts)
+
+
+def _WriteInstallStats(hours, install_counts, now):
+  """Adds install stats to buckets and install counts.
+
+  Args:
+    hours: dict of int hour to dict install stats of installs in that hour.
+    install_counts: bool, True to also add the stats to install counts.
+    now: datetime.datetime, or None for the current date/time.
+  """
+  if now is None:
+    now = datetime.datetime.utcnow()
+  now_hour = fleet_summary.GetHour(now)
+
+  hour_buckets, unused_dt = models.ReportsCache.GetInstallStats(HOURS)
+  day_buckets, unused_dt = models.ReportsCache.GetInstallStats(DAYS)
+  total = {}
+  for hour, stats in hours.iteritems():
+    Merge(hour_buckets.setdefault(hour, {}), stats)
+    Merge(day_buckets.setdefault(hour / 24, {}), stats)
+    Merge(total, stats)
+  for hour in [h for h in hour_buckets if h < now_hour - HOURS_KEPT]:
+    del hour_buckets[hour]
+  for day in [d for d in day_buckets if d < now_hour / 24 - DAYS_KEPT]:
+    del day_buckets[day]
+  models.ReportsCache.SetInstallStats(HOURS, hour_buckets)
+  models.ReportsCache.SetInstallStats(DAYS, day_buckets)
+
+  if install_counts:
+    pkgs, unused_dt = models.ReportsCache.GetInstallCounts()
+    Merge(pkgs, total)
+    for pkg in total:
+      if pkgs[pkg]['duration_count']:
+        pkgs[pkg]['duration_seconds_avg'] = int(
+            pkgs[pkg]['duration_total_seconds'] /
+            pkgs[pkg]['duration_count'])
+      else:
+        pkgs[pkg]['duration_seconds_avg'] = None
+    models.ReportsCache.SetInstallCounts(pkgs)
+
+
+def GetInstallStats(since_hours, now=None):
+  """Returns install stats of installs in the past since_hours hours.
+
+  Stats are only kept per hour, so the window covers the current hour so
+  far and the since_hours whole hours before it; stats of the past hour are
+  those of the last 60 to 120 minutes. Windows of up to HOURS_KEPT hours are
+  summed from hour buckets, longer windows from the UTC day buckets covering
+  them, i.e. are rounded up to whole days.
+
+  Args:
+    since_hours: int number of hours.
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time
+  Returns:
+    dict install stats.
+  """
+  if now is None:
+    now = datetime.datetime.utcnow()
+  first_hour = fleet_summary.GetHour(now) - since_hours
+  if since_hours <= HOURS_KEPT:
+    buckets, unused_dt = models.ReportsCache.GetInstallStats(HOURS)
+    first_bucket = first_hour
+  else:
+    buckets, unused_dt = models.ReportsCache.GetInstallStats(DAYS)
+    first_bucket = first_hour / 24
+
+  stats = {}
+  for bucket, bucket_stats in buckets.iteritems():
+    if bucket >= first_bucket:
+      Merge(stats, bucket_stats)
+  return stats
@@ -18,8 +18,17 @@
 
 """IP utility functions."""
 
+import bisect
+import logging
 
 
+IPV4_BITS = 32
+IPV6_BITS = 128
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+# IPv4-mapped IPv6 addresses, ::ffff:0:0/96.
+_IPV4_MAPPED_FIRST = 0xffff << 32
+_IPV4_MAPPED_LAST = _IPV4_MAPPED_FIRST | 0xffffffff
+
 
 def IpToInt(ip):
   """Return a integer for an IP string.
@@ -77,3 +86,163 @@ def IpMaskMatch(ip, ip_mask):
   (ip_int_mask, ip_int_mask_bits) = IpMaskToInts(ip_mask)
   ip_int = IpToInt(ip)
   return (ip_int & ip_int_mask_bits) == ip_int_mask
+
+
+def _Ipv4ToInt(ip):
+  """Return an integer for an IPv4 address string, strictly validated.
+
+  Args:
+    ip: str, IPv4 address, like "192.168.0.1"
+  Returns:
+    int
+  Raises:
+    ValueError: if ip is not a valid IPv4 address.
+  """
+  octets = ip.split('.')
+  if len(octets) != 4:
+    raise ValueError('Invalid IPv4 address: %s' % ip)
+  ip_int = 0
+  for octet in octets:
+    if not octet.isdigit() or int(octet) > 255:
+      raise ValueError('Invalid IPv4 address: %s' % ip)
+    ip_int = (ip_int << 8) | int(octet)
+  return ip_int
+
+
+def _Ipv6ToInt(ip):
+  """Return an integer for an IPv6 address string.
+
+  Args:
+    ip: str, IPv6 address, like "2620:0:1003::1" or "::ffff:10.0.0.1"
+  Returns:
+    int
+  Raises:
+    ValueError: if ip is not a valid IPv6 address.
+  """
+  if ip.count('::') > 1:
+    raise ValueError('Invalid IPv6 address: %s' % ip)
+  head, sep, tail = ip.partition('::')
+  head_groups = head and head.split(':') or []
+  tail_groups = tail and tail.split(':') or []
+
+  # the last 32 bits may be written in IPv4 dotted decimal notation.
+  if sep:
+    last_groups = tail_groups
+  else:
+    last_groups = head_groups
+  if last_groups and '.' in last_groups[-1]:
+    ipv4_int = _Ipv4ToInt(last_groups[-1])
+    last_groups[-1:] = ['%x' % (ipv4_int >> 16), '%x' % (ipv4_int & 0xffff)]
+
+  missing = 8 - len(head_groups) - len(tail_groups)
+  if missing < int(bool(sep)) or (not sep and missing):
+    raise ValueError('Invalid IPv6 address: %s' % ip)
+
+  ip_int = 0
+  for group in head_groups + ['0'] * missing + tail_groups:
+    if not 1 <= len(group) <= 4 or not _HEX_DIGITS.issuperset(group):
+      raise ValueError('Invalid IPv6 address: %s' % ip)
+    ip_int = (ip_int << 16) | int(group, 16)
+  return ip_int
+
+
+def IpToVersionInt(ip):
+  """Return the IP version and an integer for an IPv4 or IPv6 string.
+
+  IPv4-mapped IPv6 addresses, like "::ffff:10.0.0.1", are returned as the
+  IPv4 address they map.
+
+  Args:
+    ip: str, IP address, like "192.168.0.1" or "2620:0:1003::1"
+  Returns:
+    (int version, 4 or 6, int ip)
+  Raises:
+    ValueError: if ip is not a valid IP address.
+  """
+  if ':' not in ip:
+    return 4, _Ipv4ToInt(ip)
+  ip_int = _Ipv6ToInt(ip)
+  if _IPV4_MAPPED_FIRST <= ip_int <= _IPV4_MAPPED_LAST:
+    return 4, ip_int & 0xffffffff
+  return 6, ip_int
+
+
+def IpMaskToRange(ip_mask):
+  """Transform a network/mask string into the range of IPs it contains.
+
+  A network without a mask is a single host, i.e. /32 or /128.
+
+  Args:
+    ip_mask: str, IP network, like "192.168.0.0/24" or "2620:0:1003::/48"
+  Returns:
+    (int version, 4 or 6, int first ip, int last ip)
+  Raises:
+    ValueError: if ip_mask is not a valid IP network.
+  """
+  net, sep, mask = ip_mask.partition('/')
+  if ':' in net:
+    version, bits, net_int = 6, IPV6_BITS, _Ipv6ToInt(net)
+  else:
+    version, bits, net_int = 4, IPV4_BITS, _Ipv4ToInt(net)
+  if not sep:
+    mask = bits
+  elif mask.isdigit() and int(mask) <= bits:
+    mask = int(mask)
+  else:
+    raise ValueError('Invalid IP mask: %s' % ip_mask)
+  host_bits = (1 << (bits - mask)) - 1
+  first = net_int & ~host_bits
+  return version, first, first | host_bits
+
+
+class IpMatcher(object):
+  """Matches IPv4 and IPv6 addresses against a list of IP networks.
+
+  The networks are compiled into sorted tables of merged, non-overlapping
+  ranges per IP version, so a match is a binary search instead of a test of
+  every network.
+  """
+
+  def __init__(self, ip_masks):
+    """Constructor.
+
+    Args:
+      ip_masks: iterable of str IP networks, like "192.168.0.0/24";
+        invalid networks are logged and skipped.
+    """
+    ranges = {4: [], 6: []}
+    for ip_mask in ip_masks:
+      try:
+        version, first, last = IpMaskToRange(ip_mask)
+      except ValueError:
+        logging.warning('IpMatcher: skipping invalid IP mask %r', ip_mask)
+        continue
+      ranges[version].append((first, last))
+
+    self._firsts = {}
+    self._lasts = {}
+    for version, version_ranges in ranges.iteritems():
+      firsts = []
+      lasts = []
+      for first, last in sorted(version_ranges):
+        if lasts and first <= lasts[-1] + 1:
+          lasts[-1] = max(lasts[-1], last)
+        else:
+          firsts.append(first)
+          lasts.append(last)
+      self._firsts[version] = firsts
+      self._lasts[version] = lasts
+
+  def Match(self, ip):
+    """Check if an IP is inside any of the networks.
+
+    Args:
+      ip: str, IP address, like "192.168.0.1" or "2620:0:1003::1"
+    Returns:
+      True or False
+    Raises:
+      ValueError: if ip is not a valid IP address.
+    """
+    version, ip_int = IpToVersionInt(ip)
+    i = bisect.bisect_right(self._firsts[version], ip_int) - 1
+    return i >= 0 and ip_int <= self._lasts[version][i]
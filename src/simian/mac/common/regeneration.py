@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Coalescing scheduler of catalog and manifest regenerations.
+
+Request() marks a regeneration of a name as pending in memcache, and defers a
+single task for it; requests while it is pending are coalesced into that task.
+The task calls Begin(), which defers the task again until no request arrived
+for QUIET_SECS, or MAX_WAIT_SECS passed since the first request, then clears
+the pending marker before the regeneration, so that requests arriving during
+it schedule another one.
+
+Pending markers evicted from memcache at worst cause an extra regeneration.
+While memcache is unavailable, requests are instead coalesced into a task
+named after their QUIET_SECS window, which regenerates without further delay.
+"""
+
+import datetime
+import logging
+import math
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+
+CATALOG = 'catalog'
+MANIFEST = 'manifest'
+
+# int seconds without requests before a pending regeneration runs.
+QUIET_SECS = 5
+# int max seconds a regeneration is delayed by further requests.
+MAX_WAIT_SECS = 60
+# int seconds pending markers expire after, should their task be lost.
+PENDING_SECS = 600
+
+PENDING_MEMCACHE_KEY = 'regeneration_pending_%s_%s'
+LAST_REQUEST_MEMCACHE_KEY = 'regeneration_last_request_%s_%s'
+STATS_MEMCACHE_KEY = 'regeneration_stats_%s_%s'
+
+REQUESTED = 'requested'
+SCHEDULED = 'scheduled'
+EXECUTED = 'executed'
+
+
+def _IncrStat(kind, stat):
+  memcache.incr(STATS_MEMCACHE_KEY % (kind, stat), initial_value=0)
+
+
+def _Defer(kind, name, func, countdown, window=None):
+  """Defers func(name) by countdown seconds.
+
+  Args:
+    kind: str, CATALOG or MANIFEST.
+    name: str, name of the catalog or manifest.
+    func: callable, called with name by the task.
+    countdown: int, seconds to defer the task by.
+    window: int, optional, QUIET_SECS window to name the task after, so only
+        one task is deferred per window.
+  """
+  if window is None:
+    now = datetime.datetime.utcnow()
+    suffix = '%s-%d' % (now.strftime('%Y-%m-%d-%H-%M-%S'), now.microsecond)
+  else:
+    suffix = 'w%d' % window
+  deferred_name = 'regenerate-%s-%s-%s' % (kind, name, suffix)
+  deferred.defer(func, name, _name=deferred_name, _countdown=countdown)
+
+
+def Request(kind, name, func, delay):
+  """Requests a regeneration, coalesced with a pending one.
+
+  Args:
+    kind: str, CATALOG or MANIFEST.
+    name: str, name of the catalog or manifest.
+    func: callable, called with name by a task, which must call Begin() and
+        only regenerate if it returns True.
+    delay: int, seconds to defer the task by, if none is pending.
+  Returns:
+    bool, True if a task was deferred, False if coalesced with a pending one.
+  """
+  now = time.time()
+  _IncrStat(kind, REQUESTED)
+  memcache.set(LAST_REQUEST_MEMCACHE_KEY % (kind, name), now, time=PENDING_SECS)
+  pending_key = PENDING_MEMCACHE_KEY % (kind, name)
+  if not memcache.add(pending_key, now, time=PENDING_SECS):
+    if memcache.get(pending_key) is not None:
+      logging.debug('Regeneration of %s %s is pending.', kind, name)
+      return False
+    # memcache is unavailable.
+    try:
+      _Defer(kind, name, func, delay, window=int(now) / QUIET_SECS)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Regeneration of %s %s is pending.', kind, name)
+      return False
+    _IncrStat(kind, SCHEDULED)
+    return True
+  try:
+    _Defer(kind, name, func, delay)
+  except Exception:  # pylint: disable=broad-except
+    memcache.delete(pending_key)
+    raise
+  _IncrStat(kind, SCHEDULED)
+  return True
+
+
+def Begin(kind, name, func):
+  """Begins a requested regeneration, unless requests are still arriving.
+
+  Args:
+    kind: str, CATALOG or MANIFEST.
+    name: str, name of the catalog or manifest.
+    func: callable, deferred again with name if requests are still arriving.
+  Returns:
+    bool, True if the regeneration must run now, False if deferred again.
+  """
+  now = time.time()
+  pending_key = PENDING_MEMCACHE_KEY % (kind, name)
+  last_request_key = LAST_REQUEST_MEMCACHE_KEY % (kind, name)
+  cached = memcache.get_multi([pending_key, last_request_key])
+  first_request = cached.get(pending_key)
+  last_request = cached.get(last_request_key)
+  if first_request is not None and last_request is not None:
+    wait = min(last_request + QUIET_SECS,
+               first_request + MAX_WAIT_SECS) - now
+    if wait > 0:
+      _Defer(kind, name, func, int(math.ceil(wait)))
+      return False
+  memcache.delete(pending_key)
+  _IncrStat(kind, EXECUTED)
+  logging.info('Regenerating %s %s; stats: %s', kind, name, GetStats())
+  return True
+
+
+def GetStats():
+  """Returns regeneration counts since memcache last lost them.
+
+  Returns:
+    dict of str kind to dict of str REQUESTED, SCHEDULED and EXECUTED to int
+    count of regenerations requested, of tasks deferred for them, and of
+    regenerations run.
+  """
+  keys = {}
+  for kind in [CATALOG, MANIFEST]:
+    for stat in [REQUESTED, SCHEDULED, EXECUTED]:
+      keys[STATS_MEMCACHE_KEY % (kind, stat)] = (kind, stat)
+  cached = memcache.get_multi(keys.keys())
+  stats = {}
+  for key, (kind, stat) in keys.iteritems():
+    stats.setdefault(kind, {})[stat] = cached.get(key, 0)
+  return stats
@@ -18,6 +18,8 @@
 
 Classes:
   AppleSUSCatalogSync: syncs SUS catalogs from Apple.
+  AppleSUSAutoPromote: auto-promotes Apple Updates.
+  AppleSUSCatalogBackupCleanup: deletes expired SUS catalog backups.
 """
 
 import datetime
@@ -396,3 +398,11 @@ class AppleSUSAutoPromote(webapp2.RequestHandler):
 
     if promotions:
       self._NotifyAdminsOfAutoPromotions(promotions)
+
+
+class AppleSUSCatalogBackupCleanup(webapp2.RequestHandler):
+  """Class to delete expired Apple SUS catalog backups."""
+
+  def get(self):
+    """Delete expired catalog backups and their unreferenced chunks."""
+    applesus.CleanupAppleSUSCatalogBackups()
@@ -32,10 +32,13 @@ app = webapp2.WSGIApplication([
     # Apple SUS
     (r'/cron/applesus/catalogsync$', applesus.AppleSUSCatalogSync),
     (r'/cron/applesus/autopromote$', applesus.AppleSUSAutoPromote),
+    (r'/cron/applesus/backup_cleanup$', applesus.AppleSUSCatalogBackupCleanup),
 
 
     # Maintenance
     ('/cron/maintenance/authsession_cleanup', maintenance.AuthSessionCleanup),
+    ('/cron/maintenance/flush_client_connections',
+     maintenance.FlushClientConnections),
     ('/cron/maintenance/mark_computers_inactive',
      maintenance.MarkComputersInactive),
     ('/cron/maintenance/verify_packages', maintenance.VerifyPackages),
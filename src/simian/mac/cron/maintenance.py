@@ -38,6 +38,7 @@ from simian.mac import common
 from simian.mac import models
 from simian.mac.common import gae_util
 from simian.mac.common import mail
+from simian.mac.munki import common as munki_common
 
 
 class AuthSessionCleanup(webapp2.RequestHandler):
@@ -82,6 +83,16 @@ class AuthSessionCleanup(webapp2.RequestHandler):
         auth_base.AGE_APPLESUS_TOKEN_SECONDS)
 
 
+class FlushClientConnections(webapp2.RequestHandler):
+  """Class to flush client connection logs a scheduled flush may have missed."""
+
+  def get(self):
+    """Handle GET."""
+    deferred.defer(
+        munki_common.FlushClientConnections,
+        _queue=munki_common.CLIENT_CONNECTION_FLUSH_QUEUE)
+
+
 class MarkComputersInactive(webapp2.RequestHandler):
   """Class to mark all inactive hosts as such in Datastore."""
 
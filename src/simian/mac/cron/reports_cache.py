@@ -31,12 +31,16 @@ from google.appengine.ext import db
 from google.appengine.ext import deferred
 
 from simian.mac.common import datastore_locks
+from simian.mac.common import fleet_summary
+from simian.mac.common import install_stats
 from simian.mac import models
 from simian.mac.admin import summary as summary_module
 
 
 TRENDING_INSTALLS_LIMIT = 5
 RUNTIME_MAX_SECS = 30
+PENDING_COUNTS_FETCH_LIMIT = 1000
+INSTALL_COUNTS_CURSOR_NAME = 'pkgs_list_cursor'
 
 
 class ReportsCache(webapp2.RequestHandler):
@@ -71,7 +75,7 @@ class ReportsCache(webapp2.RequestHandler):
         kwargs = {}
       _GenerateTrendingInstallsCache(**kwargs)
     elif name == 'pendingcounts':
-      self._GeneratePendingCounts()
+      _GeneratePendingCounts()
     elif name == 'msu_user_summary':
       if arg:
         try:
@@ -208,17 +212,67 @@ class ReportsCache(webapp2.RequestHandler):
 
     lock.Release()
 
-  def _GeneratePendingCounts(self):
-    """Generates a dictionary of all install names and their pending count."""
-    d = {}
-    for munki_name in [p.munki_name for p in models.PackageInfo.all()]:
-      d[munki_name] = models.Computer.AllActive(keys_only=True).filter(
-          'pkgs_to_install =', munki_name).count(999999)
-    models.ReportsCache.SetPendingCounts(d)
+def _GeneratePendingCounts(cursor=None, counts=None):
+  """Generates a dictionary of all install names and their pending count.
+
+  pkgs_to_install of all active computers is read with one projection query,
+  which yields a result per pending install per computer, so the counts of
+  every package are built in a single scan. The scan defers itself to resume
+  from its cursor after RUNTIME_MAX_SECS.
+
+  Between runs, FlushClientConnections() keeps the counts up to date with the
+  pkgs_to_install changes of each postflight.
+
+  Args:
+    cursor: str, optional, query cursor to resume the scan from.
+    counts: dict, optional, of str install name to int pending count so far.
+  """
+  if counts is None:
+    counts = {}
+  query = models.Computer.AllActive(projection=('pkgs_to_install',))
+  query.with_cursor(cursor)
+
+  begin = time.time()
+  while True:
+    computers = query.fetch(PENDING_COUNTS_FETCH_LIMIT)
+    if not computers:
+      break
+    for c in computers:
+      for pkg in c.pkgs_to_install:
+        counts[pkg] = counts.get(pkg, 0) + 1
+    query.with_cursor(query.cursor())
+    if time.time() - begin > RUNTIME_MAX_SECS:
+      deferred.defer(_GeneratePendingCounts, query.cursor(), counts)
+      return
+
+  models.ReportsCache.SetPendingCounts(counts)
+
+
+def _IsRebuildingInstallCounts():
+  """Returns True if install counts are being rebuilt from InstallLog."""
+  return models.KeyValueCache.get_by_key_name(
+      INSTALL_COUNTS_CURSOR_NAME) is not None
 
 
 def _GenerateInstallCounts():
-  """Generates a dictionary of all installs names and the count of each."""
+  """Adds buffered install stats to install counts, and their time buckets.
+
+  While a rebuild of install counts from all InstallLog entities is in
+  progress, the stats are only added to the time buckets, as the rebuild
+  counts their InstallLog entities.
+  """
+  rebuilding = _IsRebuildingInstallCounts()
+  install_stats.Flush(install_counts=not rebuilding)
+  if rebuilding:
+    _RebuildInstallCounts()
+
+
+def _RebuildInstallCounts():
+  """Counts all InstallLog entities into install counts, by cursor.
+
+  A rebuild is started by creating a KeyValueCache entity named
+  INSTALL_COUNTS_CURSOR_NAME, which is deleted once all entities are counted.
+  """
 
   # Obtain a lock.
   lock_name = 'pkgs_list_cron_lock'
@@ -234,8 +288,8 @@ def _GenerateInstallCounts():
 
   # Generate a query of all InstallLog entites that haven't been read yet.
   query = models.InstallLog.all().order('server_datetime')
-  cursor_obj = models.KeyValueCache.get_by_key_name('pkgs_list_cursor')
-  if cursor_obj:
+  cursor_obj = models.KeyValueCache.get_by_key_name(INSTALL_COUNTS_CURSOR_NAME)
+  if cursor_obj and cursor_obj.text_value:
     query.with_cursor(cursor_obj.text_value)
 
   # Loop over new InstallLog entries.
@@ -245,6 +299,11 @@ def _GenerateInstallCounts():
     installs = None
   if not installs:
     models.ReportsCache.SetInstallCounts(pkgs)
+    if cursor_obj:
+      # stats still buffered are of installs counted above, so they are only
+      # added to the time buckets before the rebuild completes; otherwise the
+      # next flush would add them to install counts again.
+      install_stats.Flush(install_counts=False, on_drained=cursor_obj.delete)
     lock.Release()
     return
 
@@ -280,7 +339,7 @@ def _GenerateInstallCounts():
   models.ReportsCache.SetInstallCounts(pkgs)
 
   if not cursor_obj:
-    cursor_obj = models.KeyValueCache(key_name='pkgs_list_cursor')
+    cursor_obj = models.KeyValueCache(key_name=INSTALL_COUNTS_CURSOR_NAME)
 
   cursor_txt = str(query.cursor())
   cursor_obj.text_value = cursor_txt
@@ -289,29 +348,27 @@ def _GenerateInstallCounts():
   # Delete the lock.
   lock.Release()
 
-  deferred.defer(_GenerateInstallCounts)
-
-
-def _GenerateTrendingInstallsCacheDeferCallback(
-    since_hours, query, cursor, total_success, total_failure,
-    trending):
-  """Defer task for _GenerateTrendingInstallsCache."""
-  installs = query.with_cursor(cursor).fetch(
-      summary_module.DEFAULT_COMPUTER_FETCH_LIMIT)
-  if installs:
-    for install in installs:
-      pkg = install.package.encode('utf-8')
-      if install.IsSuccess():
-        trending['success'][pkg] = trending['success'].setdefault(pkg, 0) + 1
-        total_success += 1
-      else:
-        trending['failure'][pkg] = trending['failure'].setdefault(pkg, 0) + 1
-        total_failure += 1
+  deferred.defer(_RebuildInstallCounts)
 
-    deferred.defer(
-        _GenerateTrendingInstallsCacheDeferCallback, since_hours, query,
-        query.cursor(), total_success, total_failure, trending)
-    return
+
+def _GenerateTrendingInstallsCache(since_hours=None):
+  """Generates trending install and failure data from install stats."""
+  if not since_hours:
+    since_hours = 1
+
+  install_stats.Flush(install_counts=not _IsRebuildingInstallCounts())
+
+  trending = {'success': {}, 'failure': {}}
+  total_success = 0
+  total_failure = 0
+  for pkg, counts in install_stats.GetInstallStats(since_hours).iteritems():
+    pkg = pkg.encode('utf-8')
+    if counts['install_count']:
+      trending['success'][pkg] = counts['install_count']
+      total_success += counts['install_count']
+    if counts['install_fail_count']:
+      trending['failure'][pkg] = counts['install_fail_count']
+      total_failure += counts['install_fail_count']
 
   # Get the top trending installs and failures.
   success = sorted(
@@ -331,19 +388,6 @@ def _GenerateTrendingInstallsCacheDeferCallback(
   models.ReportsCache.SetTrendingInstalls(since_hours, trending)
 
 
-def _GenerateTrendingInstallsCache(since_hours=None):
-  """Generates trending install and failure data."""
-  if not since_hours:
-    since_hours = 1
-
-  trending = {'success': {}, 'failure': {}}
-  dt = datetime.datetime.utcnow() - datetime.timedelta(minutes=since_hours * 60)
-  query = models.InstallLog.all().filter('mtime >', dt)
-
-  _GenerateTrendingInstallsCacheDeferCallback(
-      since_hours, query, None, 0, 0, trending)
-
-
 def IsTimeDelta(dt1, dt2, seconds=None, minutes=None, hours=None, days=None):
   """Returns delta if datetime values are within a time period.
 
@@ -376,14 +420,25 @@ def IsTimeDelta(dt1, dt2, seconds=None, minutes=None, hours=None, days=None):
     return delta
 
 
-def _GenerateComputersSummaryCache(cursor=None, summary=None):
+def _GenerateComputersSummaryCache(cursor=None, fleet=None):
+  """Reconciles the fleet summary with a full scan of active computers.
+
+  FlushClientConnections() keeps the fleet summary up to date as clients
+  connect; this corrects any drift, e.g. from computers marked inactive.
+
+  Args:
+    cursor: str, optional, query cursor to resume the scan from.
+    fleet: dict, optional, fleet summary of the computers scanned so far.
+  """
+  if fleet is None:
+    fleet = {}
   query = models.Computer.AllActive().with_cursor(cursor)
 
   computers = query.fetch(summary_module.DEFAULT_COMPUTER_FETCH_LIMIT)
   if computers:
-    summary = summary_module.GetComputerSummary(
-        computers, initial_summary=summary)
-    deferred.defer(_GenerateComputersSummaryCache, query.cursor(), summary)
+    for c in computers:
+      fleet_summary.AddComputer(fleet, c)
+    deferred.defer(_GenerateComputersSummaryCache, query.cursor(), fleet)
     return
-  models.ReportsCache.SetStatsSummary(
-      summary_module.PrepareComputerSummaryForTemplate(summary))
+  fleet_summary.Prune(fleet)
+  models.ReportsCache.SetFleetSummary(fleet)
@@ -21,9 +21,11 @@ import difflib
 import gc
 import logging
 import re
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 from simian.mac.common import ipcalc
 from simian.mac.common import gae_util
@@ -49,10 +51,39 @@ MEMCACHE_SECS = 300
 # causing that to be an unreliable upper-bound.
 _MEMCACHE_ENTITY_SIZE_LIMIT = 900000
 
+# Memcache key of the counter bumped on every manifest modification change.
+MANIFEST_MODS_VERSION_MEMCACHE_KEY = 'manifest_mods_version'
+
+# Max name index entities updated per cross-group transaction, which also
+# reads the indexed entity and spans at most 25 entity groups.
+NAME_INDEX_TRANSACTION_SIZE = 24
+# Max name index entities updated inline by a put; more are deferred, in
+# tasks of NAME_INDEX_TASK_SIZE each.
+NAME_INDEX_INLINE_SIZE = 96
+NAME_INDEX_TASK_SIZE = 480
+
+# Per instance cache of ipcalc.IpMatcher objects compiled from KeyValueCache
+# IP lists, keyed by key_name, with the mtime of the entity compiled.
+_IP_MATCHERS = {}
+
 
 class BaseModel(db.Model):
   """Abstract base model with useful generic methods."""
 
+  @classmethod
+  def _GetMemcacheWrapKey(cls, key_name, prop_name=None):
+    """Returns the memcache key of a MemcacheWrappedGet entity or property.
+
+    Args:
+      key_name: str key name of the entity.
+      prop_name: optional, default None, property name.
+    Returns:
+      str memcache key.
+    """
+    if prop_name:
+      return 'mwgpn_%s_%s_%s' % (cls.kind(), key_name, prop_name)
+    return 'mwg_%s_%s' % (cls.kind(), key_name)
+
   @classmethod
   def DeleteMemcacheWrap(cls, key_name, prop_name=None):
     """Deletes a cached entity or property from memcache.
@@ -61,11 +92,7 @@ class BaseModel(db.Model):
       key_name: str key name of the entity to delete.
       prop_name: optional, default None, property name to delete.
     """
-    if prop_name:
-      memcache_key = 'mwgpn_%s_%s_%s' % (cls.kind(), key_name, prop_name)
-    else:
-      memcache_key = 'mwg_%s_%s' % (cls.kind(), key_name)
-    memcache.delete(memcache_key)
+    memcache.delete(cls._GetMemcacheWrapKey(key_name, prop_name=prop_name))
 
   @classmethod
   def ResetMemcacheWrap(
@@ -102,10 +129,7 @@ class BaseModel(db.Model):
         returns None.
     """
     output = None
-    if prop_name:
-      memcache_key = 'mwgpn_%s_%s_%s' % (cls.kind(), key_name, prop_name)
-    else:
-      memcache_key = 'mwg_%s_%s' % (cls.kind(), key_name)
+    memcache_key = cls._GetMemcacheWrapKey(key_name, prop_name=prop_name)
 
     cached = memcache.get(memcache_key)
 
@@ -175,8 +199,7 @@ class BaseModel(db.Model):
     Returns:
       entities
     """
-    filter_str = '|'.join(map(lambda x: '_%s,%s_' % (x[0], x[1]), filters))
-    memcache_key = 'mwgaf_%s%s' % (cls.kind(), filter_str)
+    memcache_key = cls._GetMemcacheWrappedGetAllFilterKey(filters)
 
     entities = memcache.get(memcache_key)
     if entities is None:
@@ -188,6 +211,50 @@ class BaseModel(db.Model):
 
     return entities
 
+  @classmethod
+  def MemcacheWrappedGetAllFilterMulti(
+      cls, lookups, limit=1000, memcache_secs=MEMCACHE_SECS):
+    """Fetches entities for many filter sets, wrapped by Memcache.
+
+    All lookups are read from memcache with a single get_multi, and queries
+    for memcache misses are started together so they run concurrently.
+
+    Args:
+      lookups: list of (model class, filters) tuples, where filters is as
+        accepted by MemcacheWrappedGetAllFilter.
+      limit: int, number of rows to fetch per lookup.
+      memcache_secs: int seconds to store in memcache; default MEMCACHE_SECS.
+    Returns:
+      tuple of (list of entity lists in lookups order, int number of RPCs).
+    """
+    if not lookups:
+      return [], 0
+
+    memcache_keys = [
+        model._GetMemcacheWrappedGetAllFilterKey(filters)
+        for model, filters in lookups]
+    cached = memcache.get_multi(memcache_keys)
+    rpcs = 1
+
+    queries = {}
+    for memcache_key, (model, filters) in zip(memcache_keys, lookups):
+      if memcache_key in cached or memcache_key in queries:
+        continue
+      query = model.all()
+      for filt, value in filters:
+        query = query.filter(filt, value)
+      queries[memcache_key] = query.run(limit=limit)
+
+    if queries:
+      missed = {}
+      for memcache_key, results in queries.iteritems():
+        missed[memcache_key] = list(results)
+      memcache.set_multi(missed, time=memcache_secs)
+      cached.update(missed)
+      rpcs += len(queries) + 1
+
+    return [cached[memcache_key] for memcache_key in memcache_keys], rpcs
+
   @classmethod
   def DeleteMemcacheWrappedGetAllFilter(cls, filters=()):
     """Deletes the memcache wrapped response for this GetAllFilter.
@@ -197,9 +264,21 @@ class BaseModel(db.Model):
         ( ( "foo =", True ),
           ( "zoo =", 1 ), ),
     """
+    memcache.delete(cls._GetMemcacheWrappedGetAllFilterKey(filters))
+
+  @classmethod
+  def _GetMemcacheWrappedGetAllFilterKey(cls, filters=()):
+    """Returns the memcache key for a MemcacheWrappedGetAllFilter filter set.
+
+    Args:
+      filters: tuple, optional, filter arguments, e.g.
+        ( ( "foo =", True ),
+          ( "zoo =", 1 ), ),
+    Returns:
+      str memcache key.
+    """
     filter_str = '|'.join(map(lambda x: '_%s,%s_' % (x[0], x[1]), filters))
-    memcache_key = 'mwgaf_%s%s' % (cls.kind(), filter_str)
-    memcache.delete(memcache_key)
+    return 'mwgaf_%s%s' % (cls.kind(), filter_str)
 
   @classmethod
   def MemcacheWrappedSet(
@@ -212,8 +291,8 @@ class BaseModel(db.Model):
       value: object, value to set
       memcache_secs: int seconds to store in memcache; default MEMCACHE_SECS.
     """
-    memcache_entity_key = 'mwg_%s_%s' % (cls.kind(), key_name)
-    memcache_key = 'mwgpn_%s_%s_%s' % (cls.kind(), key_name, prop_name)
+    memcache_entity_key = cls._GetMemcacheWrapKey(key_name)
+    memcache_key = cls._GetMemcacheWrapKey(key_name, prop_name=prop_name)
     entity = cls.get_or_insert(key_name)
     setattr(entity, prop_name, value)
     entity.put()
@@ -247,8 +326,7 @@ class BaseModel(db.Model):
 
     if entity:
       entity.delete()
-    memcache_key = 'mwg_%s_%s' % (cls.kind(), key_name)
-    memcache.delete(memcache_key)
+    memcache.delete(cls._GetMemcacheWrapKey(key_name))
 
 
 class BasePlistModel(BaseModel):
@@ -310,13 +388,20 @@ class BasePlistModel(BaseModel):
   def put(self, *args, **kwargs):
     """Put to Datastore.
 
+    The plist is serialized again whenever it was accessed since it was
+    loaded, as values nested in it may have been changed in place without
+    marking it changed; a plist that was never accessed is stored as is.
+
     Args:
       args: list, optional, args to superclass put()
       kwargs: dict, optional, keyword args to superclass put()
     Returns:
       return value from superclass put()
     """
-    if self.plist:
+    if not hasattr(self, '_plist_obj') and self._plist:
+      pass  # the plist was never accessed, so the stored XML is current.
+    elif self.plist:
+      self.plist.SetChanged()  # discard XML cached before any such change.
       self._plist = self.plist.GetXml()
     return super(BasePlistModel, self).put(*args, **kwargs)
 
@@ -388,9 +473,10 @@ class Computer(db.Model):
   user_settings = property(_GetUserSettings, _SetUserSettings)
 
   @classmethod
-  def AllActive(cls, keys_only=False):
+  def AllActive(cls, keys_only=False, projection=None):
     """Returns a query for all Computer entities that are active."""
-    return cls.all(keys_only=keys_only).filter('active =', True)
+    return cls.all(keys_only=keys_only, projection=projection).filter(
+        'active =', True)
 
   @classmethod
   def MarkInactive(cls):
@@ -417,16 +503,20 @@ class Computer(db.Model):
       query.with_cursor(cursor)
     return count
 
+  def UpdateActive(self):
+    """Sets active according to preflight_datetime."""
+    now = datetime.datetime.utcnow()
+    earliest_active_date = now - datetime.timedelta(days=COMPUTER_ACTIVE_DAYS)
+    if self.preflight_datetime:
+      if self.preflight_datetime > earliest_active_date:
+        self.active = True
+      else:
+        self.active = False
+
   def put(self, update_active=True):
     """Forcefully set active according to preflight_datetime."""
     if update_active:
-      now = datetime.datetime.utcnow()
-      earliest_active_date = now - datetime.timedelta(days=COMPUTER_ACTIVE_DAYS)
-      if self.preflight_datetime:
-        if self.preflight_datetime > earliest_active_date:
-          self.active = True
-        else:
-          self.active = False
+      self.UpdateActive()
     super(Computer, self).put()
 
 
@@ -626,6 +716,24 @@ class KeyValueCache(BaseModel):
   blob_value = db.BlobProperty()
   mtime = db.DateTimeProperty(auto_now=True)
 
+  @classmethod
+  def MemcacheWrappedSet(
+      cls, key_name, prop_name, value, memcache_secs=MEMCACHE_SECS):
+    """Sets an entity by key name and property wrapped by Memcache.
+
+    The memcached mtime property is also deleted, so that instances notice
+    the change on their next IpInList() call.
+
+    Args:
+      key_name: str, key name of entity to fetch
+      prop_name: str, property name to set with value
+      value: object, value to set
+      memcache_secs: int seconds to store in memcache; default MEMCACHE_SECS.
+    """
+    super(KeyValueCache, cls).MemcacheWrappedSet(
+        key_name, prop_name, value, memcache_secs=memcache_secs)
+    cls.DeleteMemcacheWrap(key_name, prop_name='mtime')
+
   @classmethod
   def IpInList(cls, key_name, ip):
     """Check whether IP is in serialized IP/mask list in key_name.
@@ -635,53 +743,44 @@ class KeyValueCache(BaseModel):
 
     [ "200.0.0.0/24",
       "10.0.0.0/8",
+      "2620:0:1003::/48",
       etc ...
     ]
 
-    Note that this function is not IPv6 safe and will always return False
-    if the input ip is IPv6 format.
+    The list is compiled into an ipcalc.IpMatcher once per instance, and only
+    compiled again when the mtime of the entity changes.
 
     Args:
       key_name: str, like 'auth_bad_ip_blocks'
-      ip: str, like '127.0.0.1'
+      ip: str, like '127.0.0.1' or '2620:0:1003::1'
     Returns:
       True if the ip is inside a mask in the list, False if not
     """
     if not ip:
       return False  # lenient response
 
-    # TODO(user): Once the underlying util.Ip* methods support ipv6
-    # this method can go away. Until then, this stops all of the churn
-    # and exits early.
-    if ip.find(':') > -1:  # ipv6
-      return False
-
     try:
-      ip_blocks_str = cls.MemcacheWrappedGet(key_name, 'text_value')
-      if not ip_blocks_str:
+      mtime = cls.MemcacheWrappedGet(key_name, 'mtime')
+      if not mtime:
         return False
-      ip_blocks = util.Deserialize(ip_blocks_str)
+      cached = _IP_MATCHERS.get(key_name)
+      if cached and cached[0] == mtime:
+        matcher = cached[1]
+      else:
+        entity = cls.MemcacheWrappedGet(key_name)
+        if not entity or not entity.text_value:
+          return False
+        matcher = ipcalc.IpMatcher(util.Deserialize(entity.text_value))
+        _IP_MATCHERS[key_name] = (entity.mtime, matcher)
     except (util.DeserializeError, db.Error):
       logging.exception('IpInList(%s)', ip)
       return False  # lenient response
 
-    # Note: The method below, parsing a serialized list of networks
-    # expressed as strings, might seem silly. But the total time to
-    # deserialize and translate the strings back into IP network/mask
-    # integers is actually faster than storing them already split, e.g. a
-    # list of 2 item lists (network,mask). Apparently JSON isn't as
-    # efficient at parsing ints or nested lists.
-    #
-    # (pickle is 2X+ faster but not secure & deprecated inside util module)
-
-    ip_int = ipcalc.IpToInt(ip)
-
-    for ip_mask_str in ip_blocks:
-      ip_mask = ipcalc.IpMaskToInts(ip_mask_str)
-      if (ip_int & ip_mask[1]) == ip_mask[0]:
-        return True
-
-    return False
+    try:
+      return matcher.Match(ip)
+    except ValueError:
+      logging.warning('IpInList: invalid IP %r', ip)
+      return False  # lenient response
 
   @classmethod
   def GetSerializedItem(cls, key):
@@ -736,7 +835,9 @@ class ReportsCache(KeyValueCache):
   """Model for various reports data caching."""
 
   _SUMMARY_KEY = 'summary'
+  _FLEET_SUMMARY_KEY = 'fleet_summary'
   _INSTALL_COUNTS_KEY = 'install_counts'
+  _INSTALL_STATS_KEY = 'install_stats_%s'
   _TRENDING_INSTALLS_KEY = 'trending_installs_%d_hours'
   _PENDING_COUNTS_KEY = 'pending_counts'
   _MSU_USER_SUMMARY_KEY = 'msu_user_summary'
@@ -747,17 +848,31 @@ class ReportsCache(KeyValueCache):
 
   @classmethod
   def GetStatsSummary(cls):
-    """Returns tuples (stats summary dictionary, datetime) from Datastore."""
+    """Returns tuple (stats summary dictionary, datetime) from Datastore.
+
+    The stats summary was cached before the fleet summary replaced it, and is
+    only read until the fleet summary is first generated.
+    """
     return cls.GetSerializedItem(cls._SUMMARY_KEY)
 
   @classmethod
-  def SetStatsSummary(cls, d):
-    """Sets a the stats summary dictionary to Datastore.
+  def GetFleetSummary(cls):
+    """Returns tuple (fleet summary dictionary, datetime) from Datastore."""
+    summary, mtime = cls.GetSerializedItem(cls._FLEET_SUMMARY_KEY)
+    if 'hours' in summary:
+      # serialization turns the int hour keys into str.
+      summary['hours'] = dict(
+          (int(hour), counts) for hour, counts in summary['hours'].iteritems())
+    return summary, mtime
+
+  @classmethod
+  def SetFleetSummary(cls, d):
+    """Sets the fleet summary dictionary to Datastore.
 
     Args:
-      d: dict of summary data.
+      d: dict of fleet summary data, see simian.mac.common.fleet_summary.
     """
-    return cls.SetSerializedItem(cls._SUMMARY_KEY, d)
+    return cls.SetSerializedItem(cls._FLEET_SUMMARY_KEY, d)
 
   @classmethod
   def GetInstallCounts(cls):
@@ -773,6 +888,27 @@ class ReportsCache(KeyValueCache):
     """
     return cls.SetSerializedItem(cls._INSTALL_COUNTS_KEY, d)
 
+  @classmethod
+  def GetInstallStats(cls, unit):
+    """Returns tuple (install stats buckets dict, datetime) from Datastore.
+
+    Args:
+      unit: str, 'hours' or 'days'; the unit of the int bucket keys.
+    """
+    buckets, mtime = cls.GetSerializedItem(cls._INSTALL_STATS_KEY % unit)
+    # serialization turns the int bucket keys into str.
+    return dict((int(k), v) for k, v in buckets.iteritems()), mtime
+
+  @classmethod
+  def SetInstallStats(cls, unit, d):
+    """Sets an install stats buckets dictionary to Datastore.
+
+    Args:
+      unit: str, 'hours' or 'days'; the unit of the int bucket keys.
+      d: dict of int bucket to install stats dict.
+    """
+    return cls.SetSerializedItem(cls._INSTALL_STATS_KEY % unit, d)
+
   @classmethod
   def GetTrendingInstalls(cls, since_hours):
     key = cls._TRENDING_INSTALLS_KEY % since_hours
@@ -797,6 +933,18 @@ class ReportsCache(KeyValueCache):
     """
     return cls.SetSerializedItem(cls._PENDING_COUNTS_KEY, d)
 
+  @classmethod
+  def UpdatePendingCounts(cls, delta):
+    """Adds changes to the pending counts dictionary in Datastore.
+
+    Args:
+      delta: dict of str install name to int change in pending count.
+    """
+    d, unused_dt = cls.GetPendingCounts()
+    for name, change in delta.iteritems():
+      d[name] = max(d.get(name, 0) + change, 0)
+    return cls.SetPendingCounts(d)
+
   @classmethod
   def _GetMsuUserSummaryKey(cls, since, tmp):
     if since is not None:
@@ -873,6 +1021,22 @@ class AppleSUSCatalog(BaseCompressedMunkiModel):
   """Apple Software Update Service Catalog."""
 
   last_modified_header = db.StringProperty()
+  # digest of the untouched catalog and approved products a catalog was
+  # generated from; see applesus.GenerateAppleSUSTrackCatalogs().
+  source_digest = db.StringProperty()
+  # sha256 digests of the AppleSUSCatalogChunk entities holding the catalog,
+  # in order. Backups only hold these, not the plist.
+  chunk_digests = db.StringListProperty(indexed=False)
+
+
+class AppleSUSCatalogChunk(BaseModel):
+  """Content-addressed chunk of Apple SUS catalogs.
+
+  key_name is the sha256 hex digest of the uncompressed chunk.
+  """
+
+  data = db.BlobProperty()  # zlib compressed chunk.
+  mtime = db.DateTimeProperty(auto_now=True)
 
 
 class AppleSUSProduct(BaseModel):
@@ -948,6 +1112,144 @@ class AppleSUSProduct(BaseModel):
   munki_name = property(_GetMunkiName)
 
 
+class BaseNameIndex(BaseModel):
+  """Reverse index of entity names which reference the index key_name.
+
+  Index entities are built lazily on first read, and are then maintained by
+  the put() and delete() methods of the indexed model. Updates set the
+  membership of a name from the indexed entity, read in the same transaction,
+  so they may be applied in any order. Updates of an index not built yet are
+  recorded in it, and applied over the eventually consistent query which
+  builds it, so none are lost.
+  """
+
+  names = db.StringListProperty()
+  # False while only recording updates; names then lists added names.
+  built = db.BooleanProperty(default=True)
+  # names removed while not built.
+  removed_names = db.StringListProperty()
+
+  @classmethod
+  def _GetMemberKeyNames(cls, name):
+    """Returns the set of str key names an indexed entity references.
+
+    Called in the transaction updating the index entities.
+
+    Args:
+      name: str name of the indexed entity.
+    """
+    raise NotImplementedError
+
+  @classmethod
+  def GetNames(cls, key_name, query):
+    """Returns indexed names for a key_name.
+
+    Args:
+      key_name: str key name of the index entity.
+      query: db.Query of keys to build the index from if it is not built.
+    Returns:
+      list of str names.
+    """
+    index = cls.MemcacheWrappedGet(key_name)
+    if index is not None and index.built:
+      return index.names
+    names = [k.name() for k in query]
+    return db.run_in_transaction(cls._Build, key_name, names)
+
+  @classmethod
+  def _Build(cls, key_name, names):
+    """Builds an index from queried names and the updates it recorded."""
+    index = cls.get_by_key_name(key_name)
+    if index is None:
+      index = cls(key_name=key_name, names=names)
+    elif index.built:
+      return index.names  # built concurrently.
+    else:
+      names = [n for n in names if n not in index.removed_names]
+      index.names = names + [n for n in index.names if n not in names]
+      index.removed_names = []
+      index.built = True
+    index.put()
+    cls.DeleteMemcacheWrap(key_name)
+    return index.names
+
+  @classmethod
+  def UpdateNames(cls, name, old_key_names, new_key_names):
+    """Updates the index for a changed entity.
+
+    Args:
+      name: str name of the indexed entity.
+      old_key_names: iterable of str key names the entity referenced.
+      new_key_names: iterable of str key names the entity now references.
+    """
+    key_names = sorted(
+        set(old_key_names).symmetric_difference(new_key_names))
+    if len(key_names) <= NAME_INDEX_INLINE_SIZE:
+      cls._UpdateNamesTask(name, key_names)
+      return
+    for i in xrange(0, len(key_names), NAME_INDEX_TASK_SIZE):
+      deferred.defer(
+          cls._UpdateNamesTask, name, key_names[i:i + NAME_INDEX_TASK_SIZE])
+
+  @classmethod
+  def _UpdateNamesTask(cls, name, key_names):
+    """Updates index entities for a changed entity, a batch per transaction.
+
+    Args:
+      name: str name of the indexed entity.
+      key_names: list of str key names of the index entities.
+    """
+    options = db.create_transaction_options(xg=True)
+    for i in xrange(0, len(key_names), NAME_INDEX_TRANSACTION_SIZE):
+      batch = key_names[i:i + NAME_INDEX_TRANSACTION_SIZE]
+      db.run_in_transaction_options(options, cls._UpdateName, name, batch)
+      memcache.delete_multi(
+          [cls._GetMemcacheWrapKey(key_name) for key_name in batch])
+
+  @classmethod
+  def _UpdateName(cls, name, key_names):
+    """Sets the membership of a name in index entities, in a transaction."""
+    members = cls._GetMemberKeyNames(name)
+    indexes = cls.get_by_key_name(key_names)
+    to_put = []
+    for key_name, index in zip(key_names, indexes):
+      add = key_name in members
+      if index is None:
+        index = cls(key_name=key_name, built=False)
+      if index.built:
+        if add == (name in index.names):
+          continue
+      elif add and name in index.removed_names:
+        index.removed_names.remove(name)
+      elif not add and name not in index.removed_names:
+        index.removed_names.append(name)
+      if add and name not in index.names:
+        index.names.append(name)
+      elif not add and name in index.names:
+        index.names.remove(name)
+      to_put.append(index)
+    if to_put:
+      db.put(to_put)
+
+
+class KeyTagIndex(BaseNameIndex):
+  """Tag names for a str db.Key key_name."""
+
+  @classmethod
+  def _GetMemberKeyNames(cls, name):
+    tag = Tag.get_by_key_name(name)
+    return set(str(key) for key in tag.keys) if tag else set()
+
+
+class UserGroupIndex(BaseNameIndex):
+  """Group names for a str user key_name."""
+
+  @classmethod
+  def _GetMemberKeyNames(cls, name):
+    group = Group.get_by_key_name(name)
+    return set(group.users) if group else set()
+
+
 class Tag(BaseModel):
   """A generic string tag that references a list of db.Key objects."""
 
@@ -960,13 +1262,20 @@ class Tag(BaseModel):
   def put(self, *args, **kwargs):
     """Ensure tags memcache entries are purged when a new one is created."""
     memcache.delete(self.ALL_TAGS_MEMCACHE_KEY)
-    return super(Tag, self).put(*args, **kwargs)
+    old = db.get(self.key())
+    ret = super(Tag, self).put(*args, **kwargs)
+    KeyTagIndex.UpdateNames(
+        self.key().name(), map(str, old.keys if old else []),
+        map(str, self.keys))
+    return ret
 
   def delete(self, *args, **kwargs):
     """Ensure tags memcache entries are purged when one is delete."""
     # TODO(user): extend BaseModel so such memcache cleanup is reusable.
     memcache.delete(self.ALL_TAGS_MEMCACHE_KEY)
-    return super(Tag, self).delete(*args, **kwargs)
+    ret = super(Tag, self).delete(*args, **kwargs)
+    KeyTagIndex.UpdateNames(self.key().name(), map(str, self.keys), [])
+    return ret
 
   @classmethod
   def GetAllTagNames(cls):
@@ -981,8 +1290,8 @@ class Tag(BaseModel):
   @classmethod
   def GetAllTagNamesForKey(cls, key):
     """Returns a list of all tag names for a given db.Key."""
-    return [k.name() for k in
-            cls.all(keys_only=True).filter('keys =', key)]
+    return KeyTagIndex.GetNames(
+        str(key), cls.all(keys_only=True).filter('keys =', key))
 
   @classmethod
   def GetAllTagNamesForEntity(cls, entity):
@@ -1001,12 +1310,18 @@ class Group(BaseModel):
   def put(self, *args, **kwargs):
     """Ensure groups memcache entries are purged when a new one is created."""
     memcache.delete(self.ALL_GROUPS_MEMCACHE_KEY)
-    return super(Group, self).put(*args, **kwargs)
+    old = db.get(self.key())
+    ret = super(Group, self).put(*args, **kwargs)
+    UserGroupIndex.UpdateNames(
+        self.key().name(), old.users if old else [], self.users)
+    return ret
 
   def delete(self, *args, **kwargs):
     """Ensure groups memcache entries are purged when one is delete."""
     memcache.delete(self.ALL_GROUPS_MEMCACHE_KEY)
-    return super(Group, self).delete(*args, **kwargs)
+    ret = super(Group, self).delete(*args, **kwargs)
+    UserGroupIndex.UpdateNames(self.key().name(), self.users, [])
+    return ret
 
   @classmethod
   def GetAllGroupNames(cls):
@@ -1021,8 +1336,8 @@ class Group(BaseModel):
   @classmethod
   def GetAllGroupNamesForUser(cls, user):
     """Returns a list of all group names for a given string user."""
-    return [k.name() for k in
-            cls.all(keys_only=True).filter('users =', user)]
+    return UserGroupIndex.GetNames(
+        user, cls.all(keys_only=True).filter('users =', user))
 
 
 class BaseManifestModification(BaseModel):
@@ -1104,7 +1419,51 @@ class BaseManifestModification(BaseModel):
     if not model:
       raise ValueError
 
-    model.DeleteMemcacheWrappedGetAllFilter((('%s =' % mod_type, target),))
+    model.DeleteMemcacheWrappedGetAllFilter(
+        (('%s =' % model.TARGET_PROPERTY_NAME, target),))
+    cls.BumpModsVersion()
+
+  @classmethod
+  def GetModsVersion(cls):
+    """Returns the current version of all manifest modifications.
+
+    The version changes whenever any manifest modification is changed, so
+    it can be used to validate process caches of compiled modifications.
+
+    Returns:
+      int version.
+    """
+    version = memcache.get(MANIFEST_MODS_VERSION_MEMCACHE_KEY)
+    if version is None:
+      # Start from a timestamp so a lost counter never repeats an old version.
+      version = int(time.time() * 1000000)
+      if not memcache.add(MANIFEST_MODS_VERSION_MEMCACHE_KEY, version):
+        version = memcache.get(MANIFEST_MODS_VERSION_MEMCACHE_KEY) or version
+    return version
+
+  @classmethod
+  def BumpModsVersion(cls):
+    """Increments the version of all manifest modifications."""
+    if memcache.incr(MANIFEST_MODS_VERSION_MEMCACHE_KEY) is None:
+      cls.GetModsVersion()
+
+  def _ResetModCaches(self):
+    """Clears cached modifications for the target of this modification."""
+    self.DeleteMemcacheWrappedGetAllFilter(
+        (('%s =' % self.TARGET_PROPERTY_NAME, self.target),))
+    self.BumpModsVersion()
+
+  def put(self, *args, **kwargs):
+    """Put to Datastore, clearing cached modifications for the target."""
+    ret = super(BaseManifestModification, self).put(*args, **kwargs)
+    self._ResetModCaches()
+    return ret
+
+  def delete(self, *args, **kwargs):
+    """Delete from Datastore, clearing cached modifications for the target."""
+    ret = super(BaseManifestModification, self).delete(*args, **kwargs)
+    self._ResetModCaches()
+    return ret
 
 
 class SiteManifestModification(BaseManifestModification):
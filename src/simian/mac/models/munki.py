@@ -17,20 +17,25 @@
 """App Engine Models related to Munki."""
 
 import datetime
+import gzip
+import hashlib
 import logging
 import os
 import re
+import StringIO
+import time
 import urllib
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
-from google.appengine.ext import deferred
 
 from simian.mac.common import datastore_locks
 from simian.mac import common
 from simian.mac.common import gae_util
 from simian.mac.common import mail as mail_tool
+from simian.mac.common import regeneration
 from simian.mac.models import base
 from simian.mac.models import constants
 from simian.mac.models import settings
@@ -39,6 +44,22 @@ from simian.mac.munki import plist as plist_lib
 
 PACKAGE_LOCK_PREFIX = 'pkgsinfo_'
 
+# Memcache key prefix for serialized PackageInfo catalog fragments.
+CATALOG_FRAGMENT_MEMCACHE_PREFIX = 'catalog_fragment_'
+CATALOG_FRAGMENT_MEMCACHE_SECS = 86400
+
+# Memcache keys of the packagemap index of all PackageInfo, and of its version.
+PACKAGEMAP_MEMCACHE_KEY = 'packagemap_index'
+PACKAGEMAP_VERSION_MEMCACHE_KEY = 'packagemap_version'
+PACKAGEMAP_MEMCACHE_SECS = 86400
+# Seconds without changes after which an index rebuilt from an eventually
+# consistent query, which may have missed recent changes, is rebuilt again.
+PACKAGEMAP_SETTLE_SECS = 300
+
+# Catalogs are stored with a gzip compressed variant while both fit this many
+# bytes, to keep entities within the Datastore entity size limit.
+CATALOG_GZIP_MAX_BYTES = 900000
+
 PLIST_SIGNATURES = [
     'installcheck_script_signature',
     'installer_item_hash_signature',
@@ -51,6 +72,17 @@ PLIST_SIGNATURES = [
 ]
 
 
+def _GzipCompress(data):
+  """Returns gzip compressed str data, with a fixed header mtime."""
+  buf = StringIO.StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+  try:
+    f.write(data)
+  finally:
+    f.close()
+  return buf.getvalue()
+
+
 class MunkiError(base.Error):
   """Class for domain specific exceptions."""
 
@@ -106,6 +138,9 @@ class Catalog(BaseMunkiModel):
   """
 
   package_names = db.StringListProperty()
+  # sha256 hex digest of the utf-8 catalog XML, served as its ETag.
+  plist_sha256 = db.StringProperty(indexed=False)
+  plist_gzip = db.BlobProperty()  # gzip compressed utf-8 catalog XML.
 
   PLIST_LIB_CLASS = plist_lib.MunkiPlist
 
@@ -116,13 +151,12 @@ class Catalog(BaseMunkiModel):
     Args:
       name: str, catalog name. all PackageInfo entities with this name in the
           "catalogs" property will be included in the generated catalog.
-      delay: int, if > 0, Generate call is deferred this many seconds.
+      delay: int, if > 0, Generate call is deferred at least this many seconds,
+          and coalesced with other deferred calls for the catalog.
     """
     if delay:
-      now = datetime.datetime.utcnow()
-      now_str = '%s-%d' % (now.strftime('%Y-%m-%d-%H-%M-%S'), now.microsecond)
-      deferred_name = 'create-catalog-%s-%s' % (name, now_str)
-      deferred.defer(cls.Generate, name, _name=deferred_name, _countdown=delay)
+      regeneration.Request(
+          regeneration.CATALOG, name, cls.GenerateRequested, delay)
       return
 
     lock_name = 'catalog_lock_%s' % name
@@ -144,13 +178,13 @@ class Catalog(BaseMunkiModel):
       # download daily.
       mtimes = [midnight]
       pkgsinfo_dicts = []
-      package_infos = PackageInfo.all().filter('catalogs =', name).fetch(None)
-      if not package_infos:
+      fragments = cls._GetPackageInfoFragments(name)
+      if not fragments:
         logging.warning('No PackageInfo entities with catalog: %s', name)
-      for p in package_infos:
-        package_names.append(p.name)
-        pkgsinfo_dicts.append(p.plist.GetXmlContent(indent_num=1))
-        mtimes.append(p.mtime)
+      for fragment in fragments:
+        package_names.append(fragment['name'])
+        pkgsinfo_dicts.append(fragment['xml'])
+        mtimes.append(fragment['mtime'])
 
       if name in settings.Settings.GetItem('early_force_catalogs'):
         pkgsinfo_dicts = cls.ProcessEarlyForceDates(pkgsinfo_dicts)
@@ -161,6 +195,7 @@ class Catalog(BaseMunkiModel):
       c.package_names = package_names
       c.name = name
       c.plist = catalog
+      c.SetCompressedVariant(catalog)
 
       c.mtime = max(mtimes)
       c.put(avoid_mtime_update=True)
@@ -174,6 +209,85 @@ class Catalog(BaseMunkiModel):
     finally:
       lock.Release()
 
+  def SetCompressedVariant(self, catalog_xml):
+    """Sets the digest and gzip compressed variant of the catalog XML.
+
+    Args:
+      catalog_xml: str or unicode catalog XML, as set to the plist.
+    """
+    if isinstance(catalog_xml, unicode):
+      catalog_xml = catalog_xml.encode('utf-8')
+    self.plist_sha256 = hashlib.sha256(catalog_xml).hexdigest()
+    compressed = _GzipCompress(catalog_xml)
+    if len(catalog_xml) + len(compressed) <= CATALOG_GZIP_MAX_BYTES:
+      self.plist_gzip = db.Blob(compressed)
+    else:
+      logging.warning(
+          'Catalog %s is too large to store compressed.', self.name)
+      self.plist_gzip = None
+
+  @classmethod
+  def GenerateRequested(cls, name):
+    """Generates a catalog once Generate() calls with a delay are coalesced.
+
+    Args:
+      name: str, catalog name.
+    """
+    if regeneration.Begin(
+        regeneration.CATALOG, name, cls.GenerateRequested):
+      cls.Generate(name)
+
+  @classmethod
+  def _GetPackageInfoFragments(cls, name):
+    """Returns serialized catalog fragments for all PackageInfo in a catalog.
+
+    Fragments are cached in memcache keyed by PackageInfo key name, and are
+    only valid for the PackageInfo mtime they were generated from. Only
+    PackageInfo entities with a missing or stale fragment are fetched in full
+    and have their plist parsed and serialized again, so the cost of a
+    regeneration grows with the number of changed packages rather than with
+    the size of the catalog.
+
+    Args:
+      name: str, catalog name.
+    Returns:
+      list of dicts with name, mtime and xml keys, ordered by key name.
+    Raises:
+      db.Error: a Datastore operation failed.
+      plist_lib.Error: a PackageInfo plist could not be serialized.
+    """
+    query = PackageInfo.all(projection=('mtime',)).filter('catalogs =', name)
+    projections = sorted(query.fetch(None), key=lambda p: p.key().name())
+    key_names = [p.key().name() for p in projections]
+
+    cached = memcache.get_multi(
+        key_names, key_prefix=CATALOG_FRAGMENT_MEMCACHE_PREFIX)
+    stale_keys = []
+    for p in projections:
+      fragment = cached.get(p.key().name())
+      if not fragment or fragment['mtime'] != p.mtime:
+        stale_keys.append(p.key())
+
+    new_fragments = {}
+    for p in db.get(stale_keys):
+      if p is None:
+        continue  # PackageInfo was deleted since the projection query.
+      new_fragments[p.key().name()] = {
+          'name': p.name,
+          'mtime': p.mtime,
+          'xml': p.plist.GetXmlContent(indent_num=1),
+      }
+    if new_fragments:
+      memcache.set_multi(
+          new_fragments, time=CATALOG_FRAGMENT_MEMCACHE_SECS,
+          key_prefix=CATALOG_FRAGMENT_MEMCACHE_PREFIX)
+    cached.update(new_fragments)
+
+    logging.debug(
+        'Catalog %s: regenerated %d of %d pkginfo fragments.',
+        name, len(new_fragments), len(key_names))
+    return [cached[k] for k in key_names if k in cached]
+
   @classmethod
   def ProcessEarlyForceDates(cls, pkgsinfo_dicts):
     processed_pkgsinfo_dicts = []
@@ -213,13 +327,12 @@ class Manifest(BaseMunkiModel):
     Args:
       name: str, manifest name. all PackageInfo entities with this name in the
           "manifests" property will be included in the generated manifest.
-      delay: int. if > 0, Generate call is deferred this many seconds.
+      delay: int. if > 0, Generate call is deferred at least this many
+          seconds, and coalesced with other deferred calls for the manifest.
     """
     if delay:
-      now = datetime.datetime.utcnow()
-      now_str = '%s-%d' % (now.strftime('%Y-%m-%d-%H-%M-%S'), now.microsecond)
-      deferred_name = 'create-manifest-%s-%s' % (name, now_str)
-      deferred.defer(cls.Generate, name, _name=deferred_name, _countdown=delay)
+      regeneration.Request(
+          regeneration.MANIFEST, name, cls.GenerateRequested, delay)
       return
 
     lock_name = 'manifest_lock_%s' % name
@@ -261,6 +374,17 @@ class Manifest(BaseMunkiModel):
     finally:
       lock.Release()
 
+  @classmethod
+  def GenerateRequested(cls, name):
+    """Generates a manifest once Generate() calls with a delay are coalesced.
+
+    Args:
+      name: str, manifest name.
+    """
+    if regeneration.Begin(
+        regeneration.MANIFEST, name, cls.GenerateRequested):
+      cls.Generate(name)
+
 
 class PackageInfo(BaseMunkiModel):
   """Munki pkginfo file, Blobstore key, etc., for the corresponding package.
@@ -418,7 +542,118 @@ class PackageInfo(BaseMunkiModel):
       self.munki_name = self.plist.GetMunkiName()
     except plist_lib.PlistNotParsedError:
       self.munki_name = None
-    return super(PackageInfo, self).put(*args, **kwargs)
+    ret = super(PackageInfo, self).put(*args, **kwargs)
+    # The plist may have changed without an mtime update, so always drop the
+    # cached catalog fragment.
+    self.DeleteCatalogFragment()
+    self._PatchPackageMap((self.name, self.GetPackageMapEntry()))
+    return ret
+
+  def DeleteCatalogFragment(self):
+    """Deletes the cached catalog fragment of this PackageInfo."""
+    memcache.delete(CATALOG_FRAGMENT_MEMCACHE_PREFIX + self.key().name())
+
+  def GetPackageMapEntry(self):
+    """Returns the str packagemap entry like "Firefox-3.6", or None."""
+    if self.plist is None:
+      return None
+    display_name = (
+        self.plist.get('display_name', None) or self.plist.get('name'))
+    if not display_name:
+      return None
+    return '%s-%s' % (display_name.strip(), self.plist.get('version', ''))
+
+  @classmethod
+  def _GetPackageMapVersion(cls, cached):
+    """Returns the current packagemap index version.
+
+    Args:
+      cached: dict of memcache get_multi results which may include the version.
+    Returns:
+      int version.
+    """
+    version = cached.get(PACKAGEMAP_VERSION_MEMCACHE_KEY)
+    if version is None:
+      # Start from a timestamp so a lost counter never repeats an old version.
+      version = int(time.time() * 1000000)
+      if not memcache.add(PACKAGEMAP_VERSION_MEMCACHE_KEY, version):
+        version = memcache.get(PACKAGEMAP_VERSION_MEMCACHE_KEY) or version
+    return version
+
+  @classmethod
+  def GetPackageMap(cls):
+    """Returns the display name and version of all packages by name.
+
+    The map is read from an index in memcache which put() and delete() patch,
+    so no pkginfo plist is parsed. The index is only rebuilt from all
+    PackageInfo entities when memcache lost it, or when a change could not be
+    applied to it, which its version then no longer matches. As the query may
+    miss recent changes, a rebuilt index is rebuilt once more when no change
+    was made to it for PACKAGEMAP_SETTLE_SECS.
+
+    Returns:
+      dict of str package name to str "display_name-version".
+    """
+    cached = memcache.get_multi(
+        [PACKAGEMAP_MEMCACHE_KEY, PACKAGEMAP_VERSION_MEMCACHE_KEY])
+    version = cls._GetPackageMapVersion(cached)
+    index = cached.get(PACKAGEMAP_MEMCACHE_KEY)
+    now = time.time()
+    stale = not index or index['version'] != version
+    settle = (not stale and not index.get('settled') and
+              now - index.get('mtime', 0) >= PACKAGEMAP_SETTLE_SECS)
+    if stale or settle:
+      # changes while the index is rebuilt bump the version, so they are never
+      # lost, at worst the index is rebuilt again.
+      index = {
+          'version': version, 'entries': {}, 'mtime': now, 'settled': settle}
+      for p in cls.all():
+        index['entries'][p.key().name()] = (p.name, p.GetPackageMapEntry())
+      try:
+        stored = memcache.set(
+            PACKAGEMAP_MEMCACHE_KEY, index, time=PACKAGEMAP_MEMCACHE_SECS)
+      except ValueError:
+        stored = False  # too large for memcache.
+      if not stored:
+        logging.warning('Packagemap index of %d packages was not cached.',
+                        len(index['entries']))
+
+    packagemap = {}
+    # in key name order, like a PackageInfo query, should names be duplicated.
+    for key_name in sorted(index['entries']):
+      name, entry = index['entries'][key_name]
+      if entry is not None:
+        packagemap[name] = entry
+    return packagemap
+
+  def _PatchPackageMap(self, entry):
+    """Applies a change of this PackageInfo to the packagemap index.
+
+    The index version is bumped first, so if the index was stale or another
+    change is applied concurrently, the index no longer matches the version
+    and is rebuilt by the next GetPackageMap().
+
+    Args:
+      entry: tuple of (str name, str packagemap entry or None), or None if the
+          PackageInfo was deleted.
+    """
+    version = memcache.incr(PACKAGEMAP_VERSION_MEMCACHE_KEY)
+    if version is None:
+      return  # the index is rebuilt along with a new version.
+    client = memcache.Client()
+    index = client.gets(PACKAGEMAP_MEMCACHE_KEY)
+    if not index or index['version'] != version - 1:
+      return
+    if entry is None:
+      index['entries'].pop(self.key().name(), None)
+    else:
+      index['entries'][self.key().name()] = entry
+    index['version'] = version
+    index['mtime'] = time.time()
+    try:
+      client.cas(PACKAGEMAP_MEMCACHE_KEY, index, time=PACKAGEMAP_MEMCACHE_SECS)
+    except ValueError:
+      pass  # too large for memcache; rebuilt, as it misses this version.
 
   def delete(self, *args, **kwargs):
     """Deletes a PackageInfo and cleans up associated data in other models.
@@ -433,6 +668,8 @@ class PackageInfo(BaseMunkiModel):
       return value from superlass delete()
     """
     ret = super(PackageInfo, self).delete(*args, **kwargs)
+    self.DeleteCatalogFragment()
+    self._PatchPackageMap(None)
     for catalog in self.catalogs:
       Catalog.Generate(catalog, delay=1)
     if self.blobstore_key:
@@ -749,6 +986,9 @@ class PackageInfoProposal(PackageInfo):
     new_pkginfo_proposal.pkginfo = pkginfo
     return new_pkginfo_proposal
 
+  def _PatchPackageMap(self, unused_entry):
+    """Proposals are not part of the packagemap index."""
+
   @property
   def proposal_in_flight(self):
     if self.status == 'proposed':
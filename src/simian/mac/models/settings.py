@@ -16,8 +16,22 @@
 #
 """Simian Settings Models."""
 
+import copy
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from simian.mac.common import util
 from simian.mac.models import base
 
+# Memcache key of the counter bumped on every settings change.
+SETTINGS_GENERATION_MEMCACHE_KEY = 'settings_generation'
+# int seconds between checks of the settings generation counter.
+SETTINGS_CACHE_GENERATION_SECS = 10
+# int max seconds settings are cached, should the counter be lost.
+SETTINGS_CACHE_SECS = base.MEMCACHE_SECS
+
 SETTINGS = {
     'api_info_key': {
         'type': 'random_str',
@@ -254,6 +268,93 @@ SETTINGS = {
 }
 
 
+class _SettingsCache(object):
+  """Per instance snapshot of all settings.
+
+  The snapshot is loaded in one batch get, and loaded again when the settings
+  generation counter in memcache, which Settings.SetItem() increments, has
+  changed. The counter is read at most every SETTINGS_CACHE_GENERATION_SECS.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._entities = None
+    self._items = {}
+    self._names = set()
+    self._generation = None
+    self._check_time = 0
+    self._load_time = 0
+
+  def _IsStale(self, now):
+    """Returns True if the snapshot must be loaded again."""
+    if (self._entities is None or
+        now - self._load_time >= SETTINGS_CACHE_SECS):
+      return True
+    if now - self._check_time < SETTINGS_CACHE_GENERATION_SECS:
+      return False
+    self._check_time = now
+    return memcache.get(SETTINGS_GENERATION_MEMCACHE_KEY) != self._generation
+
+  def _Load(self, model, now):
+    """Loads all settings entities of model."""
+    # read before loading, so that later changes load again.
+    generation = memcache.get(SETTINGS_GENERATION_MEMCACHE_KEY)
+    with self._lock:
+      names = set(SETTINGS).union(self._names)
+    # the query may miss new entities, unlike a get of their keys.
+    names.update(k.name() for k in model.all(keys_only=True))
+    names = list(names)
+    entities = dict(
+        (name, entity) for name, entity in zip(
+            names, model.get_by_key_name(names)) if entity)
+    with self._lock:
+      self._entities = entities
+      self._items = {}
+      self._generation = generation
+      self._check_time = now
+      self._load_time = now
+
+  def Get(self, model, name):
+    """Get an item from the snapshot.
+
+    Args:
+      model: Settings class.
+      name: str, setting name.
+    Returns:
+      (value for that setting, datetime time of last change)
+    """
+    now = time.time()
+    if self._IsStale(now):
+      self._Load(model, now)
+    with self._lock:
+      entities = self._entities
+      item = self._items.get(name)
+    if item is None:
+      item = model.GetItemFromEntities(name, entities)
+      with self._lock:
+        self._names.add(name)
+        if self._entities is entities:
+          self._items[name] = item
+    value, mtime = item
+    if isinstance(value, (dict, list)):
+      value = copy.deepcopy(value)  # callers may modify the value.
+    return value, mtime
+
+  def Invalidate(self):
+    """Invalidates the snapshot on all instances."""
+    self.Clear()
+    memcache.incr(SETTINGS_GENERATION_MEMCACHE_KEY, initial_value=0)
+
+  def Clear(self):
+    """Clear the snapshot of this instance."""
+    with self._lock:
+      self._entities = None
+      self._items = {}
+
+
+_SETTINGS_CACHE = _SettingsCache()
+
+
 class Settings(base.KeyValueCache):
   """Model for settings."""
 
@@ -281,17 +382,36 @@ class Settings(base.KeyValueCache):
     """Get an item from settings.
 
     If the item is in a serialized container it will be deserialized
-    before returning it.
+    before returning it. Items are read from a per instance snapshot of all
+    settings, which SetItem() invalidates on all instances.
 
     Args:
       name: str, like 'ca_public_cert_pem' or 'required_issuer'
     Returns:
       (value for that setting, datetime time of last change)
     """
-    if Settings.GetType(name) in ['pem', 'string', 'random_str']:
-      value, mtime = super(Settings, cls).GetItem(name)
-    else:
-      value, mtime = cls.GetSerializedItem(name)
+    return _SETTINGS_CACHE.Get(cls, name)
+
+  @classmethod
+  def GetItemFromEntities(cls, name, entities):
+    """Get an item from loaded settings entities.
+
+    Args:
+      name: str, like 'ca_public_cert_pem' or 'required_issuer'
+      entities: dict of str key name to Settings entity.
+    Returns:
+      (value for that setting, datetime time of last change)
+    """
+    value, mtime = None, None
+    entity = entities.get(name)
+    if entity and Settings.GetType(name) in ['pem', 'string', 'random_str']:
+      value, mtime = entity.text_value, entity.mtime
+    elif entity and entity.blob_value:
+      # pylint: disable=protected-access
+      if len(entity.blob_value) >= base._MEMCACHE_ENTITY_SIZE_LIMIT:
+        value, mtime = cls.GetSerializedItem(name)  # sharded value.
+      else:
+        value, mtime = util.Deserialize(entity.blob_value), entity.mtime
 
     if mtime is None:  # item was not in Datastore, use default if it exists.
       value = SETTINGS.get(name, {}).get('default')
@@ -309,9 +429,15 @@ class Settings(base.KeyValueCache):
       value: str, value
     """
     if Settings.GetType(name) in ['pem', 'string', 'random_str']:
-      return super(Settings, cls).SetItem(name, value)
+      super(Settings, cls).SetItem(name, value)
     else:
-      return cls.SetSerializedItem(name, value)
+      cls.SetSerializedItem(name, value)
+    _SETTINGS_CACHE.Invalidate()
+
+  @classmethod
+  def ClearCache(cls):
+    """Clear the settings snapshot of this instance."""
+    _SETTINGS_CACHE.Clear()
 
   @classmethod
   def GetAll(cls):
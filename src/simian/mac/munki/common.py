@@ -17,16 +17,24 @@
 """Shared resources for handlers."""
 
 import base64
+import collections
 import datetime
+import hashlib
 import logging
+import threading
+import time
 
 from google.appengine import runtime
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 from google.appengine.runtime import apiproxy_errors
 
 from simian.mac import common
 from simian.mac import models
+from simian.mac.common import fleet_summary
+from simian.mac.common import gae_util
 from simian.mac.common import util
 from simian.mac.munki import plist as plist_module
 
@@ -41,6 +49,30 @@ CLIENT_ID_FIELDS = {
 }
 CONNECTION_DATETIMES_LIMIT = 10
 CONNECTION_DATES_LIMIT = 30
+# Pull queue buffering client connection logs until FlushClientConnections()
+# writes them to Computer entities in batches.
+CLIENT_CONNECTION_QUEUE = 'client-connections'
+# Push queue running FlushClientConnections() tasks one at a time.
+CLIENT_CONNECTION_FLUSH_QUEUE = 'client-connections-flush'
+# Seconds client connection logs are buffered before they are flushed.
+CLIENT_CONNECTION_FLUSH_SECS = 10
+# Max number of client connection logs leased at a time by a flush, and max
+# number of leases by one flush task.
+CLIENT_CONNECTION_FLUSH_MAX = 1000
+CLIENT_CONNECTION_FLUSH_LEASES = 10
+# Seconds logs are leased for by a flush; logs it fails to write are flushed
+# again after the lease expires.
+CLIENT_CONNECTION_LEASE_SECS = 120
+# Max number of Computer entities written in one cross-group transaction.
+CLIENT_CONNECTION_TRANSACTION_SIZE = 25
+# Logs leased this many times without being written are dropped.
+CLIENT_CONNECTION_MAX_RETRIES = 10
+# Client id fields manifests are generated from; logs of new clients or which
+# change one of these are written to the Computer entity right away.
+CLIENT_CONNECTION_DIRECT_FIELDS = [
+    'owner', 'track', 'config_track', 'site', 'os_version']
+CLIENT_CONNECTION_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+CLIENT_CONNECTION_FLUSH_MEMCACHE_KEY = 'client_connection_flush_%d'
 # If the datastore goes write-only, delay a write for x seconds:
 DATASTORE_NOWRITE_DELAY = 60
 # Panic mode prefix for key names in KeyValueCache
@@ -55,6 +87,18 @@ APPLESUS_PKGS_TO_INSTALL_FORMAT = 'AppleSUS: %s'
 # Serial numbers for which first connection de-duplication should be skipped.
 DUPE_SERIAL_NUMBER_EXCEPTIONS = [
     'SystemSerialNumb', 'System Serial#', 'Not Available', None]
+# Max number of (mod_type, target) entries in the compiled mods cache.
+COMPILED_MODS_CACHE_SIZE = 10000
+# Seconds compiled mods are cached for, so mods read from an eventually
+# consistent query which missed a change are read again.
+COMPILED_MODS_CACHE_SECS = 300
+# Max total length of the generated manifests in the manifest result cache.
+MANIFEST_RESULT_CACHE_BYTES = 16 * 1024 * 1024
+
+# Per instance caches of CompiledManifest objects keyed by manifest name, and
+# of compiled manifest modifications keyed by (mod_type, target).
+_COMPILED_MANIFESTS = {}
+_COMPILED_MODS = {}
 
 
 class Error(Exception):
@@ -104,9 +148,15 @@ def _SaveFirstConnection(client_id, computer_key):
 def LogClientConnection(
     event, client_id, user_settings=None, pkgs_to_install=None,
     apple_updates_to_install=None, ip_address=None, report_feedback=None,
-    computer=None, delay=0, cert_fingerprint=None):
+    delay=0, cert_fingerprint=None):
   """Logs a host checkin to Simian.
 
+  The log is buffered in CLIENT_CONNECTION_QUEUE, and written to the Computer
+  entity by FlushClientConnections() along with logs of other clients.  Logs
+  of new clients, and logs changing fields in CLIENT_CONNECTION_DIRECT_FIELDS,
+  are written right away instead, so the client's next manifest request sees
+  them; their changes to the reports cache are still buffered for the flush.
+
   Args:
     event: str name of the event that prompted a client connection log.
     client_id: dict client id with fields: uuid, hostname, owner.
@@ -116,7 +166,6 @@ def LogClientConnection(
         to install.
     ip_address: str IP address of the connection.
     report_feedback: dict ReportFeedback commands sent to the client.
-    computer: optional models.Computer object.
     delay: int. if > 0, LogClientConnection call is deferred this many seconds.
     cert_fingerprint: optional str Client certificate fingerprint.
   """
@@ -136,128 +185,483 @@ def LogClientConnection(
     logging.warning('LogClientConnection: uuid is unknown, skipping log')
     return
 
-  def __UpdateComputerEntity(
-      event, _client_id, _user_settings, _pkgs_to_install,
-      _apple_updates_to_install, _ip_address, _report_feedback, c=None,
-      cert_fingerprint=None):
-    """Update the computer entity, or create a new one if it doesn't exists."""
-    now = datetime.datetime.utcnow()
-    is_new_client = False
-    if c is None:
-      c = models.Computer.get_by_key_name(_client_id['uuid'])
-    if c is None:  # First time this client has connected.
-      c = models.Computer(key_name=_client_id['uuid'])
-      is_new_client = True
-    c.uuid = _client_id['uuid']
-    c.hostname = _client_id['hostname']
-    c.serial= _client_id['serial']
-    c.owner = _client_id['owner']
-    c.track = _client_id['track']
-    c.site = _client_id['site']
-    c.config_track = _client_id['config_track']
-    c.client_version = _client_id['client_version']
-    c.os_version = _client_id['os_version']
-    c.uptime = _client_id['uptime']
-    c.root_disk_free = _client_id['root_disk_free']
-    c.user_disk_free = _client_id['user_disk_free']
-    c.runtype = _client_id['runtype']
-    c.ip_address = _ip_address
-    c.cert_fingerprint = cert_fingerprint
-
-    last_notified_datetime = _client_id['last_notified_datetime']
-    if last_notified_datetime:  # might be None
-      try:
-        last_notified_datetime = datetime.datetime.strptime(
-            last_notified_datetime, '%Y-%m-%d %H:%M:%S')  # timestamp is UTC.
-        c.last_notified_datetime = last_notified_datetime
-      except ValueError:  # non-standard datetime sent.
-        logging.warning(
-            'Non-standard last_notified_datetime: %s', last_notified_datetime)
+  connection = {
+      'event': event,
+      'client_id': client_id,
+      'pkgs_to_install': pkgs_to_install,
+      'apple_updates_to_install': apple_updates_to_install,
+      'ip_address': ip_address,
+      'report_feedback': report_feedback,
+      'cert_fingerprint': cert_fingerprint,
+      'datetime': datetime.datetime.utcnow().strftime(
+          CLIENT_CONNECTION_DATETIME_FORMAT),
+  }
 
-    # Update event specific (preflight vs postflight) report values.
-    if event == 'preflight':
-      c.preflight_datetime = now
-      if _client_id['on_corp'] == True:
-        c.last_on_corp_preflight_datetime = now
-
-      # Increment the number of preflight connections since the last successful
-      # postflight, but only if the current connection is not going to exit due
-      # to report feedback (WWAN, GoGo InFlight, etc.)
-      if not _report_feedback or not _report_feedback.get('exit'):
-        if c.preflight_count_since_postflight is not None:
-          c.preflight_count_since_postflight += 1
-        else:
-          c.preflight_count_since_postflight = 1
+  c = models.Computer.get_by_key_name(client_id['uuid'])
+  if c is None or [
+      f for f in CLIENT_CONNECTION_DIRECT_FIELDS
+      if getattr(c, f) != client_id[f]]:
+    unused_transactions, failed, pending_delta, fleet_delta = (
+        _WriteClientConnectionLogs(
+            {client_id['uuid']: [(connection['datetime'], connection, None)]}))
+    if not failed:
+      if pending_delta or fleet_delta:
+        _BufferReportsDelta(pending_delta, fleet_delta)
+      return
+    # buffer the log, to be written by the next flush.
 
-    elif event == 'postflight':
-      c.preflight_count_since_postflight = 0
-      c.postflight_datetime = now
+  try:
+    taskqueue.Queue(CLIENT_CONNECTION_QUEUE).add(taskqueue.Task(
+        payload=util.Serialize(connection), method='PULL'))
+  except (taskqueue.Error, apiproxy_errors.Error,
+          runtime.DeadlineExceededError) as e:
+    logging.warning(
+        'LogClientConnection add() error %s: %s', e.__class__.__name__, str(e))
+    LogClientConnection(
+        event, client_id, user_settings, pkgs_to_install,
+        apple_updates_to_install, ip_address, report_feedback,
+        delay=DATASTORE_NOWRITE_DELAY, cert_fingerprint=cert_fingerprint)
+    return
 
-      # Update pkgs_to_install.
-      if _pkgs_to_install:
-        c.pkgs_to_install = _pkgs_to_install
-        c.all_pkgs_installed = False
-      else:
-        c.pkgs_to_install = []
-        c.all_pkgs_installed = True
-      # Update all_apple_updates_installed and add Apple updates to
-      # pkgs_to_install. It's important that this code block comes after
-      # all_pkgs_installed is updated above, to ensure that all_pkgs_installed
-      # is only considers Munki updates, ignoring Apple updates added below.
-      # NOTE: if there are any pending Munki updates then we simply assume
-      # there are also pending Apple Updates, even though we cannot be sure
-      # due to the fact that Munki only checks for Apple Updates if all regular
-      # updates are installed
-      if not pkgs_to_install and not _apple_updates_to_install:
-        c.all_apple_updates_installed = True
-      else:
-        c.all_apple_updates_installed = False
-        # For now, let's store Munki and Apple Update pending installs together,
-        # using APPLESUS_PKGS_TO_INSTALL_FORMAT to format the text as desired.
-        for update in _apple_updates_to_install:
-          c.pkgs_to_install.append(APPLESUS_PKGS_TO_INSTALL_FORMAT % update)
-
-      # Keep the last CONNECTION_DATETIMES_LIMIT connection datetimes.
-      if len(c.connection_datetimes) == CONNECTION_DATETIMES_LIMIT:
-        c.connection_datetimes.pop(0)
-      c.connection_datetimes.append(now)
-
-      # Increase on_corp/off_corp count appropriately.
-      if _client_id['on_corp'] == True:
-        c.connections_on_corp = (c.connections_on_corp or 0) + 1
-      elif _client_id['on_corp'] == False:
-        c.connections_off_corp = (c.connections_off_corp or 0) + 1
-
-      # Keep the last CONNECTION_DATES_LIMIT connection dates
-      # (with time = 00:00:00)
-      # Use newly created datetime.time object to set time to 00:00:00
-      now_date = datetime.datetime.combine(now, datetime.time())
-      if now_date not in c.connection_dates:
-        if len(c.connection_dates) == CONNECTION_DATES_LIMIT:
-          c.connection_dates.pop(0)
-        c.connection_dates.append(now_date)
-    else:
-      logging.warning('Unknown event value: %s', event)
+  _ScheduleClientConnectionFlush()
 
-    c.put()
-    if is_new_client:  # Queue welcome email to be sent.
+
+def _BufferReportsDelta(pending_delta, fleet_delta):
+  """Buffers reports cache changes, to be applied by FlushClientConnections().
+
+  The flush is then the only writer of the pending counts and fleet summary,
+  which are updated without a transaction.
+
+  Args:
+    pending_delta: dict of str install name to int change in its pending count.
+    fleet_delta: dict fleet summary of count changes.
+  """
+  try:
+    taskqueue.Queue(CLIENT_CONNECTION_QUEUE).add(taskqueue.Task(
+        payload=util.Serialize({'reports_delta': {
+            'pending': pending_delta, 'fleet': fleet_delta}}),
+        method='PULL'))
+  except (taskqueue.Error, apiproxy_errors.Error,
+          runtime.DeadlineExceededError) as e:
+    # the next pending counts and summary crons correct the counts.
+    logging.warning(
+        'LogClientConnection reports delta add() error %s: %s',
+        e.__class__.__name__, str(e))
+    return
+  _ScheduleClientConnectionFlush()
+
+
+def _ScheduleClientConnectionFlush():
+  """Schedules FlushClientConnections(), at most once per flush interval.
+
+  If memcache is unavailable, the flush is scheduled as a task named after the
+  interval instead.  The flush_client_connections cron also drains any logs
+  left buffered.
+  """
+  interval = int(time.time()) / CLIENT_CONNECTION_FLUSH_SECS
+  key = CLIENT_CONNECTION_FLUSH_MEMCACHE_KEY % interval
+  name = None
+  if not memcache.add(key, 1, time=CLIENT_CONNECTION_FLUSH_SECS * 2):
+    if memcache.get(key) is not None:
+      return  # a flush was already scheduled in this interval.
+    name = key.replace('_', '-')
+  try:
+    deferred.defer(
+        FlushClientConnections, _countdown=CLIENT_CONNECTION_FLUSH_SECS,
+        _queue=CLIENT_CONNECTION_FLUSH_QUEUE, _name=name)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass  # a flush was already scheduled in this interval.
+  except (taskqueue.Error, apiproxy_errors.Error) as e:
+    # buffered logs are flushed by the next scheduled flush.
+    logging.warning(
+        'Scheduling client connection flush error %s: %s',
+        e.__class__.__name__, str(e))
+
+
+def FlushClientConnections():
+  """Writes buffered client connection logs to Computer entities.
+
+  All logs of a client are applied to its Computer entity in order, and the
+  entities are written with one cross-group transaction per
+  CLIENT_CONNECTION_TRANSACTION_SIZE computers, rather than one transaction
+  per connection.
+  """
+  queue = taskqueue.Queue(CLIENT_CONNECTION_QUEUE)
+  for _ in xrange(CLIENT_CONNECTION_FLUSH_LEASES):
+    tasks = queue.lease_tasks(
+        CLIENT_CONNECTION_LEASE_SECS, CLIENT_CONNECTION_FLUSH_MAX)
+    if tasks and _FlushClientConnectionTasks(queue, tasks):
+      # logs which failed to write are leased until then.
       deferred.defer(
-          _SaveFirstConnection, client_id=_client_id, computer_key=c.key(),
-          _countdown=300, _queue='first')
+          FlushClientConnections, _countdown=CLIENT_CONNECTION_LEASE_SECS,
+          _queue=CLIENT_CONNECTION_FLUSH_QUEUE)
+    if len(tasks) < CLIENT_CONNECTION_FLUSH_MAX:
+      return
+
+  # more logs are buffered than one task should flush.
+  deferred.defer(
+      FlushClientConnections, _queue=CLIENT_CONNECTION_FLUSH_QUEUE)
+
+
+def _FlushClientConnectionTasks(queue, tasks):
+  """Writes leased client connection logs to Computer entities.
+
+  Args:
+    queue: taskqueue.Queue, CLIENT_CONNECTION_QUEUE.
+    tasks: list of leased taskqueue.Task client connection logs.
+  Returns:
+    int number of transactions which failed.
+  """
+  connections = {}
+  dropped = []
+  reports_deltas = []
+  for task in tasks:
+    try:
+      connection = util.Deserialize(task.payload)
+      if 'reports_delta' in connection:
+        reports_deltas.append((task, _GetReportsDelta(connection)))
+        continue
+      uuid = connection['client_id']['uuid']
+    except (util.DeserializeError, KeyError, TypeError, ValueError) as e:
+      logging.error('Dropping invalid client connection log: %s', str(e))
+      dropped.append(task)
+      continue
+    if task.retry_count >= CLIENT_CONNECTION_MAX_RETRIES:
+      logging.error(
+          'Dropping %s client connection log of %s after %d retries.',
+          connection.get('event'), uuid, task.retry_count)
+      dropped.append(task)
+      continue
+    connections.setdefault(uuid, []).append(
+        (connection['datetime'], connection, task))
+
+  def _DeleteTasks(deleted_tasks):
+    try:
+      queue.delete_tasks(deleted_tasks)
+    except (taskqueue.Error, apiproxy_errors.Error) as e:
+      logging.warning(
+          'FlushClientConnections delete_tasks() error %s: %s',
+          e.__class__.__name__, str(e))
+      return False
+    return True
+
+  if dropped:
+    _DeleteTasks(dropped)
+
+  transactions, failed, pending_delta, fleet_delta = (
+      _WriteClientConnectionLogs(
+          connections, on_write=lambda batch: _DeleteTasks(
+              [task for l in batch.values() for _, _, task in l])))
+
+  # buffered deltas are applied only once deleted, so none is applied twice.
+  if reports_deltas and _DeleteTasks([task for task, _ in reports_deltas]):
+    for _, (pending, fleet) in reports_deltas:
+      for pkg, change in pending.iteritems():
+        pending_delta[pkg] = pending_delta.get(pkg, 0) + change
+      fleet_summary.Merge(fleet_delta, fleet)
+  _UpdateReportsCache(pending_delta, fleet_delta)
+
+  logging.info(
+      'Flushed %d client connections to %d computers in %d transactions, '
+      'avoiding %d transactions; %d transactions failed.',
+      len(tasks) - len(reports_deltas), len(connections), transactions,
+      len(tasks) - len(reports_deltas) - transactions, failed)
+  return failed
+
 
+def _GetReportsDelta(buffered):
+  """Returns the reports cache changes buffered by _BufferReportsDelta().
+
+  Args:
+    buffered: dict deserialized reports delta task payload.
+  Returns:
+    tuple of (dict of str install name to int change in its pending count,
+        dict fleet summary of count changes).
+  Raises:
+    KeyError, TypeError, ValueError: the payload is invalid.
+  """
+  pending = buffered['reports_delta']['pending']
+  fleet = buffered['reports_delta']['fleet']
+  if 'hours' in fleet:
+    # serialization turns the int hour keys into str.
+    fleet['hours'] = dict(
+        (int(hour), counts) for hour, counts in fleet['hours'].iteritems())
+  return pending, fleet
+
+
+def _UpdateReportsCache(pending_delta, fleet_delta):
+  """Applies client connection changes to the pending counts and summary.
+
+  Only FlushClientConnections() calls this, as the updates are not
+  transactional.
+
+  Args:
+    pending_delta: dict of str install name to int change in its pending count.
+    fleet_delta: dict fleet summary of count changes.
+  """
+  pending_delta = dict((k, v) for k, v in pending_delta.iteritems() if v)
   try:
-    db.run_in_transaction(
-        __UpdateComputerEntity,
-        event, client_id, user_settings, pkgs_to_install,
-        apple_updates_to_install, ip_address, report_feedback, c=computer,
-        cert_fingerprint=cert_fingerprint)
-  except (db.Error, apiproxy_errors.Error, runtime.DeadlineExceededError) as e:
+    if pending_delta:
+      models.ReportsCache.UpdatePendingCounts(pending_delta)
+    if fleet_delta:
+      fleet_summary.Update(fleet_delta)
+  except (db.Error, apiproxy_errors.Error) as e:
+    # the next pending counts and summary crons correct the counts.
     logging.warning(
-        'LogClientConnection put() error %s: %s', e.__class__.__name__, str(e))
-    LogClientConnection(
-        event, client_id, user_settings, pkgs_to_install,
-        apple_updates_to_install, ip_address, report_feedback,
-        delay=DATASTORE_NOWRITE_DELAY)
+        'FlushClientConnections reports cache error %s: %s',
+        e.__class__.__name__, str(e))
+
+
+def _WriteClientConnectionLogs(connections, on_write=None):
+  """Writes client connection logs to Computer entities, in batches.
+
+  Args:
+    connections: dict of str uuid to list of (str datetime, dict connection
+        log, taskqueue.Task or None) tuples.
+    on_write: function, optional, called with the dict of logs of each batch
+        once its transaction committed.
+  Returns:
+    tuple of (int number of transactions, int number which failed,
+        dict of str install name to int change in its pending count,
+        dict fleet summary of the changes to the computers).
+  """
+  uuids = sorted(connections)
+  batches = [
+      uuids[i:i + CLIENT_CONNECTION_TRANSACTION_SIZE]
+      for i in xrange(0, len(uuids), CLIENT_CONNECTION_TRANSACTION_SIZE)]
+  options = db.create_transaction_options(xg=True)
+  transactions = 0
+  failed = 0
+  pending_delta = {}
+  fleet_delta = {}
+  while batches:
+    batch = dict(
+        (uuid, sorted(connections[uuid], key=lambda c: c[0]))
+        for uuid in batches.pop(0))
+    try:
+      new_computers, delta, fleet = db.run_in_transaction_options(
+          options, _WriteClientConnections, batch)
+    except (db.Error, apiproxy_errors.Error) as e:
+      logging.warning(
+          'FlushClientConnections put() error %s: %s',
+          e.__class__.__name__, str(e))
+      failed += 1
+      continue
+    except (KeyError, TypeError, ValueError) as e:
+      # an invalid log; write each client on its own, so only the logs of the
+      # client it belongs to are left to be retried and eventually dropped.
+      if len(batch) > 1:
+        batches.extend([uuid] for uuid in sorted(batch))
+      else:
+        logging.error(
+            'FlushClientConnections invalid log of %s: %s',
+            batch.keys()[0], str(e))
+        failed += 1
+      continue
+    transactions += 1
+    for pkg, change in delta.iteritems():
+      pending_delta[pkg] = pending_delta.get(pkg, 0) + change
+    fleet_summary.Merge(fleet_delta, fleet)
+    if on_write is not None:
+      on_write(batch)
+
+    for c in new_computers:  # Queue welcome email to be sent.
+      client_id = batch[c.key().name()][0][1]['client_id']
+      deferred.defer(
+          _SaveFirstConnection, client_id=client_id, computer_key=c.key(),
+          _countdown=300, _queue='first')
+
+  pending_delta = dict((k, v) for k, v in pending_delta.iteritems() if v)
+  return transactions, failed, pending_delta, fleet_delta
+
+
+def _WriteClientConnections(connections):
+  """Applies client connection logs to Computer entities, in a transaction.
+
+  Args:
+    connections: dict of str uuid to list of (str datetime, dict connection
+        log, taskqueue.Task) tuples, in order.
+  Returns:
+    tuple of (list of models.Computer entities created for first time clients,
+        dict of str install name to int change in its pending count,
+        dict fleet summary of the changes to the computers).
+  """
+  uuids = connections.keys()
+  computers = models.Computer.get_by_key_name(uuids)
+  new_computers = []
+  pending_delta = {}
+  fleet_delta = {}
+  for i, uuid in enumerate(uuids):
+    c = computers[i]
+    if c is None:  # First time this client has connected.
+      c = models.Computer(key_name=uuid)
+      computers[i] = c
+      new_computers.append(c)
+      pending_before = set()
+    else:
+      pending_before = _GetPendingInstalls(c)
+      fleet_summary.AddComputer(fleet_delta, c, -1)
+    for _, connection, _ in connections[uuid]:
+      _ApplyClientConnection(c, connection)
+    c.UpdateActive()  # db.put() bypasses Computer.put().
+    pending_after = _GetPendingInstalls(c)
+    fleet_summary.AddComputer(fleet_delta, c)
+    for pkg in pending_after - pending_before:
+      pending_delta[pkg] = pending_delta.get(pkg, 0) + 1
+    for pkg in pending_before - pending_after:
+      pending_delta[pkg] = pending_delta.get(pkg, 0) - 1
+  db.put(computers)
+  return new_computers, pending_delta, fleet_delta
+
+
+def _GetPendingInstalls(c):
+  """Returns the set of str installs a Computer adds to pending counts."""
+  if not c.active:
+    return set()
+  return set(c.pkgs_to_install)
+
+
+def _ApplyClientConnection(c, connection):
+  """Updates a Computer entity with a client connection log.
+
+  Args:
+    c: models.Computer entity.
+    connection: dict client connection log, from LogClientConnection().
+  """
+  event = connection['event']
+  client_id = connection['client_id']
+  pkgs_to_install = connection['pkgs_to_install']
+  apple_updates_to_install = connection['apple_updates_to_install'] or []
+  report_feedback = connection['report_feedback']
+  now = datetime.datetime.strptime(
+      connection['datetime'], CLIENT_CONNECTION_DATETIME_FORMAT)
+
+  # a log buffered before a later one was written directly by
+  # LogClientConnection() only adds to counters, and does not revert the
+  # client's details or state.
+  if [d for d in [c.preflight_datetime, c.postflight_datetime]
+      if d is not None and now < d]:
+    if event == 'preflight':
+      _CountPreflight(c, now, report_feedback)
+    elif event == 'postflight':
+      _CountPostflight(c, client_id, now)
+    return
+
+  c.uuid = client_id['uuid']
+  c.hostname = client_id['hostname']
+  c.serial = client_id['serial']
+  c.owner = client_id['owner']
+  c.track = client_id['track']
+  c.site = client_id['site']
+  c.config_track = client_id['config_track']
+  c.client_version = client_id['client_version']
+  c.os_version = client_id['os_version']
+  c.uptime = client_id['uptime']
+  c.root_disk_free = client_id['root_disk_free']
+  c.user_disk_free = client_id['user_disk_free']
+  c.runtype = client_id['runtype']
+  c.ip_address = connection['ip_address']
+  c.cert_fingerprint = connection['cert_fingerprint']
+
+  last_notified_datetime = client_id['last_notified_datetime']
+  if last_notified_datetime:  # might be None
+    try:
+      last_notified_datetime = datetime.datetime.strptime(
+          last_notified_datetime, '%Y-%m-%d %H:%M:%S')  # timestamp is UTC.
+      c.last_notified_datetime = last_notified_datetime
+    except ValueError:  # non-standard datetime sent.
+      logging.warning(
+          'Non-standard last_notified_datetime: %s', last_notified_datetime)
+
+  # Update event specific (preflight vs postflight) report values.
+  if event == 'preflight':
+    c.preflight_datetime = now
+    if client_id['on_corp'] == True:
+      c.last_on_corp_preflight_datetime = now
+    _CountPreflight(c, now, report_feedback)
+
+  elif event == 'postflight':
+    c.postflight_datetime = now
+
+    # Update pkgs_to_install.
+    if pkgs_to_install:
+      c.pkgs_to_install = list(pkgs_to_install)
+      c.all_pkgs_installed = False
+    else:
+      c.pkgs_to_install = []
+      c.all_pkgs_installed = True
+    # Update all_apple_updates_installed and add Apple updates to
+    # pkgs_to_install. It's important that this code block comes after
+    # all_pkgs_installed is updated above, to ensure that all_pkgs_installed
+    # is only considers Munki updates, ignoring Apple updates added below.
+    # NOTE: if there are any pending Munki updates then we simply assume
+    # there are also pending Apple Updates, even though we cannot be sure
+    # due to the fact that Munki only checks for Apple Updates if all regular
+    # updates are installed
+    if not pkgs_to_install and not apple_updates_to_install:
+      c.all_apple_updates_installed = True
+    else:
+      c.all_apple_updates_installed = False
+      # For now, let's store Munki and Apple Update pending installs together,
+      # using APPLESUS_PKGS_TO_INSTALL_FORMAT to format the text as desired.
+      for update in apple_updates_to_install:
+        c.pkgs_to_install.append(APPLESUS_PKGS_TO_INSTALL_FORMAT % update)
+
+    _CountPostflight(c, client_id, now)
+  else:
+    logging.warning('Unknown event value: %s', event)
+
+
+def _CountPreflight(c, now, report_feedback):
+  """Updates the counters of a Computer entity for a preflight.
+
+  Args:
+    c: models.Computer entity.
+    now: datetime of the preflight.
+    report_feedback: dict ReportFeedback commands sent to the client.
+  """
+  # Increment the number of preflight connections since the last successful
+  # postflight, but only if the current connection is not going to exit due
+  # to report feedback (WWAN, GoGo InFlight, etc.)
+  if c.postflight_datetime is not None and now < c.postflight_datetime:
+    return
+  if not report_feedback or not report_feedback.get('exit'):
+    if c.preflight_count_since_postflight is not None:
+      c.preflight_count_since_postflight += 1
+    else:
+      c.preflight_count_since_postflight = 1
+
+
+def _CountPostflight(c, client_id, now):
+  """Updates the counters of a Computer entity for a postflight.
+
+  Args:
+    c: models.Computer entity.
+    client_id: dict client id of the postflight.
+    now: datetime of the postflight.
+  """
+  if c.preflight_datetime is None or now >= c.preflight_datetime:
+    c.preflight_count_since_postflight = 0
+
+  # Keep the last CONNECTION_DATETIMES_LIMIT connection datetimes.
+  if len(c.connection_datetimes) == CONNECTION_DATETIMES_LIMIT:
+    c.connection_datetimes.pop(0)
+  c.connection_datetimes.append(now)
+
+  # Increase on_corp/off_corp count appropriately.
+  if client_id['on_corp'] == True:
+    c.connections_on_corp = (c.connections_on_corp or 0) + 1
+  elif client_id['on_corp'] == False:
+    c.connections_off_corp = (c.connections_off_corp or 0) + 1
+
+  # Keep the last CONNECTION_DATES_LIMIT connection dates
+  # (with time = 00:00:00)
+  # Use newly created datetime.time object to set time to 00:00:00
+  now_date = datetime.datetime.combine(now, datetime.time())
+  if now_date not in c.connection_dates:
+    if len(c.connection_dates) == CONNECTION_DATES_LIMIT:
+      c.connection_dates.pop(0)
+    c.connection_dates.append(now_date)
 
 
 def WriteClientLog(model, uuid, **kwargs):
@@ -325,27 +729,24 @@ def WriteBrokenClient(uuid, reason, details):
   bc.put()
 
 
-def WriteComputerMSULog(uuid, details):
-  """Write log details from MSU GUI into ComputerMSULog model.
+def _GetComputerMSULog(uuid, details):
+  """Returns a ComputerMSULog entity for log details from MSU GUI.
 
   Args:
-    uuid: str, computer uuid to update
-    details: dict like = {
-      'event': str, 'something_happened',
-      'source': str, 'MSU' or 'user',
-      'user': str, 'username',
-      'time': int, epoch seconds,
-      'desc': str, 'additional descriptive text',
-    }
+    uuid: str, sanitized computer uuid.
+    details: dict, like the details of WriteComputerMSULog().
+  Returns:
+    models.ComputerMSULog entity to put, or None if it is not newer.
+  Raises:
+    db.BadValueError: details have an invalid value.
   """
-  uuid = common.SanitizeUUID(uuid)
   key = '%s_%s_%s' % (uuid, details['source'], details['event'])
   c = models.ComputerMSULog(key_name=key)
   c.uuid = uuid
   c.event = details['event']
   c.source = details['source']
-  c.user = details['user']
-  c.desc = details['desc']
+  c.user = details.get('user')
+  c.desc = details.get('desc')
   try:
     mtime = util.Datetime.utcfromtimestamp(details.get('time', None))
   except ValueError, e:
@@ -358,9 +759,64 @@ def WriteComputerMSULog(uuid, details):
     mtime = datetime.datetime.utcnow()
   if c.mtime is None or mtime > c.mtime:
     c.mtime = mtime
+    return c
+  return None
+
+
+def WriteComputerMSULog(uuid, details):
+  """Write log details from MSU GUI into ComputerMSULog model.
+
+  Args:
+    uuid: str, computer uuid to update
+    details: dict like = {
+      'event': str, 'something_happened',
+      'source': str, 'MSU' or 'user',
+      'user': str, 'username',
+      'time': int, epoch seconds,
+      'desc': str, 'additional descriptive text',
+    }
+  """
+  c = _GetComputerMSULog(common.SanitizeUUID(uuid), details)
+  if c is not None:
     c.put()
 
 
+def WriteComputerMSULogs(uuid, logs):
+  """Write a batch of log details from MSU GUI into ComputerMSULog models.
+
+  Invalid entries are skipped, and the rest written with async batch puts.
+
+  Args:
+    uuid: str, computer uuid to update
+    logs: list of dicts like the details of WriteComputerMSULog().
+  Returns:
+    int number of entries written.
+  """
+  start = time.time()
+  uuid = common.SanitizeUUID(uuid)
+  entities = {}
+  for details in logs:
+    if (type(details) is not dict or
+        not isinstance(details.get('source'), basestring) or
+        not isinstance(details.get('event'), basestring)):
+      logging.warning('Ignoring invalid msu_log from %s: %r', uuid, details)
+      continue
+    try:
+      c = _GetComputerMSULog(uuid, details)
+    except db.BadValueError, e:
+      logging.warning('Ignoring invalid msu_log from %s: %s', uuid, str(e))
+      continue
+    if c is not None:
+      # like consecutive msu_log reports, the last log of an event wins.
+      entities[c.key().name()] = c
+
+  gae_util.BatchDatastoreOpAsync(db.put_async, entities.values())
+  logging.info(
+      'msu_logs %s: %d of %d logs written in %.3fs.',
+      uuid, len(entities), len(logs), time.time() - start)
+  return len(entities)
+
+
 def GetBoolValueFromString(s):
   """Returns True for true/1 strings, and False for false/0, None otherwise."""
   if s and s.lower() == 'true' or s == '1':
@@ -507,27 +963,17 @@ def SetPanicModeNoPackages(enabled):
   SetPanicMode(PANIC_MODE_NO_PACKAGES, enabled)
 
 
-def GetComputerManifest(uuid=None, client_id=None, packagemap=False):
-  """For a computer uuid or client_id, return the current manifest.
+def _GetComputerClientId(uuid=None, client_id=None):
+  """Returns the client_id and user settings a computer manifest is built for.
 
   Args:
     uuid: str, computer uuid    OR
     client_id: dict, client_id
-    packagemap: bool, default False, whether to return packagemap or not
   Returns:
-    if packagemap, dict = {
-        'plist': plist.MunkiManifestPlist instance,
-        'packagemap': {   # if packagemap == True
-            'Firefox': 'Firefox-3.x.x.x.dmg',
-        },
-    }
-
-    if not packagemap, str, manifest plist
+    tuple of (dict client_id, dict user_settings or None)
   Raises:
     ValueError: error in type of arguments supplied to this method
     ComputerNotFoundError: computer cannot be found for uuid
-    ManifestNotFoundError: manifest requested is invalid (not found)
-    ManifestDisabledError: manifest requested is disabled
   """
   if client_id is None and uuid is None:
     raise ValueError('uuid or client_id must be supplied')
@@ -562,51 +1008,73 @@ def GetComputerManifest(uuid=None, client_id=None, packagemap=False):
         'user_disk_free': None,
     }
 
-  # Step 1: Obtain a manifest for this uuid.
-  manifest_plist_xml = None
+  return client_id, user_settings
 
-  if IsPanicModeNoPackages():
-    manifest_plist_xml = '%s%s' % (
-        plist_module.PLIST_HEAD, plist_module.PLIST_FOOT)
-  else:
-    manifest_name = client_id['track']
-    m = models.Manifest.MemcacheWrappedGet(manifest_name)
-    if not m:
-      raise ManifestNotFoundError(manifest_name)
-    elif not m.enabled:
-      raise ManifestDisabledError(manifest_name)
 
-    manifest_plist_xml = GenerateDynamicManifest(
-        m.plist, client_id, user_settings=user_settings)
+def GetComputerManifest(uuid=None, client_id=None, packagemap=False):
+  """For a computer uuid or client_id, return the current manifest.
 
-  if not manifest_plist_xml:
-    raise ManifestNotFoundError(manifest_name)
+  Args:
+    uuid: str, computer uuid    OR
+    client_id: dict, client_id
+    packagemap: bool, default False, whether to return packagemap or not
+  Returns:
+    if packagemap, dict = {
+        'plist': plist.MunkiManifestPlist instance,
+        'packagemap': {   # if packagemap == True
+            'Firefox': 'Firefox-3.x.x.x.dmg',
+        },
+    }
+
+    if not packagemap, str, manifest plist
+  Raises:
+    ValueError: error in type of arguments supplied to this method
+    ComputerNotFoundError: computer cannot be found for uuid
+    ManifestNotFoundError: manifest requested is invalid (not found)
+    ManifestDisabledError: manifest requested is disabled
+  """
+  # Step 1: Obtain a manifest for this uuid.
+  manifest_plist_xml = ComputerManifest(
+      uuid=uuid, client_id=client_id).GetXml()
 
   # Step 1: Return now with xml if packagemap not requested.
   if not packagemap:
     return manifest_plist_xml
 
-  # Step 2: Build lookup table from PackageName to PackageName-VersionNumber
-  # for packages found in catalogs used by the client.
+  # Step 2: Read the lookup table from PackageName to PackageName-VersionNumber
+  # from the packagemap index.
 
   manifest_plist = plist_module.MunkiManifestPlist(manifest_plist_xml)
   manifest_plist.Parse()
 
-  packages = {}
-
-  query = models.PackageInfo.all()
-  for p in query:
-    display_name = p.plist.get('display_name', None) or p.plist.get('name')
-    display_name = display_name.strip()
-    version = p.plist.get('version', '')
-    packages[p.name] = '%s-%s' % (display_name, version)
-
   return {
       'plist': manifest_plist,
-      'packagemap': packages,
+      'packagemap': models.PackageInfo.GetPackageMap(),
   }
 
 
+def _GetEnabledManifest(client_id):
+  """Returns the base manifest of a client.
+
+  Args:
+    client_id: dict client_id parsed by common.ParseClientId.
+  Returns:
+    models.Manifest entity, or None in no packages panic mode.
+  Raises:
+    ManifestNotFoundError: manifest requested is invalid (not found)
+    ManifestDisabledError: manifest requested is disabled
+  """
+  if IsPanicModeNoPackages():
+    return None
+  manifest_name = client_id['track']
+  m = models.Manifest.MemcacheWrappedGet(manifest_name)
+  if not m:
+    raise ManifestNotFoundError(manifest_name)
+  elif not m.enabled:
+    raise ManifestDisabledError(manifest_name)
+  return m
+
+
 def _ModifyList(l, value):
   """Adds or removes a value from a list.
 
@@ -623,114 +1091,389 @@ def _ModifyList(l, value):
     l.append(value)
 
 
-def GenerateDynamicManifest(plist, client_id, user_settings=None):
+class CompiledManifest(object):
+  """A parsed base manifest, shared by all requests for a track.
+
+  Compiled manifests are cached per instance and only rebuilt when the
+  Manifest entity mtime changes, so dynamic manifest generation does not
+  parse any XML per request.
+  """
+
+  def __init__(self, contents, xml):
+    """Initializes the compiled manifest.
+
+    Args:
+      contents: dict, parsed manifest plist contents.
+      xml: str XML of the unmodified manifest.
+    """
+    self.contents = contents
+    self.xml = xml
+
+  def GetContents(self):
+    """Returns a copy of the contents which is safe to modify."""
+    contents = {}
+    for k, v in self.contents.iteritems():
+      if type(v) is list:
+        v = list(v)
+      contents[k] = v
+    return contents
+
+  def GetXml(self):
+    """Returns str XML of the unmodified manifest."""
+    return self.xml
+
+
+def GetCompiledManifest(manifest):
+  """Returns a CompiledManifest for a Manifest entity.
+
+  Args:
+    manifest: models.Manifest entity.
+  Returns:
+    CompiledManifest instance.
+  """
+  name = manifest.key().name()
+  cached = _COMPILED_MANIFESTS.get(name)
+  if cached and manifest.mtime and cached[0] == manifest.mtime:
+    return cached[1]
+
+  plist = manifest.plist
+  compiled = CompiledManifest(plist.GetContents(), plist.GetXml())
+  _COMPILED_MANIFESTS[name] = (manifest.mtime, compiled)
+  return compiled
+
+
+def _CompileMods(mods):
+  """Returns compiled, enabled manifest modifications.
+
+  Args:
+    mods: list of models.BaseManifestModification entities.
+  Returns:
+    list of (manifests, install_types, value) tuples.
+  """
+  return [
+      (frozenset(mod.manifests or []), tuple(mod.install_types), mod.value)
+      for mod in mods if mod.enabled]
+
+
+def _GetModTargets(client_id):
+  """Returns all manifest modification lookups for a client_id.
+
+  Args:
+    client_id: dict client_id parsed by common.ParseClientId.
+  Returns:
+    tuple of (list of (mod_type, target) tuples, int number of RPCs).
+  """
+  targets = [
+      ('site', client_id['site']),
+      ('os_version', client_id['os_version']),
+      ('owner', client_id['owner']),
+      ('uuid', client_id['uuid']),
+  ]
+  rpcs = 0
+  if client_id['uuid']:  # not set if viewing a base manifest.
+    computer_key = models.db.Key.from_path('Computer', client_id['uuid'])
+    for tag in models.Tag.GetAllTagNamesForKey(computer_key):
+      targets.append(('tag', tag))
+    rpcs += 1
+  if client_id['owner']:
+    for group in models.Group.GetAllGroupNamesForUser(client_id['owner']):
+      targets.append(('group', group))
+    rpcs += 1
+  return targets, rpcs
+
+
+def _PrefetchCompiledMods(targets, version):
+  """Returns compiled, enabled manifest modifications for many targets.
+
+  Targets not in the per instance cache are fetched with a single
+  memcache.get_multi, and a single round of concurrent queries for the
+  memcache misses.
+
+  Args:
+    targets: list of (mod_type, target) tuples.
+    version: int, current models.BaseManifestModification.GetModsVersion().
+  Returns:
+    tuple of (list of compiled mod lists in targets order, int number of RPCs).
+  """
+  now = time.time()
+  compiled_mods = {}
+  lookups = []
+  missing = []
+  for key in targets:
+    cached = _COMPILED_MODS.get(key)
+    if cached and cached[0] == version and cached[1] > now:
+      compiled_mods[key] = cached[2]
+    elif key not in missing:
+      model = models.MANIFEST_MOD_MODELS[key[0]]
+      lookups.append(
+          (model, (('%s =' % model.TARGET_PROPERTY_NAME, key[1]),)))
+      missing.append(key)
+
+  results, rpcs = models.BaseModel.MemcacheWrappedGetAllFilterMulti(lookups)
+
+  if len(_COMPILED_MODS) + len(missing) > COMPILED_MODS_CACHE_SIZE:
+    _COMPILED_MODS.clear()
+  for key, mods in zip(missing, results):
+    compiled_mods[key] = _CompileMods(mods)
+    _COMPILED_MODS[key] = (
+        version, now + COMPILED_MODS_CACHE_SECS, compiled_mods[key])
+
+  return [compiled_mods[key] for key in targets], rpcs
+
+
+def _GetUserSettingsMods(user_settings):
+  """Returns the manifest modifications requested by user settings.
+
+  Args:
+    user_settings: dict UserSettings as defined in Simian client, or None.
+  Returns:
+    tuple of (bool FlashDeveloper, list of str BlockPackages).
+  """
+  if not user_settings:
+    return False, []
+  return (user_settings.get('FlashDeveloper', False),
+          user_settings.get('BlockPackages', []))
+
+
+def GenerateDynamicManifest(
+    plist, client_id, user_settings=None, compiled_mods=None):
   """Generate a dynamic manifest based on a the various client_id fields.
 
   Args:
-    plist: str XML or plist_module.ApplePlist object, manifest to start with.
+    plist: str XML, plist_module.ApplePlist or CompiledManifest object,
+        manifest to start with.
     client_id: dict client_id parsed by common.ParseClientId.
     user_settings: dict UserSettings as defined in Simian client.
+    compiled_mods: optional list of compiled mod lists of the client already
+        returned by _PrefetchCompiledMods(), to not look them up again.
   Returns:
     str XML manifest with any custom modifications based on the client_id.
   """
-  # TODO(user): This function is getting out of control and needs refactoring.
   manifest = client_id['track']
 
-  site_mods = models.SiteManifestModification.MemcacheWrappedGetAllFilter(
-      (('site =', client_id['site']),))
+  if compiled_mods is None:
+    targets, rpcs = _GetModTargets(client_id)
+    compiled_mods, prefetch_rpcs = _PrefetchCompiledMods(
+        targets, models.BaseManifestModification.GetModsVersion())
+    logging.debug(
+        'GenerateDynamicManifest: %d mod lookups with %d RPCs',
+        len(targets), rpcs + prefetch_rpcs + 1)
 
-  os_version_mods = \
-      models.OSVersionManifestModification.MemcacheWrappedGetAllFilter(
-          (('os_version =', client_id['os_version']),))
+  mods = []
+  for target_mods in compiled_mods:
+    for manifests, install_types, value in target_mods:
+      # if mod manifests is empty, the mod is made to any manifest.
+      if not manifests or manifest in manifests:
+        mods.append((install_types, value))
 
-  owner_mods = models.OwnerManifestModification.MemcacheWrappedGetAllFilter(
-      (('owner =', client_id['owner']),))
+  flash_developer, block_packages = _GetUserSettingsMods(user_settings)
 
-  uuid_mods = models.UuidManifestModification.MemcacheWrappedGetAllFilter(
-      (('uuid =', client_id['uuid']),))
+  if not mods and not flash_developer and not block_packages:
+    if type(plist) is str:
+      return plist
+    return plist.GetXml()
+
+  if type(plist) is str:
+    plist = plist_module.MunkiManifestPlist(plist)
+    plist.Parse()
+  contents = plist.GetContents()
+
+  for install_types, value in mods:
+    for install_type in install_types:
+      _ModifyList(contents.setdefault(install_type, []), value)
+
+  # If FlashDeveloper is True, replace the regular flash plugin with the
+  # debug version in managed_updates.
+  if flash_developer:
+    managed_updates = contents.setdefault(common.MANAGED_UPDATES, [])
+    managed_updates.append(FLASH_PLUGIN_DEBUG_NAME)
+    try:
+      managed_updates.remove(FLASH_PLUGIN_NAME)
+    except ValueError:
+      pass  # FLASH_PLUGIN_NAME was not in managed_updates to begin with.
+
+  # Look for each block package in each install type, remove if found.
+  for block_package in block_packages:
+    for install_type in common.INSTALL_TYPES:
+      if block_package in contents.get(install_type, []):
+        contents[install_type].remove(block_package)
+
+  return plist_module.GetXmlDocument(contents)
 
-  tag_mods = []
-  if client_id['uuid']:  # not set if viewing a base manifest.
-    computer_key = models.db.Key.from_path('Computer', client_id['uuid'])
-    computer_tags = models.Tag.GetAllTagNamesForKey(computer_key)
-    if computer_tags:
-      # NOTE(user): if we feel most computers will have tags, it might make
-      #             sense to regularly fetch and cache all mods.
-      for tag in computer_tags:
-        t = (('tag_key_name =', tag),)
-        tag_mods.extend(
-            models.TagManifestModification.MemcacheWrappedGetAllFilter(t))
-
-  group_mods = []
-  if client_id['owner']:
-    owner_groups = models.Group.GetAllGroupNamesForUser(client_id['owner'])
-    if owner_groups:
-      for group in owner_groups:
-        g = (('group_key_name =', group),)
-        group_mods.extend(
-            models.GroupManifestModification.MemcacheWrappedGetAllFilter(g))
 
-  def __ApplyModifications(manifest, mod, plist):
-    """Applies a manifest modification if the manifest matches mod manifest.
+class _ManifestResultCache(object):
+  """Bounded per instance LRU cache of generated manifests keyed by ETag.
 
-    NOTE(user): if mod.manifests is empty or None, mod is made to any manifest.
+  ETags are fingerprints of everything a manifest is generated from, so
+  entries never need to be invalidated; stale ones are simply never read again
+  and are evicted once the cache holds MANIFEST_RESULT_CACHE_BYTES.
+  """
+
+  def __init__(self, max_bytes=MANIFEST_RESULT_CACHE_BYTES):
+    self._max_bytes = max_bytes
+    self._results = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.stats = {
+        'hits': 0, 'misses': 0, 'not_modified': 0, 'bytes_saved': 0,
+        'evictions': 0}
+
+  def _Touch(self, etag):
+    """Returns a cached manifest, now most recently used; call with lock."""
+    xml = self._results.pop(etag, None)
+    if xml is not None:
+      self._results[etag] = xml
+    return xml
+
+  def Get(self, etag):
+    """Get a manifest from the cache.
+
+    Args:
+      etag: str, manifest ETag.
+    Returns:
+      str XML manifest, or None if not cached.
     """
-    plist_xml = None
-    if type(plist) is str:
-      plist_xml = plist
+    with self._lock:
+      xml = self._Touch(etag)
+      if xml is None:
+        self.stats['misses'] += 1
+      else:
+        self.stats['hits'] += 1
+      return xml
 
-    if not mod.enabled:
-      return  # return it the mod is disabled
-    elif mod.manifests and manifest not in mod.manifests:
-      return  # return if the desired manifest is not in the mod manifests.
+  def Set(self, etag, xml):
+    """Cache a manifest.
 
-    for install_type in mod.install_types:
-      plist_module.UpdateIterable(
-          plist, install_type, mod.value, default=[], op=_ModifyList)
+    Args:
+      etag: str, manifest ETag.
+      xml: str XML manifest.
+    """
+    if len(xml) > self._max_bytes:
+      return
+    with self._lock:
+      old_xml = self._results.pop(etag, None)
+      if old_xml is not None:
+        self._bytes -= len(old_xml)
+      self._results[etag] = xml
+      self._bytes += len(xml)
+      while self._bytes > self._max_bytes:
+        self._bytes -= len(self._results.popitem(last=False)[1])
+        self.stats['evictions'] += 1
+
+  def NotModified(self, etag):
+    """Records a manifest the client already had.
+
+    Args:
+      etag: str, manifest ETag.
+    """
+    with self._lock:
+      xml = self._Touch(etag)
+      self.stats['not_modified'] += 1
+      if xml is not None:
+        self.stats['bytes_saved'] += len(xml)
 
-  if (site_mods or owner_mods or os_version_mods or uuid_mods or tag_mods
-      or group_mods):
-    if type(plist) is str:
-      plist = plist_module.MunkiManifestPlist(plist)
-      plist.Parse()
-    for mod in site_mods:
-      __ApplyModifications(manifest, mod, plist)
-    for mod in os_version_mods:
-      __ApplyModifications(manifest, mod, plist)
-    for mod in owner_mods:
-      __ApplyModifications(manifest, mod, plist)
-    for mod in uuid_mods:
-      __ApplyModifications(manifest, mod, plist)
-    for mod in tag_mods:
-      __ApplyModifications(manifest, mod, plist)
-    for mod in group_mods:
-      __ApplyModifications(manifest, mod, plist)
-
-  if user_settings:
-    flash_developer = user_settings.get('FlashDeveloper', False)
-    block_packages = user_settings.get('BlockPackages', [])
-    # If plist is not parsed yet and modifications are required, parse it.
-    if (flash_developer or block_packages) and type(plist) is str:
-      if type(plist) is str:
-        plist = plist_module.MunkiManifestPlist(plist)
-        plist.Parse()
-
-    # If FlashDeveloper is True, replace the regular flash plugin with the
-    # debug version in managed_updates.
-    if flash_developer:
-      plist[common.MANAGED_UPDATES].append(FLASH_PLUGIN_DEBUG_NAME)
-      try:
-        plist[common.MANAGED_UPDATES].remove(FLASH_PLUGIN_NAME)
-      except ValueError:
-        pass  # FLASH_PLUGIN_NAME was not in managed_updates to begin with.
+  def Clear(self):
+    """Clear the cache."""
+    with self._lock:
+      self._results.clear()
+      self._bytes = 0
 
-    # Look for each block package in each install type, remove if found.
-    for block_package in block_packages:
-      for install_type in common.INSTALL_TYPES:
-        if block_package in plist.get(install_type, []):
-          plist[install_type].remove(block_package)
 
-  if type(plist) is str:
-    return plist
-  else:
-    return plist.GetXml()
+_MANIFEST_RESULT_CACHE = _ManifestResultCache()
+
+
+def GetManifestResultCacheStats():
+  """Returns a dict of manifest result cache counts and hit ratio.
+
+  Returns:
+    dict with int hits, misses, not_modified, evictions, bytes_saved, the
+    total length of manifests not resent to clients which already had them,
+    and float hit_ratio, the share of requests answered without generating a
+    manifest.
+  """
+  stats = dict(_MANIFEST_RESULT_CACHE.stats)
+  requests = stats['hits'] + stats['misses'] + stats['not_modified']
+  stats['hit_ratio'] = 0.0
+  if requests:
+    stats['hit_ratio'] = float(
+        stats['hits'] + stats['not_modified']) / requests
+  return stats
+
+
+class ComputerManifest(object):
+  """The current manifest of a computer, and its ETag.
+
+  The ETag is a fingerprint of everything the manifest is generated from: the
+  base manifest and its mtime, the manifest modifications of the client,
+  including those of its tags and groups, and its user settings. It is
+  computed without generating the manifest, so requests from clients which
+  already have the manifest are answered without generating it, and the
+  others are served from a per instance result cache. As the fingerprint
+  covers the modifications read rather than their version, modifications read
+  from a query which missed a change are never cached as the changed manifest.
+  """
+
+  def __init__(self, uuid=None, client_id=None):
+    """Looks up the manifest inputs and computes the ETag.
+
+    Args:
+      uuid: str, computer uuid    OR
+      client_id: dict, client_id
+    Raises:
+      ValueError: error in type of arguments supplied to this method
+      ComputerNotFoundError: computer cannot be found for uuid
+      ManifestNotFoundError: manifest requested is invalid (not found)
+      ManifestDisabledError: manifest requested is disabled
+    """
+    self.client_id, self.user_settings = _GetComputerClientId(
+        uuid=uuid, client_id=client_id)
+    self.manifest = _GetEnabledManifest(self.client_id)
+    self.compiled_mods = None
+
+    if self.manifest is None:
+      fingerprint = [PANIC_MODE_PREFIX + PANIC_MODE_NO_PACKAGES]
+    else:
+      if self.manifest.mtime:
+        manifest_version = str(self.manifest.mtime)
+      else:
+        manifest_version = GetCompiledManifest(self.manifest).GetXml()
+      targets, unused_rpcs = _GetModTargets(self.client_id)
+      self.compiled_mods, unused_rpcs = _PrefetchCompiledMods(
+          targets, models.BaseManifestModification.GetModsVersion())
+      mods = [
+          [sorted(manifests), list(install_types), value]
+          for target_mods in self.compiled_mods
+          for manifests, install_types, value in target_mods]
+      fingerprint = [
+          self.client_id['track'], manifest_version, mods,
+          _GetUserSettingsMods(self.user_settings)]
+
+    self.etag = hashlib.sha256(util.Serialize(fingerprint)).hexdigest()
+
+  def GetXml(self):
+    """Returns the manifest, from the result cache if it was generated before.
+
+    Returns:
+      str XML manifest.
+    Raises:
+      ManifestNotFoundError: the generated manifest is empty.
+    """
+    xml = _MANIFEST_RESULT_CACHE.Get(self.etag)
+    if xml is not None:
+      return xml
+
+    if self.manifest is None:
+      xml = '%s%s' % (plist_module.PLIST_HEAD, plist_module.PLIST_FOOT)
+    else:
+      xml = GenerateDynamicManifest(
+          GetCompiledManifest(self.manifest), self.client_id,
+          user_settings=self.user_settings, compiled_mods=self.compiled_mods)
+      if not xml:
+        raise ManifestNotFoundError(self.client_id['track'])
+
+    _MANIFEST_RESULT_CACHE.Set(self.etag, xml)
+    return xml
+
+  def NotModified(self):
+    """Records that the manifest was not resent, as the client had it."""
+    _MANIFEST_RESULT_CACHE.NotModified(self.etag)
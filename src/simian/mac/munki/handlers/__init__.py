@@ -83,6 +83,50 @@ def IsClientResourceExpired(resource_dt, str_header_dt):
     return True
 
 
+def IsETagInHeader(etags, str_header):
+  """Checks whether an If-None-Match header matches any of the ETags.
+
+  Args:
+    etags: list of str ETag values, unquoted.
+    str_header: str If-None-Match header value, like '"abc", W/"def"'.
+  Returns:
+    Boolean. True if the header matches any of the ETags.
+  """
+  for tag in str_header.split(','):
+    tag = tag.strip()
+    if tag == '*':
+      return True
+    if tag.startswith('W/'):
+      tag = tag[2:]  # If-None-Match uses the weak comparison.
+    if tag.strip('"') in etags:
+      return True
+  return False
+
+
+def IsEncodingAccepted(encoding, str_header):
+  """Checks whether an Accept-Encoding header accepts a content coding.
+
+  Args:
+    encoding: str content coding, like 'gzip'.
+    str_header: str Accept-Encoding header value, like 'gzip, deflate;q=0.5'.
+  Returns:
+    Boolean. True if the content coding is accepted.
+  """
+  for coding in str_header.split(','):
+    params = coding.split(';')
+    if params[0].strip().lower() not in [encoding, '*']:
+      continue
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          return float(value) > 0
+        except ValueError:
+          return False
+    return True
+  return False
+
+
 def GetClientIdForRequest(request, session=None, client_id_str=None):
   """Returns a client_id dict for the given request.
 
@@ -22,6 +22,9 @@ from simian.mac.common import auth
 from simian.mac.munki import handlers
 
 
+GZIP_ETAG_SUFFIX = '-gzip'
+
+
 class Catalogs(handlers.AuthenticationHandler):
   """Handler for /catalogs/"""
 
@@ -41,8 +44,22 @@ class Catalogs(handlers.AuthenticationHandler):
       self.response.set_status(httplib.NOT_FOUND)
       return
 
-    header_date_str = self.request.headers.get('If-Modified-Since', '')
-    if not handlers.IsClientResourceExpired(catalog.mtime, header_date_str):
+    use_gzip = bool(catalog.plist_gzip) and handlers.IsEncodingAccepted(
+        'gzip', self.request.headers.get('Accept-Encoding', ''))
+    if_none_match_str = self.request.headers.get('If-None-Match', '')
+    if catalog.plist_sha256:
+      # the compressed variant is another representation, with another ETag.
+      etags = [catalog.plist_sha256, catalog.plist_sha256 + GZIP_ETAG_SUFFIX]
+      self.response.headers['ETag'] = '"%s"' % etags[use_gzip]
+      self.response.headers['Vary'] = 'Accept-Encoding'
+
+    if catalog.plist_sha256 and if_none_match_str:
+      not_modified = handlers.IsETagInHeader(etags, if_none_match_str)
+    else:
+      header_date_str = self.request.headers.get('If-Modified-Since', '')
+      not_modified = not handlers.IsClientResourceExpired(
+          catalog.mtime, header_date_str)
+    if not_modified:
       self.response.set_status(httplib.NOT_MODIFIED)
       return
 
@@ -50,4 +67,8 @@ class Catalogs(handlers.AuthenticationHandler):
         handlers.HEADER_DATE_FORMAT)
 
     self.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
-    self.response.out.write(catalog.plist_xml)
+    if use_gzip:
+      self.response.headers['Content-Encoding'] = 'gzip'
+      self.response.out.write(catalog.plist_gzip)
+    else:
+      self.response.out.write(catalog.plist_xml)
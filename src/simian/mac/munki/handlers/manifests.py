@@ -41,8 +41,14 @@ class Manifests(handlers.AuthenticationHandler):
         self.request, session=session, client_id_str=client_id_str)
 
     try:
-      plist_xml = common.GetComputerManifest(
-          client_id=client_id, packagemap=False)
+      manifest = common.ComputerManifest(client_id=client_id)
+      if handlers.IsETagInHeader(
+          [manifest.etag], self.request.headers.get('If-None-Match', '')):
+        manifest.NotModified()
+        self.response.headers['ETag'] = '"%s"' % manifest.etag
+        self.response.set_status(httplib.NOT_MODIFIED)
+        return
+      plist_xml = manifest.GetXml()
     except common.ManifestNotFoundError, e:
       logging.warning('Invalid manifest requested: %s', str(e))
       self.response.set_status(httplib.NOT_FOUND)
@@ -58,4 +64,5 @@ class Manifests(handlers.AuthenticationHandler):
       return
 
     self.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+    self.response.headers['ETag'] = '"%s"' % manifest.etag
     self.response.out.write(plist_xml)
@@ -127,7 +127,13 @@ class Packages(
       self.response.headers['Last-Modified'] = pkg_date.strftime(
           handlers.HEADER_DATE_FORMAT)
       self.response.headers['X-Download-Size'] = str(pkg_size_bytes)
-      self.send_blob(pkg.blobstore_key)
+      self.response.headers['Accept-Ranges'] = 'bytes'
+      # Only honor a Range request to resume a download if the client's
+      # partial file, identified by If-Range, is of the current package.
+      if_range_str = self.request.headers.get('If-Range', '')
+      use_range = not if_range_str or bool(
+          pkg.pkgdata_sha256 and if_range_str == pkg.pkgdata_sha256)
+      self.send_blob(pkg.blobstore_key, use_range=use_range)
     else:
       # Client doesn't need to do anything, current version is OK based on
       # ETag and/or last modified date.
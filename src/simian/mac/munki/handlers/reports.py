@@ -17,16 +17,22 @@
 """Reports URL handlers."""
 
 import datetime
+import hashlib
 import json
 import logging
 import os
 import re
+import time
 import urllib
 
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
 from simian.auth import gaeserver
 from simian.mac import common as main_common
 from simian.mac import models
 from simian.mac.common import gae_util
+from simian.mac.common import install_stats
 from simian.mac.common import util
 from simian.mac.munki import common
 from simian.mac.munki import handlers
@@ -43,6 +49,13 @@ INSTALL_RESULT_SUCCESSFUL = 'SUCCESSFUL'
 
 JSON_PREFIX = ')]}\',\n'
 
+# str name of the queue install reports are written from, so clients need not
+# wait on the Datastore; None writes them before responding to the client.
+INSTALL_REPORT_QUEUE = 'install-reports'
+
+# Max number of MSU logs written per msu_logs report.
+MSU_LOGS_MAX = 1000
+
 LEGACY_INSTALL_RESULTS_STRING_REGEX = re.compile(
     r'^Install of (.*)-(\d+.*): (%s|%s: (\-?\d+))$' % (
         INSTALL_RESULT_SUCCESSFUL, INSTALL_RESULT_FAILED))
@@ -70,6 +83,138 @@ def IsExitFeedbackIpAddress(ip_address):
       models.KeyValueCache.IpInList('client_exit_ip_blocks', ip_address))
 
 
+def _GetInstallLogs(uuid, computer, installs, on_corp, report_id):
+  """Parses install strings into InstallLog entities.
+
+  Args:
+    uuid: str, computer uuid.
+    computer: models.Computer entity, or None if unknown.
+    installs: list, of str install data from a preflight/postflight report.
+    on_corp: bool on_corp status of the client, or None if unknown.
+    report_id: str, id of the report, which key names are derived from.
+  Returns:
+    list of unsaved models.InstallLog entities.
+  """
+  install_logs = []
+  for i, install in enumerate(installs):
+    if install.startswith('Install of'):
+      d = {
+          'applesus': 'false',
+          'duration_seconds': None,
+          'download_kbytes_per_sec': None,
+          'name': install,
+          'status': 'UNKNOWN',
+          'version': '',
+          'unattended': 'false',
+      }
+      # support for old 'Install of FooPkg-1.0: SUCCESSFUL' style strings.
+      try:
+        m = LEGACY_INSTALL_RESULTS_STRING_REGEX.search(install)
+        if not m:
+          raise ValueError
+        elif m.group(3) == INSTALL_RESULT_SUCCESSFUL:
+          d['status'] = 0
+        else:
+          d['status'] = m.group(4)
+        d['name'] = m.group(1)
+        d['version'] = m.group(2)
+      except (IndexError, AttributeError, ValueError):
+        logging.warning('Unknown install string format: %s', install)
+    else:
+      # support for new 'name=pkg|version=foo|...' style strings.
+      d = common.KeyValueStringToDict(install)
+
+    name = d.get('display_name', '') or d.get('name', '')
+    version = d.get('version', '')
+    status = str(d.get('status', ''))
+    applesus = common.GetBoolValueFromString(d.get('applesus', '0'))
+    unattended = common.GetBoolValueFromString(d.get('unattended', '0'))
+    try:
+      duration_seconds = int(d.get('duration_seconds', None))
+    except (TypeError, ValueError):
+      duration_seconds = None
+    try:
+      dl_kbytes_per_sec = int(d.get('download_kbytes_per_sec', None))
+      # Ignore zero KB/s download speeds, as that's how Munki reports
+      # unknown speed.
+      if dl_kbytes_per_sec == 0:
+        dl_kbytes_per_sec = None
+    except (TypeError, ValueError):
+      dl_kbytes_per_sec = None
+
+    try:
+      install_datetime = util.Datetime.utcfromtimestamp(d.get('time', None))
+    except ValueError as e:
+      logging.info('Ignoring invalid install_datetime: %s', str(e))
+      install_datetime = datetime.datetime.utcnow()
+    except util.EpochExtremeFutureValueError as e:
+      logging.info('Ignoring extreme future install_datetime: %s', str(e))
+      install_datetime = datetime.datetime.utcnow()
+    except util.EpochFutureValueError:
+      install_datetime = datetime.datetime.utcnow()
+
+    pkg = '%s-%s' % (name, version)
+    entity = models.InstallLog(
+        key_name='%s_install_%d' % (report_id, i),
+        uuid=uuid, computer=computer, package=pkg, status=status,
+        on_corp=on_corp, applesus=applesus, unattended=unattended,
+        duration_seconds=duration_seconds, mtime=install_datetime,
+        dl_kbytes_per_sec=dl_kbytes_per_sec)
+    # set here too, as db.put_async() bypasses InstallLog.put().
+    entity.success = entity.IsSuccess()
+    install_logs.append(entity)
+  return install_logs
+
+
+def LogInstallReport(
+    uuid, installs, removals, problems, on_corp, received_time=None):
+  """Writes all logs of an install_report.
+
+  Every section of the report is parsed into entities in a single pass, which
+  are then written with overlapping async batch puts.  Key names are derived
+  from uuid and received_time, so if the task is retried after some of the
+  entities were written, they are overwritten rather than written twice, and
+  the install stats of the report are only buffered once.
+
+  Args:
+    uuid: str, computer uuid.
+    installs: list, of str install data.
+    removals: list, of str removal details.
+    problems: list, of str problem install details.
+    on_corp: str on_corp status from the client; '1', '0' or unknown.
+    received_time: float, optional, time.time() the report was received.
+  """
+  start = time.time()
+  if received_time is None:
+    received_time = start
+  report_id = hashlib.sha256('%s_%r' % (uuid, received_time)).hexdigest()
+  if on_corp == '1':
+    on_corp = True
+  elif on_corp == '0':
+    on_corp = False
+  else:
+    on_corp = None
+
+  computer = models.Computer.get_by_key_name(uuid)
+  install_logs = _GetInstallLogs(
+      uuid, computer, installs, on_corp, report_id)
+  entities = list(install_logs)
+  for action, details in [('removal', removals), ('install_problem', problems)]:
+    for i, detail in enumerate(details):
+      entities.append(models.ClientLog(
+          key_name='%s_%s_%d' % (report_id, action, i),
+          uuid=uuid, computer=computer, action=action, details=detail))
+
+  gae_util.BatchDatastoreOpAsync(models.db.put_async, entities)
+  install_stats.LogInstalls(install_logs, name='install-report-' + report_id)
+
+  now = time.time()
+  logging.info(
+      'install_report %s: %d installs, %d removals, %d problems written in '
+      '%.3fs; %.3fs after receipt.', uuid, len(installs), len(removals),
+      len(problems), now - start, now - received_time)
+
+
 class Reports(handlers.AuthenticationHandler):
   """Handler for /reports/."""
 
@@ -136,93 +281,6 @@ class Reports(handlers.AuthenticationHandler):
 
     return feedback
 
-  def _LogInstalls(self, installs, computer):
-    """Logs a batch of installs for a given computer.
-
-    Args:
-      installs: list, of str install data from a preflight/postflight report.
-      computer: models.Computer entity.
-    """
-    if not installs:
-      return
-
-    on_corp = self.request.get('on_corp')
-    if on_corp == '1':
-      on_corp = True
-    elif on_corp == '0':
-      on_corp = False
-    else:
-      on_corp = None
-
-    to_put = []
-    for install in installs:
-      if install.startswith('Install of'):
-        d = {
-            'applesus': 'false',
-            'duration_seconds': None,
-            'download_kbytes_per_sec': None,
-            'name': install,
-            'status': 'UNKNOWN',
-            'version': '',
-            'unattended': 'false',
-        }
-        # support for old 'Install of FooPkg-1.0: SUCCESSFUL' style strings.
-        try:
-          m = LEGACY_INSTALL_RESULTS_STRING_REGEX.search(install)
-          if not m:
-            raise ValueError
-          elif m.group(3) == INSTALL_RESULT_SUCCESSFUL:
-            d['status'] = 0
-          else:
-            d['status'] = m.group(4)
-          d['name'] = m.group(1)
-          d['version'] = m.group(2)
-        except (IndexError, AttributeError, ValueError):
-          logging.warning('Unknown install string format: %s', install)
-      else:
-        # support for new 'name=pkg|version=foo|...' style strings.
-        d = common.KeyValueStringToDict(install)
-
-      name = d.get('display_name', '') or d.get('name', '')
-      version = d.get('version', '')
-      status = str(d.get('status', ''))
-      applesus = common.GetBoolValueFromString(d.get('applesus', '0'))
-      unattended = common.GetBoolValueFromString(d.get('unattended', '0'))
-      try:
-        duration_seconds = int(d.get('duration_seconds', None))
-      except (TypeError, ValueError):
-        duration_seconds = None
-      try:
-        dl_kbytes_per_sec = int(d.get('download_kbytes_per_sec', None))
-        # Ignore zero KB/s download speeds, as that's how Munki reports
-        # unknown speed.
-        if dl_kbytes_per_sec == 0:
-          dl_kbytes_per_sec = None
-      except (TypeError, ValueError):
-        dl_kbytes_per_sec = None
-
-      try:
-        install_datetime = util.Datetime.utcfromtimestamp(d.get('time', None))
-      except ValueError as e:
-        logging.info('Ignoring invalid install_datetime: %s', str(e))
-        install_datetime = datetime.datetime.utcnow()
-      except util.EpochExtremeFutureValueError as e:
-        logging.info('Ignoring extreme future install_datetime: %s', str(e))
-        install_datetime = datetime.datetime.utcnow()
-      except util.EpochFutureValueError:
-        install_datetime = datetime.datetime.utcnow()
-
-      pkg = '%s-%s' % (name, version)
-      entity = models.InstallLog(
-          uuid=computer.uuid, computer=computer, package=pkg, status=status,
-          on_corp=on_corp, applesus=applesus, unattended=unattended,
-          duration_seconds=duration_seconds, mtime=install_datetime,
-          dl_kbytes_per_sec=dl_kbytes_per_sec)
-      entity.success = entity.IsSuccess()
-      to_put.append(entity)
-
-    gae_util.BatchDatastoreOp(models.db.put, to_put)
-
   def post(self):
     """Reports get handler.
 
@@ -256,9 +314,9 @@ class Reports(handlers.AuthenticationHandler):
       apple_updates_to_install = self.request.get_all(
           'apple_updates_to_install')
 
-      computer = models.Computer.get_by_key_name(uuid)
       ip_address = os.environ.get('REMOTE_ADDR', '')
       if report_type == 'preflight':
+        computer = models.Computer.get_by_key_name(uuid)
         # we want to get feedback now, before preflight_datetime changes.
         client_exit = self.request.get('client_exit', None)
         report_feedback = self.GetReportFeedback(
@@ -288,24 +346,27 @@ class Reports(handlers.AuthenticationHandler):
 
       common.LogClientConnection(
           report_type, client_id, user_settings, pkgs_to_install,
-          apple_updates_to_install, computer=computer, ip_address=ip_address,
+          apple_updates_to_install, ip_address=ip_address,
           report_feedback=report_feedback, cert_fingerprint=cert_fingerprint)
 
 
     elif report_type == 'install_report':
-      computer = models.Computer.get_by_key_name(uuid)
-
-      self._LogInstalls(self.request.get_all('installs'), computer)
-
-      for removal in self.request.get_all('removals'):
-        common.WriteClientLog(
-            models.ClientLog, uuid, computer=computer, action='removal',
-            details=removal)
-
-      for problem in self.request.get_all('problem_installs'):
-        common.WriteClientLog(
-            models.ClientLog, uuid, computer=computer,
-            action='install_problem', details=problem)
+      installs = self.request.get_all('installs')
+      removals = self.request.get_all('removals')
+      problems = self.request.get_all('problem_installs')
+      if installs or removals or problems:
+        args = (uuid, installs, removals, problems,
+                self.request.get('on_corp'), time.time())
+        if INSTALL_REPORT_QUEUE:
+          try:
+            deferred.defer(
+                LogInstallReport, *args, _queue=INSTALL_REPORT_QUEUE)
+          except taskqueue.Error as e:
+            logging.warning(
+                'Deferring install_report failed (%s); writing now.', str(e))
+            LogInstallReport(*args)
+        else:
+          LogInstallReport(*args)
     elif report_type == 'broken_client':
       # Default reason of "objc" to support legacy clients, existing when objc
       # was the only broken state ever reported.
@@ -318,6 +379,20 @@ class Reports(handlers.AuthenticationHandler):
       for k in ['time', 'user', 'source', 'event', 'desc']:
         details[k] = self.request.get(k, None)
       common.WriteComputerMSULog(uuid, details)
+    elif report_type == 'msu_logs':
+      # batch of msu_log details; the number of logs accepted is returned, so
+      # clients can tell servers predating msu_logs reports from these.
+      logs = None
+      try:
+        logs = util.Deserialize(self.request.get('logs'))
+      except util.DeserializeError:
+        pass
+      if type(logs) is list:
+        logs = logs[:MSU_LOGS_MAX]
+        common.WriteComputerMSULogs(uuid, logs)
+        self.response.out.write(str(len(logs)))
+      else:
+        logging.warning('Client %s sent invalid msu_logs.', uuid)
     else:
       # unknown report type; log all post params.
       params = []
@@ -42,6 +42,9 @@ PLIST_FOOT = '\n</plist>\n'
 
 PLIST_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
+# Number of bytes to read at a time when iterating over a plist file.
+PARSE_CHUNK_SIZE = 65536
+
 # lookup table for valid plist element names
 APPLE_PLIST_ELEMENTS = {
     'plist': None,
@@ -175,6 +178,8 @@ class ApplePlist(object):
     # pylint: disable=protected-access
     new_plist = self.__class__()
     new_plist._validation_hooks = self._validation_hooks
+    # values nested in the shallow copy may be changed through either plist.
+    self._ExposeContents()
     new_plist._plist = self._plist.copy()
     new_plist._plist_xml = self._plist_xml
     new_plist._plist_xml_encoding = self._plist_xml_encoding
@@ -225,6 +230,11 @@ class ApplePlist(object):
   def Reset(self):
     """Reset all internal properties to empty."""
     self._changed = False
+    # GetXml() output by indent_num.  it is only kept for the _plist built by
+    # Parse(), until any of its lists or dicts is exposed to the caller, who
+    # may then change them at any time.
+    self._xml_cache = {}
+    self._xml_cache_plist = None
     self._plist_bin = None
     self._plist_xml = None
     self._plist_xml_encoding = None
@@ -928,6 +938,12 @@ class ApplePlist(object):
 
     self.Validate()
     self.EncodeXml()
+    self._xml_cache_plist = self._plist
+
+  def _ExposeContents(self):
+    """Stops caching XML, as lists or dicts of the plist are exposed."""
+    self._xml_cache = {}
+    self._xml_cache_plist = None
 
   def AddValidationHook(self, method):
     """Adds a validation hook to run when Validate is called.
@@ -1000,6 +1016,7 @@ class ApplePlist(object):
     """
     if not hasattr(self, '_plist'):
       raise PlistNotParsedError
+    self._ExposeContents()
     return self._plist
 
   def SetContents(self, plist_obj):
@@ -1016,7 +1033,7 @@ class ApplePlist(object):
           'Plist contents type is not supported: %s' % type(plist_obj))
 
     self._plist = plist_obj
-    self._changed = True
+    self.SetChanged()
     self._plist_xml = self.GetXml()
     self.Validate()
 
@@ -1068,14 +1085,21 @@ class ApplePlist(object):
       raise PlistError(
           'Plist contents type is not supported: %s' % type(self._plist))
 
+    # indent +1 from <plist> node if xml_doc
+    indent_num += xml_doc * 1
+    cache = self._xml_cache_plist is self._plist
+
     # workaround for empty plists, don't try to decode the None
     # value because of how GetXmlStr() handles them.  at this GetXml()
     # level we know None means NO (0) values, not ONE (1) None value.
     if self._plist is None:
       str_xml = ''
+    elif cache and indent_num in self._xml_cache:
+      str_xml = self._xml_cache[indent_num]
     else:
-      # indent +1 from <plist> node if xml_doc
-      str_xml = GetXmlStr(self._plist, indent_num=indent_num + (xml_doc * 1))
+      str_xml = GetXmlStr(self._plist, indent_num=indent_num)
+      if cache:
+        self._xml_cache[indent_num] = str_xml
 
     if xml_doc:
       return ''.join([PLIST_HEAD, str_xml, PLIST_FOOT])
@@ -1112,9 +1136,19 @@ class ApplePlist(object):
     return changed
 
   def SetChanged(self, changed=True):
-    """Set changed flag."""
+    """Set changed flag.
+
+    Setting the flag also discards XML cached by GetXml().
+
+    Args:
+      changed: bool, optional, default True.
+    Raises:
+      ValueError: changed is not a bool
+    """
     if type(changed) is bool:
       self._changed = changed
+      if changed:
+        self._xml_cache = {}
     else:
       raise ValueError('changed must be bool')
 
@@ -1158,7 +1192,10 @@ class ApplePlist(object):
     if not hasattr(self, '_plist'):
       raise PlistNotParsedError
 
-    return self._plist[k]
+    value = self._plist[k]
+    if type(value) is list or type(value) is dict:
+      self._ExposeContents()  # the caller may change the value.
+    return value
 
   def __setitem__(self, k, v):
     """Standard python __setitem__ method."""
@@ -1166,7 +1203,9 @@ class ApplePlist(object):
       raise PlistNotParsedError
 
     self._plist[k] = v
-    self._changed = True
+    if type(v) is list or type(v) is dict:
+      self._ExposeContents()  # the caller may change the value.
+    self.SetChanged()
 
   def __delitem__(self, k):
     """Standard python __delitem__ method."""
@@ -1174,13 +1213,15 @@ class ApplePlist(object):
       raise PlistNotParsedError
 
     del self._plist[k]
-    self._changed = True
+    self.SetChanged()
 
   def __iter__(self):
     """Standard python __iter__ method."""
     if not hasattr(self, '_plist'):
       raise PlistNotParsedError
 
+    if type(self._plist) is list:
+      self._ExposeContents()
     for i in self._plist:
       yield i
 
@@ -1217,6 +1258,115 @@ class ApplePlist(object):
     self[k] = v
 
 
+class ApplePlistIterator(ApplePlist):
+  """Iterates over a XML plist without building the whole plist in memory.
+
+  Items of the top-level array, or (key, value) tuples of the top-level
+  dict, are yielded as soon as they are parsed, so memory use is bounded by
+  the largest item rather than the whole document.
+
+  To use:
+    for pkginfo in ApplePlistIterator(open('catalog.plist')):
+      ...
+  """
+
+  def __init__(self, source, chunk_size=PARSE_CHUNK_SIZE):
+    """Initialize the class.
+
+    Args:
+      source: file-like object, str XML, or iterable of str XML chunks.
+      chunk_size: int, number of bytes to parse at a time.
+    """
+    super(ApplePlistIterator, self).__init__()
+    self._source = source
+    self._chunk_size = chunk_size
+    self._items = []
+    self._cdata = []
+
+  def _IterChunks(self):
+    """Yields str chunks of the source XML."""
+    if hasattr(self._source, 'read'):
+      chunk = self._source.read(self._chunk_size)
+      while chunk:
+        yield chunk
+        chunk = self._source.read(self._chunk_size)
+    elif isinstance(self._source, basestring):
+      for i in xrange(0, len(self._source), self._chunk_size):
+        yield self._source[i:i + self._chunk_size]
+    else:
+      for chunk in self._source:
+        yield chunk
+
+  def _GetParser(self, encoding=None):
+    """Return an expat Parser instance; see ApplePlist.
+
+    CDATA is appended straight to a buffer, and handled on the next element
+    start or end, since expat may split it over several calls, for example
+    at chunk boundaries, while ApplePlist expects each value in one call.
+    """
+    parser = super(ApplePlistIterator, self)._GetParser(encoding=encoding)
+    parser.buffer_text = True
+    parser.CharacterDataHandler = self._cdata.append
+    return parser
+
+  def _FlushCharacterData(self):
+    """Handles all CDATA collected since the last element start or end."""
+    value = ''.join(self._cdata)
+    del self._cdata[:]
+    ApplePlist._CharacterDataHandler(self, value)
+
+  def _StartElementHandler(self, name, attributes):
+    """Handle the start of a XML element; see ApplePlist."""
+    if self._cdata:
+      self._FlushCharacterData()
+    ApplePlist._StartElementHandler(self, name, attributes)
+
+  def _EndElementHandler(self, name):
+    """Handle the end of a XML element, collecting completed items."""
+    if self._cdata:
+      self._FlushCharacterData()
+    ApplePlist._EndElementHandler(self, name)
+    # only the top-level value is on the stack between its items.  a closing
+    # key is only a placeholder in a dict until its value element closes.
+    if (name != 'key' and len(self._current_mode) == 2 and
+        self._current_value):
+      top = self._current_value[0]
+      if type(top) is list:
+        self._items.extend(top)
+        del top[:]
+      elif type(top) is dict:
+        self._items.extend(top.iteritems())
+        top.clear()
+
+  def __iter__(self):
+    """Yields items of the top-level array or dict of the plist.
+
+    Raises:
+      PlistAlreadyParsedError: the plist was already iterated over
+      MalformedPlistError: XML error
+    """
+    if hasattr(self, '_plist'):
+      raise PlistAlreadyParsedError
+
+    parser = self._GetParser()
+    try:
+      for chunk in self._IterChunks():
+        parser.Parse(chunk, False)
+        items, self._items = self._items, []
+        for item in items:
+          yield item
+      parser.Parse('', True)
+    except xml.parsers.expat.ExpatError as e:
+      raise MalformedPlistError(str(e))
+
+    for item in self._items:
+      yield item
+    self._items = []
+
+    if not hasattr(self, '_plist'):
+      raise MalformedPlistError('Plist not parsed; invalid XML?')
+
+
 class MunkiPlist(ApplePlist):
   """Class to read Munki plists and produce a dict."""
 
@@ -1375,7 +1525,7 @@ class MunkiPackageInfoPlist(MunkiPlist):
       raise PlistNotParsedError
 
     self._plist['description'] = description
-    self._changed = True
+    self.SetChanged()
 
   def SetDisplayName(self, display_name):
     """Set the package info display name.
@@ -1389,7 +1539,7 @@ class MunkiPackageInfoPlist(MunkiPlist):
       raise PlistNotParsedError
 
     self._plist['display_name'] = display_name
-    self._changed = True
+    self.SetChanged()
 
   def SetUnattendedInstall(self, unattended_install):
     """Set the package info unattended install.
@@ -1406,15 +1556,15 @@ class MunkiPackageInfoPlist(MunkiPlist):
       self._plist['unattended_install'] = True
       # TODO(user): remove backwards compatibility at some point...
       self._plist['forced_install'] = True
-      self._changed = True
+      self.SetChanged()
     else:
       if 'unattended_install' in self._plist:
         del self._plist['unattended_install']
-        self._changed = True
+        self.SetChanged()
       # TODO(user): remove backwards compatibility at some point...
       if 'forced_install' in self._plist:
         del self._plist['forced_install']
-        self._changed = True
+        self.SetChanged()
 
   def SetUnattendedUninstall(self, unattended_uninstall):
     """Set the package info unattended uninstall.
@@ -1431,15 +1581,15 @@ class MunkiPackageInfoPlist(MunkiPlist):
       self._plist['unattended_uninstall'] = True
       # TODO(user): remove backwards compatibility at some point...
       self._plist['forced_uninstall'] = True
-      self._changed = True
+      self.SetChanged()
     else:
       if 'unattended_uninstall' in self._plist:
         del self._plist['unattended_uninstall']
-        self._changed = True
+        self.SetChanged()
       # TODO(user): remove backwards compatibility at some point...
       if 'forced_uninstall' in self._plist:
         del self._plist['forced_uninstall']
-        self._changed = True
+        self.SetChanged()
 
   def SetCatalogs(self, catalogs):
     """Set the package info catalogs.
@@ -1452,13 +1602,13 @@ class MunkiPackageInfoPlist(MunkiPlist):
     if not hasattr(self, '_plist'):
       raise PlistNotParsedError
 
-    self._plist['catalogs'] = catalogs
-    self._changed = True
+    self['catalogs'] = catalogs
 
   def RemoveDisplayName(self):
     """Removes the display_name key from the plist."""
     if 'display_name' in self._plist:
       del self._plist['display_name']
+      self.SetChanged()
 
   def EqualIgnoringManifestsAndCatalogs(self, pkginfo):
     """Returns True if the pkginfo is equal except the manifests."""
@@ -1479,8 +1629,7 @@ class AppleSoftwareCatalogPlist(ApplePlist):
     if not hasattr(self, '_plist'):
       raise PlistNotParsedError
 
-    self._plist['catalogs'] = catalogs
-    self._changed = True
+    self['catalogs'] = catalogs
 
 
 def EscapeString(s):
@@ -1491,7 +1640,81 @@ def EscapeString(s):
   Returns:
     str
   """
-  return xml.sax.saxutils.escape(s)
+  # most strings need no escaping, and the checks are cheaper than escape().
+  if '&' in s or '<' in s or '>' in s:
+    return xml.sax.saxutils.escape(s)
+  return s
+
+
+def _AppendXml(value, indent_num, lines):
+  """Appends XML lines representing a variable to a list.
+
+  Nested values are appended to the same list, so the whole document is
+  joined once instead of at every level of nesting.
+
+  Args:
+    value: any supported type: list, tuple, dict, str, unicode, int.
+    indent_num: integer; how many times to indent output.
+    lines: list of str XML lines to append to.
+  Raises:
+    PlistError: a plist type is not supported in output
+  """
+  indent = INDENT_CHAR * indent_num
+  value_type = type(value)
+  if value_type is str or value_type is unicode:
+    lines.append('%s<string>%s</string>' % (indent, EscapeString(value)))
+  elif value_type is dict:
+    child_indent = INDENT_CHAR * (indent_num + 1)
+    lines.append(indent + '<dict>')
+    for key in sorted(value):
+      item = value[key]
+      item_type = type(item)
+      # strings are the bulk of most plists, so skip the call for them.
+      if item_type is str or item_type is unicode:
+        lines.append('%s<key>%s</key>\n%s<string>%s</string>' % (
+            child_indent, EscapeString(key), child_indent, EscapeString(item)))
+      else:
+        lines.append('%s<key>%s</key>' % (child_indent, EscapeString(key)))
+        _AppendXml(item, indent_num + 1, lines)
+    lines.append(indent + '</dict>')
+  elif value_type is list or value_type is tuple:
+    child_indent = INDENT_CHAR * (indent_num + 1)
+    lines.append(indent + '<array>')
+    for item in value:
+      item_type = type(item)
+      if item_type is str or item_type is unicode:
+        lines.append(
+            '%s<string>%s</string>' % (child_indent, EscapeString(item)))
+      else:
+        _AppendXml(item, indent_num + 1, lines)
+    lines.append(indent + '</array>')
+  elif value_type is int or value_type is long:
+    lines.append('%s<integer>%d</integer>' % (indent, value))
+  elif value_type is bool:
+    if value:
+      lines.append('%s<true/>' % indent)
+    else:
+      lines.append('%s<false/>' % indent)
+  elif value_type is float:
+    lines.append('%s<real>%f</real>' % (indent, value))
+  elif value_type is datetime.datetime:
+    date_str = value.strftime(PLIST_DATE_FORMAT)
+    lines.append('%s<date>%s</date>' % (indent, date_str))
+  elif value_type is type(None):
+    # NOTE(user):  This is not the defined behavior if we use plutil(1)
+    # as a reference.  plutil is unwilling to convert binary plists
+    # with null type values into XML.
+    lines.append('%s<string></string>' % indent)
+  elif value.__class__ is AppleUid:
+    lines.append(
+        '%s<dict><key>CF$UID</key><integer>%s</integer></dict>' % (
+            indent, value))
+  elif value.__class__ is AppleData:
+    lines.append('%s<data>%s</data>' % (indent, base64.b64encode(value)))
+  elif issubclass(value.__class__, ApplePlist):
+    lines.append(value.GetXmlContent(indent_num=indent_num))
+  else:
+    raise PlistError('Value type %s not supported: %s', value_type, value)
 
 
 def DictToXml(xml_dict, indent_num=None):
@@ -1503,19 +1726,9 @@ def DictToXml(xml_dict, indent_num=None):
   Returns:
     String XML.
   """
-  if indent_num is None:
-    indent_num = 0
-  indent = INDENT_CHAR * indent_num
-  child_indent = INDENT_CHAR * (indent_num + 1)
-  str_xml = []
-  str_xml.append('%s<dict>' % indent)
-
-  for key in sorted(xml_dict):
-    value = xml_dict[key]
-    str_xml.append('%s<key>%s</key>' % (child_indent, EscapeString(key)))
-    str_xml.append(GetXmlStr(value, indent_num=indent_num + 1))
-  str_xml.append('%s</dict>' % indent)
-  return '\n'.join(str_xml)
+  if type(xml_dict) is not dict:
+    xml_dict = dict(xml_dict)
+  return GetXmlStr(xml_dict, indent_num=indent_num)
 
 
 def SequenceToXml(sequence, indent_num=None):
@@ -1527,15 +1740,9 @@ def SequenceToXml(sequence, indent_num=None):
   Returns:
     String XML.
   """
-  if indent_num is None:
-    indent_num = 0
-  indent = INDENT_CHAR * indent_num
-  str_xml = []
-  str_xml.append('%s<array>' % indent)
-  for value in sequence:
-    str_xml.append(GetXmlStr(value, indent_num=indent_num + 1))
-  str_xml.append('%s</array>' % indent)
-  return '\n'.join(str_xml)
+  if type(sequence) is not list and type(sequence) is not tuple:
+    sequence = list(sequence)
+  return GetXmlStr(sequence, indent_num=indent_num)
 
 
 def GetXmlStr(value, indent_num=None):
@@ -1549,46 +1756,27 @@ def GetXmlStr(value, indent_num=None):
   Raises:
     PlistError: a plist type is not supported in output
   """
-  # TODO(user): refactor and write unit tests.
   if indent_num is None:
     indent_num = 0
-  indent = INDENT_CHAR * indent_num
-  str_xml = []
-  value_type = type(value)
-  if value_type is list or value_type is tuple:
-    str_xml.append(SequenceToXml(value, indent_num=indent_num))
-  elif value_type is dict:
-    str_xml.append(DictToXml(value, indent_num=indent_num))
-  elif value_type is str or value_type is unicode:
-    str_xml.append('%s<string>%s</string>' % (indent, EscapeString(value)))
-  elif value_type is int or value_type is long:
-    str_xml.append('%s<integer>%d</integer>' % (indent, value))
-  elif value_type is float:
-    str_xml.append('%s<real>%f</real>' % (indent, value))
-  elif value_type is bool:
-    if value:
-      str_xml.append('%s<true/>' % indent)
-    else:
-      str_xml.append('%s<false/>' % indent)
-  elif value_type is datetime.datetime:
-    date_str = value.strftime(PLIST_DATE_FORMAT)
-    str_xml.append('%s<date>%s</date>' % (indent, date_str))
-  elif value_type is type(None):
-    # NOTE(user):  This is not the defined behavior if we use plutil(1)
-    # as a reference.  plutil is unwilling to convert binary plists
-    # with null type values into XML.
-    str_xml.append('%s<string></string>' % indent)
-  elif value.__class__ is AppleUid:
-    str_xml.append(
-        '%s<dict><key>CF$UID</key><integer>%s</integer></dict>' % (
-            indent, value))
-  elif value.__class__ is AppleData:
-    str_xml.append('%s<data>%s</data>' % (indent, base64.b64encode(value)))
-  elif issubclass(value.__class__, ApplePlist):
-    str_xml.append(value.GetXmlContent(indent_num=indent_num))
-  else:
-    raise PlistError('Value type %s not supported: %s', value_type, value)
-  return '\n'.join(str_xml)
+  lines = []
+  _AppendXml(value, indent_num, lines)
+  return '\n'.join(lines)
+
+
+def GetXmlDocument(value):
+  """Returns a full plist XML document for a value.
+
+  This is equivalent to ApplePlist.GetXml() for the same contents, without
+  constructing and validating an ApplePlist.
+
+  Args:
+    value: any supported type: list, tuple, dict, str, unicode, int.
+  Returns:
+    String XML document.
+  Raises:
+    PlistError: a plist type is not supported in output
+  """
+  return ''.join([PLIST_HEAD, GetXmlStr(value, indent_num=1), PLIST_FOOT])
 
 
 def UpdateIterable(o, ki, value=None, default=None, op=None):
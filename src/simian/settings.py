@@ -262,7 +262,7 @@ class BaseSettings(types.ModuleType):
       ValueError: if the value is not appropriately formed to be set for k.
     """
     try:
-      _ = x509.LoadCertificateFromPEM(v)
+      x509.LoadCertificateFromPEM(v).DecodeAll()
     except x509.Error, e:
       raise ValueError(str(e))
 
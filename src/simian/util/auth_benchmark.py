@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmarks of the Auth1 handshake.
+
+Usage: auth_benchmark.py ca_cert.pem server_cert.pem server_key.pem
+    client_cert.pem client_key.pem [number of handshakes]
+
+The client cert must be signed by the CA cert. Reports the throughput of the
+server side of complete client/server handshakes with cold per process cert
+caches, as each handshake paid before certs were cached, and with warm caches.
+"""
+
+import sys
+import time
+
+from simian.auth import base
+
+
+DEFAULT_HANDSHAKES = 100
+
+
+def Handshake(pems, clear_caches):
+  """Runs one handshake, returning float seconds spent in the server.
+
+  Args:
+    pems: dict of str PEM name to str PEM.
+    clear_caches: bool, True to clear the cert caches before each server step.
+  Returns:
+    float seconds.
+  Raises:
+    base.Error: the handshake failed.
+  """
+  server = base.Auth1()
+  server.LoadSelfKey(pems['server_key'])
+  server._ca_pem = pems['ca_cert']  # pylint: disable=protected-access
+  client = base.Auth1Client()
+  client.LoadSelfKey(pems['client_key'])
+  client.LoadSelfCert(pems['client_cert'])
+  client._server_cert_pem = pems['server_cert']  # pylint: disable=protected-access
+  client._ca_pem = pems['ca_cert']  # pylint: disable=protected-access
+
+  cn = str(client.Nonce() | base.MIN_VALUE_CN)
+  client._session.Set('cn', cn)  # pylint: disable=protected-access
+
+  if clear_caches:
+    base._PARSED_CERTS.clear()  # pylint: disable=protected-access
+    base._VERIFIED_CERTS.clear()  # pylint: disable=protected-access
+  start = time.time()
+  server.Input(n=cn)
+  server_secs = time.time() - start
+
+  client.Input(m=server.Output())
+  output = client.Output()
+
+  if clear_caches:
+    base._PARSED_CERTS.clear()  # pylint: disable=protected-access
+    base._VERIFIED_CERTS.clear()  # pylint: disable=protected-access
+  start = time.time()
+  server.Input(m=output['m'], s=output['s'])
+  server_secs += time.time() - start
+
+  if server.AuthState() != base.AuthState.OK:
+    raise base.Error('Handshake failed')
+  return server_secs
+
+
+def main(argv):
+  if len(argv) < 6:
+    print __doc__
+    return 1
+  pems = {}
+  for name, path in zip(
+      ['ca_cert', 'server_cert', 'server_key', 'client_cert', 'client_key'],
+      argv[1:6]):
+    with open(path) as f:
+      pems[name] = f.read()
+  count = DEFAULT_HANDSHAKES
+  if len(argv) > 6:
+    count = int(argv[6])
+
+  print 'Handshakes: %d' % count
+  for name, clear_caches in [('cold caches', True), ('warm caches', False)]:
+    secs = sum(Handshake(pems, clear_caches) for _ in xrange(count))
+    print '%-12s %8.1f handshakes/s %8.2f ms/handshake' % (
+        name, count / secs, secs * 1000 / count)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmarks of IP list lookups.
+
+Usage: ipcalc_benchmark.py [number of networks] [number of lookups]
+
+Compares lookups against a synthetic list of IPv4 networks by the former
+KeyValueCache.IpInList() loop, which deserialized and parsed the whole list
+on every call, to lookups in a compiled IpMatcher, and reports the time to
+compile the IpMatcher.
+"""
+
+import random
+import sys
+import time
+
+from simian.mac.common import ipcalc
+from simian.mac.common import util
+
+
+DEFAULT_NETWORKS = 10000
+DEFAULT_LOOKUPS = 1000
+
+
+def GetNetworks(count):
+  """Returns a list of count random str IPv4 networks."""
+  rand = random.Random(count)
+  networks = []
+  for unused_i in xrange(count):
+    mask = rand.randint(16, 32)
+    net = rand.getrandbits(32) & ~((1 << (32 - mask)) - 1)
+    networks.append('%d.%d.%d.%d/%d' % (
+        net >> 24, (net >> 16) & 255, (net >> 8) & 255, net & 255, mask))
+  return networks
+
+
+def GetIps(count):
+  """Returns a list of count random str IPv4 addresses."""
+  rand = random.Random(-count)
+  return ['%d.%d.%d.%d' % tuple(rand.randint(0, 255) for _ in xrange(4))
+          for _ in xrange(count)]
+
+
+def LoopMatch(serialized, ip):
+  """Matches an IP like the former KeyValueCache.IpInList() loop."""
+  ip_int = ipcalc.IpToInt(ip)
+  for ip_mask_str in util.Deserialize(serialized):
+    ip_mask = ipcalc.IpMaskToInts(ip_mask_str)
+    if (ip_int & ip_mask[1]) == ip_mask[0]:
+      return True
+  return False
+
+
+def Measure(fn, ips):
+  """Returns (int matches, float microseconds per lookup) of fn over ips."""
+  start = time.time()
+  matches = 0
+  for ip in ips:
+    if fn(ip):
+      matches += 1
+  return matches, (time.time() - start) * 1000000 / len(ips)
+
+
+def main(argv):
+  networks_count = DEFAULT_NETWORKS
+  lookups = DEFAULT_LOOKUPS
+  if len(argv) > 1:
+    networks_count = int(argv[1])
+  if len(argv) > 2:
+    lookups = int(argv[2])
+
+  networks = GetNetworks(networks_count)
+  serialized = util.Serialize(networks)
+  ips = GetIps(lookups)
+
+  start = time.time()
+  matcher = ipcalc.IpMatcher(networks)
+  compile_secs = time.time() - start
+
+  print 'Networks: %d, lookups: %d' % (networks_count, lookups)
+  print '%-20s %10.3f secs' % ('IpMatcher compile', compile_secs)
+  for name, fn in [
+      ('Loop', lambda ip: LoopMatch(serialized, ip)),
+      ('IpMatcher.Match()', matcher.Match)]:
+    matches, usecs = Measure(fn, ips)
+    print '%-20s %10.2f usecs/lookup %6d matches' % (name, usecs, matches)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmarks of plist parsing and serialization.
+
+Usage: plist_benchmark.py [number of catalog items]
+
+Reports the throughput of parsing, serializing and round tripping a
+synthetic catalog, then compares ApplePlist.Parse() to ApplePlistIterator.
+Each parser runs in a forked child process, so the reported peak memory
+growth is that of the parser alone.
+"""
+
+import datetime
+import os
+import resource
+import StringIO
+import sys
+import time
+
+from simian.mac.munki import plist
+
+
+DEFAULT_ITEMS = 10000
+
+
+def GetCatalogXml(count):
+  """Returns a str XML catalog of count synthetic pkginfo items."""
+  pkginfos = []
+  for i in xrange(count):
+    pkginfos.append({
+        'name': 'Package%d' % i,
+        'display_name': 'Package %d' % i,
+        'version': '1.0.%d' % i,
+        'description': 'A synthetic package used to benchmark parsing. ' * 4,
+        'installer_item_location': 'Package%d-1.0.%d.dmg' % (i, i),
+        'installer_item_size': 123456 + i,
+        'installer_item_hash': '%064x' % i,
+        'catalogs': ['unstable', 'testing', 'stable'],
+        'receipts': [{
+            'packageid': 'com.example.package%d' % i,
+            'version': '1.0.%d' % i,
+            'installed_size': 4567 + i,
+        }],
+        'unattended_install': True,
+        'force_install_after_date': datetime.datetime(2018, 1, 1, 13, 0, 0),
+    })
+  return plist.GetXmlDocument(pkginfos)
+
+
+def GetThroughput(xml, repeat=1):
+  """Measures parse, serialize and round trip throughput.
+
+  Args:
+    xml: str, XML catalog.
+    repeat: int, number of times to run each operation.
+  Returns:
+    dict of str operation name to float MB/s of XML.
+  """
+  mbytes = len(xml) * repeat / 1048576.0
+
+  start = time.time()
+  for unused_i in xrange(repeat):
+    p = plist.ApplePlist(xml)
+    p.Parse()
+  parse_secs = time.time() - start
+
+  contents = p.GetContents()
+  start = time.time()
+  for unused_i in xrange(repeat):
+    plist.GetXmlDocument(contents)
+  serialize_secs = time.time() - start
+
+  start = time.time()
+  for unused_i in xrange(repeat):
+    p = plist.ApplePlist(xml)
+    p.Parse()
+    p.GetXml()
+  round_trip_secs = time.time() - start
+
+  return {
+      'parse': mbytes / parse_secs,
+      'serialize': mbytes / serialize_secs,
+      'round trip': mbytes / round_trip_secs,
+  }
+
+
+def ParseAll(xml):
+  """Parses the whole catalog, returning the number of items."""
+  p = plist.ApplePlist(xml)
+  p.Parse()
+  return len(p.GetContents())
+
+
+def IterateAll(xml):
+  """Iterates over the catalog, returning the number of items."""
+  count = 0
+  for unused_item in plist.ApplePlistIterator(StringIO.StringIO(xml)):
+    count += 1
+  return count
+
+
+def Measure(fn, xml):
+  """Runs fn(xml) in a child process.
+
+  Args:
+    fn: func, parser to measure.
+    xml: str, XML catalog.
+  Returns:
+    tuple of (int items parsed, float seconds, int peak memory growth in KB).
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    os.close(read_fd)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    count = fn(xml)
+    secs = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(write_fd, '%d %f %d' % (count, secs, rss_after - rss_before))
+    os._exit(0)  # pylint: disable=protected-access
+
+  os.close(write_fd)
+  result = os.read(read_fd, 1024)
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+  count, secs, rss = result.split()
+  return int(count), float(secs), int(rss)
+
+
+def main(argv):
+  count = DEFAULT_ITEMS
+  if len(argv) > 1:
+    count = int(argv[1])
+
+  xml = GetCatalogXml(count)
+  print 'Catalog: %d items, %d bytes' % (count, len(xml))
+  p = plist.ApplePlist(xml)
+  p.Parse()
+  if p.GetXml() != xml:
+    print 'Round trip of the catalog changed its XML.'
+    return 1
+  for name, mbytes_per_sec in sorted(GetThroughput(xml).iteritems()):
+    print '%-20s %8.2f MB/s' % (name, mbytes_per_sec)
+  for name, fn in [
+      ('ApplePlist.Parse()', ParseAll),
+      ('ApplePlistIterator', IterateAll)]:
+    items, secs, rss = Measure(fn, xml)
+    print '%-20s %6d items %8.3f secs %8d KB peak memory growth' % (
+        name, items, secs, rss)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
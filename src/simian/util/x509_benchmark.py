@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmarks of X509 certificate parsing.
+
+Usage: x509_benchmark.py [--count=N] cert.pem [cert.pem ...]
+
+Reports the parse cost per cert over a corpus of PEM certs, e.g. client
+certs. "full tree decode" is the pyasn1 decode of the whole cert and
+re-encode of its fields which LoadFromByteString() formerly did before
+reading any field. The other rows are the lazy LoadFromByteString(), alone
+as when only checking a cert, plus the subject and public key as read per
+Auth1 handshake, and plus all fields.
+"""
+
+import base64
+import sys
+import time
+
+from pyasn1.codec.der import decoder as der_decoder
+from pyasn1.codec.der import encoder as der_encoder
+from pyasn1_modules import rfc2459
+
+from simian.auth import x509
+
+
+DEFAULT_COUNT = 100
+
+
+def FullTreeDecode(bytes_str):
+  """Decodes a cert like the former LoadFromByteString(), before checks."""
+  cert = der_decoder.decode(bytes_str, asn1Spec=rfc2459.Certificate())[0]
+  der_encoder.encode(cert['tbsCertificate'])
+  der_encoder.encode(cert['signatureValue'])
+
+
+def Load(bytes_str):
+  """Loads a cert."""
+  x = x509.X509Certificate()
+  x.LoadFromByteString(bytes_str)
+  return x
+
+
+def LoadForHandshake(bytes_str):
+  """Loads a cert and reads the fields Auth1 reads per handshake."""
+  x = Load(bytes_str)
+  x.GetSubject()
+  x.GetPublicKey()
+
+
+def LoadAll(bytes_str):
+  """Loads a cert and decodes all fields."""
+  Load(bytes_str).DecodeAll()
+
+
+def Measure(fn, certs, count):
+  """Returns float milliseconds per cert of fn over certs, count times."""
+  start = time.time()
+  for unused_i in xrange(count):
+    for cert in certs:
+      fn(cert)
+  return (time.time() - start) * 1000 / (count * len(certs))
+
+
+def main(argv):
+  count = DEFAULT_COUNT
+  paths = []
+  for arg in argv[1:]:
+    if arg.startswith('--count='):
+      count = int(arg.split('=', 1)[1])
+    else:
+      paths.append(arg)
+  if not paths:
+    print __doc__
+    return 1
+
+  certs = []
+  for path in paths:
+    with open(path) as f:
+      lines = x509.LoadPemGeneric(
+          f.read(), 'BEGIN CERTIFICATE', 'END CERTIFICATE')
+    certs.append(base64.b64decode(''.join(lines[1:-1])))
+
+  print 'Certs: %d, count: %d' % (len(certs), count)
+  for name, fn in [
+      ('full tree decode', FullTreeDecode),
+      ('LoadFromByteString', Load),
+      ('+ subject, pubkey', LoadForHandshake),
+      ('+ all fields', LoadAll)]:
+    print '%-20s %8.3f ms/cert' % (name, Measure(fn, certs, count))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
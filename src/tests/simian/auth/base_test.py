@@ -57,6 +57,8 @@ class AuthTestingBase(mox.MoxTestBase):
     mox.MoxTestBase.setUp(self)
     self.stubs = stubout.StubOutForTesting()
     self.ba = self.GetTestClass()
+    base._PARSED_CERTS.clear()
+    base._VERIFIED_CERTS.clear()
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -628,15 +630,21 @@ class Auth1Test(AuthTestingBase):
   def testLoadCert(self):
     """Test _LoadCert()."""
     certstr='pemcert'
-    mock_cert = self.mox.CreateMockAnything()
+    cert = base.x509.X509Certificate()
 
     self.mox.StubOutWithMock(base.x509, 'LoadCertificateFromPEM')
-    base.x509.LoadCertificateFromPEM(certstr).AndReturn(mock_cert)
-    base.x509.LoadCertificateFromPEM(certstr).AndRaise(base.x509.Error)
+    base.x509.LoadCertificateFromPEM(certstr).AndReturn(cert)
+    base.x509.LoadCertificateFromPEM('badcert').AndRaise(base.x509.Error)
 
     self.mox.ReplayAll()
-    self.assertEqual(mock_cert, self.ba._LoadCert(certstr))
-    self.assertRaises(ValueError, self.ba._LoadCert, certstr)
+    loaded = self.ba._LoadCert(certstr)
+    self.assertTrue(loaded is not cert)
+    self.assertTrue(loaded._GetDataDict() is cert._GetDataDict())
+    # parsed only once.
+    loaded_again = self.ba._LoadCert(certstr)
+    self.assertTrue(loaded_again is not loaded)
+    self.assertTrue(loaded_again._GetDataDict() is cert._GetDataDict())
+    self.assertRaises(ValueError, self.ba._LoadCert, 'badcert')
     self.mox.VerifyAll()
 
   def testLoadKey(self):
@@ -719,10 +727,32 @@ class Auth1Test(AuthTestingBase):
     self.ba._ca_pem = 'ca pem'
     mock_ca_cert = self.mox.CreateMockAnything()
     mock_cert = self.mox.CreateMockAnything()
+    mock_cert.GetFieldsData().AndReturn('fields')
+    mock_cert.GetSignatureData().AndReturn('sig')
     self.ba.LoadOtherCert(self.ba._ca_pem).AndReturn(mock_ca_cert)
     mock_cert.IsSignedBy(mock_ca_cert).AndReturn(True)
+    # verified again without loading the CA cert.
+    mock_cert.GetFieldsData().AndReturn('fields')
+    mock_cert.GetSignatureData().AndReturn('sig')
     self.mox.ReplayAll()
     self.assertTrue(self.ba.VerifyCertSignedByCA(mock_cert))
+    self.assertTrue(self.ba.VerifyCertSignedByCA(mock_cert))
+    self.mox.VerifyAll()
+
+  def testVerifyCertSignedByCAWhenNotSigned(self):
+    """Test VerifyCertSignedByCA() does not cache failed verifications."""
+    self.mox.StubOutWithMock(self.ba, 'LoadOtherCert')
+    self.ba._ca_pem = 'ca pem'
+    mock_ca_cert = self.mox.CreateMockAnything()
+    mock_cert = self.mox.CreateMockAnything()
+    for unused_i in xrange(2):
+      mock_cert.GetFieldsData().AndReturn('fields')
+      mock_cert.GetSignatureData().AndReturn('sig')
+      self.ba.LoadOtherCert(self.ba._ca_pem).AndReturn(mock_ca_cert)
+      mock_cert.IsSignedBy(mock_ca_cert).AndReturn(False)
+    self.mox.ReplayAll()
+    self.assertFalse(self.ba.VerifyCertSignedByCA(mock_cert))
+    self.assertFalse(self.ba.VerifyCertSignedByCA(mock_cert))
     self.mox.VerifyAll()
 
   def testVerifyDataSignedWithCert(self):
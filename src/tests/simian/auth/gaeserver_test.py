@@ -384,7 +384,9 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     self._StubGetModelClass()
     self.ams = gaeserver.Auth1ServerDatastoreMemcacheSession()
     self._mocked = {}
-    self.sid = '12345'
+    self.sid = 't_12345'
+    self.mock_cache = self.mox.CreateMock(gaeserver._SessionCache)
+    self.stubs.Set(gaeserver, '_SESSION_CACHE', self.mock_cache)
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -477,12 +479,24 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     self.ams._CallSuperWithDefer(method_name, *args, **kwargs)
     self.mox.VerifyAll()
 
+  def testGetWhenSessionCacheHit(self):
+    """Test _Get()."""
+    sid = self.sid
+    data = 'data we want to be cached'
+    self.mock_cache.Get(self._Key(sid)).AndReturn((True, data))
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.ams._Get(sid), data)
+    self.mox.VerifyAll()
+
   def testGetWhenCacheHit(self):
     """Test _Get()."""
     sid = self.sid
     data = 'data we want to be cached'
+    self.mock_cache.Get(self._Key(sid)).AndReturn((False, None))
     self._MockMemcache(
         'get', self._Key(sid)).AndReturn(data)
+    self.mock_cache.Set(self._Key(sid), data)
 
     self.mox.ReplayAll()
     self.assertEqual(self.ams._Get(sid), data)
@@ -492,14 +506,40 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     """Test _Get()."""
     sid = self.sid
     data = 'data we got from datastore'
+    self.mock_cache.Get(self._Key(sid)).AndReturn((False, None))
     self._MockMemcache(
         'get', self._Key(sid)).AndReturn(None)
     self._MockSuper('_Get', sid).AndReturn(data)
+    self.mock_cache.Set(self._Key(sid), data)
 
     self.mox.ReplayAll()
     self.assertEqual(self.ams._Get(sid), data)
     self.mox.VerifyAll()
 
+  def testGetWhenUnknown(self):
+    """Test _Get() caches unknown session ids."""
+    sid = self.sid
+    self.mock_cache.Get(self._Key(sid)).AndReturn((False, None))
+    self._MockMemcache(
+        'get', self._Key(sid)).AndReturn(None)
+    self._MockSuper('_Get', sid).AndReturn(None)
+    self.mock_cache.Set(self._Key(sid), None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.ams._Get(sid), None)
+    self.mox.VerifyAll()
+
+  def testGetCn(self):
+    """Test _Get() does not cache cn sessions."""
+    sid = 'cn_12345'
+    self._MockMemcache(
+        'get', self._Key(sid)).AndReturn(None)
+    self._MockSuper('_Get', sid).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(self.ams._Get(sid), None)
+    self.mox.VerifyAll()
+
   def testPut(self):
     """Test _Put()."""
     session = self._GetMockSession()
@@ -507,6 +547,7 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
         'set', self._Key(self.sid),
         value=session,
         time=self.ams.ttl).AndReturn(None)
+    self.mock_cache.Set(self._Key(self.sid), session)
     self._MockSuper('_Put', session).AndReturn(None)
 
     self.mox.ReplayAll()
@@ -516,6 +557,33 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
   def testDeleteById(self):
     """Test DeleteById()."""
     sid = self.sid
+    self._MockMemcache(
+        'delete', self._Key(sid)).AndReturn(None)
+    self.mock_cache.Delete(self._Key(sid))
+    self._MockSuper(
+        'DeleteById', sid).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.ams.DeleteById(sid)
+    self.mox.VerifyAll()
+
+  def testPutCn(self):
+    """Test _Put() does not cache cn sessions."""
+    sid = 'cn_12345'
+    session = self._GetMockSession(sid)
+    self._MockMemcache(
+        'set', self._Key(sid),
+        value=session,
+        time=self.ams.ttl).AndReturn(None)
+    self._MockSuper('_Put', session).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.ams._Put(session)
+    self.mox.VerifyAll()
+
+  def testDeleteByIdCn(self):
+    """Test DeleteById() with a cn session."""
+    sid = 'cn_12345'
     self._MockMemcache(
         'delete', self._Key(sid)).AndReturn(None)
     self._MockSuper(
@@ -530,6 +598,7 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     session = self._GetMockSession()
     self._MockMemcache(
         'delete', self._Key(self.sid)).AndReturn(None)
+    self.mock_cache.Delete(self._Key(self.sid))
     self._MockSuper('Delete', session).AndReturn(None)
 
     self.mox.ReplayAll()
@@ -537,6 +606,152 @@ class Auth1ServerDatastoreMemcacheSessionTest(DatastoreModelTest):
     self.mox.VerifyAll()
 
 
+class SessionCacheTest(mox.MoxTestBase):
+  """Test _SessionCache class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(
+        gaeserver, 'memcache', self.mox.CreateMock(gaeserver.memcache))
+    self.mox.StubOutWithMock(gaeserver.time, 'time')
+    self.cache = gaeserver._SessionCache(max_size=2)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _ExpectGeneration(self, generation):
+    gaeserver.memcache.get(
+        gaeserver.SESSION_GENERATION_MEMCACHE_KEY).AndReturn(generation)
+
+  def testGet(self):
+    """Test Get() and Set()."""
+    gaeserver.time.time().AndReturn(100)  # Set
+    gaeserver.time.time().AndReturn(100)  # Set
+    gaeserver.time.time().AndReturn(101)
+    self._ExpectGeneration(None)
+    gaeserver.time.time().AndReturn(102)
+    gaeserver.time.time().AndReturn(103)
+    gaeserver.time.time().AndReturn(100 + gaeserver.SESSION_CACHE_SECS + 1)
+    self._ExpectGeneration(None)
+
+    self.mox.ReplayAll()
+    self.cache.Set('a', 'session')
+    self.cache.Set('b', None)
+    self.assertEqual((True, 'session'), self.cache.Get('a'))
+    self.assertEqual((True, None), self.cache.Get('b'))
+    self.assertEqual((False, None), self.cache.Get('c'))
+    self.assertEqual((False, None), self.cache.Get('a'))  # expired.
+    self.assertEqual(
+        {'hits': 1, 'negative_hits': 1, 'misses': 2, 'evictions': 0},
+        self.cache.stats)
+    self.mox.VerifyAll()
+
+  def testSetEvictsLeastRecentlyUsed(self):
+    """Test Set() evicts the least recently used session."""
+    gaeserver.time.time().AndReturn(100)
+    gaeserver.time.time().AndReturn(100)
+    gaeserver.time.time().AndReturn(100)
+    self._ExpectGeneration(None)
+    gaeserver.time.time().AndReturn(100)
+    gaeserver.time.time().AndReturn(100)
+    gaeserver.time.time().AndReturn(100)
+
+    self.mox.ReplayAll()
+    self.cache.Set('a', 'session a')
+    self.cache.Set('b', 'session b')
+    self.cache.Get('a')
+    self.cache.Set('c', 'session c')
+    self.assertEqual((True, 'session a'), self.cache.Get('a'))
+    self.assertEqual((False, None), self.cache.Get('b'))
+    self.assertEqual(1, self.cache.stats['evictions'])
+    self.mox.VerifyAll()
+
+  def testGetLogsStats(self):
+    """Test Get() logs the stats once per SESSION_CACHE_STATS_LOG_SECS."""
+    later = 1000 + gaeserver.SESSION_CACHE_STATS_LOG_SECS
+    self.mox.StubOutWithMock(gaeserver.logging, 'info')
+    gaeserver.time.time().AndReturn(1000)
+    self._ExpectGeneration(None)
+    gaeserver.logging.info(
+        'Session cache stats: %s',
+        {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0})
+    gaeserver.time.time().AndReturn(later - 1)
+    self._ExpectGeneration(None)
+    gaeserver.time.time().AndReturn(later)
+    self._ExpectGeneration(None)
+    gaeserver.logging.info(
+        'Session cache stats: %s',
+        {'hits': 0, 'negative_hits': 0, 'misses': 2, 'evictions': 0})
+
+    self.mox.ReplayAll()
+    self.cache.Get('a')
+    self.cache.Get('a')
+    self.cache.Get('a')
+    self.mox.VerifyAll()
+
+  def testDelete(self):
+    """Test Delete() records the deleted session under a new generation."""
+    gaeserver.time.time().AndReturn(100)
+    gaeserver.memcache.incr(
+        gaeserver.SESSION_GENERATION_MEMCACHE_KEY,
+        initial_value=0).AndReturn(7)
+    gaeserver.memcache.set(
+        gaeserver.SESSION_DELETED_MEMCACHE_KEY % 7, 'a',
+        time=gaeserver.SESSION_CACHE_NEGATIVE_SECS * 2)
+    gaeserver.time.time().AndReturn(100)
+    self._ExpectGeneration(7)
+
+    self.mox.ReplayAll()
+    self.cache.Delete('a')
+    self.assertEqual((True, None), self.cache.Get('a'))
+    self.mox.VerifyAll()
+
+  def testGetEvictsSessionsDeletedElsewhere(self):
+    """Test Get() caches sessions deleted by other instances as unknown."""
+    later = 100 + gaeserver.SESSION_CACHE_GENERATION_SECS
+    gaeserver.time.time().AndReturn(100)
+    self._ExpectGeneration(5)
+    gaeserver.time.time().AndReturn(100)  # Set
+    gaeserver.time.time().AndReturn(100)  # Set
+    gaeserver.time.time().AndReturn(later)
+    self._ExpectGeneration(7)
+    gaeserver.memcache.get_multi([
+        gaeserver.SESSION_DELETED_MEMCACHE_KEY % 6,
+        gaeserver.SESSION_DELETED_MEMCACHE_KEY % 7]).AndReturn({
+            gaeserver.SESSION_DELETED_MEMCACHE_KEY % 6: 'a',
+            gaeserver.SESSION_DELETED_MEMCACHE_KEY % 7: 'c'})
+    gaeserver.time.time().AndReturn(later)
+
+    self.mox.ReplayAll()
+    self.cache.Get('a')
+    self.cache.Set('a', 'session a')
+    self.cache.Set('b', 'session b')
+    self.assertEqual((True, None), self.cache.Get('a'))
+    self.assertEqual((False, None), self.cache.Get('b'))  # evicted by c.
+    self.mox.VerifyAll()
+
+  def testGetClearsWhenDeletesLost(self):
+    """Test Get() clears the cache when deleted session ids are lost."""
+    later = 100 + gaeserver.SESSION_CACHE_GENERATION_SECS
+    gaeserver.time.time().AndReturn(100)
+    self._ExpectGeneration(5)
+    gaeserver.time.time().AndReturn(100)  # Set
+    gaeserver.time.time().AndReturn(later)
+    self._ExpectGeneration(7)
+    gaeserver.memcache.get_multi([
+        gaeserver.SESSION_DELETED_MEMCACHE_KEY % 6,
+        gaeserver.SESSION_DELETED_MEMCACHE_KEY % 7]).AndReturn({
+            gaeserver.SESSION_DELETED_MEMCACHE_KEY % 7: 'c'})
+
+    self.mox.ReplayAll()
+    self.cache.Get('a')
+    self.cache.Set('a', 'session a')
+    self.assertEqual((False, None), self.cache.Get('a'))
+    self.mox.VerifyAll()
+
+
 class AuthSessionSimianServer(mox.MoxTestBase, test.AppengineTest):
   """Test AuthSessionSimianServer class."""
 
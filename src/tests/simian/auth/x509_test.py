@@ -44,6 +44,14 @@ def _RDNSeqFromTuple(values):
   return rfc2459.Name().setComponentByPosition(0, seq)
 
 
+def _Der(tag, contents):
+  """Returns a DER encoded element, with a short or long form length."""
+  if len(contents) < 0x80:
+    return '%s%s%s' % (chr(tag), chr(len(contents)), contents)
+  return '%s\x82%s%s%s' % (
+      chr(tag), chr(len(contents) >> 8), chr(len(contents) & 0xff), contents)
+
+
 
 
 class X509ModuleTest(mox.MoxTestBase):
@@ -56,6 +64,100 @@ class X509ModuleTest(mox.MoxTestBase):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
+  def testReadDerElement(self):
+    """Test _ReadDerElement()."""
+    self.assertEqual((0x04, 2, 5), x509._ReadDerElement('\x04\x03abc', 0))
+    data = 'xx\x30\x82\x01\x00' + 'a' * 256
+    self.assertEqual((0x30, 6, 262), x509._ReadDerElement(data, 2))
+
+  def testReadDerElementWhenTruncated(self):
+    """Test _ReadDerElement()."""
+    for data in ['', '\x04', '\x04\x03ab', '\x04\x82\x01']:
+      self.assertRaises(
+          x509.CertificateASN1FormatError, x509._ReadDerElement, data, 0)
+
+  def testReadDerElementWhenNotDer(self):
+    """Test _ReadDerElement()."""
+    # indefinite length
+    self.assertRaises(
+        x509.CertificateASN1FormatError,
+        x509._ReadDerElement, '\x30\x80\x00\x00', 0)
+    # high tag number
+    self.assertRaises(
+        x509.CertificateASN1FormatError,
+        x509._ReadDerElement, '\x1f\x81\x01\x00', 0)
+
+  def testGetDerElements(self):
+    """Test _GetDerElements()."""
+    self.assertEqual(
+        [(0x02, '\x02\x01\x05', '\x05'),
+         (0x30, '\x30\x03\x04\x01a', '\x04\x01a')],
+        x509._GetDerElements('\x02\x01\x05\x30\x03\x04\x01a'))
+    self.assertEqual([], x509._GetDerElements(''))
+
+  def testDecodeDerWhenPyAsn1Error(self):
+    """Test _DecodeDer()."""
+    self.mox.StubOutWithMock(x509.der_decoder, 'decode', True)
+    x509.der_decoder.decode('bytes').AndRaise(x509.pyasn1.error.PyAsn1Error)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        x509.CertificateASN1FormatError, x509._DecodeDer, 'bytes')
+    self.mox.VerifyAll()
+
+
+class LazyDictTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.d = x509._LazyDict({'a': 1, 'b': 2})
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testSetLoader(self):
+    """Test SetLoader()."""
+    loader = self.mox.CreateMockAnything()
+    loader().AndReturn({'b': 3})
+
+    self.mox.ReplayAll()
+    self.d.SetLoader(['b', 'c'], loader)
+    self.assertFalse('b' in self.d)
+    self.assertEqual(1, self.d['a'])
+    self.assertEqual(3, self.d['b'])
+    self.assertEqual(None, self.d['c'])
+    self.assertEqual(3, self.d['b'])
+    self.mox.VerifyAll()
+
+  def testSetLoaderWhenLoaderRaises(self):
+    """Test SetLoader()."""
+    loader = self.mox.CreateMockAnything()
+    loader().AndRaise(x509.CertificateParseError)
+    loader().AndReturn({'b': 3})
+
+    self.mox.ReplayAll()
+    self.d.SetLoader(['b'], loader)
+    self.assertRaises(x509.CertificateParseError, lambda: self.d['b'])
+    self.assertEqual(3, self.d['b'])
+    self.mox.VerifyAll()
+
+  def testLoadAll(self):
+    """Test LoadAll()."""
+    loader = self.mox.CreateMockAnything()
+    loader().AndReturn({'b': 3, 'c': 4})
+
+    self.mox.ReplayAll()
+    self.d.SetLoader(['b', 'c'], loader)
+    self.d.LoadAll()
+    self.assertEqual({'a': 1, 'b': 3, 'c': 4}, self.d)
+    self.mox.VerifyAll()
+
+  def testMissingKey(self):
+    """Test __missing__()."""
+    self.assertRaises(KeyError, lambda: self.d['z'])
+
   def testLoadPemGeneric(self):
     """Test LoadPemGeneric()."""
     header = 'BEGIN'
@@ -480,212 +582,172 @@ class X509CertificateTest(mox.MoxTestBase):
         self.x._AssembleDNSequence,
         value)
 
-  def testGetFieldsFromSequence(self):
-    """Test _GetFieldsFromSequence()."""
-    sig_alg_seq = ('a', 'b')
-    sig_alg = 'sigalg'
+  def _GetTbsElements(self, extensions=True):
+    """Returns tbsCertificate elements like _GetDerElements() output."""
+    elements = [
+        (x509.DER_TAG_VERSION, 'version element', 'version'),
+        (0x02, 'serial', None),
+        (0x30, 'signature', None),
+        (0x30, 'issuer', None),
+        (0x30, 'validity', None),
+        (0x30, 'subject', None),
+        (0x30, 'public key info', None),
+    ]
+    if extensions:
+      elements.append(
+          (x509.DER_TAG_EXTENSIONS, 'extensions element', 'extensions'))
+    return elements
+
+  def _ExpectDecodeTbsElements(self, validity_seq):
+    """Expects decoding of the _GetTbsElements() fields up to validity."""
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
+    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
+    self.mox.StubOutWithMock(self.x, '_AssembleDNSequence')
+    x509._DecodeDer('version').AndReturn(x509.X509_CERT_VERSION_3)
+    x509._DecodeDer(
+        'serial', mox.IsA(rfc2459.CertificateSerialNumber)).AndReturn(12345)
+    x509._DecodeDer(
+        'signature', mox.IsA(rfc2459.AlgorithmIdentifier)).AndReturn('sigseq')
+    self.x._GetSignatureAlgorithmFromSequence('sigseq').AndReturn(
+        {'sig_algorithm': 'sigalg'})
+    x509._DecodeDer('issuer', mox.IsA(rfc2459.Name)).AndReturn('issuerseq')
+    self.x._AssembleDNSequence('issuerseq').AndReturn('CN=issuer')
+    x509._DecodeDer(
+        'validity', mox.IsA(rfc2459.Validity)).AndReturn(validity_seq)
+
+  def testGetFieldsFromElements(self):
+    """Test _GetFieldsFromElements()."""
     before_ts = self.mox.CreateMockAnything()
     after_ts = self.mox.CreateMockAnything()
-    mock_utctime = self.mox.CreateMockAnything()
-    self.stubs.Set(x509.pyasn1.type.useful, 'UTCTime', mock_utctime)
+    self._ExpectDecodeTbsElements(
+        {'notBefore': before_ts, 'notAfter': after_ts})
     before_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(True)
     after_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(True)
-    serial_num = 12345
-    v3ext = {
-        'may_act_as_ca': 123,
-        'key_usage': (1, 2, 3),
-        'subject_alt_name': 'subj alt name',
-    }
-
-    seq = {
-        'version': x509.X509_CERT_VERSION_3,
-        'serialNumber': serial_num,
-        'signature': sig_alg_seq,
-        'issuer': (((x509.OID_ID['CN'], 'issuer'),),),
-        'validity': {
-            'notBefore': before_ts,
-            'notAfter': after_ts
-        },
-        'subject': (((x509.OID_ID['CN'], 'subject'),),),
-        'extensions': 'x509v3 extensions',
-        'extra_key': 'dsadas'
-    }
-    seq_encoded = 'raw bytes'
-    before_dt = 'before_dt'
-    after_dt = 'after_dt'
-
-    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
     self.mox.StubOutWithMock(self.x, '_CertTimestampToDatetime')
-    self.mox.StubOutWithMock(self.x, '_GetV3ExtensionFieldsFromSequence')
-    self.mox.StubOutWithMock(self.x, '_AssembleDNSequence')
-    self.mox.StubOutWithMock(x509.der_encoder, 'encode', True)
-    self.x._GetSignatureAlgorithmFromSequence(
-        sig_alg_seq).AndReturn(sig_alg)
-    self.x._AssembleDNSequence(seq['issuer']).AndReturn('CN=issuer')
-    self.x._CertTimestampToDatetime(before_ts).AndReturn(before_dt)
-    self.x._CertTimestampToDatetime(after_ts).AndReturn(after_dt)
-    self.x._AssembleDNSequence(seq['subject']).AndReturn('CN=subject')
-    self.x._GetV3ExtensionFieldsFromSequence(seq['extensions']).AndReturn(v3ext)
-    x509.der_encoder.encode(seq).AndReturn(seq_encoded)
-
-    self.mox.ReplayAll()
-    output = self.x._GetFieldsFromSequence(seq)
-    self._CheckSaneCertFields(output)
+    self.x._CertTimestampToDatetime(before_ts).AndReturn('before_dt')
+    self.x._CertTimestampToDatetime(after_ts).AndReturn('after_dt')
+
+    self.mox.ReplayAll()
     self.assertEqual({
-        'serial_num': serial_num,
+        'serial_num': 12345,
         'issuer': u'CN=issuer',
-        'subject': u'CN=subject',
-        'valid_notbefore': before_dt,
-        'valid_notafter': after_dt,
-        'fields_data': seq_encoded,
-        'sig_algorithm': sig_alg,
-        'may_act_as_ca': v3ext['may_act_as_ca'],
-        'key_usage': v3ext['key_usage'],
-        'subject_alt_name': v3ext['subject_alt_name'],
-    }, output)
-    self.mox.VerifyAll()
-
-  def testGetFieldsFromSequenceWhenWrongVersion(self):
-    """Test _GetFieldsFromSequence()."""
-    seq = {
-        'version': x509.X509_CERT_VERSION_3 * 2,  # fails
-    }
+        'valid_notbefore': 'before_dt',
+        'valid_notafter': 'after_dt',
+        'subject_data': 'subject',
+        'extensions_data': 'extensions',
+    }, self.x._GetFieldsFromElements(self._GetTbsElements()))
+    self.mox.VerifyAll()
+
+  def testGetFieldsFromElementsWhenWrongVersion(self):
+    """Test _GetFieldsFromElements()."""
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
+    x509._DecodeDer('version').AndReturn(x509.X509_CERT_VERSION_3 * 2)
 
     self.mox.ReplayAll()
     self.assertRaises(
         x509.CertificateParseError,
-        self.x._GetFieldsFromSequence, seq)
+        self.x._GetFieldsFromElements, self._GetTbsElements())
     self.mox.VerifyAll()
 
-  def testGetFieldsFromSequenceWhenValidityNotBeforeFail(self):
-    """Test _GetFieldsFromSequence()."""
-    sig_alg_seq = ('a', 'b')
-    sig_alg = 'sigalg'
+  def testGetFieldsFromElementsWhenVersionMissing(self):
+    """Test _GetFieldsFromElements()."""
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        x509.CertificateParseError,
+        self.x._GetFieldsFromElements, self._GetTbsElements()[1:])
+    self.mox.VerifyAll()
+
+  def testGetFieldsFromElementsWhenTooFewElements(self):
+    """Test _GetFieldsFromElements()."""
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
+    x509._DecodeDer('version').AndReturn(x509.X509_CERT_VERSION_3)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        x509.CertificateParseError,
+        self.x._GetFieldsFromElements, self._GetTbsElements()[:6])
+    self.mox.VerifyAll()
+
+  def testGetFieldsFromElementsWhenValidityNotBeforeFail(self):
+    """Test _GetFieldsFromElements()."""
     before_ts = self.mox.CreateMockAnything()
     after_ts = self.mox.CreateMockAnything()
-    mock_utctime = self.mox.CreateMockAnything()
-    self.stubs.Set(x509.pyasn1.type.useful, 'UTCTime', mock_utctime)
+    self._ExpectDecodeTbsElements(
+        {'notBefore': before_ts, 'notAfter': after_ts})
     before_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(False)  # fails
-    serial_num = 12345
-    bad_oid_cn = (9) * 10
-
-    seq = {
-        'version': x509.X509_CERT_VERSION_3,
-        'serialNumber': serial_num,
-        'signature': sig_alg_seq,
-        'issuer': (((x509.OID_ID['CN'], 'issuer'),),),
-        'validity': {
-            'notBefore': before_ts,
-            'notAfter': after_ts
-        },
-        'subject': (((x509.OID_ID['CN'], 'subject'),),),
-        'extensions': 'x509v3 extensions',
-    }
-
-    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
-    self.mox.StubOutWithMock(self.x, '_AssembleDNSequence')
-    self.x._GetSignatureAlgorithmFromSequence(
-        sig_alg_seq).AndReturn(sig_alg)
-    self.x._AssembleDNSequence(seq['issuer']).AndReturn('CN=issuer')
 
     self.mox.ReplayAll()
     self.assertRaises(
         x509.CertificateParseError,
-        self.x._GetFieldsFromSequence, seq)
+        self.x._GetFieldsFromElements, self._GetTbsElements())
     self.mox.VerifyAll()
 
-  def testGetFieldsFromSequenceWhenValidityNotAfterFail(self):
-    """Test _GetFieldsFromSequence()."""
-    sig_alg_seq = ('a', 'b')
-    sig_alg = 'sigalg'
+  def testGetFieldsFromElementsWhenValidityNotAfterFail(self):
+    """Test _GetFieldsFromElements()."""
     before_ts = self.mox.CreateMockAnything()
     after_ts = self.mox.CreateMockAnything()
-    mock_utctime = self.mox.CreateMockAnything()
-    self.stubs.Set(x509.pyasn1.type.useful, 'UTCTime', mock_utctime)
+    self._ExpectDecodeTbsElements(
+        {'notBefore': before_ts, 'notAfter': after_ts})
     before_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(True)
     after_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(False)  # fails
-    serial_num = 12345
-    bad_oid_cn = (9) * 10
-
-    seq = {
-        'version': x509.X509_CERT_VERSION_3,
-        'serialNumber': serial_num,
-        'signature': sig_alg_seq,
-        'issuer': (((x509.OID_ID['CN'], 'issuer'),),),
-        'validity': {
-            'notBefore': before_ts,
-            'notAfter': after_ts
-        },
-        'subject': (((x509.OID_ID['CN'], 'subject'),),),
-        'extensions': 'x509v3 extensions',
-    }
-
-    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
-    self.mox.StubOutWithMock(self.x, '_AssembleDNSequence')
-    self.x._GetSignatureAlgorithmFromSequence(
-        sig_alg_seq).AndReturn(sig_alg)
-    self.x._AssembleDNSequence(seq['issuer']).AndReturn('CN=issuer')
 
     self.mox.ReplayAll()
     self.assertRaises(
         x509.CertificateParseError,
-        self.x._GetFieldsFromSequence, seq)
+        self.x._GetFieldsFromElements, self._GetTbsElements())
     self.mox.VerifyAll()
 
-  def testGetFieldsFromSequenceWhenX509V3Missing(self):
-    """Test _GetFieldsFromSequence()."""
-    sig_alg_seq = ('a','b')
-    sig_alg = 'sigalg'
+  def testGetFieldsFromElementsWhenX509V3Missing(self):
+    """Test _GetFieldsFromElements()."""
     before_ts = self.mox.CreateMockAnything()
     after_ts = self.mox.CreateMockAnything()
-    mock_utctime = self.mox.CreateMockAnything()
-    self.stubs.Set(x509.pyasn1.type.useful, 'UTCTime', mock_utctime)
+    self._ExpectDecodeTbsElements(
+        {'notBefore': before_ts, 'notAfter': after_ts})
     before_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(True)
     after_ts.isSameTypeWith(mox.IgnoreArg()).AndReturn(True)
-    serial_num = 12345
-
-    seq = {
-        'version': x509.X509_CERT_VERSION_3,
-        'serialNumber': serial_num,
-        'signature': sig_alg_seq,
-        'issuer': (((x509.OID_ID['CN'], 'issuer'),),),
-        'validity': {
-            'notBefore': before_ts,
-            'notAfter': after_ts
-        },
-        'subject': (((x509.OID_ID['CN'], 'subject'),),),
-    }
-    seq_encoded = 'raw bytes'
-    before_dt = 'before_dt'
-    after_dt = 'after_dt'
-
-    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
     self.mox.StubOutWithMock(self.x, '_CertTimestampToDatetime')
+    self.x._CertTimestampToDatetime(before_ts).AndReturn('before_dt')
+    self.x._CertTimestampToDatetime(after_ts).AndReturn('after_dt')
+
+    self.mox.ReplayAll()
+    output = self.x._GetFieldsFromElements(
+        self._GetTbsElements(extensions=False))
+    self.assertEqual('subject', output['subject_data'])
+    self.assertEqual(None, output['extensions_data'])
+    self.mox.VerifyAll()
+
+  def testGetSubjectFromByteString(self):
+    """Test _GetSubjectFromByteString()."""
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
     self.mox.StubOutWithMock(self.x, '_AssembleDNSequence')
-    self.mox.StubOutWithMock(x509.der_encoder, 'encode', True)
-    self.x._GetSignatureAlgorithmFromSequence(
-        sig_alg_seq).AndReturn(sig_alg)
-    self.x._AssembleDNSequence(seq['issuer']).AndReturn('CN=issuer')
-    self.x._CertTimestampToDatetime(before_ts).AndReturn(before_dt)
-    self.x._CertTimestampToDatetime(after_ts).AndReturn(after_dt)
-    self.x._AssembleDNSequence(seq['subject']).AndReturn('CN=subject')
-    x509.der_encoder.encode(seq).AndReturn(seq_encoded)
+    x509._DecodeDer('subject', mox.IsA(rfc2459.Name)).AndReturn('subjectseq')
+    self.x._AssembleDNSequence('subjectseq').AndReturn('CN=subject')
 
     self.mox.ReplayAll()
-    output = self.x._GetFieldsFromSequence(seq)
+    output = self.x._GetSubjectFromByteString('subject')
     self._CheckSaneCertFields(output)
+    self.assertEqual({'subject': u'CN=subject'}, output)
+    self.mox.VerifyAll()
+
+  def testGetV3ExtensionFieldsFromByteString(self):
+    """Test _GetV3ExtensionFieldsFromByteString()."""
+    v3ext = {'may_act_as_ca': True}
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
+    self.mox.StubOutWithMock(self.x, '_GetV3ExtensionFieldsFromSequence')
+    x509._DecodeDer('extensions').AndReturn('extensionsseq')
+    self.x._GetV3ExtensionFieldsFromSequence('extensionsseq').AndReturn(v3ext)
+
+    self.mox.ReplayAll()
     self.assertEqual(
-        output, {
-            'serial_num': serial_num,
-            'issuer': 'CN=issuer',
-            'subject': 'CN=subject',
-            'valid_notbefore': before_dt,
-            'valid_notafter': after_dt,
-            'fields_data': seq_encoded,
-            'sig_algorithm': sig_alg,
-        })
+        v3ext, self.x._GetV3ExtensionFieldsFromByteString('extensions'))
     self.mox.VerifyAll()
 
+  def testGetV3ExtensionFieldsFromByteStringWhenMissing(self):
+    """Test _GetV3ExtensionFieldsFromByteString()."""
+    self.assertEqual({}, self.x._GetV3ExtensionFieldsFromByteString(None))
+
   def testGetSignatureAlgorithmFromSequence(self):
     """Test _GetSignatureAlgorithmFromSequence()."""
     alg = self.x.SIGNATURE_ALGORITHMS[0]
@@ -703,76 +765,24 @@ class X509CertificateTest(mox.MoxTestBase):
         x509.CertificateValueError,
         self.x._GetSignatureAlgorithmFromSequence, seq)
 
-  def testGetSignatureFromSequence(self):
-    """Test _GetSignatureFromSequence()."""
-    bits = 1024
-    good_seq = [1] * bits
-    good_sig = (bits/8) * 'x'
-
-    self.mox.StubOutWithMock(x509.der_encoder, 'encode', True)
-    x509.der_encoder.encode(good_seq).AndReturn('junkJunkJUNK%s' % good_sig)
-
-    self.mox.ReplayAll()
-    output = self.x._GetSignatureFromSequence(good_seq)
+  def testGetSignatureFromByteString(self):
+    """Test _GetSignatureFromByteString()."""
+    good_sig = (1024/8) * 'x'
+    output = self.x._GetSignatureFromByteString('\x00%s' % good_sig)
     self._CheckSaneCertFields(output)
     self.assertEqual(output['sig_data'], good_sig)
-    self.mox.VerifyAll()
-
-  def testGetSignatureFromSequenceWhenShortSeq(self):
-    """Test _GetSignatureFromSequence()."""
-    short_seq = [1] * 5
-
-    self.mox.ReplayAll()
-    self.assertRaises(
-        x509.CertificateParseError,
-        self.x._GetSignatureFromSequence, short_seq)
-    self.mox.VerifyAll()
-
-  def testGetSignatureFromSequenceWhenNonBinarySeq(self):
-    """Test _GetSignatureFromSequence()."""
-    non_binary_seq = [2] * 2048
-
-    self.mox.ReplayAll()
-    self.assertRaises(
-        x509.CertificateParseError,
-        self.x._GetSignatureFromSequence, non_binary_seq)
-    self.mox.VerifyAll()
-
-  def testGetCertSequencesFromTopSequence(self):
-    """Test GetCertSequencesFromTopSequence()."""
-    seq = ({'tbsCertificate': 0, 'signatureAlgorithm': 1, 'signatureValue': 2},)
 
-    self.mox.StubOutWithMock(self.x, '_GetFieldsFromSequence')
-    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
-    self.mox.StubOutWithMock(self.x, '_GetSignatureFromSequence')
-
-    self.x._GetFieldsFromSequence(seq[0]['tbsCertificate']).AndReturn({'a': 1})
-    self.x._GetSignatureAlgorithmFromSequence(
-        seq[0]['signatureAlgorithm']).AndReturn({
-            'b': 1
-        })
-    self.x._GetSignatureFromSequence(seq[0]['signatureValue']).AndReturn({
-        'c': 1
-    })
-
-    self.mox.ReplayAll()
-    o = self.x._GetCertSequencesFromTopSequence(seq)
-    self.assertEqual(o, {'a': 1, 'b': 1, 'c': 1})
-    self.mox.VerifyAll()
-
-  def testGetCertSequencesFromTopSequenceWhenBadTuple(self):
-    """Test _GetCertSequencesFromTopSequence()."""
-    seq = ()
+  def testGetSignatureFromByteStringWhenShort(self):
+    """Test _GetSignatureFromByteString()."""
     self.assertRaises(
         x509.CertificateParseError,
-        self.x._GetCertSequencesFromTopSequence,
-        seq)
+        self.x._GetSignatureFromByteString, '\x00xxxxx')
 
-    seq = 'not a tuple'
+  def testGetSignatureFromByteStringWhenUnusedBits(self):
+    """Test _GetSignatureFromByteString()."""
     self.assertRaises(
         x509.CertificateParseError,
-        self.x._GetCertSequencesFromTopSequence,
-        seq)
+        self.x._GetSignatureFromByteString, '\x01%s' % ((1024/8) * 'x'))
 
   def testGetPublicKeyFromByteString(self):
     """Test _GetPublicKeyFromByteString()."""
@@ -792,45 +802,81 @@ class X509CertificateTest(mox.MoxTestBase):
 
   def testLoadFromByteString(self):
     """Test LoadFromByteString()."""
-    self.x.Reset()
-    base_cert = self.x._cert
+    tbs = _Der(0x30, 'tbs')
+    sig_alg = _Der(0x30, 'sigalg')
+    data = _Der(0x30, 'cert')
 
-    self.mox.StubOutWithMock(x509.der_decoder, 'decode', True)
-    self.mox.StubOutWithMock(self.x, '_GetCertSequencesFromTopSequence')
+    self.mox.StubOutWithMock(x509, '_GetDerElements', True)
+    self.mox.StubOutWithMock(x509, '_DecodeDer')
+    self.mox.StubOutWithMock(self.x, '_GetFieldsFromElements')
+    self.mox.StubOutWithMock(self.x, '_GetSignatureAlgorithmFromSequence')
+    self.mox.StubOutWithMock(self.x, '_GetSignatureFromByteString')
+    self.mox.StubOutWithMock(self.x, '_GetSubjectFromByteString')
+    self.mox.StubOutWithMock(self.x, '_GetV3ExtensionFieldsFromByteString')
     self.mox.StubOutWithMock(self.x, '_GetPublicKeyFromByteString')
-    self.mox.StubOutWithMock(self.x, 'Reset')
-
-    data = 'bytes'
-    seq = 'seq'
-    certseq = {'certseq': 1}
-    pubkey = {'pubkey': 1}
-    cert = {'entire_byte_string': data}
-    cert.update(base_cert)
-    cert.update(certseq)
-    cert.update(pubkey)
 
-    x509.der_decoder.decode(data, asn1Spec=mox.IgnoreArg()).AndReturn(seq)
-    self.x._GetCertSequencesFromTopSequence(seq).AndReturn(certseq)
-    self.x._GetPublicKeyFromByteString(data).AndReturn(pubkey)
-    self.x.Reset().AndReturn(None)
+    x509._GetDerElements('cert').AndReturn([
+        (0x30, tbs, 'tbs'), (0x30, sig_alg, 'sigalg'), (0x03, 'sig el', 'sig')])
+    x509._GetDerElements('tbs').AndReturn(['tbs elements'])
+    self.x._GetFieldsFromElements(['tbs elements']).AndReturn({
+        'serial_num': 12345,
+        'issuer': u'CN=issuer',
+        'subject_data': 'subject',
+        'extensions_data': 'extensions',
+    })
+    x509._DecodeDer(
+        sig_alg, mox.IsA(rfc2459.AlgorithmIdentifier)).AndReturn('sigseq')
+    self.x._GetSignatureAlgorithmFromSequence('sigseq').AndReturn(
+        {'sig_algorithm': 'sigalg'})
+    self.x._GetSignatureFromByteString('sig').AndReturn({'sig_data': 'sig'})
+    # lazy fields, decoded once on first access.
+    self.x._GetSubjectFromByteString('subject').AndReturn(
+        {'subject': u'CN=subject'})
+    self.x._GetV3ExtensionFieldsFromByteString('extensions').AndReturn(
+        {'may_act_as_ca': True})
+    self.x._GetPublicKeyFromByteString(data).AndReturn({'public_key': 'pk'})
 
     self.mox.ReplayAll()
     self.x.LoadFromByteString(data)
-    self.assertEqual(self.x._cert, cert)
-    self.mox.VerifyAll()
+    self.assertEqual(12345, self.x.GetSerialNumber())
+    self.assertEqual(u'CN=issuer', self.x.GetIssuer())
+    self.assertEqual(tbs, self.x.GetFieldsData())
+    self.assertEqual('sigalg', self.x.GetSignatureAlgorithm())
+    self.assertEqual('sig', self.x.GetSignatureData())
+    for unused_i in xrange(2):
+      self.assertEqual(u'CN=subject', self.x.GetSubject())
+      self.assertTrue(self.x.GetMayActAsCA())
+      self.assertEqual(None, self.x.GetKeyUsage())
+      self.assertEqual(None, self.x.GetSubjectAltName())
+      self.assertEqual('pk', self.x.GetPublicKey())
+    self.mox.VerifyAll()
+
+  def testLoadFromByteStringWhenNotSequence(self):
+    """Test LoadFromByteString()."""
+    self.assertRaises(x509.CertificateASN1FormatError,
+                      self.x.LoadFromByteString, _Der(0x02, 'bytes'))
 
-  def testLoadFromByteStringWhenPyAsn1Error(self):
+  def testLoadFromByteStringWhenBadStructure(self):
     """Test LoadFromByteString()."""
-    self.mox.StubOutWithMock(x509.der_decoder, 'decode', True)
+    data = _Der(0x30, _Der(0x30, 'tbs') + _Der(0x03, 'sig'))
+    self.assertRaises(x509.CertificateASN1FormatError,
+                      self.x.LoadFromByteString, data)
 
-    data = 'bytes'
+  def testLoadFromByteStringWhenTruncated(self):
+    """Test LoadFromByteString()."""
+    data = _Der(0x30, _Der(0x30, 'tbs'))[:-1]
+    self.assertRaises(x509.CertificateASN1FormatError,
+                      self.x.LoadFromByteString, data)
 
-    x509.der_decoder.decode(
-        data, asn1Spec=mox.IgnoreArg()).AndRaise(x509.pyasn1.error.PyAsn1Error)
+  def testDecodeAll(self):
+    """Test DecodeAll()."""
+    loader = self.mox.CreateMockAnything()
+    self.x._cert.SetLoader(['subject'], loader)
+    loader().AndReturn({'subject': u'CN=subject'})
 
     self.mox.ReplayAll()
-    self.assertRaises(x509.CertificateASN1FormatError,
-                      self.x.LoadFromByteString, data)
+    self.x.DecodeAll()
+    self.assertEqual(u'CN=subject', self.x._cert.get('subject'))
     self.mox.VerifyAll()
 
   def testCheckValidityWhenObtainUtc(self):
@@ -16,9 +16,13 @@
 #
 """client module tests."""
 
+import hashlib
 import httplib
 import logging
+import os
+import shutil
 import sys
+import tempfile
 
 
 from pyfakefs import fake_filesystem
@@ -67,6 +71,13 @@ class MultiBodyConnectionTest(basetest.TestCase):
         client.Error,
         self.mbc.SetProgressCallback, 1)
 
+  def testClearProgressCallback(self):
+    """Test ClearProgressCallback()."""
+    self.mbc.ClearProgressCallback()
+    self.mbc.SetProgressCallback(lambda x: 1)
+    self.mbc.ClearProgressCallback()
+    self.assertFalse(hasattr(self.mbc, '_progress_callback'))
+
   def testProgressCallback(self):
     """Test _ProgressCallback()."""
     self.mbc._ProgressCallback(1, 2)
@@ -626,7 +637,8 @@ class HttpsClientTest(basetest.TestCase):
               method, url, body, headers, output_file))
       request_mock.assert_called_once_with(
           method, conn, req_url, body=body, headers=headers)
-      get_response_mock.assert_called_once_with(conn, output_file=output_file)
+      get_response_mock.assert_called_once_with(
+          conn, output_file=output_file, output_file_fn=None)
 
     conn.assert_not_called()
     response.assert_not_called()
@@ -671,6 +683,370 @@ class HttpsClientTest(basetest.TestCase):
     req_url = 'https://' + self.hostname + '/url'
     self._TestDoRequestResponse(test_client, '/url', req_url)
 
+  def testDoRequestResponseReusesConnection(self):
+    """Test _DoRequestResponse() reusing a keep-alive connection."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    conn.sock = mock.Mock()
+    response = client.Response(status=200)
+
+    with mock.patch.object(self.client, '_Connect', return_value=conn) as c:
+      with mock.patch.object(self.client, '_Request') as request_mock:
+        with mock.patch.object(
+            self.client, '_GetResponse', return_value=response):
+          self.client._DoRequestResponse('GET', '/url1')
+          self.client._DoRequestResponse('GET', '/url2')
+
+    c.assert_called_once_with()
+    request_mock.assert_has_calls([
+        mock.call('GET', conn, '/url1', body=None, headers=None),
+        mock.call('GET', conn, '/url2', body=None, headers=None)])
+    self.assertEqual({'handshakes': 1, 'reused': 1}, pool.GetStats())
+
+  def testDoRequestResponseWhenServerClosesConnection(self):
+    """Test _DoRequestResponse() when the connection is not kept alive."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    conn.sock = None
+
+    with mock.patch.object(self.client, '_Connect', return_value=conn) as c:
+      with mock.patch.object(self.client, '_Request'):
+        with mock.patch.object(
+            self.client, '_GetResponse',
+            return_value=client.Response(status=200)):
+          self.client._DoRequestResponse('GET', '/url1')
+          self.client._DoRequestResponse('GET', '/url2')
+
+    self.assertEqual(2, c.call_count)
+    self.assertEqual({'handshakes': 2, 'reused': 0}, pool.GetStats())
+
+  def testDoRequestResponseRetriesStaleConnection(self):
+    """Test _DoRequestResponse() when a reused connection is stale."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    stale_conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    pool.Put(self.client._GetConnectionKey(), stale_conn)
+    conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    conn.sock = mock.Mock()
+    response = client.Response(status=200)
+
+    with mock.patch.object(self.client, '_Connect', return_value=conn):
+      with mock.patch.object(self.client, '_Request') as request_mock:
+        with mock.patch.object(
+            self.client, '_GetResponse',
+            side_effect=[httplib.BadStatusLine(''), response]):
+          self.assertEqual(
+              response, self.client._DoRequestResponse('PUT', '/url', 'b'))
+
+    stale_conn.close.assert_called_once_with()
+    request_mock.assert_has_calls([
+        mock.call('PUT', stale_conn, '/url', body='b', headers=None),
+        mock.call('PUT', conn, '/url', body='b', headers=None)])
+    self.assertEqual({'handshakes': 1, 'reused': 1}, pool.GetStats())
+
+  def testDoRequestResponseRetriesUnsentRequest(self):
+    """Test _DoRequestResponse() when a request fails before it is sent."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    stale_conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    stale_conn.request_sent = False
+    pool.Put(self.client._GetConnectionKey(), stale_conn)
+    conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    conn.sock = mock.Mock()
+    response = client.Response(status=200)
+
+    with mock.patch.object(self.client, '_Connect', return_value=conn):
+      with mock.patch.object(
+          self.client, '_Request', side_effect=[IOError('reset'), None]):
+        with mock.patch.object(
+            self.client, '_GetResponse', return_value=response):
+          self.assertEqual(
+              response, self.client._DoRequestResponse('GET', '/url'))
+
+    stale_conn.close.assert_called_once_with()
+    self.assertEqual({'handshakes': 1, 'reused': 1}, pool.GetStats())
+
+  def testDoRequestResponseDoesNotRetrySentRequest(self):
+    """Test _DoRequestResponse() does not resend after a response error."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    stale_conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    stale_conn.request_sent = True
+    pool.Put(self.client._GetConnectionKey(), stale_conn)
+
+    with mock.patch.object(self.client, '_Connect') as c:
+      with mock.patch.object(self.client, '_Request'):
+        with mock.patch.object(
+            self.client, '_GetResponse', side_effect=IOError('reset')):
+          self.assertRaises(
+              client.HTTPError, self.client._DoRequestResponse, 'GET', '/url')
+
+    self.assertFalse(c.called)
+    stale_conn.close.assert_called_once_with()
+
+  def testDoRequestResponseRetriesUnsentPost(self):
+    """Test _DoRequestResponse() resends a POST which was not sent."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    stale_conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    stale_conn.request_sent = False
+    pool.Put(self.client._GetConnectionKey(), stale_conn)
+    conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    conn.sock = mock.Mock()
+    response = client.Response(status=200)
+
+    with mock.patch.object(self.client, '_Connect', return_value=conn):
+      with mock.patch.object(
+          self.client, '_Request', side_effect=[IOError('reset'), None]):
+        with mock.patch.object(
+            self.client, '_GetResponse', return_value=response):
+          self.assertEqual(
+              response, self.client._DoRequestResponse('POST', '/url', 'b'))
+
+    stale_conn.close.assert_called_once_with()
+    self.assertEqual({'handshakes': 1, 'reused': 1}, pool.GetStats())
+
+  def testDoRequestResponseDoesNotRetrySentPost(self):
+    """Test _DoRequestResponse() does not resend a POST once sent."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    stale_conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    stale_conn.request_sent = True
+    pool.Put(self.client._GetConnectionKey(), stale_conn)
+
+    with mock.patch.object(self.client, '_Connect') as c:
+      with mock.patch.object(self.client, '_Request'):
+        with mock.patch.object(
+            self.client, '_GetResponse',
+            side_effect=httplib.BadStatusLine('')):
+          self.assertRaises(
+              client.HTTPError, self.client._DoRequestResponse,
+              'POST', '/url', 'b')
+
+    self.assertFalse(c.called)
+    stale_conn.close.assert_called_once_with()
+
+  def testDoRequestResponseStaleConnectionWithFileBody(self):
+    """Test _DoRequestResponse() does not resend a partially sent body."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    stale_conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    pool.Put(self.client._GetConnectionKey(), stale_conn)
+
+    with mock.patch.object(self.client, '_Connect') as c:
+      with mock.patch.object(
+          self.client, '_Request', side_effect=httplib.BadStatusLine('')):
+        self.assertRaises(
+            client.HTTPError, self.client._DoRequestResponse,
+            'PUT', '/url', ['body', mock.Mock()])
+
+    self.assertFalse(c.called)
+    stale_conn.close.assert_called_once_with()
+
+  def testDoRequestResponseResetsProgressCallbackOnReuse(self):
+    """Test _DoRequestResponse() sets the progress callback on reuse."""
+    pool = client.ConnectionPool()
+    self.client._connection_pool = pool
+    conn = mock.create_autospec(client.HTTPMultiBodyConnection)
+    conn.sock = mock.Mock()
+    pool.Put(self.client._GetConnectionKey(), conn)
+    fn = mock.Mock()
+
+    with mock.patch.object(self.client, '_Request'):
+      with mock.patch.object(
+          self.client, '_GetResponse',
+          return_value=client.Response(status=200)):
+        self.client._DoRequestResponse('GET', '/url1')
+        self.client.SetProgressCallback(fn)
+        self.client._DoRequestResponse('GET', '/url2')
+
+    conn.ClearProgressCallback.assert_called_once_with()
+    conn.SetProgressCallback.assert_called_once_with(fn)
+
+  @mock.patch.object(client.time, 'time')
+  def testConnectionPoolIdleTimeout(self, mock_time):
+    """Test ConnectionPool does not reuse idle connections."""
+    pool = client.ConnectionPool(idle_timeout=30)
+    conn1 = mock.Mock()
+    conn2 = mock.Mock()
+
+    mock_time.return_value = 100
+    pool.Put('key', conn1)
+    mock_time.return_value = 120
+    pool.Put('key', conn2)
+    mock_time.return_value = 140
+
+    self.assertEqual(conn2, pool.Get('key'))
+    self.assertEqual(None, pool.Get('key'))
+    conn1.close.assert_called_once_with()
+    self.assertEqual(None, pool.Get('otherkey'))
+    self.assertEqual({'handshakes': 0, 'reused': 1}, pool.GetStats())
+
+  def _MockDownloadResponse(self, status, data, response_headers):
+    """Returns a _DoRequestResponse side effect sending a download response."""
+    headers_out = dict((k.lower(), v) for k, v in response_headers.iteritems())
+    response = mock.create_autospec(httplib.HTTPResponse)
+    response.status = status
+    response.getheader.side_effect = lambda h: headers_out.get(h.lower())
+
+    def _DoRequestResponse(
+        unused_method, unused_url, headers=None, output_file_fn=None):
+      self.request_headers.append(headers)
+      output_file = output_file_fn(response)
+      body = None
+      if output_file:
+        output_file.write(data)
+      else:
+        body = data
+      return client.Response(
+          status=status, body=body, headers=dict(headers_out))
+
+    return _DoRequestResponse
+
+  def _DownloadTest(self, responses, attempt_times=4):
+    """Calls DoDownload() with responses, returns its return value."""
+    self.request_headers = []
+    side_effects = [self._MockDownloadResponse(*r) for r in responses]
+    with mock.patch.object(
+        self.client, '_DoRequestResponse',
+        side_effect=lambda *args, **kwargs: side_effects.pop(0)(
+            *args, **kwargs)):
+      with mock.patch.object(client.time, 'sleep'):
+        return self.client.DoDownload(
+            '/url', self.output_filename, attempt_times=attempt_times)
+
+  def _SetUpDownload(self, data=None, etag=None):
+    """Sets up a partial download in a temporary directory."""
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    self.output_filename = os.path.join(tmpdir, 'pkg.dmg')
+    self.etag_filename = (
+        self.output_filename + client.PARTIAL_DOWNLOAD_ETAG_SUFFIX)
+    if data is not None:
+      open(self.output_filename, 'wb').write(data)
+    if etag is not None:
+      open(self.etag_filename, 'w').write(etag)
+
+  def testDoDownload(self):
+    """Test DoDownload() verifying a sha256 ETag."""
+    data = 'package data'
+    etag = hashlib.sha256(data).hexdigest()
+    self._SetUpDownload()
+
+    response = self._DownloadTest([
+        (200, data, {'ETag': etag, 'Content-Length': str(len(data))})])
+
+    self.assertEqual(200, response.status)
+    self.assertEqual(data, open(self.output_filename, 'rb').read())
+    self.assertFalse(os.path.exists(self.etag_filename))
+    self.assertEqual([{}], self.request_headers)
+
+  def testDoDownloadResumesPartialDownload(self):
+    """Test DoDownload() resuming a partial download with a Range request."""
+    data = 'package data'
+    etag = hashlib.sha256(data).hexdigest()
+    self._SetUpDownload(data=data[:5], etag=etag)
+
+    response = self._DownloadTest([
+        (206, data[5:], {'ETag': etag, 'Content-Length': str(len(data) - 5)})])
+
+    self.assertEqual(206, response.status)
+    self.assertEqual(data, open(self.output_filename, 'rb').read())
+    self.assertFalse(os.path.exists(self.etag_filename))
+    self.assertEqual(
+        [{'Range': 'bytes=5-', 'If-Range': etag}], self.request_headers)
+
+  def testDoDownloadResumesIncompleteDownload(self):
+    """Test DoDownload() resuming after an incomplete response."""
+    data = 'package data'
+    etag = hashlib.sha256(data).hexdigest()
+    self._SetUpDownload()
+
+    response = self._DownloadTest([
+        (200, data[:4], {'ETag': etag, 'Content-Length': str(len(data))}),
+        (206, data[4:], {'ETag': etag, 'Content-Length': str(len(data) - 4)}),
+    ])
+
+    self.assertEqual(206, response.status)
+    self.assertEqual(data, open(self.output_filename, 'rb').read())
+    self.assertEqual(
+        [{}, {'Range': 'bytes=4-', 'If-Range': etag}], self.request_headers)
+
+  def testDoDownloadWhenRetriedOnNewConnection(self):
+    """Test DoDownload() when the response is retried on a new connection."""
+    data = 'package data'
+    etag = hashlib.sha256(data).hexdigest()
+    self._SetUpDownload(data=data[:5], etag=etag)
+    response = mock.create_autospec(httplib.HTTPResponse)
+    response.status = 206
+
+    def _DoRequestResponse(
+        unused_method, unused_url, headers=None, output_file_fn=None):
+      output_file_fn(response).write(data[5:8])
+      output_file_fn(response).write(data[5:])
+      return client.Response(
+          status=206, headers={'content-length': str(len(data) - 5)})
+
+    with mock.patch.object(
+        self.client, '_DoRequestResponse', side_effect=_DoRequestResponse):
+      self.assertEqual(
+          206, self.client.DoDownload('/url', self.output_filename).status)
+
+    self.assertEqual(data, open(self.output_filename, 'rb').read())
+
+  def testDoDownloadPartialContentWithoutOffset(self):
+    """Test DoDownload() streams a 206 response for a new download."""
+    data = 'package data'
+    etag = hashlib.sha256(data).hexdigest()
+    self._SetUpDownload()
+
+    response = self._DownloadTest([
+        (206, data, {'ETag': etag, 'Content-Length': str(len(data))})])
+
+    self.assertEqual(206, response.status)
+    self.assertEqual(None, response.body)
+    self.assertEqual(data, open(self.output_filename, 'rb').read())
+    self.assertFalse(os.path.exists(self.etag_filename))
+
+  def testDoDownloadWhenPackageChanged(self):
+    """Test DoDownload() when the server sends a new package in full."""
+    data = 'new package data'
+    etag = hashlib.sha256(data).hexdigest()
+    self._SetUpDownload(data='old p', etag='oldetag')
+
+    response = self._DownloadTest([
+        (200, data, {'ETag': etag, 'Content-Length': str(len(data))})])
+
+    self.assertEqual(200, response.status)
+    self.assertEqual(data, open(self.output_filename, 'rb').read())
+    self.assertFalse(os.path.exists(self.etag_filename))
+
+  def testDoDownloadWithError(self):
+    """Test DoDownload() keeps a partial download on errors."""
+    self._SetUpDownload(data='part', etag='etag')
+
+    response = self._DownloadTest([(403, 'forbidden', {})])
+
+    self.assertEqual(403, response.status)
+    self.assertEqual('forbidden', response.body)
+    self.assertEqual('part', open(self.output_filename, 'rb').read())
+    self.assertTrue(os.path.exists(self.etag_filename))
+
+  def testDoDownloadWithSha256Mismatch(self):
+    """Test DoDownload() when the download does not match its sha256."""
+    etag = hashlib.sha256('package data').hexdigest()
+    self._SetUpDownload()
+
+    self.assertRaises(
+        client.SimianClientError, self._DownloadTest,
+        [(200, 'corrupt data', {'ETag': etag}),
+         (200, 'corrupt data', {'ETag': etag})],
+        attempt_times=2)
+    self.assertFalse(os.path.exists(self.output_filename))
+    self.assertFalse(os.path.exists(self.etag_filename))
+
   def testDoWithInvalidMethod(self):
     """Test Do() with invalid method."""
     self.assertRaises(
@@ -1082,7 +1458,14 @@ class SimianClientTest(basetest.TestCase):
     name = 'name'
     self.GenericStubTest(
         self.client.GetPackage, [name],
-        '_SimianRequest', 'GET', '/pkgs/%s' % name, output_filename=None)
+        '_SimianRequest', 'GET', '/pkgs/%s' % name)
+
+  def testGetPackageWithOutputFilename(self):
+    """Test GetPackage() with an output_filename."""
+    name = 'name'
+    self.GenericStubTest(
+        self.client.GetPackage, [name, 'filename'],
+        '_SimianDownload', '/pkgs/%s' % name, 'filename')
 
   def testGetPackageInfo(self):
     """Test GetPackageInfo()."""
@@ -1117,8 +1500,15 @@ class SimianClientTest(basetest.TestCase):
     self.GenericStubTest(
         self.client.DownloadPackage,
         [filename],
-        '_SimianRequest', 'GET',
-        '/pkgs/%s' % filename, output_filename=filename)
+        '_SimianDownload', '/pkgs/%s' % filename, filename)
+
+  def testSimianDownloadWithError(self):
+    """Test _SimianDownload() when the server returns an error."""
+    response = client.Response(status=404, reason='Not Found', body='body')
+    with mock.patch.object(self.client, 'DoDownload', return_value=response):
+      self.assertRaises(
+          client.SimianServerError,
+          self.client._SimianDownload, '/pkgs/foo', 'foo')
 
   def testPostReport(self):
     """Test PostReport()."""
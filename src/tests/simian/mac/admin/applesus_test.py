@@ -56,6 +56,29 @@ class ApplesusModuleTest(test.AppengineTest):
 
     generate_catalog_mock.assert_called_once_with(tracks=['stable'], delay=1)
 
+  @mock.patch.object(auth, 'IsAdminUser', return_value=True)
+  @mock.patch.object(xsrf, 'XsrfTokenValidate', return_value=True)
+  @mock.patch.object(applesus.applesus, 'RestoreAppleSUSCatalogBackup')
+  def testPostRestoreCatalogBackup(self, restore_mock, *_):
+    backup = 'backup_10.11_stable_2018-06-01-01-00-00'
+    resp = self.testapp.post('/admin/applesus', {
+        'restore-catalog-backup': 1,
+        'backup': backup,
+    }, status=httplib.FOUND)
+
+    restore_mock.assert_called_once_with(backup)
+    self.assertIn('restored', resp.headers['Location'])
+
+  @mock.patch.object(auth, 'IsAdminUser', return_value=True)
+  @mock.patch.object(xsrf, 'XsrfTokenValidate', return_value=True)
+  def testPostRestoreCatalogBackupNotFound(self, *_):
+    resp = self.testapp.post('/admin/applesus', {
+        'restore-catalog-backup': 1,
+        'backup': 'backup_10.11_stable_2018-06-01-01-00-00',
+    }, status=httplib.FOUND)
+
+    self.assertNotIn('restored', resp.headers['Location'])
+
   @mock.patch.object(auth, 'IsAdminUser', return_value=True)
   @mock.patch.object(xsrf, 'XsrfTokenValidate', return_value=True)
   def testChangeProduct(self, *_):
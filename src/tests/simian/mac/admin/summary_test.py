@@ -29,6 +29,7 @@ from simian.mac import models
 from simian.mac.admin import main as gae_main
 from simian.mac.admin import summary
 from simian.mac.common import auth
+from simian.mac.common import fleet_summary
 from tests.simian.mac.common import test
 
 
@@ -117,6 +118,55 @@ class SummaryModuleTest(basetest.TestCase):
     self.assertEqual(3, s['active'][14])
     self.assertAlmostEqual(98.0582, s['conns_off_corp_percent'], 3)
 
+  def testGetComputerSummaryFromFleet(self):
+    computers = models.Computer.all().filter('active =', True).fetch(500)
+    fleet = {}
+    for c in computers:
+      fleet_summary.AddComputer(fleet, c)
+    self.assertEqual(
+        summary.GetComputerSummary(computers),
+        summary.GetComputerSummaryFromFleet(fleet))
+
+  @mock.patch.object(auth, 'IsGroupMember', return_value=False)
+  @mock.patch.object(auth, 'IsAdminUser', return_value=True)
+  @mock.patch.object(summary.Summary, 'Render')
+  @mock.patch.dict(summary.settings.__dict__, {'CLIENT_SITE_ENABLED': False})
+  def testCachedSummary(self, render, *_):
+    fleet = {}
+    for c in models.Computer.all().filter('active =', True):
+      fleet_summary.AddComputer(fleet, c)
+    models.ReportsCache.SetFleetSummary(fleet)
+
+    resp = gae_main.app.get_response('/admin/')
+    self.assertEqual(httplib.OK, resp.status_int)
+
+    params = test.GetArgFromCallHistory(render, arg_index=1)
+    self.assertEqual('summary', params['report_type'])
+    self.assertEqual(3, params['summary']['active'][30])
+    self.assertEqual(('MTV', 2), params['summary']['sites_histogram'][0])
+
+  @mock.patch.object(auth, 'IsGroupMember', return_value=False)
+  @mock.patch.object(auth, 'IsAdminUser', return_value=True)
+  @mock.patch.object(summary.Summary, 'Render')
+  @mock.patch.dict(summary.settings.__dict__, {'CLIENT_SITE_ENABLED': False})
+  def testCachedSummaryBeforeFleetSummary(self, render, *_):
+    computers = models.Computer.all().filter('active =', True).fetch(500)
+    stats_summary = summary.PrepareComputerSummaryForTemplate(
+        summary.GetComputerSummary(computers))
+    models.ReportsCache.SetSerializedItem(
+        models.ReportsCache._SUMMARY_KEY, stats_summary)
+
+    resp = gae_main.app.get_response('/admin/')
+    self.assertEqual(httplib.OK, resp.status_int)
+
+    params = test.GetArgFromCallHistory(render, arg_index=1)
+    self.assertEqual(3, params['summary']['active'][30])
+    self.assertEqual(('MTV', 2), params['summary']['sites_histogram'][0])
+
+    taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskqueue_stub.get_filtered_tasks(url=summary.FLEET_SUMMARY_URL)
+    self.assertEqual(1, len(tasks))
+
   @mock.patch.dict(summary.settings.__dict__, {
       'ALLOW_SELF_REPORT': False, 'AUTH_DOMAIN': 'example.com'})
   @mock.patch.object(auth, 'IsGroupMember', return_value=False)
@@ -16,6 +16,8 @@
 #
 
 
+import json
+
 import mox
 import stubout
 
@@ -34,9 +36,11 @@ class PreflightTest(mox.MoxTestBase):
 
   def setUp(self):
     mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
 
   def tearDown(self):
     self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
 
   def testRunPreflight(self):
     client_id = {
@@ -100,6 +104,35 @@ class PreflightTest(mox.MoxTestBase):
     preflight.RunPreflight('auto')
     self.mox.VerifyAll()
 
+  def testPostManagedSoftwareUpdateLogs(self):
+    """Tests PostManagedSoftwareUpdateLogs() posts batches of logs."""
+    self.stubs.Set(preflight, 'MSU_LOGS_BATCH_SIZE', 2)
+    logs = [{'event': 'e%d' % i, 'source': 'MSU'} for i in xrange(3)]
+    mock_client = self.mox.CreateMockAnything()
+
+    mock_client.PostReport(
+        'msu_logs', {'logs': json.dumps(logs[:2])}).AndReturn('2')
+    mock_client.PostReport(
+        'msu_logs', {'logs': json.dumps(logs[2:])}).AndReturn('1')
+
+    self.mox.ReplayAll()
+    preflight.PostManagedSoftwareUpdateLogs(mock_client, logs)
+    self.mox.VerifyAll()
+
+  def testPostManagedSoftwareUpdateLogsToLegacyServer(self):
+    """Tests PostManagedSoftwareUpdateLogs() when msu_logs is unsupported."""
+    logs = [{'event': 'e%d' % i, 'source': 'MSU'} for i in xrange(2)]
+    mock_client = self.mox.CreateMockAnything()
+
+    mock_client.PostReport(
+        'msu_logs', {'logs': json.dumps(logs)}).AndReturn('')
+    for log in logs:
+      mock_client.PostReport('msu_log', log).AndReturn('')
+
+    self.mox.ReplayAll()
+    preflight.PostManagedSoftwareUpdateLogs(mock_client, logs)
+    self.mox.VerifyAll()
+
 
 if __name__ == '__main__':
   basetest.main()
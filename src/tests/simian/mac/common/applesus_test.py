@@ -28,6 +28,7 @@ from google.apputils import app
 from google.apputils import basetest
 from simian.mac.common import applesus
 from simian.mac.common import gae_util
+from simian.mac.munki import plist
 from tests.simian.mac.common import test
 
 
@@ -56,6 +57,60 @@ class AppleModuleTest(mox.MoxTestBase, test.AppengineTest):
     return ''.join(buf)
 
 
+  def _PutUntouchedCatalog(self, os_version):
+    catalog_xml = self._GetTestData('applesus.sucatalog')
+    applesus.models.AppleSUSCatalog(
+        key_name='%s_untouched' % os_version, plist=catalog_xml).put()
+    return catalog_xml
+
+  def _PutProduct(self, product_id, tracks):
+    applesus.models.AppleSUSProduct(
+        key_name=product_id, product_id=product_id, tracks=tracks).put()
+
+  def _GetProductIds(self, catalog):
+    catalog_plist = plist.ApplePlist(catalog.plist)
+    catalog_plist.Parse()
+    return sorted(catalog_plist['Products'])
+
+  def _GetBackupKeyNames(self):
+    return sorted(
+        c.key().name() for c in applesus.models.AppleSUSCatalog.all()
+        if c.key().name().startswith('backup_'))
+
+  def testGenerateAppleSUSCatalogs(self):
+    """Test GenerateAppleSUSCatalogs()."""
+    tracks = ['testing', 'stable']
+    self.mox.StubOutWithMock(applesus, 'GenerateAppleSUSTrackCatalogs')
+    self.mox.StubOutWithMock(applesus, 'GenerateAppleSUSMetadataCatalog')
+    for os_version in applesus.OS_VERSIONS:
+      applesus.GenerateAppleSUSTrackCatalogs(
+          os_version, tracks, catalog_locks=mox.IgnoreArg()).InAnyOrder()
+    applesus.GenerateAppleSUSMetadataCatalog()
+
+    self.mox.ReplayAll()
+    applesus.GenerateAppleSUSCatalogs(tracks=tracks)
+    self.mox.VerifyAll()
+
+  def testGenerateAppleSUSCatalogsWhenLocked(self):
+    """Test GenerateAppleSUSCatalogs() skips tracks being generated."""
+    lock = datastore_locks.DatastoreLock(
+        applesus.CatalogRegenerationLockName('testing', '10.9'))
+    lock.Acquire()
+    self.mox.StubOutWithMock(applesus, 'GenerateAppleSUSTrackCatalogs')
+    self.mox.StubOutWithMock(applesus, 'GenerateAppleSUSMetadataCatalog')
+    for os_version in applesus.OS_VERSIONS:
+      tracks = ['testing', 'stable']
+      if os_version == '10.9':
+        tracks = ['stable']
+      applesus.GenerateAppleSUSTrackCatalogs(
+          os_version, tracks, catalog_locks=mox.IgnoreArg()).InAnyOrder()
+    applesus.GenerateAppleSUSMetadataCatalog()
+
+    self.mox.ReplayAll()
+    applesus.GenerateAppleSUSCatalogs(tracks=['testing', 'stable'])
+    self.mox.VerifyAll()
+    lock.Release()
+
   def testGenerateAppleSUSCatalogWhereUntouchedDoesNotExist(self):
     """Test GenerateAppleSUSCatalog() where untouched catalog does not exist."""
     os_version = 'foo-version'
@@ -67,66 +122,239 @@ class AppleModuleTest(mox.MoxTestBase, test.AppengineTest):
         '%s_untouched' % os_version).AndReturn(None)
 
     self.mox.ReplayAll()
-    catalog, new_plist = applesus.GenerateAppleSUSCatalog(os_version, track)
-    self.assertEqual(None, catalog)
-    self.assertEqual(None, new_plist)
+    self.assertEqual(
+        None, applesus.GenerateAppleSUSCatalog(os_version, track))
     self.mox.VerifyAll()
 
   def testGenerateAppleSUSCatalog(self):
     """Test GenerateAppleSUSCatalog()."""
-    catalog_xml = self._GetTestData('applesus.sucatalog')
     track = 'testing'
     os_version = '10.6'
-
-    product_one = self.mox.CreateMockAnything()
-    product_one.product_id = 'ID1'
-    product_two = self.mox.CreateMockAnything()
-    product_two.product_id = 'ID3'
-    products = [product_one, product_two]
-
-    mock_catalog_obj = self.mox.CreateMockAnything()
-    mock_catalog_obj.plist = catalog_xml
-    mock_query = self.mox.CreateMockAnything()
-    mock_new_catalog_obj = self.mox.CreateMockAnything()
-
-    self.mox.StubOutWithMock(applesus.models.AppleSUSCatalog, 'get_by_key_name')
-    self.mox.StubOutWithMock(applesus.models, 'AppleSUSCatalog')
-    self.mox.StubOutWithMock(applesus.models.AppleSUSProduct, 'AllActive')
-
-    applesus.models.AppleSUSCatalog.get_by_key_name(
-        '%s_untouched' % os_version).AndReturn(mock_catalog_obj)
-
-    applesus.models.AppleSUSProduct.AllActive().AndReturn(mock_query)
-    mock_query.filter('tracks =', track).AndReturn(products)
+    catalog_xml = self._PutUntouchedCatalog(os_version)
+    self._PutProduct('ID1', [track])
+    self._PutProduct('ID2', ['unstable'])
+    self._PutProduct('ID3', ['unstable', track])
 
     mock_datetime = self.mox.CreateMockAnything()
     utcnow = datetime.datetime(2010, 9, 2, 19, 30, 21, 377827)
-    now_str = '2010-09-02-19-30-21'
     mock_datetime.utcnow().AndReturn(utcnow)
-    applesus.models.AppleSUSCatalog(
-        key_name='backup_%s_%s_%s' % (os_version, track, now_str)).AndReturn(
-            mock_new_catalog_obj)
-    mock_new_catalog_obj.put().AndReturn(None)
-
-    applesus.models.AppleSUSCatalog(
-        key_name='%s_%s' % (os_version, track)).AndReturn(mock_new_catalog_obj)
-    mock_new_catalog_obj.put().AndReturn(None)
 
     lock_name = 'lock_name'
     lock = datastore_locks.DatastoreLock(lock_name)
     lock.Acquire()
 
     self.mox.ReplayAll()
-    _, new_plist = applesus.GenerateAppleSUSCatalog(
+    catalog = applesus.GenerateAppleSUSCatalog(
         os_version, track, mock_datetime, catalog_lock=lock)
-    self.assertTrue('ID1' in new_plist['Products'])
-    self.assertTrue('ID2' not in new_plist['Products'])
-    self.assertTrue('ID3' in new_plist['Products'])
-    self.assertTrue('ID4' not in new_plist['Products'])
     self.mox.VerifyAll()
 
+    # the catalog is identical to the untouched catalog without the products
+    # which are not approved.
+    expected_plist = plist.ApplePlist(catalog_xml)
+    expected_plist.Parse()
+    del expected_plist['Products']['ID2']
+    del expected_plist['Products']['ID4']
+    self.assertEqual(expected_plist.GetXml(), catalog.plist)
+    self.assertEqual(
+        catalog.plist,
+        applesus.models.AppleSUSCatalog.get_by_key_name(
+            '%s_%s' % (os_version, track)).plist)
+    self.assertEqual(
+        ['backup_10.6_testing_2010-09-02-19-30-21'], self._GetBackupKeyNames())
     self.assertFalse(gae_util.LockExists(lock_name))
 
+  def testGenerateAppleSUSTrackCatalogs(self):
+    """Test GenerateAppleSUSTrackCatalogs()."""
+    os_version = '10.6'
+    self._PutUntouchedCatalog(os_version)
+    self._PutProduct('ID1', ['testing', 'stable'])
+    self._PutProduct('ID3', ['testing'])
+    self._PutProduct('ID5', ['testing'])  # not in the untouched catalog.
+
+    catalogs = applesus.GenerateAppleSUSTrackCatalogs(
+        os_version, ['unstable', 'testing', 'stable'])
+
+    self.assertEqual([], self._GetProductIds(catalogs['unstable']))
+    self.assertEqual(['ID1', 'ID3'], self._GetProductIds(catalogs['testing']))
+    self.assertEqual(['ID1'], self._GetProductIds(catalogs['stable']))
+    self.assertEqual(3, len(self._GetBackupKeyNames()))
+
+    chunk_digests = set()
+    for key_name in self._GetBackupKeyNames():
+      backup = applesus.models.AppleSUSCatalog.get_by_key_name(key_name)
+      track = key_name.split('_')[2]
+      self.assertEqual('', backup.plist)
+      self.assertEqual(catalogs[track].chunk_digests, backup.chunk_digests)
+      self.assertEqual(
+          catalogs[track].plist, applesus.GetAppleSUSCatalogBackupXml(backup))
+      chunk_digests.update(backup.chunk_digests)
+    self.assertEqual(
+        sorted(chunk_digests),
+        sorted(c.key().name()
+               for c in applesus.models.AppleSUSCatalogChunk.all()))
+
+  def testGenerateAppleSUSTrackCatalogsWithNonAsciiCatalog(self):
+    """Test GenerateAppleSUSTrackCatalogs() with a non-ASCII catalog."""
+    os_version = '10.6'
+    catalog_xml = self._GetTestData('applesus.sucatalog').decode('utf-8')
+    catalog_xml = catalog_xml.replace(
+        u'<dict>', u'<dict>\n<key>Title</key>\n<string>Caf\xe9</string>', 1)
+    applesus.models.AppleSUSCatalog(
+        key_name='%s_untouched' % os_version, plist=catalog_xml).put()
+    self._PutProduct('ID1', ['testing'])
+
+    catalogs = applesus.GenerateAppleSUSTrackCatalogs(os_version, ['testing'])
+
+    self.assertEqual(['ID1'], self._GetProductIds(catalogs['testing']))
+    self.assertTrue(u'<string>Caf\xe9</string>' in catalogs['testing'].plist)
+
+  def testGenerateAppleSUSTrackCatalogsWhenUnchanged(self):
+    """Test GenerateAppleSUSTrackCatalogs() skips unchanged catalogs."""
+    os_version = '10.6'
+    tracks = ['testing', 'stable']
+    self._PutUntouchedCatalog(os_version)
+    self._PutProduct('ID1', ['testing', 'stable'])
+    mock_datetime = self.mox.CreateMockAnything()
+    for hour in [1, 2, 3]:
+      mock_datetime.utcnow().AndReturn(datetime.datetime(2018, 6, 1, hour))
+
+    self.mox.ReplayAll()
+    first = applesus.GenerateAppleSUSTrackCatalogs(
+        os_version, tracks, datetime_=mock_datetime)
+    second = applesus.GenerateAppleSUSTrackCatalogs(
+        os_version, tracks, datetime_=mock_datetime)
+    self.assertEqual(first['testing'].mtime, second['testing'].mtime)
+    self.assertEqual(2, len(self._GetBackupKeyNames()))
+
+    self._PutProduct('ID3', ['testing'])
+    third = applesus.GenerateAppleSUSTrackCatalogs(
+        os_version, tracks, datetime_=mock_datetime)
+    self.mox.VerifyAll()
+
+    self.assertEqual(['ID1', 'ID3'], self._GetProductIds(third['testing']))
+    self.assertEqual(first['stable'].mtime, third['stable'].mtime)
+    self.assertEqual([
+        'backup_10.6_stable_2018-06-01-01-00-00',
+        'backup_10.6_testing_2018-06-01-01-00-00',
+        'backup_10.6_testing_2018-06-01-03-00-00',
+    ], self._GetBackupKeyNames())
+
+  def testSplitCatalogChunks(self):
+    """Test _SplitCatalogChunks()."""
+    self.stubs.Set(applesus, 'CHUNK_MIN_SIZE', 64)
+    self.stubs.Set(applesus, 'CHUNK_MAX_SIZE', 512)
+    self.stubs.Set(applesus, 'CHUNK_BOUNDARY_MASK', 0x3)
+    catalog_xml = self._GetTestData('applesus.sucatalog')
+    changed_xml = '%s<string>new</string>\n%s' % (
+        catalog_xml[:1500], catalog_xml[1500:])
+
+    chunks = applesus._SplitCatalogChunks(catalog_xml)
+    changed_chunks = applesus._SplitCatalogChunks(changed_xml)
+
+    self.assertEqual(catalog_xml, ''.join(chunks))
+    self.assertEqual(changed_xml, ''.join(changed_chunks))
+    self.assertTrue(len(chunks) > 1)
+    self.assertTrue(max(len(c) for c in chunks) <= 512)
+    # only the chunks around the change differ.
+    self.assertTrue(len(set(changed_chunks) - set(chunks)) <= 2)
+    self.assertEqual([], applesus._SplitCatalogChunks(''))
+
+  def testGetAppleSUSCatalogBackupXmlWhenChunkMissing(self):
+    """Test GetAppleSUSCatalogBackupXml() with a missing chunk."""
+    backup = applesus.models.AppleSUSCatalog(
+        key_name='backup_10.6_stable_2018-06-01-01-00-00',
+        chunk_digests=['missing'])
+    self.assertRaises(
+        applesus.CatalogChunkMissingError,
+        applesus.GetAppleSUSCatalogBackupXml, backup)
+
+  def testRestoreAppleSUSCatalogBackup(self):
+    """Test RestoreAppleSUSCatalogBackup()."""
+    os_version = '10.6'
+    self._PutUntouchedCatalog(os_version)
+    self._PutProduct('ID1', ['stable'])
+    mock_datetime = self.mox.CreateMockAnything()
+    for hour in [1, 2]:
+      mock_datetime.utcnow().AndReturn(datetime.datetime(2018, 6, 1, hour))
+
+    self.mox.ReplayAll()
+    first = applesus.GenerateAppleSUSTrackCatalogs(
+        os_version, ['stable'], datetime_=mock_datetime)['stable']
+    self._PutProduct('ID3', ['stable'])
+    applesus.GenerateAppleSUSTrackCatalogs(
+        os_version, ['stable'], datetime_=mock_datetime)
+    self.mox.VerifyAll()
+
+    c = applesus.RestoreAppleSUSCatalogBackup(
+        'backup_10.6_stable_2018-06-01-01-00-00')
+
+    self.assertEqual('10.6_stable', c.key().name())
+    served = applesus.models.AppleSUSCatalog.get_by_key_name('10.6_stable')
+    self.assertEqual(first.plist, served.plist)
+    self.assertEqual(['ID1'], self._GetProductIds(served))
+    self.assertRaises(
+        ValueError, applesus.RestoreAppleSUSCatalogBackup,
+        'backup_10.6_stable_2018-06-01-05-00-00')
+
+  def testCleanupAppleSUSCatalogBackups(self):
+    """Test CleanupAppleSUSCatalogBackups()."""
+    self.stubs.Set(applesus, 'BACKUP_MIN_KEPT', 1)
+    for digest in ['served', 'expired', 'kept', 'other', 'orphan']:
+      applesus.models.AppleSUSCatalogChunk(key_name=digest, data='x').put()
+    applesus.models.AppleSUSCatalog(
+        key_name='10.6_testing', chunk_digests=['served']).put()
+    for key_name, digest in [
+        ('backup_10.6_testing_2018-01-01-00-00-00', 'expired'),
+        ('backup_10.6_testing_2018-02-01-00-00-00', 'kept'),
+        ('backup_10.6_stable_2018-01-01-00-00-00', 'other')]:
+      applesus.models.AppleSUSCatalog(
+          key_name=key_name, chunk_digests=[digest]).put()
+    now = datetime.datetime.utcnow()
+
+    # chunks within the grace period are kept.
+    self.assertEqual((1, 0), applesus.CleanupAppleSUSCatalogBackups(now=now))
+    self.assertEqual(
+        (0, 2), applesus.CleanupAppleSUSCatalogBackups(
+            now=now + datetime.timedelta(days=1)))
+
+    self.assertEqual([
+        'backup_10.6_stable_2018-01-01-00-00-00',
+        'backup_10.6_testing_2018-02-01-00-00-00',
+    ], self._GetBackupKeyNames())
+    self.assertEqual(
+        ['kept', 'other', 'served'],
+        sorted(c.key().name()
+               for c in applesus.models.AppleSUSCatalogChunk.all()))
+
+  def testDeleteChunkWhenStoredAgain(self):
+    """Test _DeleteChunk() keeps chunks stored since the cutoff."""
+    key = applesus.models.AppleSUSCatalogChunk(key_name='c', data='x').put()
+    now = datetime.datetime.utcnow()
+
+    self.assertEqual(0, applesus._DeleteChunk(
+        key, now - datetime.timedelta(hours=1)))
+    self.assertTrue(applesus.models.AppleSUSCatalogChunk.get(key))
+    self.assertEqual(1, applesus._DeleteChunk(
+        key, now + datetime.timedelta(hours=1)))
+    self.assertEqual(None, applesus.models.AppleSUSCatalogChunk.get(key))
+    self.assertEqual(0, applesus._DeleteChunk(
+        key, now + datetime.timedelta(hours=1)))
+
+  def testGetAppleSUSCatalogBackupKeyNames(self):
+    """Test GetAppleSUSCatalogBackupKeyNames()."""
+    for key_name in [
+        '10.6_stable',
+        'backup_10.6_stable_2018-01-01-00-00-00',
+        'backup_10.6_stable_2018-02-01-00-00-00',
+        'backup_10.6_testing_2018-01-01-00-00-00']:
+      applesus.models.AppleSUSCatalog(key_name=key_name).put()
+
+    self.assertEqual([
+        'backup_10.6_testing_2018-01-01-00-00-00',
+        'backup_10.6_stable_2018-02-01-00-00-00',
+        'backup_10.6_stable_2018-01-01-00-00-00',
+    ], applesus.GetAppleSUSCatalogBackupKeyNames())
+
   def testGetAutoPromoteDateTesting(self):
     """Test GetAutoPromoteDate() for testing track."""
     applesus_product = self.mox.CreateMockAnything()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""fleet_summary module tests."""
+
+import datetime
+
+from google.appengine.ext import testbed
+
+from google.apputils import app
+from google.apputils import basetest
+from simian.mac import models
+from simian.mac.common import fleet_summary
+
+
+class FleetSummaryModuleTest(basetest.TestCase):
+
+  def setUp(self):
+    super(FleetSummaryModuleTest, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_all_stubs()
+
+    self.now = datetime.datetime(2018, 6, 1, 12, 30, 0)
+    self.hour = fleet_summary.GetHour(self.now)
+
+  def tearDown(self):
+    super(FleetSummaryModuleTest, self).tearDown()
+    self.testbed.deactivate()
+
+  def _GetComputer(self, **kwargs):
+    d = {
+        'active': True, 'os_version': '10.13', 'client_version': '2.3.1',
+        'site': 'NYC', 'track': 'stable', 'connections_on_corp': 2,
+        'connections_off_corp': 1, 'preflight_datetime': self.now,
+        'all_pkgs_installed': True, 'all_apple_updates_installed': False,
+    }
+    d.update(kwargs)
+    return models.Computer(**d)
+
+  def testGetHour(self):
+    self.assertEqual(
+        1, fleet_summary.GetHour(datetime.datetime(1970, 1, 1, 1, 59, 59)))
+
+  def testMerge(self):
+    summary = {'a': 1, 'b': {'c': 2, 'd': 1}}
+    fleet_summary.Merge(summary, {'a': -1, 'b': {'c': 1, 'd': -1}, 'e': 3})
+    self.assertEqual({'b': {'c': 3}, 'e': 3}, summary)
+
+  def testAddComputer(self):
+    summary = {}
+    fleet_summary.AddComputer(summary, self._GetComputer())
+    fleet_summary.AddComputer(summary, self._GetComputer(site='MTV'))
+    fleet_summary.AddComputer(summary, self._GetComputer(active=False))
+
+    self.assertEqual({
+        'hours': {self.hour: {
+            'active': 2, 'all_pkgs_installed': 2, 'tracks': {'stable': 2}}},
+        'os_versions': {'10.13': 2},
+        'client_versions': {'2.3.1': 2},
+        'sites_histogram': {'NYC': 1, 'MTV': 1},
+        'conns_on_corp': 4,
+        'conns_off_corp': 2,
+    }, summary)
+
+  def testAddComputerRemove(self):
+    c = self._GetComputer()
+    summary = {}
+    fleet_summary.AddComputer(summary, c)
+    fleet_summary.AddComputer(summary, c, -1)
+    self.assertEqual({}, summary)
+
+  def testPrune(self):
+    old_hour = self.hour - models.COMPUTER_ACTIVE_DAYS * 24 - 1
+    summary = {'hours': {self.hour: {'active': 1}, old_hour: {'active': 1}}}
+    fleet_summary.Prune(summary, now=self.now)
+    self.assertEqual({'hours': {self.hour: {'active': 1}}}, summary)
+
+  def testUpdate(self):
+    models.ReportsCache.SetFleetSummary({'conns_on_corp': 1})
+    fleet_summary.Update({'conns_on_corp': 2, 'conns_off_corp': 1})
+    self.assertEqual(
+        {'conns_on_corp': 3, 'conns_off_corp': 1},
+        models.ReportsCache.GetFleetSummary()[0])
+
+  def testUpdateHours(self):
+    hour = fleet_summary.GetHour(datetime.datetime.utcnow())
+    models.ReportsCache.SetFleetSummary({'hours': {hour: {'active': 1}}})
+    fleet_summary.Update({'hours': {hour: {'active': 1}}})
+    fleet = models.ReportsCache.GetFleetSummary()[0]
+    self.assertEqual({hour: {'active': 2}}, fleet['hours'])
+
+  def testUpdateWithoutFleetSummary(self):
+    fleet_summary.Update({'conns_on_corp': 2})
+    self.assertEqual(({}, None), models.ReportsCache.GetFleetSummary())
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -34,6 +34,38 @@ class GaeUtilModuleTest(mox.MoxTestBase):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
+  def testBatchDatastoreOpAsync(self):
+    """Test BatchDatastoreOpAsync() issues all batches before waiting."""
+    op_async = self.mox.CreateMockAnything()
+    rpc1 = self.mox.CreateMockAnything()
+    rpc2 = self.mox.CreateMockAnything()
+    op_async([1, 2]).AndReturn(rpc1)
+    op_async([3]).AndReturn(rpc2)
+    rpc1.get_result().AndReturn(['k1', 'k2'])
+    rpc2.get_result().AndReturn(['k3'])
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        [['k1', 'k2'], ['k3']],
+        gae_util.BatchDatastoreOpAsync(op_async, [1, 2, 3], batch_size=2))
+    self.mox.VerifyAll()
+
+  def testBatchDatastoreOpAsyncError(self):
+    """Test BatchDatastoreOpAsync() waits on every batch before raising."""
+    op_async = self.mox.CreateMockAnything()
+    rpc1 = self.mox.CreateMockAnything()
+    rpc2 = self.mox.CreateMockAnything()
+    op_async([1]).AndReturn(rpc1)
+    op_async([2]).AndReturn(rpc2)
+    rpc1.get_result().AndRaise(gae_util.db.Timeout)
+    rpc2.get_result().AndReturn(['k2'])
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        gae_util.db.Timeout,
+        gae_util.BatchDatastoreOpAsync, op_async, [1, 2], batch_size=1)
+    self.mox.VerifyAll()
+
   def testSafeBlobDel(self):
     """Test SafeBlobDel()."""
     self.mox.StubOutWithMock(gae_util.blobstore, 'delete_async')
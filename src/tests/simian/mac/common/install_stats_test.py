@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""install_stats module tests."""
+
+import datetime
+
+import mox
+import stubout
+
+from google.apputils import app
+from google.apputils import basetest
+from simian.mac import models
+from simian.mac.common import fleet_summary
+from simian.mac.common import install_stats
+from simian.mac.common import util
+from tests.simian.mac.common import test
+
+
+class InstallStatsModuleTest(test.AppengineTest, mox.MoxTestBase):
+
+  def setUp(self):
+    test.AppengineTest.setUp(self)
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+    self.now = datetime.datetime(2018, 6, 1, 12, 30, 0)
+    self.hour = fleet_summary.GetHour(self.now)
+
+  def tearDown(self):
+    test.AppengineTest.tearDown(self)
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _GetStats(self, success=0, failure=0, duration=None, applesus=False):
+    return {
+        'install_count': success,
+        'install_fail_count': failure,
+        'applesus': applesus,
+        'duration_count': duration is not None and 1 or 0,
+        'duration_total_seconds': duration or 0,
+    }
+
+  def testMerge(self):
+    stats = {'foo': self._GetStats(success=1, duration=10)}
+    install_stats.Merge(stats, {
+        'foo': self._GetStats(failure=1, applesus=True),
+        'bar': self._GetStats(success=1, applesus=True),
+    })
+    self.assertEqual({
+        'foo': self._GetStats(success=1, failure=1, duration=10),
+        'bar': self._GetStats(success=1, applesus=True),
+    }, stats)
+
+  def testLogInstalls(self):
+    installs = [
+        models.InstallLog(
+            package='foo-1', status='0', mtime=self.now, duration_seconds=10),
+        models.InstallLog(package='foo-1', status='1', mtime=self.now),
+    ]
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.add(mox.Func(lambda t: util.Deserialize(t.payload) == {
+        str(self.hour): {
+            'foo-1': self._GetStats(success=1, failure=1, duration=10)}}))
+
+    self.mox.ReplayAll()
+    install_stats.LogInstalls(installs)
+    self.mox.VerifyAll()
+
+  def testLogInstallsAlreadyBuffered(self):
+    installs = [models.InstallLog(package='foo-1', status='0', mtime=self.now)]
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.add(mox.Func(lambda t: t.name == 'report1')).AndRaise(
+        install_stats.taskqueue.TaskAlreadyExistsError)
+
+    self.mox.ReplayAll()
+    install_stats.LogInstalls(installs, name='report1')
+    self.mox.VerifyAll()
+
+  def testLogInstallsNone(self):
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+
+    self.mox.ReplayAll()
+    install_stats.LogInstalls([])
+    self.mox.VerifyAll()
+
+  def testFlush(self):
+    old_hour = self.hour - install_stats.HOURS_KEPT - 1
+    models.ReportsCache.SetInstallStats(install_stats.HOURS, {
+        old_hour: {'foo': self._GetStats(success=5)},
+    })
+    models.ReportsCache.SetInstallCounts({
+        'foo': {'install_count': 2, 'applesus': False},
+    })
+    tasks = []
+    for stats in [self._GetStats(success=1, duration=10),
+                  self._GetStats(failure=1)]:
+      tasks.append(install_stats.taskqueue.Task(
+          payload=util.Serialize({self.hour: {'foo': stats}}),
+          method='PULL'))
+
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        install_stats.LEASE_SECS, install_stats.FLUSH_MAX).AndReturn(tasks)
+    mock_queue.delete_tasks(tasks)
+
+    self.mox.ReplayAll()
+    install_stats.Flush(now=self.now)
+    self.mox.VerifyAll()
+
+    expected = self._GetStats(success=1, failure=1, duration=10)
+    self.assertEqual(
+        {self.hour: {'foo': expected}},
+        models.ReportsCache.GetInstallStats(install_stats.HOURS)[0])
+    self.assertEqual(
+        {self.hour / 24: {'foo': expected}},
+        models.ReportsCache.GetInstallStats(install_stats.DAYS)[0])
+    self.assertEqual({
+        'foo': {
+            'install_count': 3, 'install_fail_count': 1, 'applesus': False,
+            'duration_count': 1, 'duration_total_seconds': 10,
+            'duration_seconds_avg': 10,
+        }}, models.ReportsCache.GetInstallCounts()[0])
+
+  def testFlushWithoutInstallCounts(self):
+    tasks = [install_stats.taskqueue.Task(
+        payload=util.Serialize({self.hour: {'foo': self._GetStats(1)}}),
+        method='PULL')]
+
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        install_stats.LEASE_SECS, install_stats.FLUSH_MAX).AndReturn(tasks)
+    mock_queue.delete_tasks(tasks)
+
+    self.mox.ReplayAll()
+    install_stats.Flush(install_counts=False, now=self.now)
+    self.mox.VerifyAll()
+
+    self.assertEqual({}, models.ReportsCache.GetInstallCounts()[0])
+
+  def testFlushOnDrained(self):
+    self.stubs.Set(install_stats, 'FLUSH_MAX', 1)
+    tasks = [install_stats.taskqueue.Task(
+        payload=util.Serialize({self.hour: {'foo': self._GetStats(1)}}),
+        method='PULL')]
+    on_drained = self.mox.CreateMockAnything()
+
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(install_stats.LEASE_SECS, 1).AndReturn(tasks)
+    mock_queue.delete_tasks(tasks)
+    mock_queue.lease_tasks(install_stats.LEASE_SECS, 1).AndReturn([])
+    on_drained()
+
+    self.mox.ReplayAll()
+    install_stats.Flush(install_counts=False, now=self.now,
+                        on_drained=on_drained)
+    self.mox.VerifyAll()
+
+    self.assertEqual({}, models.ReportsCache.GetInstallCounts()[0])
+
+  def testFlushRemaining(self):
+    self.stubs.Set(install_stats, 'FLUSH_MAX', 1)
+    self.stubs.Set(install_stats, 'FLUSH_LEASES', 1)
+    tasks = [install_stats.taskqueue.Task(
+        payload=util.Serialize({self.hour: {'foo': self._GetStats(1)}}),
+        method='PULL')]
+
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    self.mox.StubOutWithMock(install_stats.deferred, 'defer')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(install_stats.LEASE_SECS, 1).AndReturn(tasks)
+    mock_queue.delete_tasks(tasks)
+    install_stats.deferred.defer(install_stats.Flush, install_counts=True)
+
+    self.mox.ReplayAll()
+    # not drained, as stats remain.
+    install_stats.Flush(now=self.now, on_drained=self.fail)
+    self.mox.VerifyAll()
+
+    self.assertEqual(
+        {self.hour: {'foo': self._GetStats(1)}},
+        models.ReportsCache.GetInstallStats(install_stats.HOURS)[0])
+
+  def testFlushDeleteFails(self):
+    tasks = [install_stats.taskqueue.Task(
+        payload=util.Serialize({self.hour: {'foo': self._GetStats(1)}}),
+        method='PULL')]
+
+    self.mox.StubOutWithMock(install_stats.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    install_stats.taskqueue.Queue(install_stats.QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        install_stats.LEASE_SECS, install_stats.FLUSH_MAX).AndReturn(tasks)
+    mock_queue.delete_tasks(tasks).AndRaise(
+        install_stats.taskqueue.TransientError)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        install_stats.taskqueue.TransientError, install_stats.Flush,
+        now=self.now)
+    self.mox.VerifyAll()
+
+    self.assertEqual(
+        {}, models.ReportsCache.GetInstallStats(install_stats.HOURS)[0])
+
+  def testGetInstallStats(self):
+    models.ReportsCache.SetInstallStats(install_stats.HOURS, {
+        self.hour: {'foo': self._GetStats(success=1)},
+        self.hour - 1: {'foo': self._GetStats(failure=1)},
+        self.hour - 2: {'bar': self._GetStats(success=1)},
+    })
+    self.assertEqual(
+        {'foo': self._GetStats(success=1, failure=1)},
+        install_stats.GetInstallStats(1, now=self.now))
+
+  def testGetInstallStatsDays(self):
+    day = self.hour / 24
+    models.ReportsCache.SetInstallStats(install_stats.DAYS, {
+        day: {'foo': self._GetStats(success=1)},
+        day - 3: {'foo': self._GetStats(failure=1)},
+        day - 4: {'bar': self._GetStats(success=1)},
+    })
+    self.assertEqual(
+        {'foo': self._GetStats(success=1, failure=1)},
+        install_stats.GetInstallStats(72, now=self.now))
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -123,6 +123,81 @@ class IpModuleTest(mox.MoxTestBase):
           '%s %s expected %s' % (ip, ip_mask, expected))
 
 
+  def testIpToVersionInt(self):
+    """Test IpToVersionInt()."""
+    ip_tests = [
+        ['10.0.0.5', (4, 167772165)],
+        ['::', (6, 0)],
+        ['::1', (6, 1)],
+        ['1::', (6, 1 << 112)],
+        ['2620:0:1003:1007:216:36ff:feee:f090',
+         (6, 0x2620000010031007021636fffeeef090)],
+        ['2620:0:1003::1', (6, 0x26200000100300000000000000000001)],
+        ['64:ff9b::10.0.0.5', (6, 0x0064ff9b00000000000000000a000005)],
+        ['::ffff:10.0.0.5', (4, 167772165)],
+    ]
+
+    for ip_str, expected in ip_tests:
+      self.assertEqual(expected, ipcalc.IpToVersionInt(ip_str), ip_str)
+
+  def testIpToVersionIntWhenInvalid(self):
+    """Test IpToVersionInt() with invalid IPs."""
+    for ip_str in [
+        '', '10.0.0', '10.0.0.256', '10.0.0.-1', '1::2::3', ':1',
+        '1:2:3:4:5:6:7', '1:2:3:4:5:6:7:8::', '12345::', 'g::', '1.2.3.4::']:
+      self.assertRaises(ValueError, ipcalc.IpToVersionInt, ip_str)
+
+  def testIpMaskToRange(self):
+    """Test IpMaskToRange()."""
+    self.assertEqual(
+        (4, self._socket_ip2int('192.168.0.0'),
+         self._socket_ip2int('192.168.1.255')),
+        ipcalc.IpMaskToRange('192.168.1.7/23'))
+    self.assertEqual(
+        (4, self._socket_ip2int('10.0.0.5'), self._socket_ip2int('10.0.0.5')),
+        ipcalc.IpMaskToRange('10.0.0.5'))
+    self.assertEqual(
+        (6, 0x26200000100300000000000000000000,
+         0x262000001003ffffffffffffffffffff),
+        ipcalc.IpMaskToRange('2620:0:1003::/48'))
+    self.assertEqual((6, 0, (1 << 128) - 1), ipcalc.IpMaskToRange('::/0'))
+
+  def testIpMaskToRangeWhenInvalid(self):
+    """Test IpMaskToRange() with invalid masks."""
+    for ip_mask in ['10.0.0.0/33', '10.0.0.0/', '10.0.0.0/x', '::/129']:
+      self.assertRaises(ValueError, ipcalc.IpMaskToRange, ip_mask)
+
+  def testIpMatcher(self):
+    """Test IpMatcher."""
+    matcher = ipcalc.IpMatcher([
+        '10.0.0.0/8', '10.1.0.0/16', '192.168.0.0/25', '192.168.0.128/25',
+        '1.2.3.4', '2620:0:1003::/48', 'invalid', '1.0.0.0/33'])
+    ip_tests = [
+        ['9.255.255.255', False],
+        ['10.0.0.0', True],
+        ['10.1.2.3', True],
+        ['10.255.255.255', True],
+        ['11.0.0.0', False],
+        ['192.168.0.255', True],
+        ['192.168.1.0', False],
+        ['1.2.3.4', True],
+        ['1.2.3.5', False],
+        ['1.0.0.0', False],
+        ['::ffff:10.0.0.1', True],
+        ['2620:0:1003:1007:216:36ff:feee:f090', True],
+        ['2620:0:1004::', False],
+        ['::', False],
+    ]
+
+    for ip, expected in ip_tests:
+      self.assertEqual(expected, matcher.Match(ip), ip)
+    self.assertRaises(ValueError, matcher.Match, '10.0.0.256')
+
+  def testIpMatcherWhenEmpty(self):
+    """Test IpMatcher with no networks."""
+    matcher = ipcalc.IpMatcher([])
+    self.assertFalse(matcher.Match('10.0.0.1'))
+    self.assertFalse(matcher.Match('::1'))
 
 
 def main(unused_argv):
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""regeneration module tests."""
+
+import mox
+import stubout
+
+from google.apputils import app
+from google.apputils import basetest
+from simian.mac.common import regeneration
+from tests.simian.mac.common import test
+
+
+def Regenerate(unused_name):
+  """Regeneration func deferred by the tests."""
+
+
+class RegenerationModuleTest(test.AppengineTest, mox.MoxTestBase):
+
+  def setUp(self):
+    test.AppengineTest.setUp(self)
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+    self.now = 1000.0
+    self.stubs.Set(regeneration.time, 'time', lambda: self.now)
+    self.mox.StubOutWithMock(regeneration.deferred, 'defer')
+
+  def tearDown(self):
+    test.AppengineTest.tearDown(self)
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _ExpectDefer(self, countdown):
+    regeneration.deferred.defer(
+        Regenerate, 'stable',
+        _name=mox.StrContains('regenerate-catalog-stable'),
+        _countdown=countdown)
+
+  def testRequest(self):
+    self._ExpectDefer(1)
+
+    self.mox.ReplayAll()
+    self.assertTrue(regeneration.Request(
+        regeneration.CATALOG, 'stable', Regenerate, 1))
+    self.now += 1
+    self.assertFalse(regeneration.Request(
+        regeneration.CATALOG, 'stable', Regenerate, 1))
+    self.mox.VerifyAll()
+
+    self.assertEqual(
+        {regeneration.REQUESTED: 2, regeneration.SCHEDULED: 1,
+         regeneration.EXECUTED: 0},
+        regeneration.GetStats()[regeneration.CATALOG])
+
+  def testRequestWhenDeferFails(self):
+    regeneration.deferred.defer(
+        Regenerate, 'stable', _name=mox.IgnoreArg(),
+        _countdown=1).AndRaise(regeneration.deferred.Error)
+    self._ExpectDefer(1)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        regeneration.deferred.Error, regeneration.Request,
+        regeneration.CATALOG, 'stable', Regenerate, 1)
+    self.assertTrue(regeneration.Request(
+        regeneration.CATALOG, 'stable', Regenerate, 1))
+    self.mox.VerifyAll()
+
+  def testRequestWhenMemcacheUnavailable(self):
+    self.stubs.Set(regeneration.memcache, 'add', lambda *_, **__: False)
+    regeneration.deferred.defer(
+        Regenerate, 'stable', _name='regenerate-catalog-stable-w200',
+        _countdown=1)
+    regeneration.deferred.defer(
+        Regenerate, 'stable', _name='regenerate-catalog-stable-w200',
+        _countdown=1).AndRaise(regeneration.taskqueue.TaskAlreadyExistsError)
+
+    self.mox.ReplayAll()
+    self.assertTrue(regeneration.Request(
+        regeneration.CATALOG, 'stable', Regenerate, 1))
+    self.now += 1
+    self.assertFalse(regeneration.Request(
+        regeneration.CATALOG, 'stable', Regenerate, 1))
+    self.mox.VerifyAll()
+
+  def testBegin(self):
+    self._ExpectDefer(1)
+    self._ExpectDefer(2)  # the quiet window restarted at the last request.
+    self._ExpectDefer(1)  # requested again after Begin().
+
+    self.mox.ReplayAll()
+    regeneration.Request(regeneration.CATALOG, 'stable', Regenerate, 1)
+    self.now += 3
+    regeneration.Request(regeneration.CATALOG, 'stable', Regenerate, 1)
+    self.now += 3
+    self.assertFalse(
+        regeneration.Begin(regeneration.CATALOG, 'stable', Regenerate))
+    self.now += 2
+    self.assertTrue(
+        regeneration.Begin(regeneration.CATALOG, 'stable', Regenerate))
+    self.assertTrue(regeneration.Request(
+        regeneration.CATALOG, 'stable', Regenerate, 1))
+    self.mox.VerifyAll()
+
+    self.assertEqual(
+        {regeneration.REQUESTED: 3, regeneration.SCHEDULED: 2,
+         regeneration.EXECUTED: 1},
+        regeneration.GetStats()[regeneration.CATALOG])
+
+  def testBeginAfterMaxWait(self):
+    self._ExpectDefer(1)
+
+    self.mox.ReplayAll()
+    regeneration.Request(regeneration.CATALOG, 'stable', Regenerate, 1)
+    for unused_i in xrange(regeneration.MAX_WAIT_SECS):
+      self.now += 1
+      regeneration.Request(regeneration.CATALOG, 'stable', Regenerate, 1)
+    self.assertTrue(
+        regeneration.Begin(regeneration.CATALOG, 'stable', Regenerate))
+    self.mox.VerifyAll()
+
+  def testBeginWithoutRequest(self):
+    """Test Begin() of a task retried after its marker was deleted."""
+    self.mox.StubOutWithMock(regeneration.logging, 'info')
+    regeneration.logging.info(
+        'Regenerating %s %s; stats: %s', regeneration.MANIFEST, 'stable',
+        mox.Func(lambda stats: stats[regeneration.MANIFEST] == {
+            regeneration.REQUESTED: 0, regeneration.SCHEDULED: 0,
+            regeneration.EXECUTED: 1}))
+
+    self.mox.ReplayAll()
+    self.assertTrue(
+        regeneration.Begin(regeneration.MANIFEST, 'stable', Regenerate))
+    self.mox.VerifyAll()
+
+    self.assertEqual(
+        {regeneration.REQUESTED: 0, regeneration.SCHEDULED: 0,
+         regeneration.EXECUTED: 1},
+        regeneration.GetStats()[regeneration.MANIFEST])
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
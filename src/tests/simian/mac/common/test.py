@@ -32,6 +32,7 @@ from google.apputils import basetest
 
 from tests.simian.mac.common import test_base as test_base
 from simian import settings
+from simian.mac import models
 from simian.mac.common import auth
 
 
@@ -55,6 +56,7 @@ class AppengineTest(basetest.TestCase):
         DEFAULT_VERSION_HOSTNAME='example.appspot.com')
 
     self.testbed.init_all_stubs()
+    models.Settings.ClearCache()
 
   def tearDown(self):
     super(AppengineTest, self).tearDown()
@@ -93,6 +95,7 @@ class RequestHandlerTest(test_base.RequestHandlerTest):
     self.testbed.init_taskqueue_stub()
     self.testbed.init_user_stub()
     self.testbed.init_mail_stub()
+    models.Settings.ClearCache()
     settings.ADMINS = ['admin@example.com']
 
   def tearDown(self):
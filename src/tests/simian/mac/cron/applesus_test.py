@@ -409,6 +409,16 @@ class AppleSUSAutoPromoteTest(test.AppengineTest):
     self.assertTrue(applesus.common.STABLE in promote_stable_product.tracks)
 
 
+class AppleSUSCatalogBackupCleanupTest(basetest.TestCase):
+
+  def testGet(self):
+    with mock.patch.object(
+        applesus.applesus, 'CleanupAppleSUSCatalogBackups') as cleanup_mock:
+      applesus.AppleSUSCatalogBackupCleanup().get()
+
+    cleanup_mock.assert_called_once_with()
+
+
 logging.disable(logging.ERROR)
 
 
@@ -82,6 +82,18 @@ class AuthSessionCleanupTest(basetest.TestCase):
     self.assertEqual(valid_session_name, sessions[0].key().name())
 
 
+class FlushClientConnectionsTest(basetest.TestCase):
+
+  @mock.patch.object(maint.deferred, 'defer')
+  def testGet(self, defer_mock):
+    """Test get()."""
+    maint.FlushClientConnections().get()
+
+    defer_mock.assert_called_once_with(
+        maint.munki_common.FlushClientConnections,
+        _queue=maint.munki_common.CLIENT_CONNECTION_FLUSH_QUEUE)
+
+
 class UpdateAverageInstallDurationsTest(test.RequestHandlerTest):
 
   def GetTestClassInstance(self):
@@ -586,6 +586,29 @@ class ReportsCacheCleanupTest(test.AppengineTest, mox.MoxTestBase):
 
   def testGenerateInstallCounts(self):
     """Test _GenerateInstallCounts()."""
+    self.mox.StubOutWithMock(reports_cache.install_stats, 'Flush')
+    self.mox.StubOutWithMock(reports_cache, '_RebuildInstallCounts')
+    reports_cache.install_stats.Flush(install_counts=True)
+
+    self.mox.ReplayAll()
+    reports_cache._GenerateInstallCounts()
+    self.mox.VerifyAll()
+
+  def testGenerateInstallCountsWhileRebuilding(self):
+    """Test _GenerateInstallCounts() while install counts are rebuilt."""
+    models.KeyValueCache(
+        key_name=reports_cache.INSTALL_COUNTS_CURSOR_NAME).put()
+    self.mox.StubOutWithMock(reports_cache.install_stats, 'Flush')
+    self.mox.StubOutWithMock(reports_cache, '_RebuildInstallCounts')
+    reports_cache.install_stats.Flush(install_counts=False)
+    reports_cache._RebuildInstallCounts()
+
+    self.mox.ReplayAll()
+    reports_cache._GenerateInstallCounts()
+    self.mox.VerifyAll()
+
+  def testRebuildInstallCounts(self):
+    """Test _RebuildInstallCounts()."""
     install_counts = {
         'foo': {
             'install_count': 2,
@@ -669,7 +692,7 @@ class ReportsCacheCleanupTest(test.AppengineTest, mox.MoxTestBase):
     mock_cursor_obj = self.mox.CreateMockAnything()
     mock_cursor_obj.text_value = 'foocursor'
     reports_cache.models.KeyValueCache.get_by_key_name(
-        'pkgs_list_cursor').AndReturn(mock_cursor_obj)
+        reports_cache.INSTALL_COUNTS_CURSOR_NAME).AndReturn(mock_cursor_obj)
     mock_query.with_cursor(mock_cursor_obj.text_value)
     mock_query.fetch(1000).AndReturn(new_installs)
 
@@ -679,12 +702,45 @@ class ReportsCacheCleanupTest(test.AppengineTest, mox.MoxTestBase):
 
     self.mox.StubOutWithMock(reports_cache.deferred, 'defer')
     reports_cache.deferred.defer(
-        reports_cache._GenerateInstallCounts).AndReturn(None)
+        reports_cache._RebuildInstallCounts).AndReturn(None)
 
     self.mox.ReplayAll()
-    reports_cache._GenerateInstallCounts()
+    reports_cache._RebuildInstallCounts()
     self.mox.VerifyAll()
 
+  def testRebuildInstallCountsComplete(self):
+    """Test _RebuildInstallCounts() ends the rebuild when all are counted."""
+    models.KeyValueCache(
+        key_name=reports_cache.INSTALL_COUNTS_CURSOR_NAME).put()
+    models.ReportsCache.SetInstallCounts({'foo': {'install_count': 1}})
+    flushes = []
+
+    def Flush(install_counts, on_drained):
+      flushes.append(install_counts)
+      on_drained()
+    self.stubs.Set(reports_cache.install_stats, 'Flush', Flush)
+
+    reports_cache._RebuildInstallCounts()
+
+    # buffered stats of counted installs are not added to install counts.
+    self.assertEqual([False], flushes)
+    self.assertFalse(reports_cache._IsRebuildingInstallCounts())
+    self.assertEqual(
+        {'foo': {'install_count': 1}},
+        models.ReportsCache.GetInstallCounts()[0])
+
+  def testRebuildInstallCountsCompleteWhenStatsRemain(self):
+    """Test _RebuildInstallCounts() continues while stats are buffered."""
+    models.KeyValueCache(
+        key_name=reports_cache.INSTALL_COUNTS_CURSOR_NAME).put()
+    self.stubs.Set(
+        reports_cache.install_stats, 'Flush',
+        lambda install_counts, on_drained: None)
+
+    reports_cache._RebuildInstallCounts()
+
+    self.assertTrue(reports_cache._IsRebuildingInstallCounts())
+
   def testGenerateTrendingInstallsCache(self):
     """Tests _GenerateTrendingInstallsCache."""
     package1_name = 'package1'
@@ -709,25 +765,65 @@ class ReportsCacheCleanupTest(test.AppengineTest, mox.MoxTestBase):
         },
     }
 
-    for i in range(10):
-      models.InstallLog(package=package1_name, status='0').put()
-      models.InstallLog(package=package1_name, status='1').put()
-      models.InstallLog(package=package2_name, status='-1').put()
-      if i % 2:
-        models.InstallLog(package=package3_name, status='-1').put()
-        models.InstallLog(package=package4_name, status='0').put()
+    self.mox.StubOutWithMock(reports_cache.install_stats, 'Flush')
+    reports_cache.install_stats.Flush(install_counts=True)
+    self.mox.StubOutWithMock(reports_cache.install_stats, 'GetInstallStats')
+    reports_cache.install_stats.GetInstallStats(1).AndReturn({
+        u'package1': {'install_count': 10, 'install_fail_count': 10},
+        u'package2': {'install_count': 0, 'install_fail_count': 10},
+        u'package3': {'install_count': 0, 'install_fail_count': 5},
+        u'package4': {'install_count': 5, 'install_fail_count': 0},
+    })
 
+    self.mox.ReplayAll()
     reports_cache._GenerateTrendingInstallsCache(1)
+    self.mox.VerifyAll()
+
+    self.assertEqual(
+        expected_trending,
+        reports_cache.models.ReportsCache.GetTrendingInstalls(1)[0])
+
+  def testGeneratePendingCounts(self):
+    """Tests _GeneratePendingCounts()."""
+    models.Computer(
+        key_name='uuid1', active=True, pkgs_to_install=['FooApp1', 'FooApp2']
+        ).put(update_active=False)
+    models.Computer(
+        key_name='uuid2', active=True, pkgs_to_install=['FooApp1']
+        ).put(update_active=False)
+    models.Computer(
+        key_name='uuid3', active=False, pkgs_to_install=['FooApp1']
+        ).put(update_active=False)
+    models.Computer(
+        key_name='uuid4', active=True, pkgs_to_install=[]
+        ).put(update_active=False)
+
+    reports_cache._GeneratePendingCounts()
+
+    self.assertEqual(
+        {'FooApp1': 2, 'FooApp2': 1},
+        models.ReportsCache.GetPendingCounts()[0])
+
+  def testGeneratePendingCountsResumes(self):
+    """Tests _GeneratePendingCounts() defers itself after RUNTIME_MAX_SECS."""
+    for i in xrange(3):
+      models.Computer(
+          key_name='uuid%d' % i, active=True, pkgs_to_install=['FooApp1']
+          ).put(update_active=False)
+    self.stubs.Set(reports_cache, 'PENDING_COUNTS_FETCH_LIMIT', 2)
+    self.stubs.Set(reports_cache, 'RUNTIME_MAX_SECS', -1)
+
+    reports_cache._GeneratePendingCounts()
 
     taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
     tasks = taskqueue_stub.get_filtered_tasks()
     self.assertEqual(1, len(tasks))
+    self.assertEqual({}, models.ReportsCache.GetPendingCounts()[0])
+    self.stubs.Set(reports_cache, 'RUNTIME_MAX_SECS', 30)
     deferred.run(tasks[0].payload)
-    self.assertEqual(1, len(taskqueue_stub.get_filtered_tasks()))
 
     self.assertEqual(
-        expected_trending,
-        reports_cache.models.ReportsCache.GetTrendingInstalls(1)[0])
+        {'FooApp1': 3}, models.ReportsCache.GetPendingCounts()[0])
 
   def testGenerateComputersSummaryCache(self):
     today = datetime.datetime.utcnow()
@@ -747,8 +843,9 @@ class ReportsCacheCleanupTest(test.AppengineTest, mox.MoxTestBase):
     deferred.run(tasks[0].payload)
     self.assertEqual(1, len(taskqueue_stub.get_filtered_tasks()))
 
-    self.assertEqual(
-        100, models.ReportsCache.GetStatsSummary()[0]['conns_off_corp'])
+    fleet = models.ReportsCache.GetFleetSummary()[0]
+    self.assertEqual(100, fleet['conns_off_corp'])
+    self.assertEqual({'MTV': 1}, fleet['sites_histogram'])
 
 
 logging.basicConfig(filename='/dev/null')
@@ -437,8 +437,10 @@ class BaseManifestModificationTest(mox.MoxTestBase):
     mod_type_cls = models.MANIFEST_MOD_MODELS[mod_type]
 
     self.mox.StubOutWithMock(mod_type_cls, 'DeleteMemcacheWrappedGetAllFilter')
+    self.mox.StubOutWithMock(models.BaseManifestModification, 'BumpModsVersion')
     mod_type_cls.DeleteMemcacheWrappedGetAllFilter(
-        (('%s =' % mod_type, target),)).AndReturn(None)
+        (('%s =' % mod_type_cls.TARGET_PROPERTY_NAME, target),)).AndReturn(None)
+    models.BaseManifestModification.BumpModsVersion().AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertTrue(mod_type_invalid not in models.MANIFEST_MOD_MODELS)
@@ -458,6 +460,7 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.stubs = stubout.StubOutForTesting()
     self.cls = models.KeyValueCache
     self.key = 'example_ip_blocks'
+    models._IP_MATCHERS.clear()
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -468,17 +471,34 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.assertEqual(False, self.cls.IpInList(self.key, ''))
     self.assertEqual(False, self.cls.IpInList(self.key, None))
 
+  def _ExpectIpList(self, deserialized, mtime=1):
+    """Expects IpInList() to compile an IP list."""
+    entity = self.mox.CreateMockAnything()
+    entity.text_value = 'serialized'
+    entity.mtime = mtime
+    self.cls.MemcacheWrappedGet(self.key, 'mtime').AndReturn(mtime)
+    self.cls.MemcacheWrappedGet(self.key).AndReturn(entity)
+    models.util.Deserialize('serialized').AndReturn(deserialized)
+
   def testIpInListWhenIpNotInEmptyList(self):
     """Tests IpInList() with an IP that will not match an empty list."""
     self.mox.StubOutWithMock(models.util, 'Deserialize')
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
 
     ip = '1.2.3.4'
-    deserialized = []
+    self._ExpectIpList([])
 
-    self.cls.MemcacheWrappedGet(
-        self.key, 'text_value').AndReturn('serialized')
-    models.util.Deserialize('serialized').AndReturn(deserialized)
+    self.mox.ReplayAll()
+    self.assertFalse(self.cls.IpInList(self.key, ip))
+    self.mox.VerifyAll()
+
+  def testIpInListWhenNoEntity(self):
+    """Tests IpInList() when the list entity does not exist."""
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+
+    ip = '1.2.3.4'
+
+    self.cls.MemcacheWrappedGet(self.key, 'mtime').AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertFalse(self.cls.IpInList(self.key, ip))
@@ -490,8 +510,11 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
 
     ip = '1.2.3.4'
+    entity = self.mox.CreateMockAnything()
+    entity.text_value = ''
 
-    self.cls.MemcacheWrappedGet(self.key, 'text_value').AndReturn('')
+    self.cls.MemcacheWrappedGet(self.key, 'mtime').AndReturn(1)
+    self.cls.MemcacheWrappedGet(self.key).AndReturn(entity)
 
     self.mox.ReplayAll()
     self.assertFalse(self.cls.IpInList(self.key, ip))
@@ -503,11 +526,7 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
 
     ip = '1.2.3.4'
-    deserialized = ['192.168.0.0/16']
-
-    self.cls.MemcacheWrappedGet(
-        self.key, 'text_value').AndReturn('serialized')
-    models.util.Deserialize('serialized').AndReturn(deserialized)
+    self._ExpectIpList(['192.168.0.0/16'])
 
     self.mox.ReplayAll()
     self.assertFalse(self.cls.IpInList(self.key, ip))
@@ -519,11 +538,7 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
 
     ip = '1.2.3.4'
-    deserialized = ['192.168.0.0/16', '1.0.0.0/8']
-
-    self.cls.MemcacheWrappedGet(
-        self.key, 'text_value').AndReturn('serialized')
-    models.util.Deserialize('serialized').AndReturn(deserialized)
+    self._ExpectIpList(['192.168.0.0/16', '1.0.0.0/8'])
 
     self.mox.ReplayAll()
     self.assertTrue(self.cls.IpInList(self.key, ip))
@@ -531,10 +546,53 @@ class KeyValueCacheTest(mox.MoxTestBase):
 
   def testIpInListWhenIpv6(self):
     """Tests IpInList() with an IPv6 IP."""
+    self.mox.StubOutWithMock(models.util, 'Deserialize')
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+
     ip = '2620:0:1003:1007:216:36ff:feee:f090'
+    self._ExpectIpList(['1.0.0.0/8', '2620:0:1003::/48'])
 
     self.mox.ReplayAll()
-    self.assertFalse(self.cls.IpInList(self.key, ip))
+    self.assertTrue(self.cls.IpInList(self.key, ip))
+    self.mox.VerifyAll()
+
+  def testIpInListWhenInvalidIp(self):
+    """Tests IpInList() with an invalid IP."""
+    self.mox.StubOutWithMock(models.util, 'Deserialize')
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+
+    self._ExpectIpList(['1.0.0.0/8'])
+
+    self.mox.ReplayAll()
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.400'))
+    self.mox.VerifyAll()
+
+  def testIpInListCachesMatcher(self):
+    """Tests IpInList() only compiles the list again once mtime changes."""
+    self.mox.StubOutWithMock(models.util, 'Deserialize')
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+
+    self._ExpectIpList(['1.0.0.0/8'], mtime=1)
+    self.cls.MemcacheWrappedGet(self.key, 'mtime').AndReturn(1)
+    self._ExpectIpList(['2.0.0.0/8'], mtime=2)
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.cls.IpInList(self.key, '1.2.3.4'))
+    self.assertTrue(self.cls.IpInList(self.key, '1.2.3.5'))
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.4'))
+    self.mox.VerifyAll()
+
+  def testMemcacheWrappedSet(self):
+    """Tests MemcacheWrappedSet() deletes the memcached mtime."""
+    self.mox.StubOutWithMock(models.BaseModel, 'MemcacheWrappedSet')
+    self.mox.StubOutWithMock(self.cls, 'DeleteMemcacheWrap')
+
+    models.BaseModel.MemcacheWrappedSet(
+        self.key, 'text_value', 'value', memcache_secs=models.MEMCACHE_SECS)
+    self.cls.DeleteMemcacheWrap(self.key, prop_name='mtime')
+
+    self.mox.ReplayAll()
+    self.cls.MemcacheWrappedSet(self.key, 'text_value', 'value')
     self.mox.VerifyAll()
 
 
@@ -568,6 +626,277 @@ class KValueCacheTest(basetest.TestCase):
 
     self.assertEqual(value, models.KeyValueCache.GetSerializedItem(key)[0])
 
+  def testUpdatePendingCounts(self):
+    models.ReportsCache.SetPendingCounts({'a': 2, 'b': 1})
+
+    models.ReportsCache.UpdatePendingCounts({'a': -1, 'b': -2, 'c': 1})
+
+    self.assertEqual(
+        {'a': 1, 'b': 0, 'c': 1}, models.ReportsCache.GetPendingCounts()[0])
+
+
+class MemcacheWrappedGetAllFilterMultiTest(basetest.TestCase):
+
+  def setUp(self):
+    super(MemcacheWrappedGetAllFilterMultiTest, self).setUp()
+
+    self.testbed = testbed.Testbed()
+
+    self.testbed.activate()
+    self.testbed.setup_env(
+        overwrite=True,
+        USER_EMAIL='user@example.com',
+        USER_ID='123',
+        USER_IS_ADMIN='0',
+        DEFAULT_VERSION_HOSTNAME='example.appspot.com')
+
+    self.testbed.init_all_stubs()
+
+  def tearDown(self):
+    super(MemcacheWrappedGetAllFilterMultiTest, self).tearDown()
+    self.testbed.deactivate()
+
+  def testMemcacheWrappedGetAllFilterMulti(self):
+    models.SiteManifestModification(
+        key_name='foosite##foopkg', site='foosite', value='foopkg').put()
+    models.OwnerManifestModification(
+        key_name='foouser##barpkg', owner='foouser', value='barpkg').put()
+    lookups = [
+        (models.SiteManifestModification, (('site =', 'foosite'),)),
+        (models.OwnerManifestModification, (('owner =', 'foouser'),)),
+        (models.OwnerManifestModification, (('owner =', 'nobody'),)),
+    ]
+
+    results, rpcs = models.BaseModel.MemcacheWrappedGetAllFilterMulti(lookups)
+    self.assertEqual(
+        [['foopkg'], ['barpkg'], []],
+        [[e.value for e in entities] for entities in results])
+    # get_multi, three concurrent queries and set_multi.
+    self.assertEqual(5, rpcs)
+
+    results, rpcs = models.BaseModel.MemcacheWrappedGetAllFilterMulti(lookups)
+    self.assertEqual(
+        [['foopkg'], ['barpkg'], []],
+        [[e.value for e in entities] for entities in results])
+    self.assertEqual(1, rpcs)
+    self.assertEqual(
+        ['barpkg'],
+        [e.value for e in models.OwnerManifestModification.
+         MemcacheWrappedGetAllFilter((('owner =', 'foouser'),))])
+
+  def testMemcacheWrappedGetAllFilterMultiEmpty(self):
+    self.assertEqual(
+        ([], 0), models.BaseModel.MemcacheWrappedGetAllFilterMulti([]))
+
+
+class NameIndexTest(basetest.TestCase):
+
+  def setUp(self):
+    super(NameIndexTest, self).setUp()
+
+    self.testbed = testbed.Testbed()
+
+    self.testbed.activate()
+    self.testbed.setup_env(
+        overwrite=True,
+        USER_EMAIL='user@example.com',
+        USER_ID='123',
+        USER_IS_ADMIN='0',
+        DEFAULT_VERSION_HOSTNAME='example.appspot.com')
+
+    self.testbed.init_all_stubs()
+
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    super(NameIndexTest, self).tearDown()
+    self.testbed.deactivate()
+    self.stubs.UnsetAll()
+
+  def testGetAllTagNamesForKey(self):
+    key1 = models.db.Key.from_path('Computer', 'uuid1')
+    key2 = models.db.Key.from_path('Computer', 'uuid2')
+    models.Tag(key_name='tag1', keys=[key1]).put()
+
+    # the index is built from a query on first read.
+    self.assertEqual(['tag1'], models.Tag.GetAllTagNamesForKey(key1))
+    self.assertEqual([], models.Tag.GetAllTagNamesForKey(key2))
+    self.assertEqual(
+        ['tag1'], models.KeyTagIndex.get_by_key_name(str(key1)).names)
+
+    models.Tag(key_name='tag2', keys=[key1, key2]).put()
+    self.assertEqual(['tag1', 'tag2'], models.Tag.GetAllTagNamesForKey(key1))
+    self.assertEqual(['tag2'], models.Tag.GetAllTagNamesForKey(key2))
+
+    t = models.Tag.get_by_key_name('tag2')
+    t.keys.remove(key1)
+    t.put()
+    self.assertEqual(['tag1'], models.Tag.GetAllTagNamesForKey(key1))
+    self.assertEqual(['tag2'], models.Tag.GetAllTagNamesForKey(key2))
+
+    t.delete()
+    self.assertEqual([], models.Tag.GetAllTagNamesForKey(key2))
+
+  def testGetAllGroupNamesForUser(self):
+    models.Group(key_name='group1', users=['user1']).put()
+    self.assertEqual(['group1'], models.Group.GetAllGroupNamesForUser('user1'))
+    self.assertEqual([], models.Group.GetAllGroupNamesForUser('user2'))
+
+    # put of a new entity replacing an existing one.
+    models.Group(key_name='group1', users=['user2']).put()
+    self.assertEqual([], models.Group.GetAllGroupNamesForUser('user1'))
+    self.assertEqual(['group1'], models.Group.GetAllGroupNamesForUser('user2'))
+
+    models.Group.get_by_key_name('group1').delete()
+    self.assertEqual([], models.Group.GetAllGroupNamesForUser('user2'))
+
+  def testGetNamesAppliesUpdatesMissingFromQuery(self):
+    """Test an index built from a stale query gets updates made meanwhile."""
+    models.Group(key_name='group1', users=['user1']).put()
+    models.Group(key_name='group2', users=['user2']).put()
+    models.Group(key_name='group2', users=['user1']).put()
+    index = models.UserGroupIndex.get_by_key_name('user1')
+    self.assertFalse(index.built)
+
+    # a query from before the puts of group2, without group1.
+    query = [models.db.Key.from_path('Group', 'group3')]
+    self.assertEqual(
+        ['group3', 'group1', 'group2'],
+        models.UserGroupIndex.GetNames('user1', query))
+    self.assertTrue(models.UserGroupIndex.get_by_key_name('user1').built)
+
+    models.Group(key_name='group1', users=[]).put()
+    self.assertEqual(
+        ['group3', 'group2'], models.UserGroupIndex.GetNames('user1', []))
+    # the removal recorded for user2 hides the stale query result.
+    self.assertEqual(
+        [], models.UserGroupIndex.GetNames(
+            'user2', [models.db.Key.from_path('Group', 'group2')]))
+
+  def testUpdateNamesTaskDeletesMemcacheWrap(self):
+    """Test _UpdateNamesTask() deletes the cached index entities."""
+    self.stubs.Set(models, 'NAME_INDEX_TRANSACTION_SIZE', 1)
+    models.Group(key_name='group1', users=['u1', 'u2']).put()
+    keys = [
+        models.UserGroupIndex._GetMemcacheWrapKey(key_name)
+        for key_name in ['u1', 'u2']]
+    self.assertEqual('mwg_UserGroupIndex_u1', keys[0])
+    models.memcache.set_multi(dict((key, 'stale') for key in keys))
+
+    models.UserGroupIndex._UpdateNamesTask('group1', ['u1', 'u2'])
+
+    self.assertEqual({}, models.memcache.get_multi(keys))
+
+  def testUpdateNamesDefersLargeUpdates(self):
+    """Test UpdateNames() defers the update of many index entities."""
+    self.stubs.Set(models, 'NAME_INDEX_INLINE_SIZE', 1)
+    self.stubs.Set(models, 'NAME_INDEX_TASK_SIZE', 2)
+    deferred_calls = []
+    self.stubs.Set(
+        models.deferred, 'defer',
+        lambda *args, **kwargs: deferred_calls.append(args))
+
+    models.Group(key_name='group1', users=['u1', 'u2', 'u3']).put()
+    self.assertEqual(
+        [(models.UserGroupIndex._UpdateNamesTask, 'group1', ['u1', 'u2']),
+         (models.UserGroupIndex._UpdateNamesTask, 'group1', ['u3'])],
+        deferred_calls)
+    self.assertEqual(None, models.UserGroupIndex.get_by_key_name('u1'))
+
+    for args in deferred_calls:
+      args[0](*args[1:])
+    self.assertEqual(
+        ['group1'], models.UserGroupIndex.GetNames('u3', []))
+
+
+class _PlistModel(models.BasePlistModel):
+  """BasePlistModel for tests."""
+
+
+class BasePlistModelTest(basetest.TestCase):
+
+  def setUp(self):
+    super(BasePlistModelTest, self).setUp()
+
+    self.testbed = testbed.Testbed()
+
+    self.testbed.activate()
+    self.testbed.setup_env(
+        overwrite=True,
+        USER_EMAIL='user@example.com',
+        USER_ID='123',
+        USER_IS_ADMIN='0',
+        DEFAULT_VERSION_HOSTNAME='example.appspot.com')
+
+    self.testbed.init_all_stubs()
+
+    # not formatted like GetXml() output, to detect serialization.
+    self.xml = (
+        '<plist version="1.0"><dict><key>foo</key><string>bar</string>'
+        '<key>list</key><array><integer>1</integer></array></dict></plist>')
+    e = _PlistModel(key_name='p')
+    e.plist = self.xml
+    e.put()
+
+  def tearDown(self):
+    super(BasePlistModelTest, self).tearDown()
+    self.testbed.deactivate()
+
+  def testPutPlistNotAccessed(self):
+    e = _PlistModel.get_by_key_name('p')
+    e.put()
+
+    self.assertFalse(hasattr(e, '_plist_obj'))
+    self.assertEqual(self.xml, _PlistModel.get_by_key_name('p').plist_xml)
+
+  def testPutPlistAccessed(self):
+    e = _PlistModel.get_by_key_name('p')
+    self.assertEqual('bar', e.plist['foo'])
+    e.put()
+
+    self.assertEqual(
+        models.plist_lib.GetXmlDocument({'foo': 'bar', 'list': [1]}),
+        _PlistModel.get_by_key_name('p').plist_xml)
+
+  def testPutPlistChanged(self):
+    e = _PlistModel.get_by_key_name('p')
+    e.plist['foo'] = 'zoo'
+    e.put()
+
+    self.assertEqual(
+        models.plist_lib.GetXmlDocument({'foo': 'zoo', 'list': [1]}),
+        _PlistModel.get_by_key_name('p').plist_xml)
+
+  def testPutPlistContentsChanged(self):
+    e = _PlistModel.get_by_key_name('p')
+    e.plist.GetContents()['list'].append(2)
+    e.plist.SetChanged()
+    e.put()
+
+    self.assertEqual(
+        models.plist_lib.GetXmlDocument({'foo': 'bar', 'list': [1, 2]}),
+        _PlistModel.get_by_key_name('p').plist_xml)
+
+  def testPutPlistNestedValueChanged(self):
+    e = _PlistModel.get_by_key_name('p')
+    e.plist.GetXml()
+    nested = e.plist.GetContents()['list']
+    e.plist.GetXml()
+    nested.append(2)
+    e.put()
+
+    self.assertEqual(
+        models.plist_lib.GetXmlDocument({'foo': 'bar', 'list': [1, 2]}),
+        _PlistModel.get_by_key_name('p').plist_xml)
+
+  def testPutWithoutPlist(self):
+    e = _PlistModel(key_name='empty')
+    e.put()
+
+    self.assertEqual(
+        models.plist_lib.PLIST_HEAD + models.plist_lib.PLIST_FOOT,
+        _PlistModel.get_by_key_name('empty').plist_xml)
+
 
 def main(unused_argv):
   basetest.main()
@@ -49,44 +49,46 @@ class CatalogTest(mox.MoxTestBase, test.AppengineTest):
   def testGenerateAsync(self):
     """Tests calling Generate(delay=2)."""
     name = 'catalogname'
-    utcnow = datetime.datetime(2010, 9, 2, 19, 30, 21, 377827)
-    self.mox.StubOutWithMock(datetime, 'datetime')
-    self.stubs.Set(models.deferred, 'defer', self.mox.CreateMockAnything())
-    deferred_name = 'create-catalog-%s-%s' % (
-        name, '2010-09-02-19-30-21-377827')
-    models.datetime.datetime.utcnow().AndReturn(utcnow)
-    models.deferred.defer(
-        models.Catalog.Generate, name, _name=deferred_name, _countdown=2)
+    self.mox.StubOutWithMock(models.regeneration, 'Request')
+    models.regeneration.Request(
+        models.regeneration.CATALOG, name, models.Catalog.GenerateRequested, 2)
     self.mox.ReplayAll()
     models.Catalog.Generate(name, delay=2)
     self.mox.VerifyAll()
 
+  def testGenerateRequested(self):
+    """Tests GenerateRequested() generates once requests are coalesced."""
+    self.mox.StubOutWithMock(models.regeneration, 'Begin')
+    self.mox.StubOutWithMock(models.Catalog, 'Generate')
+    for name, begin in [('waiting', False), ('ready', True)]:
+      models.regeneration.Begin(
+          models.regeneration.CATALOG, name,
+          models.Catalog.GenerateRequested).AndReturn(begin)
+    models.Catalog.Generate('ready')
+    self.mox.ReplayAll()
+    models.Catalog.GenerateRequested('waiting')
+    models.Catalog.GenerateRequested('ready')
+    self.mox.VerifyAll()
+
   def testGenerateSuccess(self):
     """Tests the success path for Generate()."""
     name = 'goodname'
     plist1 = '<dict><key>foo</key><string>bar</string></dict>'
-    mock_plist1 = self.mox.CreateMockAnything()
-    pkg1 = test.GenericContainer(
-        plist=mock_plist1, name='foo', mtime=datetime.datetime.utcnow())
     plist2 = '<dict><key>foo</key><string>bar</string></dict>'
-    mock_plist2 = self.mox.CreateMockAnything()
-    pkg2 = test.GenericContainer(
-        plist=mock_plist2, name='bar', mtime=datetime.datetime.utcnow())
 
     self.mox.StubOutWithMock(models.Manifest, 'Generate')
-    self.mox.StubOutWithMock(models.PackageInfo, 'all')
+    self.mox.StubOutWithMock(models.Catalog, '_GetPackageInfoFragments')
     self.mox.StubOutWithMock(models.Catalog, 'get_or_insert')
     self.mox.StubOutWithMock(models.Catalog, 'DeleteMemcacheWrap')
 
-    mock_model = self.mox.CreateMockAnything()
-    models.PackageInfo.all().AndReturn(mock_model)
-    mock_model.filter('catalogs =', name).AndReturn(mock_model)
-    mock_model.fetch(None).AndReturn([pkg1, pkg2])
-    pkg1.plist.GetXmlContent(indent_num=1).AndReturn(plist1)
-    pkg2.plist.GetXmlContent(indent_num=1).AndReturn(plist2)
+    models.Catalog._GetPackageInfoFragments(name).AndReturn([
+        {'name': 'foo', 'mtime': datetime.datetime.utcnow(), 'xml': plist1},
+        {'name': 'bar', 'mtime': datetime.datetime.utcnow(), 'xml': plist2},
+    ])
 
     mock_catalog = self.mox.CreateMockAnything()
     models.Catalog.get_or_insert(name).AndReturn(mock_catalog)
+    mock_catalog.SetCompressedVariant(mox.IgnoreArg())
     mock_catalog.put(avoid_mtime_update=True).AndReturn(None)
 
     models.Catalog.DeleteMemcacheWrap(name).AndReturn(None)
@@ -115,17 +117,15 @@ class CatalogTest(mox.MoxTestBase, test.AppengineTest):
     """Tests Catalog.Generate() where no coorresponding PackageInfo exist."""
     name = 'emptyname'
     self.mox.StubOutWithMock(models.Manifest, 'Generate')
-    self.mox.StubOutWithMock(models.PackageInfo, 'all')
+    self.mox.StubOutWithMock(models.Catalog, '_GetPackageInfoFragments')
     self.mox.StubOutWithMock(models.Catalog, 'get_or_insert')
     self.mox.StubOutWithMock(models.Catalog, 'DeleteMemcacheWrap')
 
-    mock_model = self.mox.CreateMockAnything()
-    models.PackageInfo.all().AndReturn(mock_model)
-    mock_model.filter('catalogs =', name).AndReturn(mock_model)
-    mock_model.fetch(None).AndReturn([])
+    models.Catalog._GetPackageInfoFragments(name).AndReturn([])
 
     mock_catalog = self.mox.CreateMockAnything()
     models.Catalog.get_or_insert(name).AndReturn(mock_catalog)
+    mock_catalog.SetCompressedVariant(mox.IgnoreArg())
     mock_catalog.put(avoid_mtime_update=True).AndReturn(None)
 
     models.Catalog.DeleteMemcacheWrap(name).AndReturn(None)
@@ -139,17 +139,30 @@ class CatalogTest(mox.MoxTestBase, test.AppengineTest):
     self.assertEqual(mock_catalog.package_names, [])
     self.mox.VerifyAll()
 
+  def testSetCompressedVariant(self):
+    """Tests SetCompressedVariant()."""
+    catalog_xml = u'<plist><string>\u00e9</string></plist>'
+    c = models.Catalog(key_name='name', name='name')
+    c.SetCompressedVariant(catalog_xml)
+
+    utf8_xml = catalog_xml.encode('utf-8')
+    self.assertEqual(
+        models.hashlib.sha256(utf8_xml).hexdigest(), c.plist_sha256)
+    self.assertEqual(
+        utf8_xml,
+        models.gzip.GzipFile(
+            fileobj=models.StringIO.StringIO(c.plist_gzip)).read())
+
+    self.stubs.Set(models, 'CATALOG_GZIP_MAX_BYTES', len(utf8_xml))
+    c.SetCompressedVariant(catalog_xml)
+    self.assertEqual(None, c.plist_gzip)
+
   def testGenerateWithPlistParseError(self):
     """Tests Generate() where plist.GetXmlDocument() raises plist.Error."""
     name = 'goodname'
-    mock_plist1 = self.mox.CreateMockAnything()
-    pkg1 = test.GenericContainer(plist=mock_plist1, name='foo')
-    mock_model = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(models.PackageInfo, 'all')
-    models.PackageInfo.all().AndReturn(mock_model)
-    mock_model.filter('catalogs =', name).AndReturn(mock_model)
-    mock_model.fetch(None).AndReturn([pkg1])
-    mock_plist1.GetXmlContent(indent_num=1).AndRaise(models.plist_lib.Error)
+    self.mox.StubOutWithMock(models.Catalog, '_GetPackageInfoFragments')
+    models.Catalog._GetPackageInfoFragments(name).AndRaise(
+        models.plist_lib.Error)
 
     self.mox.ReplayAll()
     self.assertRaises(
@@ -160,25 +173,18 @@ class CatalogTest(mox.MoxTestBase, test.AppengineTest):
     """Tests Generate() where put() raises db.Error."""
     name = 'goodname'
     plist1 = '<plist><dict><key>foo</key><string>bar</string></dict></plist>'
-    mock_plist1 = self.mox.CreateMockAnything()
-    pkg1 = test.GenericContainer(
-        plist=mock_plist1, name='foo', mtime=datetime.datetime.utcnow())
     plist2 = '<plist><dict><key>foo</key><string>bar</string></dict></plist>'
-    mock_plist2 = self.mox.CreateMockAnything()
-    pkg2 = test.GenericContainer(
-        plist=mock_plist2, name='bar', mtime=datetime.datetime.utcnow())
 
-    mock_model = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(models.PackageInfo, 'all')
-    models.PackageInfo.all().AndReturn(mock_model)
-    mock_model.filter('catalogs =', name).AndReturn(mock_model)
-    mock_model.fetch(None).AndReturn([pkg1, pkg2])
-    mock_plist1.GetXmlContent(indent_num=1).AndReturn(plist1)
-    mock_plist2.GetXmlContent(indent_num=1).AndReturn(plist2)
+    self.mox.StubOutWithMock(models.Catalog, '_GetPackageInfoFragments')
+    models.Catalog._GetPackageInfoFragments(name).AndReturn([
+        {'name': 'foo', 'mtime': datetime.datetime.utcnow(), 'xml': plist1},
+        {'name': 'bar', 'mtime': datetime.datetime.utcnow(), 'xml': plist2},
+    ])
 
     mock_catalog = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.Catalog, 'get_or_insert')
     models.Catalog.get_or_insert(name).AndReturn(mock_catalog)
+    mock_catalog.SetCompressedVariant(mox.IgnoreArg())
     mock_catalog.put(avoid_mtime_update=True).AndRaise(models.db.Error)
 
     self.mox.ReplayAll()
@@ -193,14 +199,69 @@ class CatalogTest(mox.MoxTestBase, test.AppengineTest):
 
     # here is where Generate calls itself; can't stub the method we're
     # testing, so mock the calls that happen as a result.
-    self.stubs.Set(models.deferred, 'defer', self.mox.CreateMockAnything())
-    models.deferred.defer(
-        models.Catalog.Generate, name, _name=mox.IgnoreArg(), _countdown=10)
+    self.mox.StubOutWithMock(models.regeneration, 'Request')
+    models.regeneration.Request(
+        models.regeneration.CATALOG, name, models.Catalog.GenerateRequested,
+        10)
 
     self.mox.ReplayAll()
     models.Catalog.Generate(name)
     self.mox.VerifyAll()
 
+  def _PutPackageInfo(self, filename, name, catalogs):
+    """Puts a minimal PackageInfo entity to Datastore and returns it."""
+    xml = (
+        '<plist><dict>'
+        '<key>catalogs</key><array>%s</array>'
+        '<key>installer_item_hash</key><string>hash</string>'
+        '<key>installer_item_location</key><string>%s</string>'
+        '<key>name</key><string>%s</string>'
+        '<key>version</key><string>1.0</string>'
+        '</dict></plist>') % (
+            ''.join('<string>%s</string>' % c for c in catalogs),
+            filename, name)
+    p = models.PackageInfo(key_name=filename)
+    p.filename = filename
+    p.name = name
+    p.catalogs = catalogs
+    p.plist = xml
+    p.put()
+    return p
+
+  def testGetPackageInfoFragmentsOnlySerializesChangedPackages(self):
+    """Tests _GetPackageInfoFragments() reuses fragments of unchanged pkgs."""
+    name = 'unstable'
+    pkgs = [self._PutPackageInfo('pkg%d.dmg' % i, 'pkg%d' % i, [name])
+            for i in xrange(5)]
+    self._PutPackageInfo('other.dmg', 'other', ['stable'])
+
+    get_xml_content = models.plist_lib.ApplePlist.GetXmlContent
+    with mock.patch.object(
+        models.plist_lib.ApplePlist, 'GetXmlContent', autospec=True,
+        side_effect=get_xml_content) as serialize_mock:
+      fragments = models.Catalog._GetPackageInfoFragments(name)
+      self.assertEqual(5, serialize_mock.call_count)
+      self.assertEqual(
+          ['pkg%d' % i for i in xrange(5)], [f['name'] for f in fragments])
+
+      # Nothing changed; every fragment comes from cache.
+      self.assertEqual(
+          fragments, models.Catalog._GetPackageInfoFragments(name))
+      self.assertEqual(5, serialize_mock.call_count)
+
+      # Only the changed package is serialized again.
+      pkgs[2].plist['version'] = '2.0'
+      pkgs[2].put()
+      fragments = models.Catalog._GetPackageInfoFragments(name)
+      self.assertEqual(6, serialize_mock.call_count)
+      self.assertIn('<string>2.0</string>', fragments[2]['xml'])
+
+    # Deleted packages drop out of the catalog.
+    pkgs[0].delete()
+    fragments = models.Catalog._GetPackageInfoFragments(name)
+    self.assertEqual(
+        ['pkg%d' % i for i in xrange(1, 5)], [f['name'] for f in fragments])
+
 
 class ManifestTest(mox.MoxTestBase, test.AppengineTest):
   """Test Manifest class."""
@@ -218,14 +279,10 @@ class ManifestTest(mox.MoxTestBase, test.AppengineTest):
   def testGenerateAsync(self):
     """Tests calling Manifest.Generate(delay=2)."""
     name = 'manifestname'
-    utcnow = datetime.datetime(2010, 9, 2, 19, 30, 21, 377827)
-    self.mox.StubOutWithMock(datetime, 'datetime')
-    self.stubs.Set(models.deferred, 'defer', self.mox.CreateMockAnything())
-    deferred_name = 'create-manifest-%s-%s' % (
-        name, '2010-09-02-19-30-21-377827')
-    models.datetime.datetime.utcnow().AndReturn(utcnow)
-    models.deferred.defer(
-        models.Manifest.Generate, name, _name=deferred_name, _countdown=2)
+    self.mox.StubOutWithMock(models.regeneration, 'Request')
+    models.regeneration.Request(
+        models.regeneration.MANIFEST, name, models.Manifest.GenerateRequested,
+        2)
     self.mox.ReplayAll()
     models.Manifest.Generate(name, delay=2)
     self.mox.VerifyAll()
@@ -327,9 +384,10 @@ class ManifestTest(mox.MoxTestBase, test.AppengineTest):
 
     # here is where Manifest.Generate calls itself; can't stub the method we're
     # testing, so mock the calls that happen as a result.
-    self.stubs.Set(models.deferred, 'defer', self.mox.CreateMockAnything())
-    models.deferred.defer(
-        models.Manifest.Generate, name, _name=mox.IgnoreArg(), _countdown=5)
+    self.mox.StubOutWithMock(models.regeneration, 'Request')
+    models.regeneration.Request(
+        models.regeneration.MANIFEST, name, models.Manifest.GenerateRequested,
+        5)
 
     self.mox.ReplayAll()
     models.Manifest.Generate(name)
@@ -348,6 +406,7 @@ class PackageInfoTest(mox.MoxTestBase):
         USER_ID='1337',
         USER_IS_ADMIN='0')
     self.testbed.init_all_stubs()
+    models.settings.Settings.ClearCache()
 
     mox.MoxTestBase.setUp(self)
     self.stubs = stubout.StubOutForTesting()
@@ -457,6 +516,82 @@ class PackageInfoTest(mox.MoxTestBase):
     self.assertEqual(new_full_desc, p.plist['description'])
     self.mox.VerifyAll()
 
+  def _PutPackageInfo(self, filename, d):
+    """Puts a PackageInfo entity with a test plist and returns it."""
+    p = models.PackageInfo(key_name=filename)
+    p.filename = filename
+    p.name = d['name']
+    p.plist = self._GetTestPackageInfoPlist(d)
+    p.put()
+    return p
+
+  def testGetPackageMap(self):
+    """Tests GetPackageMap() patches its index on put() and delete()."""
+    foo = self._PutPackageInfo('foo.dmg', {'name': 'Foo', 'version': '1.0'})
+    bar = self._PutPackageInfo('bar.dmg', {'name': 'Bar', 'version': '2.0'})
+    self.assertEqual(
+        {'Foo': 'Foo-1.0', 'Bar': 'Bar-2.0'},
+        models.PackageInfo.GetPackageMap())
+
+    # changes are applied to the index, which is not rebuilt.
+    self.mox.StubOutWithMock(models.PackageInfo, 'all')
+    self.mox.ReplayAll()
+    foo.plist['version'] = '1.1'
+    foo.put()
+    self._PutPackageInfo('baz.dmg', {'name': 'Baz', 'version': '3.0'})
+    bar.delete()
+    self.assertEqual(
+        {'Foo': 'Foo-1.1', 'Baz': 'Baz-3.0'},
+        models.PackageInfo.GetPackageMap())
+    self.mox.VerifyAll()
+
+  def testGetPackageMapRebuildsStaleIndex(self):
+    """Tests GetPackageMap() rebuilds an index missing a change."""
+    foo = self._PutPackageInfo('foo.dmg', {'name': 'Foo', 'version': '1.0'})
+    self.assertEqual({'Foo': 'Foo-1.0'}, models.PackageInfo.GetPackageMap())
+
+    # a change applied concurrently with another one is not in the index.
+    models.memcache.incr(models.PACKAGEMAP_VERSION_MEMCACHE_KEY)
+    foo.plist['version'] = '1.1'
+    foo.put()
+    self.assertEqual({'Foo': 'Foo-1.1'}, models.PackageInfo.GetPackageMap())
+
+  def testGetPackageMapSettlesRebuiltIndex(self):
+    """Tests GetPackageMap() rebuilds a rebuilt index once more."""
+    foo = self._PutPackageInfo('foo.dmg', {'name': 'Foo', 'version': '1.0'})
+    self.assertEqual({'Foo': 'Foo-1.0'}, models.PackageInfo.GetPackageMap())
+
+    # a change the query of the rebuild did not see yet.
+    foo.plist['version'] = '1.1'
+    super(models.PackageInfo, foo).put()
+    self.assertEqual({'Foo': 'Foo-1.0'}, models.PackageInfo.GetPackageMap())
+
+    index = models.memcache.get(models.PACKAGEMAP_MEMCACHE_KEY)
+    index['mtime'] -= models.PACKAGEMAP_SETTLE_SECS
+    models.memcache.set(models.PACKAGEMAP_MEMCACHE_KEY, index)
+    self.assertEqual({'Foo': 'Foo-1.1'}, models.PackageInfo.GetPackageMap())
+
+    # the settled index is not rebuilt again.
+    index = models.memcache.get(models.PACKAGEMAP_MEMCACHE_KEY)
+    index['mtime'] -= models.PACKAGEMAP_SETTLE_SECS
+    models.memcache.set(models.PACKAGEMAP_MEMCACHE_KEY, index)
+    self.mox.StubOutWithMock(models.PackageInfo, 'all')
+    self.mox.ReplayAll()
+    self.assertEqual({'Foo': 'Foo-1.1'}, models.PackageInfo.GetPackageMap())
+    self.mox.VerifyAll()
+
+  def testGetPackageMapWhenIndexTooLarge(self):
+    """Tests GetPackageMap() when the index is too large for memcache."""
+    self._PutPackageInfo('foo.dmg', {'name': 'Foo', 'version': '1.0'})
+    self.mox.StubOutWithMock(models.memcache, 'set')
+    models.memcache.set(
+        models.PACKAGEMAP_MEMCACHE_KEY, mox.IgnoreArg(),
+        time=models.PACKAGEMAP_MEMCACHE_SECS).AndRaise(ValueError)
+
+    self.mox.ReplayAll()
+    self.assertEqual({'Foo': 'Foo-1.0'}, models.PackageInfo.GetPackageMap())
+    self.mox.VerifyAll()
+
   def testUpdateWithObtainLockFailure(self):
     """Test Update() with a failure obtaining the lock."""
     p = models.PackageInfo()
@@ -16,10 +16,12 @@
 #
 """settings module tests."""
 
+import stubout
 
 from google.apputils import app
 from google.apputils import basetest
 from simian.mac.models import settings
+from tests.simian.mac.common import test
 
 
 class SettingsTest(basetest.TestCase):
@@ -34,6 +36,67 @@ class SettingsTest(basetest.TestCase):
     self.assertEqual(settings.Settings.GetType('email_reply_to'), 'string')
 
 
+class SettingsCacheTest(test.AppengineTest):
+  """Test the per instance settings snapshot."""
+
+  def setUp(self):
+    super(SettingsCacheTest, self).setUp()
+    self.stubs = stubout.StubOutForTesting()
+    self.now = 1000.0
+    self.stubs.Set(settings.time, 'time', lambda: self.now)
+
+  def tearDown(self):
+    super(SettingsCacheTest, self).tearDown()
+    self.stubs.UnsetAll()
+
+  def _SetOnOtherInstance(self, name, value):
+    """Sets an item like another instance would, bypassing this snapshot."""
+    cache = settings._SETTINGS_CACHE
+    self.stubs.Set(settings, '_SETTINGS_CACHE', settings._SettingsCache())
+    settings.Settings.SetItem(name, value)
+    self.stubs.Set(settings, '_SETTINGS_CACHE', cache)
+
+  def testGetItemDefault(self):
+    """Test GetItem() of an item not in Datastore."""
+    self.assertEqual(
+        ('unstable', None), settings.Settings.GetItem('early_force_catalogs'))
+    self.assertEqual((None, None), settings.Settings.GetItem('unknown'))
+
+  def testGetItemAfterSetItem(self):
+    """Test GetItem() returns an item set on this instance."""
+    settings.Settings.GetItem('early_force_days')
+    settings.Settings.SetItem('early_force_days', 3)
+    settings.Settings.SetItem('email_reply_to', 'foo@example.com')
+
+    self.assertEqual(3, settings.Settings.GetItem('early_force_days')[0])
+    self.assertEqual(
+        'foo@example.com', settings.Settings.GetItem('email_reply_to')[0])
+
+  def testGetItemCached(self):
+    """Test GetItem() reloads once another instance changes settings."""
+    self.assertEqual(7, settings.Settings.GetItem('early_force_days')[0])
+    self._SetOnOtherInstance('early_force_days', 3)
+    memcache_gets = []
+    memcache_get = settings.memcache.get
+    self.stubs.Set(
+        settings.memcache, 'get',
+        lambda key: memcache_gets.append(key) or memcache_get(key))
+
+    self.now += settings.SETTINGS_CACHE_GENERATION_SECS - 1
+    self.assertEqual(7, settings.Settings.GetItem('early_force_days')[0])
+    self.assertEqual([], memcache_gets)
+
+    self.now += 1
+    self.assertEqual(3, settings.Settings.GetItem('early_force_days')[0])
+
+  def testGetItemCopiesValue(self):
+    """Test GetItem() returns a copy of mutable values."""
+    settings.Settings.SetItem('foo_list', ['a'])
+    settings.Settings.GetItem('foo_list')[0].append('b')
+
+    self.assertEqual(['a'], settings.Settings.GetItem('foo_list')[0])
+
+
 def main(unused_argv):
   basetest.main()
 
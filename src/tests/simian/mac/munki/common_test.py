@@ -117,232 +117,501 @@ class CommonModuleTest(test.RequestHandlerTest):
     common.LogClientConnection(event, client_id)
     self.mox.VerifyAll()
 
-  def testLogClientConnectionPreflight(self):
-    """Tests LogClientConnection() function."""
-    user_settings = {'foo': True}
-    event = 'preflight'
-    uuid = 'foo-uuid'
-    hostname = 'foohostname'
-    serial = 'serial'
-    owner = 'foouser'
-    track = 'footrack'
-    config_track = 'footrack'
-    site = 'NYC'
-    os_version = '10.6.3'
-    client_version = '0.6.0.759.0'
-    on_corp = True
-    last_notified_datetime_str = '2010-11-03 15:15:10'
-    last_notified_datetime = datetime.datetime(2010, 11, 03, 15, 15, 10)
-    uptime = 123
-    root_disk_free = 456
-    user_disk_free = 789
-    ip_address = 'fooip'
-    runtype = 'auto'
-    report_feedback = {'force_continue': True}
+  def _GetTestClientId(self, uuid='foo-uuid', on_corp=True):
+    return {
+        'uuid': uuid, 'hostname': 'foohostname', 'serial': 'serial',
+        'owner': 'foouser', 'track': 'footrack', 'config_track': 'footrack',
+        'os_version': '10.6.3', 'client_version': '0.6.0.759.0',
+        'on_corp': on_corp, 'last_notified_datetime': '2010-11-03 15:15:10',
+        'site': 'NYC', 'uptime': 123, 'root_disk_free': 456,
+        'user_disk_free': 789, 'runtype': 'auto',
+    }
 
-    client_id = {
-        'uuid': uuid, 'hostname': hostname, 'serial': serial, 'owner': owner,
-        'track': track, 'config_track': config_track, 'os_version': os_version,
-        'client_version': client_version, 'on_corp': on_corp,
-        'last_notified_datetime': last_notified_datetime_str,
-        'site': site, 'uptime': uptime,
-        'root_disk_free': root_disk_free, 'user_disk_free': user_disk_free,
-        'runtype': runtype,
+  def _GetTestConnection(
+      self, event, client_id, now, pkgs_to_install=None,
+      apple_updates_to_install=None, report_feedback=None):
+    return {
+        'event': event,
+        'client_id': client_id,
+        'pkgs_to_install': pkgs_to_install,
+        'apple_updates_to_install': apple_updates_to_install,
+        'ip_address': 'fooip',
+        'report_feedback': report_feedback,
+        'cert_fingerprint': None,
+        'datetime': now.strftime(common.CLIENT_CONNECTION_DATETIME_FORMAT),
     }
-    connection_datetimes = range(1, common.CONNECTION_DATETIMES_LIMIT + 1)
-    connection_dates = range(1, common.CONNECTION_DATES_LIMIT + 1)
 
-    # bypass the db.run_in_transaction step
+  def _PutTestComputer(self, client_id, **kwargs):
+    """Puts the Computer entity of client_id, as written by a connection."""
+    c = models.Computer(key_name=client_id['uuid'], uuid=client_id['uuid'])
+    for f in common.CLIENT_CONNECTION_DIRECT_FIELDS:
+      setattr(c, f, client_id[f])
+    for k, v in kwargs.iteritems():
+      setattr(c, k, v)
+    c.put()
+
+  def testLogClientConnection(self):
+    """Tests LogClientConnection() buffers the connection log."""
+    client_id = self._GetTestClientId()
+    self._PutTestComputer(client_id)
+    utcnow = datetime.datetime(2010, 9, 2, 19, 30, 21, 377827)
+    connection = self._GetTestConnection(
+        'postflight', client_id, utcnow, pkgs_to_install=['FooApp1'],
+        apple_updates_to_install=[])
+
+    self.mox.StubOutWithMock(common.datetime, 'datetime')
+    common.datetime.datetime.utcnow().AndReturn(utcnow)
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.add(mox.Func(
+        lambda t: common.util.Deserialize(t.payload) == connection))
+    self.mox.StubOutWithMock(common, '_ScheduleClientConnectionFlush')
+    common._ScheduleClientConnectionFlush()
+
+    self.mox.ReplayAll()
+    common.LogClientConnection(
+        'postflight', client_id, pkgs_to_install=['FooApp1'],
+        apple_updates_to_install=[], ip_address='fooip')
+    self.mox.VerifyAll()
+
+  def testLogClientConnectionQueueError(self):
+    """Tests LogClientConnection() when the connection can't be buffered."""
+    client_id = self._GetTestClientId()
+    self._PutTestComputer(client_id)
+
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.add(mox.IgnoreArg()).AndRaise(common.taskqueue.TransientError)
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+    common.deferred.defer(
+        common.LogClientConnection, 'preflight', client_id,
+        user_settings=None, pkgs_to_install=None, ip_address='fooip',
+        apple_updates_to_install=None, report_feedback=None,
+        _name=mox.IgnoreArg(), _countdown=common.DATASTORE_NOWRITE_DELAY,
+        cert_fingerprint=None)
+
+    self.mox.ReplayAll()
+    common.LogClientConnection('preflight', client_id, ip_address='fooip')
+    self.mox.VerifyAll()
+
+  def _StubLogClientConnectionWrite(self):
+    """Stubs out all but the direct write of LogClientConnection()."""
+    # bypass the db.run_in_transaction_options step
     self.stubs.Set(
-        common.models.db, 'run_in_transaction',
-        lambda fn, *args, **kwargs: fn(*args, **kwargs))
+        common.models.db, 'run_in_transaction_options',
+        lambda options, fn, *args, **kwargs: fn(*args, **kwargs))
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    self.mox.StubOutWithMock(common, '_ScheduleClientConnectionFlush')
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+    # only the flush writes the reports cache.
+    self.mox.StubOutWithMock(common.models.ReportsCache, 'UpdatePendingCounts')
+    self.mox.StubOutWithMock(common.fleet_summary, 'Update')
+
+  def _ExpectBufferReportsDelta(self):
+    """Expects the reports cache changes of a direct write to be buffered."""
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.add(mox.Func(
+        lambda t: 'reports_delta' in common.util.Deserialize(t.payload)))
+    common._ScheduleClientConnectionFlush()
+
+  def testLogClientConnectionNewClient(self):
+    """Tests LogClientConnection() writes the log of a new client."""
+    client_id = self._GetTestClientId()
+    self._StubLogClientConnectionWrite()
+    common.deferred.defer(
+        common._SaveFirstConnection, client_id=client_id,
+        computer_key=models.db.Key.from_path('Computer', 'foo-uuid'),
+        _countdown=300, _queue='first')
+    self._ExpectBufferReportsDelta()
+
+    self.mox.ReplayAll()
+    common.LogClientConnection('preflight', client_id, ip_address='fooip')
+    self.mox.VerifyAll()
+
+    c = models.Computer.get_by_key_name('foo-uuid')
+    self.assertEquals('footrack', c.track)
+    self.assertEquals(1, c.preflight_count_since_postflight)
+
+  def testLogClientConnectionTrackChanged(self):
+    """Tests LogClientConnection() writes a log changing the track."""
+    client_id = self._GetTestClientId()
+    self._PutTestComputer(client_id, track='oldtrack')
+    self._StubLogClientConnectionWrite()
+    self._ExpectBufferReportsDelta()
+
+    self.mox.ReplayAll()
+    common.LogClientConnection('preflight', client_id, ip_address='fooip')
+    self.mox.VerifyAll()
+
+    self.assertEquals(
+        'footrack', models.Computer.get_by_key_name('foo-uuid').track)
+
+  def testScheduleClientConnectionFlush(self):
+    """Tests _ScheduleClientConnectionFlush() once per interval."""
+    self.mox.StubOutWithMock(common.memcache, 'add')
+    self.mox.StubOutWithMock(common.memcache, 'get')
+    common.memcache.add(
+        mox.StrContains('client_connection_flush_'), 1,
+        time=common.CLIENT_CONNECTION_FLUSH_SECS * 2).AndReturn(True)
+    common.memcache.add(
+        mox.StrContains('client_connection_flush_'), 1,
+        time=common.CLIENT_CONNECTION_FLUSH_SECS * 2).AndReturn(False)
+    common.memcache.get(
+        mox.StrContains('client_connection_flush_')).AndReturn(1)
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+    common.deferred.defer(
+        common.FlushClientConnections,
+        _countdown=common.CLIENT_CONNECTION_FLUSH_SECS,
+        _queue=common.CLIENT_CONNECTION_FLUSH_QUEUE, _name=None)
+
+    self.mox.ReplayAll()
+    common._ScheduleClientConnectionFlush()
+    common._ScheduleClientConnectionFlush()
+    self.mox.VerifyAll()
+
+  def testScheduleClientConnectionFlushWithoutMemcache(self):
+    """Tests _ScheduleClientConnectionFlush() when memcache is unavailable."""
+    self.mox.StubOutWithMock(common.memcache, 'add')
+    self.mox.StubOutWithMock(common.memcache, 'get')
+    common.memcache.add(
+        mox.StrContains('client_connection_flush_'), 1,
+        time=common.CLIENT_CONNECTION_FLUSH_SECS * 2).AndReturn(False)
+    common.memcache.get(
+        mox.StrContains('client_connection_flush_')).AndReturn(None)
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+    common.deferred.defer(
+        common.FlushClientConnections,
+        _countdown=common.CLIENT_CONNECTION_FLUSH_SECS,
+        _queue=common.CLIENT_CONNECTION_FLUSH_QUEUE,
+        _name=mox.StrContains('client-connection-flush-')).AndRaise(
+            common.taskqueue.TaskAlreadyExistsError)
 
-    mock_computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
+    self.mox.ReplayAll()
+    common._ScheduleClientConnectionFlush()
+    self.mox.VerifyAll()
+
+  def testApplyClientConnectionPreflight(self):
+    """Tests _ApplyClientConnection() with a preflight."""
+    client_id = self._GetTestClientId()
+    now = datetime.datetime(2010, 11, 4, 12, 0, 0, 1234)
+    connection = self._GetTestConnection(
+        'preflight', client_id, now,
+        report_feedback={'force_continue': True})
+    connection_datetimes = range(1, common.CONNECTION_DATETIMES_LIMIT + 1)
+    connection_dates = range(1, common.CONNECTION_DATES_LIMIT + 1)
+
+    mock_computer = self.mox.CreateMockAnything()
     mock_computer.connection_datetimes = connection_datetimes
     mock_computer.connection_dates = connection_dates
     mock_computer.connections_on_corp = 2
     mock_computer.connections_off_corp = 2
     mock_computer.preflight_count_since_postflight = 3
-    mock_computer.put().AndReturn(None)
+    mock_computer.preflight_datetime = None
+    mock_computer.postflight_datetime = None
 
     self.mox.ReplayAll()
-    common.LogClientConnection(
-        event, client_id, user_settings=user_settings, ip_address=ip_address,
-        report_feedback=report_feedback)
-    self.assertEquals(uuid, mock_computer.uuid)
-    self.assertEquals(ip_address, mock_computer.ip_address)
-    self.assertEquals(runtype, mock_computer.runtype)
-    self.assertEquals(hostname, mock_computer.hostname)
-    self.assertEquals(serial, mock_computer.serial)
-    self.assertEquals(owner, mock_computer.owner)
-    self.assertEquals(track, mock_computer.track)
-    self.assertEquals(config_track, mock_computer.config_track)
-    self.assertEquals(site, mock_computer.site)
-    self.assertEquals(os_version, mock_computer.os_version)
-    self.assertEquals(client_version, mock_computer.client_version)
+    common._ApplyClientConnection(mock_computer, connection)
+    self.assertEquals('foo-uuid', mock_computer.uuid)
+    self.assertEquals('fooip', mock_computer.ip_address)
+    self.assertEquals('auto', mock_computer.runtype)
+    self.assertEquals('foohostname', mock_computer.hostname)
+    self.assertEquals('serial', mock_computer.serial)
+    self.assertEquals('foouser', mock_computer.owner)
+    self.assertEquals('footrack', mock_computer.track)
+    self.assertEquals('footrack', mock_computer.config_track)
+    self.assertEquals('NYC', mock_computer.site)
+    self.assertEquals('10.6.3', mock_computer.os_version)
+    self.assertEquals('0.6.0.759.0', mock_computer.client_version)
     self.assertEquals(
-        last_notified_datetime, mock_computer.last_notified_datetime)
+        datetime.datetime(2010, 11, 03, 15, 15, 10),
+        mock_computer.last_notified_datetime)
+    self.assertEquals(now, mock_computer.preflight_datetime)
+    self.assertEquals(now, mock_computer.last_on_corp_preflight_datetime)
     # Verify on_corp/off_corp counts.
     self.assertEquals(2, mock_computer.connections_on_corp)
     self.assertEquals(2, mock_computer.connections_off_corp)
-    self.assertEquals(
-        datetime.datetime, type(mock_computer.last_on_corp_preflight_datetime))
     self.assertEquals(4, mock_computer.preflight_count_since_postflight)
     self.mox.VerifyAll()
 
-  def testLogClientConnectionPostflight(self):
-    """Tests LogClientConnection() function."""
-    event = 'postflight'
-    uuid = 'foo-uuid'
-    ip_address = 'fooip'
-    hostname = 'foohostname'
-    serial = 'serial'
-    owner = 'foouser'
-    track = 'footrack'
-    config_track = 'footrack'
-    site = 'NYC'
-    os_version = '10.6.3'
-    client_version = '0.6.0.759.0'
-    on_corp = True
-    last_notified_datetime_str = '2010-11-03 15:15:10'
-    last_notified_datetime = datetime.datetime(2010, 11, 03, 15, 15, 10)
-    uptime = 123
-    root_disk_free = 456
-    user_disk_free = 789
-    runtype = 'custom'
-    client_id = {
-        'uuid': uuid, 'hostname': hostname, 'serial': serial, 'owner': owner,
-        'track': track, 'config_track': config_track, 'os_version': os_version,
-        'client_version': client_version, 'on_corp': on_corp,
-        'last_notified_datetime': last_notified_datetime_str,
-        'site': site, 'uptime': uptime,
-        'root_disk_free': root_disk_free, 'user_disk_free': user_disk_free,
-        'runtype': runtype,
-    }
+  def testApplyClientConnectionPostflight(self):
+    """Tests _ApplyClientConnection() with a postflight."""
+    client_id = self._GetTestClientId()
+    now = datetime.datetime(2010, 11, 4, 12, 0, 0, 1234)
     pkgs_to_install = ['FooApp1', 'FooApp2']
     apple_updates_to_install = ['FooUpdate1', 'FooUpdate2']
     all_pkgs_to_install = pkgs_to_install + [
         common.APPLESUS_PKGS_TO_INSTALL_FORMAT % update
         for update in apple_updates_to_install]
+    connection = self._GetTestConnection(
+        'postflight', client_id, now, pkgs_to_install=pkgs_to_install,
+        apple_updates_to_install=apple_updates_to_install)
     connection_datetimes = range(1, common.CONNECTION_DATETIMES_LIMIT + 1)
     connection_dates = range(1, common.CONNECTION_DATES_LIMIT + 1)
 
-    # bypass the db.run_in_transaction step
-    self.stubs.Set(
-        common.models.db, 'run_in_transaction',
-        lambda fn, *args, **kwargs: fn(*args, **kwargs))
-
     mock_computer = self.mox.CreateMockAnything()
     mock_computer.connection_datetimes = connection_datetimes
     mock_computer.connection_dates = connection_dates
     mock_computer.connections_on_corp = None  # test (None or 0) + 1
     mock_computer.connections_off_corp = 0
-    mock_computer.put().AndReturn(None)
+    mock_computer.preflight_datetime = None
+    mock_computer.postflight_datetime = None
 
     self.mox.ReplayAll()
-    common.LogClientConnection(
-        event, client_id, pkgs_to_install=pkgs_to_install,
-        apple_updates_to_install=apple_updates_to_install,
-        computer=mock_computer, ip_address=ip_address)
-    self.assertEquals(uuid, mock_computer.uuid)
-    self.assertEquals(ip_address, mock_computer.ip_address)
-    self.assertEquals(runtype, mock_computer.runtype)
-    self.assertEquals(hostname, mock_computer.hostname)
-    self.assertEquals(serial, mock_computer.serial)
-    self.assertEquals(owner, mock_computer.owner)
-    self.assertEquals(track, mock_computer.track)
-    self.assertEquals(config_track, mock_computer.config_track)
-    self.assertEquals(site, mock_computer.site)
-    self.assertEquals(os_version, mock_computer.os_version)
-    self.assertEquals(client_version, mock_computer.client_version)
-    self.assertEquals(
-        last_notified_datetime, mock_computer.last_notified_datetime)
+    common._ApplyClientConnection(mock_computer, connection)
+    self.assertEquals('foo-uuid', mock_computer.uuid)
+    self.assertEquals(now, mock_computer.postflight_datetime)
     # Verify that the first "datetime" was popped off.
     self.assertEquals(connection_datetimes[0], 2)
     # Verify that the last datetime is the new datetime.
-    new_datetime = connection_datetimes[common.CONNECTION_DATETIMES_LIMIT - 1]
-    self.assertEquals(type(new_datetime), datetime.datetime)
+    self.assertEquals(
+        now, connection_datetimes[common.CONNECTION_DATETIMES_LIMIT - 1])
     # Verify that the first "date" was popped off.
     self.assertEquals(connection_dates[0], 2)
     # Verify that the last date is the new date.
-    new_date = connection_dates[common.CONNECTION_DATES_LIMIT - 1]
-    self.assertEquals(type(new_date), datetime.datetime)
+    self.assertEquals(
+        datetime.datetime(2010, 11, 4),
+        connection_dates[common.CONNECTION_DATES_LIMIT - 1])
     # Verify on_corp/off_corp counts.
     self.assertEquals(1, mock_computer.connections_on_corp)
     self.assertEquals(0, mock_computer.connections_off_corp)
     self.assertEquals(all_pkgs_to_install, mock_computer.pkgs_to_install)
+    # the connection log is left unchanged for transaction retries.
+    self.assertEquals(['FooApp1', 'FooApp2'], pkgs_to_install)
     self.assertEquals(False, mock_computer.all_pkgs_installed)
+    self.assertEquals(False, mock_computer.all_apple_updates_installed)
     self.assertEquals(0, mock_computer.preflight_count_since_postflight)
     self.mox.VerifyAll()
 
-  def testLogClientConnectionPreflightAndNew(self):
-    """Tests LogClientConnection() function."""
-    event = 'preflight'
-    uuid = 'foo-uuid'
-    ip_address = 'fooip'
-    hostname = 'foohostname'
-    serial = 'fooserial'
-    owner = 'foouser'
-    track = 'stable'
-    config_track = 'stable'
-    site = 'NYC'
-    os_version = '10.6.3'
-    client_version = '0.6.0.759.0'
-    on_corp = True
-    last_notified_datetime_str = '2010-11-03 15:15:10'
-    last_notified_datetime = datetime.datetime(
-        2010, 11, 03, 15, 15, 10)
-    uptime = 123.0
-    root_disk_free = 456
-    user_disk_free = 789
-    runtype = 'auto'
-    client_id = {
-        'uuid': uuid, 'hostname': hostname, 'serial': serial, 'owner': owner,
-        'track': track, 'config_track': config_track, 'os_version': os_version,
-        'client_version': client_version, 'on_corp': on_corp,
-        'last_notified_datetime': last_notified_datetime_str,
-        'site': site, 'uptime': uptime,
-        'root_disk_free': root_disk_free, 'user_disk_free': user_disk_free,
-        'runtype': runtype,
-    }
+  def testApplyClientConnectionBeforeDirectWrite(self):
+    """Tests _ApplyClientConnection() with a log older than the computer's."""
+    client_id = self._GetTestClientId()
+    now = datetime.datetime(2010, 11, 4, 12, 0, 0)
+    later = datetime.datetime(2010, 11, 4, 12, 0, 5)
+    c = models.Computer(
+        key_name='foo-uuid', track='newtrack', preflight_datetime=later,
+        postflight_datetime=later, pkgs_to_install=['FooApp1'],
+        preflight_count_since_postflight=0)
+
+    common._ApplyClientConnection(
+        c, self._GetTestConnection('preflight', client_id, now))
+    common._ApplyClientConnection(
+        c, self._GetTestConnection('postflight', client_id, now))
+
+    self.assertEquals('newtrack', c.track)
+    self.assertEquals(later, c.preflight_datetime)
+    self.assertEquals(later, c.postflight_datetime)
+    self.assertEquals(['FooApp1'], c.pkgs_to_install)
+    self.assertEquals(0, c.preflight_count_since_postflight)
+    self.assertEquals(1, c.connections_on_corp)
+    self.assertEquals([now], c.connection_datetimes)
+
+  def testFlushClientConnections(self):
+    """Tests FlushClientConnections() with new and existing clients."""
+    existing_id = self._GetTestClientId(uuid='existing-uuid')
+    new_id = self._GetTestClientId(uuid='new-uuid', on_corp=False)
+    models.Computer(
+        key_name='existing-uuid', uuid='existing-uuid',
+        preflight_count_since_postflight=3, connections_on_corp=5).put()
+    t1 = datetime.datetime(2010, 11, 4, 12, 0, 0)
+    t2 = datetime.datetime(2010, 11, 4, 12, 0, 5)
+    # leased out of order, to verify each client's logs are applied in order.
+    connections = [
+        self._GetTestConnection('preflight', existing_id, t2),
+        self._GetTestConnection('postflight', existing_id, t1),
+        self._GetTestConnection('preflight', new_id, t1),
+    ]
+    tasks = [
+        common.taskqueue.Task(
+            payload=common.util.Serialize(c), method='PULL')
+        for c in connections]
 
-    # bypass the db.run_in_transaction step
+    # bypass the db.run_in_transaction_options step
     self.stubs.Set(
-        common.models.db, 'run_in_transaction',
-        lambda fn, *args, **kwargs: fn(*args, **kwargs))
+        common.models.db, 'run_in_transaction_options',
+        lambda options, fn, *args, **kwargs: fn(*args, **kwargs))
+
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        common.CLIENT_CONNECTION_LEASE_SECS,
+        common.CLIENT_CONNECTION_FLUSH_MAX).AndReturn(tasks)
+    mock_queue.delete_tasks(mox.SameElementsAs(tasks))
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+    common.deferred.defer(
+        common._SaveFirstConnection, client_id=new_id,
+        computer_key=models.db.Key.from_path('Computer', 'new-uuid'),
+        _countdown=300, _queue='first')
+
+    self.mox.ReplayAll()
+    common.FlushClientConnections()
+    self.mox.VerifyAll()
 
+    existing = models.Computer.get_by_key_name('existing-uuid')
+    self.assertEquals(t1, existing.postflight_datetime)
+    self.assertEquals(t2, existing.preflight_datetime)
+    self.assertEquals(1, existing.preflight_count_since_postflight)
+    self.assertEquals(6, existing.connections_on_corp)
+    self.assertEquals([t1], existing.connection_datetimes)
+    # preflight_datetime is long past, so active is updated as by put().
+    self.assertFalse(existing.active)
+
+    new = models.Computer.get_by_key_name('new-uuid')
+    self.assertEquals('foohostname', new.hostname)
+    self.assertEquals(t1, new.preflight_datetime)
+    self.assertEquals(1, new.preflight_count_since_postflight)
+    self.assertEquals([], new.connection_datetimes)
+
+  def testFlushClientConnectionsWhenPutFails(self):
+    """Tests FlushClientConnections() leaves logs it fails to write."""
+    connection = self._GetTestConnection(
+        'preflight', self._GetTestClientId(), datetime.datetime.utcnow())
+    tasks = [common.taskqueue.Task(
+        payload=common.util.Serialize(connection), method='PULL')]
+
+    self.mox.StubOutWithMock(common.db, 'run_in_transaction_options')
+    common.db.run_in_transaction_options(
+        mox.IgnoreArg(), common._WriteClientConnections,
+        mox.IgnoreArg()).AndRaise(common.db.TransactionFailedError)
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        common.CLIENT_CONNECTION_LEASE_SECS,
+        common.CLIENT_CONNECTION_FLUSH_MAX).AndReturn(tasks)
     self.mox.StubOutWithMock(common.deferred, 'defer')
+    common.deferred.defer(
+        common.FlushClientConnections,
+        _countdown=common.CLIENT_CONNECTION_LEASE_SECS,
+        _queue=common.CLIENT_CONNECTION_FLUSH_QUEUE)
+
+    self.mox.ReplayAll()
+    common.FlushClientConnections()
+    self.mox.VerifyAll()
 
+  def testFlushClientConnectionsWithInvalidLogs(self):
+    """Tests FlushClientConnections() drops logs which can't be written."""
+    good = self._GetTestConnection(
+        'preflight', self._GetTestClientId(uuid='good-uuid'),
+        datetime.datetime(2010, 11, 4, 12, 0, 0))
+    invalid = self._GetTestConnection(
+        'preflight', {'uuid': 'invalid-uuid'},
+        datetime.datetime(2010, 11, 4, 12, 0, 0))
+    tasks = [
+        common.taskqueue.Task(
+            payload=common.util.Serialize(c), method='PULL')
+        for c in [good, invalid]]
+    retried = self.mox.CreateMockAnything()
+    retried.payload = common.util.Serialize(good)
+    retried.retry_count = common.CLIENT_CONNECTION_MAX_RETRIES
+    unparsable = self.mox.CreateMockAnything()
+    unparsable.payload = 'junk'
+    unparsable.retry_count = 0
+
+    # bypass the db.run_in_transaction_options step
+    self.stubs.Set(
+        common.models.db, 'run_in_transaction_options',
+        lambda options, fn, *args, **kwargs: fn(*args, **kwargs))
+
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        common.CLIENT_CONNECTION_LEASE_SECS,
+        common.CLIENT_CONNECTION_FLUSH_MAX).AndReturn(
+            tasks + [retried, unparsable])
+    mock_queue.delete_tasks([retried, unparsable])
+    mock_queue.delete_tasks([tasks[0]])
+    self.mox.StubOutWithMock(common.deferred, 'defer')
     common.deferred.defer(
-        common._SaveFirstConnection, client_id=client_id,
-        computer_key=mox.IgnoreArg(), _countdown=300, _queue='first')
+        common._SaveFirstConnection, client_id=good['client_id'],
+        computer_key=models.db.Key.from_path('Computer', 'good-uuid'),
+        _countdown=300, _queue='first')
+    # the invalid log stays leased, to be dropped after its last retry.
+    common.deferred.defer(
+        common.FlushClientConnections,
+        _countdown=common.CLIENT_CONNECTION_LEASE_SECS,
+        _queue=common.CLIENT_CONNECTION_FLUSH_QUEUE)
 
     self.mox.ReplayAll()
-    common.LogClientConnection(event, client_id, ip_address=ip_address)
-
-    computer = models.Computer.get_by_key_name(uuid)
-    self.assertEquals(uuid, computer.uuid)
-    self.assertEquals(ip_address, computer.ip_address)
-    self.assertEquals(runtype, computer.runtype)
-    self.assertEquals(hostname, computer.hostname)
-    self.assertEquals(serial, computer.serial)
-    self.assertEquals(owner, computer.owner)
-    self.assertEquals(track, computer.track)
-    self.assertEquals(config_track, computer.config_track)
-    self.assertEquals(site, computer.site)
-    self.assertEquals(os_version, computer.os_version)
-    self.assertEquals(client_version, computer.client_version)
-    self.assertEquals(
-        last_notified_datetime, computer.last_notified_datetime)
-    # New client, so zero connection date/datetimes until after postflight.
-    self.assertEquals([], computer.connection_datetimes)
-    self.assertEquals([], computer.connection_dates)
-    # Verify on_corp/off_corp counts.
-    self.assertEquals(0, computer.connections_on_corp)
-    self.assertEquals(0, computer.connections_off_corp)
-    self.assertEquals(1, computer.preflight_count_since_postflight)
+    common.FlushClientConnections()
     self.mox.VerifyAll()
 
+    self.assertNotEqual(None, models.Computer.get_by_key_name('good-uuid'))
+    self.assertEqual(None, models.Computer.get_by_key_name('invalid-uuid'))
+
+  def testFlushClientConnectionsWithReportsDelta(self):
+    """Tests FlushClientConnections() applies buffered reports changes."""
+    tasks = [
+        common.taskqueue.Task(payload=common.util.Serialize({'reports_delta': {
+            'pending': {'FooApp1': 1},
+            'fleet': {'hours': {123: {'active': 1}}, 'conns_on_corp': 1},
+        }}), method='PULL'),
+        common.taskqueue.Task(payload=common.util.Serialize({'reports_delta': {
+            'pending': {'FooApp1': -1, 'FooApp2': 1},
+            'fleet': {'conns_on_corp': 2},
+        }}), method='PULL'),
+    ]
+
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        common.CLIENT_CONNECTION_LEASE_SECS,
+        common.CLIENT_CONNECTION_FLUSH_MAX).AndReturn(tasks)
+    mock_queue.delete_tasks(tasks)
+    self.mox.StubOutWithMock(common.models.ReportsCache, 'UpdatePendingCounts')
+    common.models.ReportsCache.UpdatePendingCounts({'FooApp2': 1})
+    self.mox.StubOutWithMock(common.fleet_summary, 'Update')
+    common.fleet_summary.Update(
+        {'hours': {123: {'active': 1}}, 'conns_on_corp': 3})
+
+    self.mox.ReplayAll()
+    common.FlushClientConnections()
+    self.mox.VerifyAll()
+
+  def testFlushClientConnectionsWhenNone(self):
+    """Tests FlushClientConnections() with no buffered connection logs."""
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.CLIENT_CONNECTION_QUEUE).AndReturn(mock_queue)
+    mock_queue.lease_tasks(
+        common.CLIENT_CONNECTION_LEASE_SECS,
+        common.CLIENT_CONNECTION_FLUSH_MAX).AndReturn([])
+
+    self.mox.ReplayAll()
+    common.FlushClientConnections()
+    self.mox.VerifyAll()
+
+  def testWriteClientConnectionsPendingDelta(self):
+    """Tests _WriteClientConnections() returns pending count changes."""
+    now = datetime.datetime.utcnow()
+    models.Computer(
+        key_name='existing-uuid', uuid='existing-uuid', preflight_datetime=now,
+        pkgs_to_install=['FooApp1', 'FooApp2']).put()
+    models.Computer(
+        key_name='inactive-uuid', uuid='inactive-uuid', active=False,
+        pkgs_to_install=['FooApp1']).put(update_active=False)
+    connections = {}
+    for uuid in ['existing-uuid', 'inactive-uuid', 'new-uuid']:
+      connection = self._GetTestConnection(
+          'postflight', self._GetTestClientId(uuid=uuid), now,
+          pkgs_to_install=['FooApp2', 'FooApp3'], apple_updates_to_install=[])
+      connections[uuid] = [(connection['datetime'], connection, None)]
+
+    new_computers, delta, fleet = common._WriteClientConnections(connections)
+
+    self.assertEquals(
+        ['new-uuid'], [c.key().name() for c in new_computers])
+    # inactive-uuid stays inactive, as only a preflight reactivates it.
+    self.assertEquals(
+        {'FooApp1': -1, 'FooApp2': 1, 'FooApp3': 2}, delta)
+    # existing-uuid's old counts are replaced, and new-uuid's are added.
+    self.assertEquals({'None': -1, 'NYC': 2}, fleet['sites_histogram'])
+
   def testLogClientConnectionAsync(self):
     """Tests calling LogClientConnection(delay=2)."""
     event = 'eventname'
@@ -649,6 +918,27 @@ class CommonModuleTest(test.RequestHandlerTest):
     common.WriteComputerMSULog(uuid, details)
     self.mox.VerifyAll()
 
+  def testWriteComputerMSULogs(self):
+    """Test WriteComputerMSULogs()."""
+    uuid = 'uuid'
+    logs = [
+        {'event': 'launched', 'source': 'MSU', 'user': 'foo',
+         'time': 1292013344.12, 'desc': ''},
+        {'event': 'quit', 'source': 'MSU', 'user': 'foo', 'desc': 'first'},
+        {'event': 'quit', 'source': 'MSU', 'user': 'foo', 'desc': 'last'},
+        {'event': 'quit', 'source': 'MSU', 'desc': 'x' * 2000},
+        {'event': 'quit'},
+        'not a log',
+    ]
+
+    self.assertEqual(2, common.WriteComputerMSULogs(uuid, logs))
+    launched = models.ComputerMSULog.get_by_key_name('uuid_MSU_launched')
+    self.assertEqual('foo', launched.user)
+    self.assertEqual(
+        common.datetime.datetime(2010, 12, 10, 20, 35, 44), launched.mtime)
+    quit_log = models.ComputerMSULog.get_by_key_name('uuid_MSU_quit')
+    self.assertEqual('last', quit_log.desc)
+
   def testModifyList(self):
     """Tests _ModifyList()."""
     l = []
@@ -662,140 +952,71 @@ class CommonModuleTest(test.RequestHandlerTest):
     common._ModifyList(l, '-This value does not exist')
     self.assertEqual(l, ['yes'])  # test modify remove of non-existent value.
 
+  def _PutManifestMod(self, mod_type, target, value, **kwargs):
+    """Puts a manifest modification for GenerateDynamicManifest tests."""
+    m = models.BaseManifestModification.GenerateInstance(
+        mod_type, target, value, **kwargs)
+    m.put()
+    return m
+
   def testGenerateDynamicManifest(self):
     """Tests GenerateDynamicManifest()."""
-    plist_xml = 'fooxml'
+    common._COMPILED_MODS.clear()
     manifest = 'stable'
-    site = 'foosite'
-    os_version = '10.6.5'
-    owner = 'foouser'
-    uuid = '12345'
     client_id = {
-        'track': manifest, 'site': site, 'os_version': os_version,
-        'owner': owner, 'uuid': uuid,
+        'track': manifest, 'site': 'foosite', 'os_version': '10.6.5',
+        'owner': 'foouser', 'uuid': '12345',
     }
     blocked_package_name = 'FooBlockedPkg'
     user_settings = {
         'BlockPackages': [blocked_package_name]
     }
+    plist_xml = common.plist_module.GetXmlDocument(
+        {'managed_installs': ['FooPkg', 'BarPkg', blocked_package_name]})
+
+    models.Tag(
+        key_name='footag',
+        keys=[models.db.Key.from_path('Computer', client_id['uuid'])]).put()
+    models.Group(key_name='foogroup', users=[client_id['owner']]).put()
+
+    self._PutManifestMod(
+        'site', client_id['site'], 'foopkg', manifests=[manifest],
+        install_types=['optional_installs'])
+    self._PutManifestMod(
+        'site', client_id['site'], 'disabledpkg', enabled=False,
+        install_types=['optional_installs'])
+    self._PutManifestMod(
+        'os_version', client_id['os_version'], 'fooospkg',
+        manifests=[manifest], install_types=['managed_updates'])
+    self._PutManifestMod(
+        'owner', client_id['owner'], 'fooownerpkg',
+        install_types=['optional_installs', 'managed_updates'])
+    self._PutManifestMod(
+        'owner', client_id['owner'], 'unstablepkg', manifests=['unstable'],
+        install_types=['optional_installs'])
+    self._PutManifestMod(
+        'uuid', client_id['uuid'], 'FooPkg', remove=True,
+        install_types=['managed_installs'])
+    self._PutManifestMod(
+        'tag', 'footag', 'footagpkg', install_types=['managed_installs'])
+    self._PutManifestMod(
+        'group', 'foogroup', 'foogrouppkg', install_types=['managed_installs'])
+    self._PutManifestMod(
+        'tag', 'othertag', 'othertagpkg', install_types=['managed_installs'])
 
-    install_type_optional_installs = 'optional_installs'
-    install_type_managed_updates = 'managed_updates'
-
-    value_one = 'foopkg'
-    site_mod_one = self.mox.CreateMockAnything()
-    site_mod_one.manifests = [manifest]
-    site_mod_one.enabled = True
-    site_mod_one.install_types = [install_type_optional_installs]
-    site_mod_one.value = value_one
-    site_mod_disabled = self.mox.CreateMockAnything()
-    site_mod_disabled.enabled = False
-    site_mods = [site_mod_one, site_mod_disabled]
-    self.mox.StubOutWithMock(
-        common.models.SiteManifestModification, 'MemcacheWrappedGetAllFilter')
-    common.models.SiteManifestModification.MemcacheWrappedGetAllFilter(
-        (('site =', site),)).AndReturn(site_mods)
-
-    os_version_mod_one = self.mox.CreateMockAnything()
-    os_version_mod_one.manifests = [manifest]
-    os_version_mod_one.enabled = True
-    os_version_mod_one.install_types = [install_type_managed_updates]
-    os_version_mod_one.value = 'foo os version pkg'
-    os_version_mods = [os_version_mod_one]
-    self.mox.StubOutWithMock(
-        common.models.OSVersionManifestModification,
-        'MemcacheWrappedGetAllFilter')
-    common.models.OSVersionManifestModification.MemcacheWrappedGetAllFilter(
-        (('os_version =', os_version),)).AndReturn(os_version_mods)
-
-    owner_mod_one = self.mox.CreateMockAnything()
-    owner_mod_one.manifests = [manifest]
-    owner_mod_one.enabled = True
-    owner_mod_one.install_types = [
-        install_type_optional_installs, install_type_managed_updates]
-    owner_mod_one.value = 'foo owner pkg'
-    owner_mods = [owner_mod_one]
-    self.mox.StubOutWithMock(
-        common.models.OwnerManifestModification,
-        'MemcacheWrappedGetAllFilter')
-    common.models.OwnerManifestModification.MemcacheWrappedGetAllFilter(
-        (('owner =', client_id['owner']),)).AndReturn(owner_mods)
-
-    uuid_mod_one = self.mox.CreateMockAnything()
-    uuid_mod_one.enabled = False
-    uuid_mods = [uuid_mod_one]
-    self.mox.StubOutWithMock(
-        common.models.UuidManifestModification,
-        'MemcacheWrappedGetAllFilter')
-    common.models.UuidManifestModification.MemcacheWrappedGetAllFilter(
-        (('uuid =', client_id['uuid']),)).AndReturn(uuid_mods)
-
-    computer_tags = ['footag1', 'footag2']
-    self.mox.StubOutWithMock(common.models.Tag, 'GetAllTagNamesForKey')
-    self.mox.StubOutWithMock(common.models.db.Key, 'from_path')
-    common.models.db.Key.from_path('Computer', client_id['uuid']).AndReturn('k')
-    common.models.Tag.GetAllTagNamesForKey('k').AndReturn(computer_tags)
-    tag_mod_one = self.mox.CreateMockAnything()
-    tag_mod_one.enabled = False
-    tag_mods = [tag_mod_one]
-    self.mox.StubOutWithMock(
-        common.models.TagManifestModification,
-        'MemcacheWrappedGetAllFilter')
-    common.models.TagManifestModification.MemcacheWrappedGetAllFilter(
-        (('tag_key_name =', 'footag1'),)).AndReturn([])
-    common.models.TagManifestModification.MemcacheWrappedGetAllFilter(
-        (('tag_key_name =', 'footag2'),)).AndReturn(tag_mods)
-
-    mock_plist = self.mox.CreateMockAnything()
-    managed_installs = ['FooPkg', blocked_package_name]
-
-    self.mox.StubOutWithMock(common.plist_module, 'UpdateIterable')
-    self.mox.StubOutWithMock(common.plist_module, 'MunkiManifestPlist')
-    common.plist_module.MunkiManifestPlist(plist_xml).AndReturn(mock_plist)
-    mock_plist.Parse().AndReturn(None)
-
-    common.plist_module.UpdateIterable(
-        mock_plist, site_mod_one.install_types[0], site_mod_one.value,
-        default=[], op=common._ModifyList)
-
-    common.plist_module.UpdateIterable(
-        mock_plist, os_version_mod_one.install_types[0],
-        os_version_mod_one.value, default=[], op=common._ModifyList)
-
-    common.plist_module.UpdateIterable(
-        mock_plist, owner_mod_one.install_types[0],
-        owner_mod_one.value, default=[], op=common._ModifyList)
-
-    common.plist_module.UpdateIterable(
-        mock_plist, owner_mod_one.install_types[1],
-        owner_mod_one.value, default=[], op=common._ModifyList)
-
-    for install_type in common.common.INSTALL_TYPES:
-      if install_type == 'managed_installs':
-        mock_plist.get(install_type, []).AndReturn(managed_installs)
-        mock_plist.__getitem__(install_type).AndReturn(managed_installs)
-      else:
-        mock_plist.get(install_type, []).AndReturn([])
-
-    mock_plist.GetXml().AndReturn(plist_xml)
-
-    self.mox.ReplayAll()
     xml_out = common.GenerateDynamicManifest(
         plist_xml, client_id, user_settings=user_settings)
-    self.assertEqual(plist_xml, xml_out)
-    self.assertTrue(blocked_package_name not in managed_installs)
-    self.mox.VerifyAll()
+
+    pl = common.plist_module.MunkiManifestPlist(xml_out)
+    pl.Parse()
+    self.assertEqual(
+        ['BarPkg', 'footagpkg', 'foogrouppkg'], pl['managed_installs'])
+    self.assertEqual(['foopkg', 'fooownerpkg'], pl['optional_installs'])
+    self.assertEqual(['fooospkg', 'fooownerpkg'], pl['managed_updates'])
 
   def testGenerateDynamicManifestWhenOnlyUserSettingsMods(self):
     """Test GenerateDynamicManifest() when only user_settings mods exist."""
-    self.mox.StubOutWithMock(common.models, 'SiteManifestModification')
-    self.mox.StubOutWithMock(common.models, 'OSVersionManifestModification')
-    self.mox.StubOutWithMock(common.models, 'OwnerManifestModification')
-    self.mox.StubOutWithMock(common.models, 'UuidManifestModification')
-    self.mox.StubOutWithMock(common.models, 'TagManifestModification')
-    self.mox.StubOutWithMock(common.models.db.Key, 'from_path')
-    self.mox.StubOutWithMock(common.models.Tag, 'GetAllTagNamesForKey')
-
+    common._COMPILED_MODS.clear()
     client_id = {
         'site': 'sitex',
         'os_version': 'os_versionx',
@@ -810,67 +1031,23 @@ class CommonModuleTest(test.RequestHandlerTest):
         'FlashDeveloper': True,
     }
 
-    plist_xml = '<plist xml>'
-
-    common.models.SiteManifestModification.MemcacheWrappedGetAllFilter(
-        (('site =', client_id['site']),)).AndReturn([])
-    common.models.OSVersionManifestModification.MemcacheWrappedGetAllFilter(
-        (('os_version =', client_id['os_version']),)).AndReturn([])
-    common.models.OwnerManifestModification.MemcacheWrappedGetAllFilter(
-        (('owner =', client_id['owner']),)).AndReturn([])
-    common.models.UuidManifestModification.MemcacheWrappedGetAllFilter(
-        (('uuid =', client_id['uuid']),)).AndReturn([])
-    common.models.db.Key.from_path('Computer', client_id['uuid']).AndReturn('k')
-    common.models.Tag.GetAllTagNamesForKey('k').AndReturn(['tag'])
-    common.models.TagManifestModification.MemcacheWrappedGetAllFilter(
-        (('tag_key_name =', 'tag'),)).AndReturn([])
-
-    managed_installs = [
-        'FooPkg', blocked_package_name, common.FLASH_PLUGIN_NAME]
-    managed_updates = []
-
-    mock_plist = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(common.plist_module, 'MunkiManifestPlist')
-    common.plist_module.MunkiManifestPlist(plist_xml).AndReturn(mock_plist)
-    mock_plist.Parse().AndReturn(None)
-
-    # FlashDeveloper is True, so managed_updates and managed_installs are read.
-    mock_plist.__getitem__(common.common.MANAGED_UPDATES).AndReturn(
-        managed_updates)
-    mock_plist.__getitem__(common.common.MANAGED_UPDATES).AndReturn(
-        managed_installs)
-
-    for blocked_pkg in user_settings['BlockPackages']:
-      for install_type in common.common.INSTALL_TYPES:
-        if install_type == 'managed_installs':
-          mock_plist.get(install_type, []).AndReturn(managed_installs)
-          if blocked_pkg == blocked_package_name:
-            mock_plist.__getitem__(install_type).AndReturn(managed_installs)
-        else:
-          mock_plist.get(install_type, []).AndReturn([])
-
-    mock_plist.GetXml().AndReturn(plist_xml)
+    plist_xml = common.plist_module.GetXmlDocument({
+        'managed_installs': ['FooPkg', blocked_package_name],
+        'managed_updates': [common.FLASH_PLUGIN_NAME],
+    })
 
-    self.mox.ReplayAll()
     xml_out = common.GenerateDynamicManifest(
         plist_xml, client_id, user_settings=user_settings)
-    self.assertEqual(plist_xml, xml_out)
-    self.assertTrue(blocked_package_name not in managed_installs)
-    # non-debug flashplugin should be removed from managed_updates
-    self.assertTrue(common.FLASH_PLUGIN_NAME not in managed_installs)
 
-    self.assertTrue(common.FLASH_PLUGIN_DEBUG_NAME in managed_updates)
-    self.mox.VerifyAll()
+    pl = common.plist_module.MunkiManifestPlist(xml_out)
+    pl.Parse()
+    self.assertEqual(['FooPkg'], pl['managed_installs'])
+    # non-debug flashplugin should be replaced in managed_updates.
+    self.assertEqual([common.FLASH_PLUGIN_DEBUG_NAME], pl['managed_updates'])
 
   def testGenerateDynamicManifestWhenNoMods(self):
     """Test GenerateDynamicManifest() when no manifest mods are available."""
-    self.mox.StubOutWithMock(common.models, 'SiteManifestModification')
-    self.mox.StubOutWithMock(common.models, 'OSVersionManifestModification')
-    self.mox.StubOutWithMock(common.models, 'OwnerManifestModification')
-    self.mox.StubOutWithMock(common.models, 'UuidManifestModification')
-    self.mox.StubOutWithMock(common.models.db.Key, 'from_path')
-    self.mox.StubOutWithMock(common.models.Tag, 'GetAllTagNamesForKey')
-
+    common._COMPILED_MODS.clear()
     client_id = {
         'site': 'sitex',
         'os_version': 'os_versionx',
@@ -881,24 +1058,215 @@ class CommonModuleTest(test.RequestHandlerTest):
 
     user_settings = None
     plist_xml = '<plist xml>'
+    self._PutManifestMod(
+        'site', client_id['site'], 'otherpkg', manifests=['othertrack'],
+        install_types=['managed_installs'])
 
-    common.models.SiteManifestModification.MemcacheWrappedGetAllFilter(
-        (('site =', client_id['site']),)).AndReturn([])
-    common.models.OSVersionManifestModification.MemcacheWrappedGetAllFilter(
-        (('os_version =', client_id['os_version']),)).AndReturn([])
-    common.models.OwnerManifestModification.MemcacheWrappedGetAllFilter(
-        (('owner =', client_id['owner']),)).AndRaise([])
-    common.models.UuidManifestModification.MemcacheWrappedGetAllFilter(
-        (('uuid =', client_id['uuid']),)).AndRaise([])
-    common.models.db.Key.from_path('Computer', client_id['uuid']).AndReturn('k')
-    common.models.Tag.GetAllTagNamesForKey('k').AndReturn([])
-
-    self.mox.ReplayAll()
     self.assertTrue(
         common.GenerateDynamicManifest(
             plist_xml, client_id, user_settings) is plist_xml)
+
+    compiled = common.CompiledManifest({}, plist_xml)
+    self.assertTrue(
+        common.GenerateDynamicManifest(
+            compiled, client_id, user_settings) is plist_xml)
+
+  def testGenerateDynamicManifestWithCompiledManifest(self):
+    """Test GenerateDynamicManifest() does not modify a CompiledManifest."""
+    common._COMPILED_MODS.clear()
+    client_id = {
+        'site': 'sitex',
+        'os_version': 'os_versionx',
+        'owner': None,
+        'uuid': None,
+        'track': 'trackx',
+    }
+    contents = {'managed_installs': ['FooPkg']}
+    compiled = common.CompiledManifest(
+        contents, common.plist_module.GetXmlDocument(contents))
+    self._PutManifestMod(
+        'site', client_id['site'], 'BarPkg',
+        install_types=['managed_installs', 'optional_installs'])
+
+    xml_out = common.GenerateDynamicManifest(compiled, client_id)
+
+    pl = common.plist_module.MunkiManifestPlist(xml_out)
+    pl.Parse()
+    self.assertEqual(['FooPkg', 'BarPkg'], pl['managed_installs'])
+    self.assertEqual(['BarPkg'], pl['optional_installs'])
+    self.assertEqual({'managed_installs': ['FooPkg']}, compiled.contents)
+
+  def testGenerateDynamicManifestCachesCompiledMods(self):
+    """Test GenerateDynamicManifest() reuses compiled mods until changed."""
+    common._COMPILED_MODS.clear()
+    client_id = {
+        'site': 'sitex',
+        'os_version': 'os_versionx',
+        'owner': None,
+        'uuid': None,
+        'track': 'trackx',
+    }
+    plist_xml = common.plist_module.GetXmlDocument({'managed_installs': []})
+    self._PutManifestMod(
+        'site', client_id['site'], 'FooPkg',
+        install_types=['managed_installs'])
+
+    xml_out = common.GenerateDynamicManifest(plist_xml, client_id)
+    pl = common.plist_module.MunkiManifestPlist(xml_out)
+    pl.Parse()
+    self.assertEqual(['FooPkg'], pl['managed_installs'])
+
+    # a changed mod invalidates the compiled mods.
+    self._PutManifestMod(
+        'site', client_id['site'], 'BarPkg',
+        install_types=['managed_installs'])
+    xml_out = common.GenerateDynamicManifest(plist_xml, client_id)
+    pl = common.plist_module.MunkiManifestPlist(xml_out)
+    pl.Parse()
+    self.assertEqual(['BarPkg', 'FooPkg'], pl['managed_installs'])
+
+  def testPrefetchCompiledMods(self):
+    """Test _PrefetchCompiledMods()."""
+    common._COMPILED_MODS.clear()
+    self._PutManifestMod(
+        'site', 'foosite', 'FooPkg', install_types=['managed_installs'])
+    self._PutManifestMod(
+        'owner', 'foouser', 'BarPkg', manifests=['stable'],
+        install_types=['optional_installs'])
+    self._PutManifestMod(
+        'owner', 'foouser', 'DisabledPkg', enabled=False,
+        install_types=['optional_installs'])
+    targets = [('site', 'foosite'), ('owner', 'foouser'), ('site', 'foosite')]
+    site_mods = [(frozenset(), ('managed_installs',), 'FooPkg')]
+    owner_mods = [(frozenset(['stable']), ('optional_installs',), 'BarPkg')]
+    expected = [site_mods, owner_mods, site_mods]
+    version = models.BaseManifestModification.GetModsVersion()
+
+    # get_multi, two concurrent queries and set_multi.
+    self.assertEqual(
+        (expected, 4), common._PrefetchCompiledMods(targets, version))
+    # all compiled mods are cached in the instance.
+    self.assertEqual(
+        (expected, 0), common._PrefetchCompiledMods(targets, version))
+    # all mods are cached in memcache.
+    common._COMPILED_MODS.clear()
+    self.assertEqual(
+        (expected, 1), common._PrefetchCompiledMods(targets, version))
+
+  def testPrefetchCompiledModsExpire(self):
+    """Test _PrefetchCompiledMods() reads mods again once cached too long."""
+    common._COMPILED_MODS.clear()
+    self._PutManifestMod(
+        'site', 'foosite', 'FooPkg', install_types=['managed_installs'])
+    key = ('site', 'foosite')
+    version = models.BaseManifestModification.GetModsVersion()
+
+    # get_multi, a query and set_multi.
+    self.assertEqual(3, common._PrefetchCompiledMods([key], version)[1])
+    self.assertEqual(0, common._PrefetchCompiledMods([key], version)[1])
+    unused_version, expires, compiled = common._COMPILED_MODS[key]
+    self.assertTrue(
+        expires - common.COMPILED_MODS_CACHE_SECS <= common.time.time())
+    common._COMPILED_MODS[key] = (version, 0, compiled)
+    # read from memcache again.
+    self.assertEqual(1, common._PrefetchCompiledMods([key], version)[1])
+
+  def testGetCompiledManifest(self):
+    """Test GetCompiledManifest()."""
+    common._COMPILED_MANIFESTS.clear()
+    plist_xml = common.plist_module.GetXmlDocument(
+        {'managed_installs': ['FooPkg']})
+    m = models.Manifest(key_name='stable')
+    m.plist = plist_xml
+    m.put()
+
+    compiled = common.GetCompiledManifest(m)
+    self.assertEqual({'managed_installs': ['FooPkg']}, compiled.contents)
+    self.assertTrue(
+        common.GetCompiledManifest(models.Manifest.get_by_key_name('stable'))
+        is compiled)
+
+    m.plist = common.plist_module.GetXmlDocument(
+        {'managed_installs': ['BarPkg']})
+    m.put()
+    compiled = common.GetCompiledManifest(
+        models.Manifest.get_by_key_name('stable'))
+    self.assertEqual({'managed_installs': ['BarPkg']}, compiled.contents)
+
+  def testComputerManifest(self):
+    """Test ComputerManifest()."""
+    self.stubs.Set(
+        common, '_MANIFEST_RESULT_CACHE', common._ManifestResultCache())
+    self.mox.StubOutWithMock(common, 'IsPanicModeNoPackages')
+    common.IsPanicModeNoPackages().MultipleTimes().AndReturn(False)
+    client_id = {
+        'site': 'foosite', 'os_version': '10.6.5', 'owner': None,
+        'uuid': None, 'track': 'stable',
+    }
+    m = models.Manifest(key_name='stable')
+    m.plist = common.plist_module.GetXmlDocument(
+        {'managed_installs': ['FooPkg']})
+    m.put()
+
+    self.mox.ReplayAll()
+    manifest = common.ComputerManifest(client_id=client_id)
+    xml = manifest.GetXml()
+    self.assertEqual(m.plist.GetXml(), xml)
+
+    # unchanged inputs give the same ETag, and the cached manifest.
+    manifest = common.ComputerManifest(client_id=client_id)
+    self.assertEqual(xml, manifest.GetXml())
+    manifest.NotModified()
+    self.assertEqual(
+        {'hits': 1, 'misses': 1, 'not_modified': 1, 'evictions': 0,
+         'bytes_saved': len(xml), 'hit_ratio': 2.0 / 3},
+        common.GetManifestResultCacheStats())
+
+    # other targets, a manifest modification or manifest change the ETag.
+    etags = set([manifest.etag])
+    etags.add(common.ComputerManifest(
+        client_id=dict(client_id, os_version='10.7')).etag)
+    self._PutManifestMod(
+        'site', 'foosite', 'BarPkg', install_types=['managed_installs'])
+    manifest = common.ComputerManifest(client_id=client_id)
+    etags.add(manifest.etag)
+    pl = common.plist_module.MunkiManifestPlist(manifest.GetXml())
+    pl.Parse()
+    self.assertEqual(['FooPkg', 'BarPkg'], pl['managed_installs'])
+    m.plist = common.plist_module.GetXmlDocument({'managed_installs': []})
+    m.put()
+    etags.add(common.ComputerManifest(client_id=client_id).etag)
+    self.assertEqual(4, len(etags))
+    self.mox.VerifyAll()
+
+  def testComputerManifestIsPanicMode(self):
+    """Test ComputerManifest() in no packages panic mode."""
+    self.stubs.Set(
+        common, '_MANIFEST_RESULT_CACHE', common._ManifestResultCache())
+    self.mox.StubOutWithMock(common, 'IsPanicModeNoPackages')
+    common.IsPanicModeNoPackages().AndReturn(True)
+
+    self.mox.ReplayAll()
+    manifest = common.ComputerManifest(client_id={'uuid': None})
+    self.assertEqual(
+        common.plist_module.PLIST_HEAD + common.plist_module.PLIST_FOOT,
+        manifest.GetXml())
     self.mox.VerifyAll()
 
+  def testManifestResultCacheEviction(self):
+    """Test _ManifestResultCache evicts the least recently used manifests."""
+    cache = common._ManifestResultCache(max_bytes=10)
+    cache.Set('a', 'aaaa')
+    cache.Set('b', 'bbbb')
+    self.assertEqual('aaaa', cache.Get('a'))
+    cache.Set('c', 'cccc')
+    self.assertEqual(None, cache.Get('b'))
+    self.assertEqual('aaaa', cache.Get('a'))
+    self.assertEqual('cccc', cache.Get('c'))
+    cache.Set('d', 'd' * 11)  # too large to cache.
+    self.assertEqual(None, cache.Get('d'))
+    self.assertEqual(1, cache.stats['evictions'])
+
   def testGetComputerManifest(self):
     """Test ComputerInstallsPending()."""
     uuid = 'uuid'
@@ -926,36 +1294,32 @@ class CommonModuleTest(test.RequestHandlerTest):
     computer.connections_off_corp = 1
     computer.user_settings = None
 
-    # PackageInfo entities
-    mock_pl1 = self.mox.CreateMockAnything()
-    mock_pl2 = self.mox.CreateMockAnything()
-    mock_pl3 = self.mox.CreateMockAnything()
-    mock_pl4 = self.mox.CreateMockAnything()
-    package_infos = [
-        test.GenericContainer(plist=mock_pl1, version='1.0', name='fooname1'),
-        test.GenericContainer(plist=mock_pl2, version='1.0', name='fooname2'),
-        test.GenericContainer(plist=mock_pl3, version='1.0', name='fooname3'),
-        test.GenericContainer(plist=mock_pl4, version='1.0', name='fooname4'),
-    ]
-
-    packagemap = {}
+    packagemap = {'fooname1': 'fooname1-1.0', 'fooname2': 'fooname2-1.0'}
 
     self.mox.StubOutWithMock(common.models, 'Computer')
     self.mox.StubOutWithMock(common, 'IsPanicModeNoPackages')
     self.mox.StubOutWithMock(common.models, 'Manifest')
     self.mox.StubOutWithMock(common, 'GenerateDynamicManifest')
+    self.mox.StubOutWithMock(common, 'GetCompiledManifest')
     self.mox.StubOutWithMock(common.plist_module, 'MunkiManifestPlist')
     self.mox.StubOutWithMock(common.models, 'PackageInfo')
     self.mox.StubOutWithMock(common.plist_module, 'MunkiPackageInfoPlist')
+    self.stubs.Set(common, '_GetModTargets', lambda unused_c: ([], 0))
+    self.stubs.Set(
+        common, '_MANIFEST_RESULT_CACHE', common._ManifestResultCache())
 
     # mock manifest creation
     common.models.Computer.get_by_key_name(uuid).AndReturn(computer)
     common.IsPanicModeNoPackages().AndReturn(False)
-    mock_plist = self.mox.CreateMockAnything()
+    mock_manifest = test.GenericContainer(
+        enabled=True, mtime=datetime.datetime(2018, 6, 1))
+    mock_compiled = self.mox.CreateMockAnything()
     common.models.Manifest.MemcacheWrappedGet('track').AndReturn(
-        test.GenericContainer(enabled=True, plist=mock_plist))
+        mock_manifest)
+    common.GetCompiledManifest(mock_manifest).AndReturn(mock_compiled)
     common.GenerateDynamicManifest(
-        mock_plist, client_id, user_settings=None).AndReturn(
+        mock_compiled, client_id, user_settings=None,
+        compiled_mods=[]).AndReturn(
         'manifest_plist')
 
     # mock manifest parsing
@@ -964,26 +1328,8 @@ class CommonModuleTest(test.RequestHandlerTest):
         mock_manifest_plist)
     mock_manifest_plist.Parse().AndReturn(None)
 
-    # mock manifest reading and package map creation
-    mock_package_info = self.mox.CreateMockAnything()
-    common.models.PackageInfo.all().AndReturn(mock_package_info)
-    iter_return = []
-
-    for package_info in package_infos:
-      iter_return.append(test.GenericContainer(
-          plist=package_info.plist,
-          name=package_info.name))
-      package_info.plist.get('display_name', None).AndReturn(None)
-      package_info.plist.get('name').AndReturn(package_info.name)
-      package_info.plist.get('version', '').AndReturn(package_info.version)
-      packagemap[package_info.name] = '%s-%s' % (
-          package_info.name, package_info.version)
-
-    def __iter_func():
-      for i in iter_return:
-        yield i
-
-    mock_package_info.__iter__().AndReturn(__iter_func())
+    # mock package map reading
+    common.models.PackageInfo.GetPackageMap().AndReturn(packagemap)
 
     manifest_expected = {
         'plist': mock_manifest_plist,
@@ -1028,18 +1374,26 @@ class CommonModuleTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(common, 'IsPanicModeNoPackages')
     self.mox.StubOutWithMock(common.models, 'Manifest')
     self.mox.StubOutWithMock(common, 'GenerateDynamicManifest')
+    self.mox.StubOutWithMock(common, 'GetCompiledManifest')
     self.mox.StubOutWithMock(common.plist_module, 'MunkiManifestPlist')
     self.mox.StubOutWithMock(common.models, 'PackageInfo')
     self.mox.StubOutWithMock(common.plist_module, 'MunkiPackageInfoPlist')
+    self.stubs.Set(common, '_GetModTargets', lambda unused_c: ([], 0))
+    self.stubs.Set(
+        common, '_MANIFEST_RESULT_CACHE', common._ManifestResultCache())
 
     # mock manifest creation
     common.models.Computer.get_by_key_name(uuid).AndReturn(computer)
     common.IsPanicModeNoPackages().AndReturn(False)
-    mock_plist = self.mox.CreateMockAnything()
+    mock_manifest = test.GenericContainer(
+        enabled=True, mtime=datetime.datetime(2018, 6, 1))
+    mock_compiled = self.mox.CreateMockAnything()
     common.models.Manifest.MemcacheWrappedGet('track').AndReturn(
-        test.GenericContainer(enabled=True, plist=mock_plist))
+        mock_manifest)
+    common.GetCompiledManifest(mock_manifest).AndReturn(mock_compiled)
     common.GenerateDynamicManifest(
-        mock_plist, client_id, user_settings=None).AndReturn(None)
+        mock_compiled, client_id, user_settings=None,
+        compiled_mods=[]).AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertRaises(
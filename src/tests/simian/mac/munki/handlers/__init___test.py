@@ -65,6 +65,24 @@ class HandlersTest(test.RequestHandlerTest):
     dt = datetime.datetime(2010, 10, 06, 03, 23, 34)  # later date
     self.assertTrue(handlers.IsClientResourceExpired(dt, header_dt_str))
 
+  def testIsETagInHeader(self):
+    """Tests IsETagInHeader()."""
+    etags = ['abc', 'abc-gzip']
+    self.assertTrue(handlers.IsETagInHeader(etags, '"abc"'))
+    self.assertTrue(handlers.IsETagInHeader(etags, '"x", W/"abc-gzip"'))
+    self.assertTrue(handlers.IsETagInHeader(etags, '*'))
+    self.assertFalse(handlers.IsETagInHeader(etags, '"abcd"'))
+    self.assertFalse(handlers.IsETagInHeader(etags, ''))
+
+  def testIsEncodingAccepted(self):
+    """Tests IsEncodingAccepted()."""
+    self.assertTrue(handlers.IsEncodingAccepted('gzip', 'gzip, deflate'))
+    self.assertTrue(handlers.IsEncodingAccepted('gzip', 'GZIP;q=0.5'))
+    self.assertTrue(handlers.IsEncodingAccepted('gzip', '*'))
+    self.assertFalse(handlers.IsEncodingAccepted('gzip', 'gzip;q=0'))
+    self.assertFalse(handlers.IsEncodingAccepted('gzip', 'deflate'))
+    self.assertFalse(handlers.IsEncodingAccepted('gzip', ''))
+
   def testGetClientIdForRequestWithSession(self):
     """Tests GetClientIdForRequest()."""
     track = 'stable'
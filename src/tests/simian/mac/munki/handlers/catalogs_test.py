@@ -66,6 +66,53 @@ class CatalogsHandlersTest(basetest.TestCase):
     resp = self.testapp.get('/catalogs/' + name, status=httplib.OK)
     self.assertTrue(resp.body.find('plist') != -1)
 
+  def _PutCatalog(self, name, catalog_xml):
+    c = models.Catalog(key_name=name, name=name, _plist=catalog_xml)
+    c.SetCompressedVariant(catalog_xml)
+    c.put()
+    return c
+
+  def testGetGzip(self, _):
+    """Tests Catalogs.get() of the compressed variant."""
+    name = 'goodname'
+    catalog_xml = '<plist><dict></dict></plist>'
+    c = self._PutCatalog(name, catalog_xml)
+
+    resp = self.testapp.get(
+        '/catalogs/' + name, headers={'Accept-Encoding': 'gzip'},
+        status=httplib.OK)
+
+    self.assertEqual('gzip', resp.headers['Content-Encoding'])
+    self.assertEqual('"%s-gzip"' % c.plist_sha256, resp.headers['ETag'])
+    self.assertEqual(c.plist_gzip, resp.body)
+
+  def testGetWithoutGzip(self, _):
+    """Tests Catalogs.get() without Accept-Encoding."""
+    name = 'goodname'
+    catalog_xml = '<plist><dict></dict></plist>'
+    c = self._PutCatalog(name, catalog_xml)
+
+    resp = self.testapp.get('/catalogs/' + name, status=httplib.OK)
+
+    self.assertNotIn('Content-Encoding', resp.headers)
+    self.assertEqual('"%s"' % c.plist_sha256, resp.headers['ETag'])
+    self.assertEqual(catalog_xml, resp.body)
+
+  def testGetIfNoneMatch(self, _):
+    """Tests Catalogs.get() with a matching If-None-Match."""
+    name = 'goodname'
+    c = self._PutCatalog(name, '<plist><dict></dict></plist>')
+
+    for etag in [c.plist_sha256, c.plist_sha256 + '-gzip']:
+      self.testapp.get(
+          '/catalogs/' + name,
+          headers={'If-None-Match': '"%s"' % etag,
+                   'Accept-Encoding': 'gzip'},
+          status=httplib.NOT_MODIFIED)
+    self.testapp.get(
+        '/catalogs/' + name, headers={'If-None-Match': '"other"'},
+        status=httplib.OK)
+
   def testGet404(self, _):
     """Tests Catalogs.get() where name is not found."""
     name = 'badname'
@@ -37,36 +37,62 @@ class HandlersTest(test.RequestHandlerTest):
     client_id = {'track': 'track'}
     session = 'session'
     plist_xml = 'manifest xml'
+    manifest = self.mox.CreateMockAnything()
+    manifest.etag = 'etag'
 
     self.mox.StubOutWithMock(manifests.handlers, 'GetClientIdForRequest')
-    self.mox.StubOutWithMock(manifests.common, 'GetComputerManifest')
+    self.mox.StubOutWithMock(manifests.common, 'ComputerManifest')
 
     self.MockDoAnyAuth(and_return=session)
     manifests.handlers.GetClientIdForRequest(
         self.request, session=session, client_id_str='').AndReturn(client_id)
-    manifests.common.GetComputerManifest(
-        client_id=client_id, packagemap=False).AndReturn(plist_xml)
+    manifests.common.ComputerManifest(client_id=client_id).AndReturn(manifest)
+    self.request.headers.get('If-None-Match', '').AndReturn('"other"')
+    manifest.GetXml().AndReturn(plist_xml)
     self.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+    self.response.headers['ETag'] = '"etag"'
     self.response.out.write(plist_xml).AndReturn(None)
 
     self.mox.ReplayAll()
     self.c.get()
     self.mox.VerifyAll()
 
+  def testGetNotModified(self):
+    """Tests Manifests.get() when the client has the current manifest."""
+    client_id = {'track': 'track'}
+    session = 'session'
+    manifest = self.mox.CreateMockAnything()
+    manifest.etag = 'etag'
+
+    self.mox.StubOutWithMock(manifests.handlers, 'GetClientIdForRequest')
+    self.mox.StubOutWithMock(manifests.common, 'ComputerManifest')
+
+    self.MockDoAnyAuth(and_return=session)
+    manifests.handlers.GetClientIdForRequest(
+        self.request, session=session, client_id_str='').AndReturn(client_id)
+    manifests.common.ComputerManifest(client_id=client_id).AndReturn(manifest)
+    self.request.headers.get('If-None-Match', '').AndReturn('"etag"')
+    manifest.NotModified().AndReturn(None)
+    self.response.headers['ETag'] = '"etag"'
+    self.response.set_status(httplib.NOT_MODIFIED).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.c.get()
+    self.mox.VerifyAll()
+
   def testGetSuccessWhenManifestNotFoundError(self):
     """Tests Manifests.get()."""
     client_id = {'track': 'track'}
     session = 'session'
 
     self.mox.StubOutWithMock(manifests.handlers, 'GetClientIdForRequest')
-    self.mox.StubOutWithMock(manifests.common, 'GetComputerManifest')
+    self.mox.StubOutWithMock(manifests.common, 'ComputerManifest')
 
     self.MockDoAnyAuth(and_return=session)
     manifests.handlers.GetClientIdForRequest(
         self.request, session=session, client_id_str='').AndReturn(client_id)
-    manifests.common.GetComputerManifest(
-        client_id=client_id, packagemap=False).AndRaise(
-            manifests.common.ManifestNotFoundError)
+    manifests.common.ComputerManifest(client_id=client_id).AndRaise(
+        manifests.common.ManifestNotFoundError)
     self.response.set_status(httplib.NOT_FOUND).AndReturn(None)
 
     self.mox.ReplayAll()
@@ -79,14 +105,13 @@ class HandlersTest(test.RequestHandlerTest):
     session = 'session'
 
     self.mox.StubOutWithMock(manifests.handlers, 'GetClientIdForRequest')
-    self.mox.StubOutWithMock(manifests.common, 'GetComputerManifest')
+    self.mox.StubOutWithMock(manifests.common, 'ComputerManifest')
 
     self.MockDoAnyAuth(and_return=session)
     manifests.handlers.GetClientIdForRequest(
         self.request, session=session, client_id_str='').AndReturn(client_id)
-    manifests.common.GetComputerManifest(
-        client_id=client_id, packagemap=False).AndRaise(
-            manifests.common.ManifestDisabledError)
+    manifests.common.ComputerManifest(client_id=client_id).AndRaise(
+        manifests.common.ManifestDisabledError)
     self.response.set_status(httplib.SERVICE_UNAVAILABLE).AndReturn(None)
 
     self.mox.ReplayAll()
@@ -99,14 +124,13 @@ class HandlersTest(test.RequestHandlerTest):
     session = 'session'
 
     self.mox.StubOutWithMock(manifests.handlers, 'GetClientIdForRequest')
-    self.mox.StubOutWithMock(manifests.common, 'GetComputerManifest')
+    self.mox.StubOutWithMock(manifests.common, 'ComputerManifest')
 
     self.MockDoAnyAuth(and_return=session)
     manifests.handlers.GetClientIdForRequest(
         self.request, session=session, client_id_str='').AndReturn(client_id)
-    manifests.common.GetComputerManifest(
-        client_id=client_id, packagemap=False).AndRaise(
-            manifests.common.Error)
+    manifests.common.ComputerManifest(client_id=client_id).AndRaise(
+        manifests.common.Error)
     self.response.set_status(httplib.SERVICE_UNAVAILABLE).AndReturn(None)
 
     self.mox.ReplayAll()
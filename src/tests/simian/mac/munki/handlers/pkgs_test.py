@@ -51,7 +51,9 @@ class PackagesHandlerTest(PackagesTest):
   def GetTestClassModule(self):
     return pkgs
 
-  def testGetSuccessHelper(self, pkg_modified_since=True, supply_etag='etag'):
+  def testGetSuccessHelper(
+      self, pkg_modified_since=True, supply_etag='etag', if_range='',
+      use_range=True):
     """Tests Packages.get()."""
     filename = u'good name.dmg'
     filename_quoted = 'good%20name.dmg'
@@ -89,7 +91,9 @@ class PackagesHandlerTest(PackagesTest):
       self.response.headers['Last-Modified'] = pkg_date.strftime(
           pkgs.handlers.HEADER_DATE_FORMAT)
       self.response.headers['X-Download-Size'] = str(pkg_size)
-      self.c.send_blob(blobstore_key).AndReturn(None)
+      self.response.headers['Accept-Ranges'] = 'bytes'
+      self.request.headers.get('If-Range', '').AndReturn(if_range)
+      self.c.send_blob(blobstore_key, use_range=use_range).AndReturn(None)
     else:
       if supply_etag:
         self.response.headers['ETag'] = supply_etag
@@ -152,6 +156,18 @@ class PackagesHandlerTest(PackagesTest):
     """Tests get() where the If-Modified-Since date is older than pkg date."""
     self.testGetSuccessHelper(pkg_modified_since=False, supply_etag=None)
 
+  def testGetSuccessWithRangeIfRangeMatch(self):
+    """Tests get() resuming a download of the current package."""
+    self.testGetSuccessHelper(
+        pkg_modified_since=True, supply_etag='etag', if_range='etag',
+        use_range=True)
+
+  def testGetSuccessWithRangeIfRangeNoMatch(self):
+    """Tests get() sends the whole package if the partial file is outdated."""
+    self.testGetSuccessHelper(
+        pkg_modified_since=True, supply_etag='etag', if_range='oldetag',
+        use_range=False)
+
   def testGet412WherePackageEtagNoMatch(self):
     """Tests get() where If-Match etag does not match package etag."""
     self._GetFailureHelper(
@@ -296,9 +296,10 @@ class HandlersTest(test.RequestHandlerTest):
     user_settings = None
     user_settings_data = None
 
-    mock_computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
     report_feedback = {}
     if report_type == 'preflight':
+      mock_computer = self.MockModelStatic(
+          'Computer', 'get_by_key_name', uuid)
       report_feedback = {'force_continue': True}
       self.c.GetReportFeedback(
           uuid, report_type, computer=mock_computer,
@@ -323,7 +324,7 @@ class HandlersTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(reports.common, 'LogClientConnection')
     reports.common.LogClientConnection(
         report_type, client_id_dict, user_settings, pkgs_to_install,
-        apple_updates_to_install, computer=mock_computer, ip_address=ip_address,
+        apple_updates_to_install, ip_address=ip_address,
         report_feedback=report_feedback, cert_fingerprint=None)
 
 
@@ -339,14 +340,13 @@ class HandlersTest(test.RequestHandlerTest):
     """Tests post() with _report_type=postflight."""
     self.PostPreflightOrPostflight(report_type='postflight')
 
-  def PostInstallReportInstallsLegacy(self, on_corp=True):
-    """Tests post() with _report_type=install_report with old style strings."""
+  def LogInstallReportInstallsLegacy(self, on_corp=True):
+    """Tests LogInstallReport() with old style strings."""
     uuid = 'foouuid'
     computer = reports.models.Computer(key_name=uuid)
     computer.uuid = uuid
     self.mox.StubOutWithMock(reports.models.Computer, 'get_by_key_name')
     reports.models.Computer.get_by_key_name(uuid).AndReturn(computer)
-    report_type = 'install_report'
     installs = [
         'Install of Foo App1-1.0.0: %s' % reports.INSTALL_RESULT_SUCCESSFUL,
         'Install of Foo App2-123123: %s' % reports.INSTALL_RESULT_SUCCESSFUL,
@@ -354,40 +354,39 @@ class HandlersTest(test.RequestHandlerTest):
         'Install of Foo App4-456456: %s: -5' % reports.INSTALL_RESULT_FAILED,
         'Install of broken string, so m.group(#) raises AttributeError',
     ]
-    self.PostSetup(uuid=uuid, report_type=report_type)
-    self.request.get_all('installs').AndReturn(installs)
-    if on_corp:
-      self.request.get('on_corp').AndReturn('1')
-    else:
-      self.request.get('on_corp').AndReturn('0')
 
     self.mox.StubOutWithMock(reports.models, 'InstallLog')
     mock_install = self.mox.CreateMockAnything()
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='Foo App1-1.0.0',
         status='0', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=None, dl_kbytes_per_sec=None,
         mtime=mox.IsA(datetime.datetime)).AndReturn(mock_install)
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='Foo App2-123123',
         status='0', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=None, dl_kbytes_per_sec=None,
         mtime=mox.IsA(datetime.datetime)).AndReturn(mock_install)
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='Foo App3-2.1.1',
         status='1', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=None, dl_kbytes_per_sec=None,
         mtime=mox.IsA(datetime.datetime)).AndReturn(mock_install)
     mock_install.success = mock_install.IsSuccess().AndReturn(False)
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='Foo App4-456456',
         status='-5', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=None, dl_kbytes_per_sec=None,
         mtime=mox.IsA(datetime.datetime)).AndReturn(mock_install)
     mock_install.success = mock_install.IsSuccess().AndReturn(False)
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package=installs[-1] + '-',
         status='UNKNOWN', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=None, dl_kbytes_per_sec=None,
@@ -395,32 +394,32 @@ class HandlersTest(test.RequestHandlerTest):
             mock_install)
     mock_install.success = mock_install.IsSuccess().AndReturn(False)
 
-    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
-    reports.gae_util.BatchDatastoreOp(reports.models.db.put, mox.IsA(list))
-
-    self.request.get_all('removals').AndReturn([])
-    self.request.get_all('problem_installs').AndReturn([])
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOpAsync')
+    reports.gae_util.BatchDatastoreOpAsync(
+        reports.models.db.put_async, [mock_install] * len(installs))
+    self.mox.StubOutWithMock(reports.install_stats, 'LogInstalls')
+    reports.install_stats.LogInstalls(
+        [mock_install] * len(installs), name=mox.StrContains('install-report-'))
 
     self.mox.ReplayAll()
-    self.c.post()
+    reports.LogInstallReport(uuid, installs, [], [], on_corp and '1' or '0')
     self.mox.VerifyAll()
 
-  def testPostInstallReportInstallsOnCorpLegacy(self):
-    """Tests post() with _report_type=install_report on_corp=1."""
-    self.PostInstallReportInstallsLegacy(on_corp=True)
+  def testLogInstallReportInstallsOnCorpLegacy(self):
+    """Tests LogInstallReport() with on_corp=1."""
+    self.LogInstallReportInstallsLegacy(on_corp=True)
 
-  def testPostInstallReportInstallsOffCorpLegacy(self):
-    """Tests post() with _report_type=install_report on_corp=0."""
-    self.PostInstallReportInstallsLegacy(on_corp=False)
+  def testLogInstallReportInstallsOffCorpLegacy(self):
+    """Tests LogInstallReport() with on_corp=0."""
+    self.LogInstallReportInstallsLegacy(on_corp=False)
 
-  def PostInstallReportInstalls(self, on_corp=True):
-    """Tests post() with _report_type=install_report with old style strings."""
+  def LogInstallReportInstalls(self, on_corp=True):
+    """Tests LogInstallReport() with key=value strings."""
     uuid = 'foouuid'
     computer = reports.models.Computer(key_name=uuid)
     computer.uuid = uuid
     self.mox.StubOutWithMock(reports.models.Computer, 'get_by_key_name')
     reports.models.Computer.get_by_key_name(uuid).AndReturn(computer)
-    report_type = 'install_report'
     installs = [
         ('name=FooApp1|version=1.0.0|applesus=0|status=0|duration_seconds=100'
          '|download_kbytes_per_sec=225'),
@@ -442,17 +441,12 @@ class HandlersTest(test.RequestHandlerTest):
         ('name=Safari|version=5.1.0|applesus=true|unattended=true|status=0'
          '|duration_seconds=4'),
     ]
-    self.PostSetup(uuid=uuid, report_type=report_type)
-    self.request.get_all('installs').AndReturn(installs)
-    if on_corp:
-      self.request.get('on_corp').AndReturn('1')
-    else:
-      self.request.get('on_corp').AndReturn('0')
 
     self.mox.StubOutWithMock(reports.models, 'InstallLog')
     mock_install = self.mox.CreateMockAnything()
     # successful munki install report, lacking time.
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='FooApp1-1.0.0',
         status='0', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=100, mtime=mox.IsA(datetime.datetime),
@@ -460,6 +454,7 @@ class HandlersTest(test.RequestHandlerTest):
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
     # failed munki install report, with time.
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='FooApp2-2.1.1',
         status='2', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=200, mtime=datetime.datetime(2011, 8, 8, 15, 42, 59),
@@ -467,6 +462,7 @@ class HandlersTest(test.RequestHandlerTest):
     mock_install.success = mock_install.IsSuccess().AndReturn(False)
     # successful munki install report, with display_name reported.
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='FooApp3-3.7',
         status='0', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=300, mtime=datetime.datetime(2011, 8, 8, 15, 42, 59),
@@ -474,6 +470,7 @@ class HandlersTest(test.RequestHandlerTest):
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
     # successful munki install report, with future time.
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='FutureApp-9.9.9',
         status='0', on_corp=on_corp, applesus=False, unattended=False,
         duration_seconds=60, mtime=mox.IsA(datetime.datetime),
@@ -481,6 +478,7 @@ class HandlersTest(test.RequestHandlerTest):
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
     # successful applesus install report with bogus time.
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='iTunes-10.2.0',
         status='0', on_corp=on_corp, applesus=True, unattended=False,
         duration_seconds=300, mtime=mox.IsA(datetime.datetime),
@@ -488,82 +486,149 @@ class HandlersTest(test.RequestHandlerTest):
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
     # successful applesus install report with no time.
     reports.models.InstallLog(
+        key_name=mox.StrContains('_install_'),
         uuid=uuid, computer=computer, package='Safari-5.1.0',
         status='0', on_corp=on_corp, applesus=True, unattended=True,
         duration_seconds=4, mtime=mox.IsA(datetime.datetime),
         dl_kbytes_per_sec=None).AndReturn(mock_install)
     mock_install.success = mock_install.IsSuccess().AndReturn(True)
 
-    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
-    reports.gae_util.BatchDatastoreOp(reports.models.db.put, mox.IsA(list))
-
-    self.request.get_all('removals').AndReturn([])
-    self.request.get_all('problem_installs').AndReturn([])
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOpAsync')
+    reports.gae_util.BatchDatastoreOpAsync(
+        reports.models.db.put_async, [mock_install] * len(installs))
+    self.mox.StubOutWithMock(reports.install_stats, 'LogInstalls')
+    reports.install_stats.LogInstalls(
+        [mock_install] * len(installs), name=mox.StrContains('install-report-'))
 
     self.mox.ReplayAll()
-    self.c.post()
+    reports.LogInstallReport(uuid, installs, [], [], on_corp and '1' or '0')
     self.mox.VerifyAll()
 
-  def testPostInstallReportInstallsOnCorp(self):
-    """Tests post() with _report_type=install_report on_corp=1."""
-    self.PostInstallReportInstalls(on_corp=True)
+  def testLogInstallReportInstallsOnCorp(self):
+    """Tests LogInstallReport() with on_corp=1."""
+    self.LogInstallReportInstalls(on_corp=True)
 
-  def testPostInstallReportInstallsOffCorp(self):
-    """Tests post() with _report_type=install_report on_corp=0."""
-    self.PostInstallReportInstalls(on_corp=False)
+  def testLogInstallReportInstallsOffCorp(self):
+    """Tests LogInstallReport() with on_corp=0."""
+    self.LogInstallReportInstalls(on_corp=False)
 
-  def testPostInstallReportRemovals(self):
-    """Tests post() with _report_type=install_report."""
+  def testLogInstallReportRemovalsAndProblems(self):
+    """Tests LogInstallReport() with removals and problem installs."""
     uuid = 'foouuid'
-    report_type = 'install_report'
-    self.PostSetup(uuid=uuid, report_type=report_type)
     computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
-    self.request.get_all('installs').AndReturn([])
-    self.request.get_all('removals').AndReturn(['removal1', 'removal2'])
+    # format expected from Munki.
+    problem1 = 'FooPkg 9.9_10-2: Download failed (Error 100: download halted.)'
+    # format NOT expected from Munki, to test that we don't crash.
+    problem2 = 'UNKNOWN FORMAT'
 
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer, action='removal',
-        details='removal1')
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer, action='removal',
-        details='removal2')
-    self.request.get_all('problem_installs').AndReturn([])
+    self.mox.StubOutWithMock(reports.models, 'ClientLog')
+    logs = []
+    for action, details in [
+        ('removal', 'removal1'), ('removal', 'removal2'),
+        ('install_problem', problem1), ('install_problem', problem2)]:
+      logs.append(self.mox.CreateMockAnything())
+      reports.models.ClientLog(
+          key_name=mox.StrContains('_%s_' % action), uuid=uuid,
+          computer=computer, action=action, details=details).AndReturn(
+              logs[-1])
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOpAsync')
+    reports.gae_util.BatchDatastoreOpAsync(reports.models.db.put_async, logs)
+    self.mox.StubOutWithMock(reports.install_stats, 'LogInstalls')
+    reports.install_stats.LogInstalls(
+        [], name=mox.StrContains('install-report-'))
 
     self.mox.ReplayAll()
-    self.c.post()
+    reports.LogInstallReport(
+        uuid, [], ['removal1', 'removal2'], [problem1, problem2], None)
+    self.mox.VerifyAll()
+
+  def testLogInstallReportRetried(self):
+    """Tests LogInstallReport() writes the same entities when retried."""
+    self.mox.StubOutWithMock(reports.models.Computer, 'get_by_key_name')
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOpAsync')
+    self.mox.StubOutWithMock(reports.install_stats, 'LogInstalls')
+    entities = []
+    names = []
+    for _ in xrange(2):
+      reports.models.Computer.get_by_key_name('foouuid').AndReturn(None)
+      reports.gae_util.BatchDatastoreOpAsync(
+          reports.models.db.put_async, mox.IgnoreArg()).WithSideEffects(
+              lambda unused_op, e: entities.append(e))
+      reports.install_stats.LogInstalls(
+          mox.IgnoreArg(), name=mox.IgnoreArg()).WithSideEffects(
+              lambda unused_installs, name: names.append(name))
+
+    self.mox.ReplayAll()
+    for _ in xrange(2):
+      reports.LogInstallReport(
+          'foouuid', ['name=FooApp1|version=1|status=0'] * 2, ['removal1'],
+          [], '1', received_time=1312818179.1415989)
     self.mox.VerifyAll()
 
-  def testPostInstallReportProblems(self):
-    """Tests post() with _report_type=install_report."""
+    key_names = [[e.key().name() for e in l] for l in entities]
+    self.assertEqual(3, len(set(key_names[0])))
+    self.assertEqual(key_names[0], key_names[1])
+    self.assertEqual(names[0], names[1])
+
+  def PostInstallReport(self, queue=reports.INSTALL_REPORT_QUEUE):
+    """Sets up post() mocks for an _report_type=install_report."""
     uuid = 'foouuid'
-    report_type = 'install_report'
-    self.PostSetup(uuid=uuid, report_type=report_type)
-    computer = self.MockModelStatic('Computer', 'get_by_key_name', uuid)
-    self.request.get_all('installs').AndReturn([])
-    self.request.get_all('removals').AndReturn([])
+    self.PostSetup(uuid=uuid, report_type='install_report')
+    self.request.get_all('installs').AndReturn(['install1'])
+    self.request.get_all('removals').AndReturn(['removal1'])
+    self.request.get_all('problem_installs').AndReturn(['problem1'])
+    self.request.get('on_corp').AndReturn('1')
+    self.stubs.Set(reports, 'INSTALL_REPORT_QUEUE', queue)
+    self.mox.StubOutWithMock(reports, 'time')
+    reports.time.time().AndReturn(1000.0)
+    return (uuid, ['install1'], ['removal1'], ['problem1'], '1', 1000.0)
+
+  def testPostInstallReport(self):
+    """Tests post() with _report_type=install_report defers the writes."""
+    args = self.PostInstallReport()
+    self.mox.StubOutWithMock(reports.deferred, 'defer')
+    reports.deferred.defer(
+        reports.LogInstallReport, *args, _queue=reports.INSTALL_REPORT_QUEUE)
 
-    # format expected from Munki.
-    problem1_pkg = 'FooPkg 9.9_10-2'
-    problem1_err = 'Error 100: download halted.'
-    problem1 = '%s: Download failed (%s)' % (problem1_pkg, problem1_err)
-    # format NOT expected from Munki, to test that we don't crash.
-    problem2 = 'UNKNOWN FORMAT'
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
 
-    self.request.get_all('problem_installs').AndReturn([problem1, problem2])
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer,
-        action='install_problem', details=problem1)
-    reports.common.WriteClientLog(
-        reports.models.ClientLog, uuid, computer=computer,
-        action='install_problem', details=problem2)
+  def testPostInstallReportDeferError(self):
+    """Tests post() with _report_type=install_report when defer fails."""
+    args = self.PostInstallReport()
+    self.mox.StubOutWithMock(reports.deferred, 'defer')
+    reports.deferred.defer(
+        reports.LogInstallReport, *args,
+        _queue=reports.INSTALL_REPORT_QUEUE).AndRaise(
+            reports.taskqueue.TransientError)
+    self.mox.StubOutWithMock(reports, 'LogInstallReport')
+    reports.LogInstallReport(*args)
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+  def testPostInstallReportWithoutQueue(self):
+    """Tests post() with _report_type=install_report and no queue."""
+    args = self.PostInstallReport(queue=None)
+    self.mox.StubOutWithMock(reports, 'LogInstallReport')
+    reports.LogInstallReport(*args)
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
 
-    matched1_pkg, matched1_err = reports.DOWNLOAD_FAILED_STRING_REGEX.search(
-        problem1).groups()
+  def testPostInstallReportEmpty(self):
+    """Tests post() with an empty _report_type=install_report."""
+    self.PostSetup(uuid='foouuid', report_type='install_report')
+    self.request.get_all('installs').AndReturn([])
+    self.request.get_all('removals').AndReturn([])
+    self.request.get_all('problem_installs').AndReturn([])
+    self.mox.StubOutWithMock(reports, 'LogInstallReport')
 
     self.mox.ReplayAll()
     self.c.post()
-    self.assertEqual(problem1_pkg, matched1_pkg)
-    self.assertEqual(problem1_err, matched1_err)
     self.mox.VerifyAll()
 
   def testPostBrokenClient(self):
@@ -603,6 +668,34 @@ class HandlersTest(test.RequestHandlerTest):
     self.c.post()
     self.mox.VerifyAll()
 
+  def testPostMsuLogs(self):
+    """Tests post() with _report_type = msu_logs."""
+    uuid = 'fooooooo'
+    self.PostSetup(uuid=uuid, report_type='msu_logs')
+    self.mox.StubOutWithMock(reports.common, 'WriteComputerMSULogs')
+    logs = [{'event': 'launched', 'source': 'MSU'}, {'event': 'quit'}]
+
+    self.request.get('logs').AndReturn(json.dumps(logs))
+    reports.common.WriteComputerMSULogs(uuid, logs).AndReturn(1)
+    self.response.out.write('2')
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+  def testPostMsuLogsWhenInvalid(self):
+    """Tests post() with _report_type = msu_logs and invalid logs."""
+    uuid = 'fooooooo'
+    self.PostSetup(uuid=uuid, report_type='msu_logs')
+    self.mox.StubOutWithMock(reports.common, 'WriteComputerMSULogs')
+
+    # not a list of logs, so no number of logs is returned.
+    self.request.get('logs').AndReturn('{"event": "launched"}')
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
   def testPostUnknownReportType(self):
     """Tests post() with an unknown _report_type."""
     uuid = 'foouuid'
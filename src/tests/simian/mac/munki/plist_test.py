@@ -19,6 +19,7 @@
 import base64
 import datetime
 import pprint
+import StringIO
 
 import mox
 import stubout
@@ -72,10 +73,19 @@ class PlistModuleTest(mox.MoxTestBase):
   def testEscapeString(self):
     """Test EscapeString()."""
     self.mox.StubOutWithMock(plist.xml.sax.saxutils, 'escape')
-    plist.xml.sax.saxutils.escape('notescaped').AndReturn('escaped')
+    plist.xml.sax.saxutils.escape('not<escaped').AndReturn('escaped')
 
     self.mox.ReplayAll()
-    self.assertEqual('escaped', plist.EscapeString('notescaped'))
+    self.assertEqual('escaped', plist.EscapeString('not<escaped'))
+    self.mox.VerifyAll()
+
+  def testEscapeStringNothingToEscape(self):
+    """Test EscapeString() with a str that needs no escaping."""
+    self.mox.StubOutWithMock(plist.xml.sax.saxutils, 'escape')
+
+    self.mox.ReplayAll()
+    self.assertEqual('notescaped', plist.EscapeString('notescaped'))
+    self.assertEqual(u'notescaped', plist.EscapeString(u'notescaped'))
     self.mox.VerifyAll()
 
 
@@ -502,6 +512,87 @@ AAAAAAAAfA==""")
     self.apl._plist_xml = plist_xml
     self.assertEqual(content_xml, self.apl.GetXml(xml_doc=False))
 
+  def testGetXmlCached(self):
+    """Test GetXml() only serializes an unchanged plist once."""
+    self.apl.LoadPlist(plist.GetXmlDocument({'foo': 'bar'}))
+    self.apl.Parse()
+    self.mox.StubOutWithMock(plist, 'GetXmlStr')
+    plist.GetXmlStr({'foo': 'bar'}, indent_num=1).AndReturn('XML')
+    plist.GetXmlStr({'foo': 'bar'}, indent_num=0).AndReturn('CONTENT')
+
+    self.mox.ReplayAll()
+    xml = ''.join([plist.PLIST_HEAD, 'XML', plist.PLIST_FOOT])
+    self.assertEqual(xml, self.apl.GetXml())
+    self.assertEqual(xml, self.apl.GetXml())
+    self.assertEqual('CONTENT', self.apl.GetXmlContent())
+    self.assertEqual('CONTENT', self.apl.GetXmlContent())
+    self.assertEqual('bar', self.apl['foo'])
+    self.assertEqual('CONTENT', self.apl.GetXmlContent())
+    self.mox.VerifyAll()
+
+  def testGetXmlCacheDiscardedOnChange(self):
+    """Test GetXml() after changes through all ApplePlist methods."""
+    self.apl._plist = {'foo': 'bar', 'list': [1]}
+    self.apl.GetXml()
+
+    self.apl['foo'] = 'zoo'
+    self.assertEqual(
+        plist.GetXmlDocument({'foo': 'zoo', 'list': [1]}), self.apl.GetXml())
+
+    self.apl['list'].append(2)
+    self.assertEqual(
+        plist.GetXmlDocument({'foo': 'zoo', 'list': [1, 2]}),
+        self.apl.GetXml())
+
+    self.apl.GetContents()['list'].append(3)
+    self.assertEqual(
+        plist.GetXmlDocument({'foo': 'zoo', 'list': [1, 2, 3]}),
+        self.apl.GetXml())
+
+    del self.apl['foo']
+    self.assertEqual(
+        plist.GetXmlDocument({'list': [1, 2, 3]}), self.apl.GetXml())
+
+    self.apl._plist = ['replaced']
+    self.assertEqual(plist.GetXmlDocument(['replaced']), self.apl.GetXml())
+
+  def testGetXmlNotCachedAfterExposure(self):
+    """Test GetXml() once lists or dicts of the plist were exposed."""
+    xml = plist.GetXmlDocument({'catalogs': ['a'], 'receipts': [{'a': 1}]})
+    apl = plist.ApplePlist(xml)
+    apl.Parse()
+    catalogs = apl['catalogs']
+    self.assertEqual(xml, apl.GetXml())
+    catalogs.append('b')
+    self.assertEqual(
+        plist.GetXmlDocument({'catalogs': ['a', 'b'], 'receipts': [{'a': 1}]}),
+        apl.GetXml())
+
+    apl = plist.ApplePlist(xml)
+    apl.Parse()
+    contents = apl.GetContents()
+    self.assertEqual(xml, apl.GetXml())
+    contents['receipts'][0]['a'] = 2
+    self.assertEqual(
+        plist.GetXmlDocument({'catalogs': ['a'], 'receipts': [{'a': 2}]}),
+        apl.GetXml())
+
+    apl = plist.ApplePlist(plist.GetXmlDocument([{'a': 1}]))
+    apl.Parse()
+    self.assertEqual(plist.GetXmlDocument([{'a': 1}]), apl.GetXml())
+    for item in apl:
+      item['a'] = 2
+    self.assertEqual(plist.GetXmlDocument([{'a': 2}]), apl.GetXml())
+
+  def testGetXmlCacheDiscardedOnSetChanged(self):
+    """Test GetXml() after SetChanged() for a change it could not detect."""
+    self.apl.LoadPlist(plist.GetXmlDocument({'list': [1]}))
+    self.apl.Parse()
+    self.apl.GetXml()
+    self.apl._plist['list'].append(2)
+    self.apl.SetChanged()
+    self.assertEqual(plist.GetXmlDocument({'list': [1, 2]}), self.apl.GetXml())
+
   def testLessBasic(self):
     """Test with a more complex plist that should parse OK."""
     plist_xml = """
@@ -905,6 +996,75 @@ AAAAAAAAfA==""")
     self.assertFalse(pl.Equal(other, ignore_keys=['bar']))
 
 
+class ApplePlistIteratorTest(basetest.TestCase):
+
+  def _GetCatalogXml(self, count=50):
+    """Returns a tuple of (list of pkginfo dicts, str XML catalog)."""
+    pkginfos = []
+    for i in xrange(count):
+      pkginfos.append({
+          'name': 'pkg%d & co' % i,
+          'version': '1.%d' % i,
+          'installer_item_size': 1234567 + i,
+          'catalogs': ['stable', 'testing'],
+          'force_install_after_date': datetime.datetime(2018, 1, 2, 3, 4, 5),
+          'unattended_install': bool(i % 2),
+          'data': plist.AppleData('data'),
+      })
+    return pkginfos, plist.GetXmlDocument(pkginfos)
+
+  def testIterArray(self):
+    """Test iterating a file-like source in chunks of many sizes."""
+    pkginfos, xml = self._GetCatalogXml()
+    for chunk_size in [1, 7, 64, plist.PARSE_CHUNK_SIZE]:
+      self.assertEqual(
+          pkginfos,
+          list(plist.ApplePlistIterator(
+              StringIO.StringIO(xml), chunk_size=chunk_size)))
+
+  def testIterArrayFromChunks(self):
+    """Test iterating an iterable of str chunks."""
+    pkginfos, xml = self._GetCatalogXml()
+    chunks = [xml[i:i + 100] for i in xrange(0, len(xml), 100)]
+    self.assertEqual(pkginfos, list(plist.ApplePlistIterator(chunks)))
+
+  def testIterYieldsItemsBeforeEndOfDocument(self):
+    """Test items are yielded before the whole document is parsed."""
+    pkginfos, xml = self._GetCatalogXml()
+    xml_file = StringIO.StringIO(xml)
+    it = iter(plist.ApplePlistIterator(xml_file, chunk_size=1024))
+    self.assertEqual(pkginfos[0], it.next())
+    self.assertTrue(xml_file.tell() < len(xml))
+
+  def testIterDict(self):
+    """Test iterating a top-level dict yields (key, value) tuples."""
+    d = {'a': 1, 'b': [1, 2], 'c': {'x': 'y'}, 'e': ''}
+    self.assertEqual(
+        sorted(d.items()),
+        sorted(plist.ApplePlistIterator(
+            plist.GetXmlDocument(d), chunk_size=3)))
+
+  def testIterEmpty(self):
+    """Test iterating empty arrays."""
+    self.assertEqual(
+        [], list(plist.ApplePlistIterator(plist.GetXmlDocument([]))))
+
+  def testIterMalformed(self):
+    """Test iterating malformed XML."""
+    self.assertRaises(
+        plist.MalformedPlistError, list,
+        plist.ApplePlistIterator('<plist><array><string>x</array></plist>'))
+    self.assertRaises(
+        plist.MalformedPlistError, list,
+        plist.ApplePlistIterator('<plist><array>'))
+
+  def testIterTwice(self):
+    """Test a plist can only be iterated once."""
+    it = plist.ApplePlistIterator(plist.GetXmlDocument(['a']))
+    self.assertEqual(['a'], list(it))
+    self.assertRaises(plist.PlistAlreadyParsedError, list, it)
+
+
 class MunkiPlistTest(mox.MoxTestBase):
   """Test MunkiPlist class."""
 
@@ -1172,6 +1332,14 @@ class MunkiPackageInfoPlistTest(mox.MoxTestBase):
     self.munki.SetDisplayName('foo')
     self.assertEqual(self.munki._plist['display_name'], 'foo')
 
+  def testRemoveDisplayName(self):
+    """Test RemoveDisplayName()."""
+    self.munki._plist = {'display_name': 'foo'}
+    self.assertFalse(self.munki._changed)
+    self.munki.RemoveDisplayName()
+    self.assertFalse('display_name' in self.munki._plist)
+    self.assertTrue(self.munki._changed)
+
   def testSetUnattendedInstall(self):
     """Test SetUnattendedInstall()."""
     self.munki._plist = {}
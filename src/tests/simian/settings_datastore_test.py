@@ -55,6 +55,7 @@ class DatastoreSettingsTest(basetest.TestCase):
         DEFAULT_VERSION_HOSTNAME='example.appspot.com')
 
     self.testbed.init_all_stubs()
+    models.Settings.ClearCache()
 
     if self.__class__.__name__ == 'BaseSettingsTestBase':
       return
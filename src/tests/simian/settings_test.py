@@ -195,8 +195,11 @@ class BaseSettingsTest(BaseSettingsTestBase):
     k = 'k'
     pem_cert = 'pem'
 
+    mock_cert = self.mox.CreateMockAnything()
+
     self.mox.StubOutWithMock(settings.x509, 'LoadCertificateFromPEM')
-    settings.x509.LoadCertificateFromPEM(pem_cert).AndReturn('cert')
+    settings.x509.LoadCertificateFromPEM(pem_cert).AndReturn(mock_cert)
+    mock_cert.DecodeAll()
 
     self.mox.ReplayAll()
     self.assertTrue(self.settings.CheckValuePemX509Cert(k, pem_cert) is None)
@@ -216,6 +219,21 @@ class BaseSettingsTest(BaseSettingsTestBase):
         ValueError, self.settings.CheckValuePemX509Cert, k, pem_cert)
     self.mox.VerifyAll()
 
+  def testCheckValuePemX509CertWhenFieldBadlyFormed(self):
+    """Test CheckValuePemX509Cert()."""
+    k = 'k'
+    pem_cert = 'pem'
+    mock_cert = self.mox.CreateMockAnything()
+
+    self.mox.StubOutWithMock(settings.x509, 'LoadCertificateFromPEM')
+    settings.x509.LoadCertificateFromPEM(pem_cert).AndReturn(mock_cert)
+    mock_cert.DecodeAll().AndRaise(settings.x509.CertificateParseError)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        ValueError, self.settings.CheckValuePemX509Cert, k, pem_cert)
+    self.mox.VerifyAll()
+
   def testCheckValuePemRsaPrivateKey(self):
     """Test CheckValuePemRsaPrivateKey()."""
     k = 'k'